@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""LINZ Redistricting Plugin - Dissolve utilities
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import sys
+import multiprocessing
+from typing import (Callable,
+                    Dict,
+                    List,
+                    Optional)
+from qgis.core import (Qgis,
+                       QgsGeometry,
+                       QgsFeedback,
+                       QgsMessageLog,
+                       QgsSettings,
+                       QgsWkbTypes)
+
+SETTINGS_DISSOLVE_WORKERS_KEY = 'redistrict/dissolve_workers'
+
+
+def get_dissolve_worker_count() -> int:
+    """
+    Returns the number of worker processes to use when dissolving electorates,
+    from the settings. A value of 1 indicates that dissolves should be
+    performed serially.
+    """
+    return max(QgsSettings().value(SETTINGS_DISSOLVE_WORKERS_KEY, 1, int, QgsSettings.Plugins), 1)
+
+
+def coverage_union(parts: List[QgsGeometry]) -> Optional[QgsGeometry]:
+    """
+    Dissolves a list of polygons which form a clean polygonal coverage (i.e.
+    polygons which do not overlap, and which share identical vertices along
+    common edges), such as a set of meshblocks. This is considerably faster
+    than a generic union, as shared edges can be cancelled out directly
+    without noding the inputs.
+
+    Returns None if a coverage union or coverage validation is not available in
+    this QGIS version (QGIS 3.40 or later is required), or if the input is not
+    a valid polygonal coverage.
+    :param parts: polygons to dissolve
+    """
+    # the output of a coverage union is undefined for invalid coverages (e.g. overlapping
+    # polygons, or neighbours which don't share identical vertices), so the coverage
+    # must be validated first
+    if not hasattr(QgsGeometry, 'unionCoverage') or not hasattr(QgsGeometry, 'validateCoverage'):
+        return None
+
+    polygons = []
+    for part in parts:
+        if part.isNull() or part.isEmpty():
+            continue
+        if part.type() != QgsWkbTypes.PolygonGeometry:
+            return None
+        polygons.extend(part.asGeometryCollection())
+
+    if not polygons:
+        return None
+
+    coverage = QgsGeometry.collectGeometry(polygons)
+    validity, _ = coverage.validateCoverage(0)
+    if validity != Qgis.CoverageValidityResult.Valid:
+        return None
+
+    result = coverage.unionCoverage()
+    if result.isNull() or result.isEmpty():
+        return None
+
+    return result
+
+
+def dissolve_geometries(parts: List[QgsGeometry], make_valid: bool = True) -> QgsGeometry:
+    """
+    Dissolves a list of geometries into a single geometry. A coverage union is
+    used where possible, falling back to a generic union if the input is not a
+    valid polygonal coverage.
+    :param parts: geometries to dissolve
+    :param make_valid: set to True to ensure that the result of a generic union is valid
+    """
+    geometry = coverage_union(parts)
+    if geometry is not None:
+        return geometry
+
+    geometry = QgsGeometry.unaryUnion(parts)
+    if make_valid:
+        geometry = geometry.makeValid()
+    return geometry
+
+
+def dissolve_wkb(parts: List[bytes]) -> bytes:
+    """
+    Dissolves a list of WKB encoded geometries, returning the WKB for the
+    dissolved geometry. This is the entry point used by dissolve worker
+    processes, so must remain a top level function.
+    :param parts: WKB for geometries to dissolve
+    """
+    geometries = []
+    for wkb in parts:
+        geometry = QgsGeometry()
+        geometry.fromWkb(wkb)
+        geometries.append(geometry)
+    return bytes(dissolve_geometries(geometries).asWkb())
+
+
+def _python_executable() -> Optional[str]:
+    """
+    Returns the path to the Python interpreter to use for worker processes.
+    Inside QGIS sys.executable refers to the QGIS application itself, so the
+    interpreter must be located within the Python installation prefix.
+    """
+    if os.path.basename(sys.executable).lower().startswith('python'):
+        return sys.executable
+
+    if sys.platform == 'win32':
+        candidates = [os.path.join(sys.exec_prefix, 'pythonw.exe'),
+                      os.path.join(sys.exec_prefix, 'python.exe')]
+    else:
+        candidates = [os.path.join(sys.exec_prefix, 'bin', 'python{}.{}'.format(*sys.version_info[:2])),
+                      os.path.join(sys.exec_prefix, 'bin', 'python3')]
+    for candidate in candidates:
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+class ElectorateDissolver:
+    """
+    Dissolves sets of meshblock geometries into electorate geometries,
+    optionally distributing the dissolves across a pool of worker processes
+    """
+
+    def __init__(self, worker_count: int = 1):
+        """
+        Constructor for ElectorateDissolver
+        :param worker_count: number of worker processes to use. If 1, all
+        dissolves will be performed serially in the current process.
+        """
+        self.worker_count = worker_count
+
+    def dissolve(self, jobs: Dict[object, List[QgsGeometry]], feedback: Optional[QgsFeedback] = None,
+                 progress_callback: Optional[Callable[[float], None]] = None) -> Optional[Dict[object, QgsGeometry]]:
+        """
+        Dissolves a set of geometry lists.
+        :param jobs: dictionary of key to list of geometries to dissolve
+        :param feedback: optional feedback object for cancellation
+        :param progress_callback: optional callback for reporting progress (0-100)
+        :returns: dictionary of key to dissolved geometry, or None if the dissolve was canceled
+        """
+        results = {}
+        if self.worker_count > 1 and len(jobs) > 1:
+            if not self._dissolve_parallel(jobs, results, feedback, progress_callback):
+                return None
+
+        # serial dissolve, also used to complete any jobs remaining after a worker pool failure
+        for key, parts in jobs.items():
+            if key in results:
+                continue
+            if feedback is not None and feedback.isCanceled():
+                return None
+
+            results[key] = dissolve_geometries(parts)
+            if progress_callback is not None:
+                progress_callback(100 * len(results) / len(jobs))
+
+        return results
+
+    def _dissolve_parallel(self, jobs: Dict[object, List[QgsGeometry]], results: Dict[object, QgsGeometry],
+                           feedback: Optional[QgsFeedback],
+                           progress_callback: Optional[Callable[[float], None]]) -> bool:
+        """
+        Dissolves jobs using a pool of worker processes, storing completed dissolves in results.
+        If the pool cannot be used the method returns early, leaving any incomplete jobs to
+        be dissolved serially.
+        :returns: False if the dissolve was canceled
+        """
+        executable = _python_executable()
+        if executable is None:
+            return True
+
+        try:
+            # always spawn - forking the QGIS process from a task thread is unsafe
+            context = multiprocessing.get_context('spawn')
+            context.set_executable(executable)
+            pool = context.Pool(processes=min(self.worker_count, len(jobs)))
+        except (TypeError, ValueError, OSError) as e:
+            QgsMessageLog.logMessage('Could not start dissolve worker processes: {}'.format(e), "REDISTRICT")
+            return True
+
+        try:
+            pending = {}
+            for key, parts in jobs.items():
+                pending[key] = pool.apply_async(dissolve_wkb, ([bytes(p.asWkb()) for p in parts],))
+
+            while pending:
+                if feedback is not None and feedback.isCanceled():
+                    return False
+
+                done = [key for key, result in pending.items() if result.ready()]
+                if not done:
+                    next(iter(pending.values())).wait(0.2)
+                    continue
+
+                for key in done:
+                    geometry = QgsGeometry()
+                    geometry.fromWkb(pending.pop(key).get())
+                    results[key] = geometry
+
+                if progress_callback is not None:
+                    progress_callback(100 * len(results) / len(jobs))
+        except Exception as e:  # pylint: disable=broad-except
+            # remaining jobs are dissolved serially
+            QgsMessageLog.logMessage('Dissolve worker failed, dissolving remaining electorates serially: {}'.format(e),
+                                     "REDISTRICT")
+            return True
+        finally:
+            # stop any work still in progress (e.g. after cancellation), and wait for the
+            # worker processes to exit so that none are left running after the task ends
+            pool.terminate()
+            pool.join()
+
+        return True
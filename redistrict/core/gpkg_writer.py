@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""LINZ Redistricting Plugin - Streaming GeoPackage writer
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+from typing import Optional
+from osgeo import (ogr,
+                   osr)
+from qgis.PyQt.QtCore import (QDate,
+                              QDateTime,
+                              QVariant)
+from qgis.core import (NULL,
+                       QgsCoordinateReferenceSystem,
+                       QgsFeature,
+                       QgsFields,
+                       QgsWkbTypes)
+
+
+class GeoPackageWriter:
+    """
+    Writes features directly to a new GeoPackage, without staging them in
+    memory layers. The datasource is opened once, and all layers are written
+    within a single transaction, which is committed by commit().
+    """
+
+    FIELD_TYPES = {
+        QVariant.Int: ogr.OFTInteger,
+        QVariant.LongLong: ogr.OFTInteger64,
+        QVariant.Double: ogr.OFTReal,
+        QVariant.Bool: ogr.OFTInteger,
+        QVariant.Date: ogr.OFTDate,
+        QVariant.DateTime: ogr.OFTDateTime,
+    }
+
+    def __init__(self, path: str):
+        """
+        Constructor for GeoPackageWriter. Any existing file at the destination
+        path will be overwritten.
+        :param path: destination file path
+        """
+        self.path = path
+        self.error_message = None
+        self.datasource = None
+        self.layers = {}
+        self.in_transaction = False
+
+        driver = ogr.GetDriverByName('GPKG')
+        if os.path.exists(path):
+            driver.DeleteDataSource(path)
+        self.datasource = driver.CreateDataSource(path)
+        if self.datasource is None:
+            self.error_message = 'Could not create {}'.format(path)
+            return
+
+        if self.datasource.StartTransaction() != ogr.OGRERR_NONE:
+            self.error_message = 'Could not start transaction'
+        else:
+            self.in_transaction = True
+
+    def is_valid(self) -> bool:
+        """
+        Returns True if the writer was successfully created and no errors have occurred
+        """
+        return self.datasource is not None and self.error_message is None
+
+    def create_layer(self, name: str, wkb_type: QgsWkbTypes.Type, fields: QgsFields,
+                     crs: Optional[QgsCoordinateReferenceSystem] = None) -> bool:
+        """
+        Creates a new layer within the GeoPackage
+        :param name: layer name
+        :param wkb_type: layer geometry type
+        :param fields: layer fields
+        :param crs: layer CRS, for spatial layers
+        :returns: True if layer was created
+        """
+        if not self.is_valid():
+            return False
+
+        srs = None
+        if crs is not None and crs.isValid():
+            srs = osr.SpatialReference()
+            srs.ImportFromWkt(crs.toWkt())
+
+        ogr_type = ogr.wkbNone if wkb_type == QgsWkbTypes.NoGeometry else int(wkb_type)
+        layer = self.datasource.CreateLayer(name, srs, ogr_type, ['FID=fid'])
+        if layer is None:
+            self.error_message = 'Could not create layer {}'.format(name)
+            return False
+
+        field_indices = []
+        for idx, field in enumerate(fields):
+            # the fid column is managed by the GeoPackage itself
+            if field.name().lower() == 'fid':
+                continue
+            field_defn = ogr.FieldDefn(field.name(), self.FIELD_TYPES.get(field.type(), ogr.OFTString))
+            if field.type() == QVariant.Bool:
+                field_defn.SetSubType(ogr.OFSTBoolean)
+            if field.type() == QVariant.String and field.length() > 0:
+                field_defn.SetWidth(field.length())
+            if layer.CreateField(field_defn) != ogr.OGRERR_NONE:
+                self.error_message = 'Could not create field {}'.format(field.name())
+                return False
+            field_indices.append(idx)
+
+        self.layers[name] = (layer, field_indices)
+        return True
+
+    def add_feature(self, name: str, feature: QgsFeature) -> bool:
+        """
+        Writes a feature to a layer. Null or empty geometries are written as null.
+        :param name: layer name, as previously passed to create_layer()
+        :param feature: feature to write
+        :returns: True if feature was written
+        """
+        if not self.is_valid():
+            return False
+
+        layer, field_indices = self.layers[name]
+        ogr_feature = ogr.Feature(layer.GetLayerDefn())
+        attributes = feature.attributes()
+        for ogr_idx, idx in enumerate(field_indices):
+            value = attributes[idx] if idx < len(attributes) else None
+            if value is None or value == NULL:
+                continue
+            if isinstance(value, QDateTime):
+                if not value.isValid():
+                    continue
+                date = value.date()
+                time = value.time()
+                ogr_feature.SetField(ogr_idx, date.year(), date.month(), date.day(),
+                                     time.hour(), time.minute(), time.second() + time.msec() / 1000.0, 0)
+            elif isinstance(value, QDate):
+                if not value.isValid():
+                    continue
+                ogr_feature.SetField(ogr_idx, value.year(), value.month(), value.day(), 0, 0, 0, 0)
+            elif isinstance(value, bool):
+                ogr_feature.SetField(ogr_idx, 1 if value else 0)
+            else:
+                ogr_feature.SetField(ogr_idx, value)
+
+        geometry = feature.geometry()
+        if not geometry.isNull() and not geometry.isEmpty():
+            ogr_feature.SetGeometryDirectly(ogr.CreateGeometryFromWkb(bytes(geometry.asWkb())))
+
+        if layer.CreateFeature(ogr_feature) != ogr.OGRERR_NONE:
+            self.error_message = 'Could not write feature to {}'.format(name)
+            return False
+        return True
+
+    def commit(self) -> bool:
+        """
+        Commits all written features and closes the GeoPackage
+        :returns: True if features were successfully committed
+        """
+        if not self.is_valid():
+            self.close()
+            return False
+
+        if self.datasource.CommitTransaction() != ogr.OGRERR_NONE:
+            self.error_message = 'Could not commit transaction'
+        self.in_transaction = False
+        self.close()
+        return self.error_message is None
+
+    def close(self):
+        """
+        Closes the GeoPackage, discarding any uncommitted features
+        """
+        self.layers = {}
+        if self.datasource is not None:
+            if self.in_transaction:
+                self.datasource.RollbackTransaction()
+                self.in_transaction = False
+            self.datasource = None
@@ -15,6 +15,7 @@ __revision__ = '$Format:%H$'
 
 from qgis.PyQt.QtCore import (QObject,
                               pyqtSignal)
+from qgis.core import QgsFeatureRequest
 
 
 class RedistrictHandler(QObject):
@@ -70,20 +71,50 @@ class RedistrictHandler(QObject):
         self.redistrict_occured.emit()
         self.operation_ended.emit()
 
-    def assign_district(self, target_ids, new_district):
+    def current_districts(self, target_ids) -> dict:
         """
-        Assigns a new district to a set of target features
+        Returns the current district attributes for a set of target features,
+        fetched in a single request
+        :param target_ids: feature IDs for target features
+        :return dictionary of feature ID to current district attribute
+        """
+        field_index = self.target_layer.fields().lookupField(self.target_field)
+        request = QgsFeatureRequest().setFilterFids(list(target_ids))
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([field_index])
+        return {f.id(): f[field_index] for f in self.target_layer.getFeatures(request)}
+
+    def assign_district(self, target_ids, new_district, previous_districts=None):
+        """
+        Assigns a new district to a set of target features. All changes
+        are made within the current edit command, followed by a single
+        repaint and redistrict_occured signal.
         :param target_ids: feature IDs for features to redistrict
         :param new_district: new district attribute for targets
+        :param previous_districts: optional dictionary of feature ID to current
+        district attribute for targets. If not specified, the current districts
+        will be fetched in a single request.
         :return True if redistrict was successful
         """
         if not self.target_layer.isEditable():
             return False
 
+        if previous_districts is None:
+            previous_districts = self.current_districts(target_ids)
+
         field_index = self.target_layer.fields().lookupField(self.target_field)
         success = True
         for feature_id in target_ids:
-            if not self.target_layer.changeAttributeValue(feature_id, field_index, new_district):
+            if feature_id in previous_districts:
+                previous_district = previous_districts[feature_id]
+                if previous_district == new_district:
+                    continue
+                # passing the old value avoids the edit buffer fetching each feature individually
+                changed = self.target_layer.changeAttributeValue(feature_id, field_index, new_district,
+                                                                 previous_district)
+            else:
+                changed = self.target_layer.changeAttributeValue(feature_id, field_index, new_district)
+            if not changed:
                 success = False
 
         self.target_layer.triggerRepaint()
@@ -13,6 +13,7 @@ __copyright__ = 'Copyright 2018, LINZ'
 # This will get replaced with a git SHA1 when you do a git archive
 __revision__ = '$Format:%H$'
 
+import os
 from qgis.PyQt.QtWidgets import (QDialog,
                                  QDialogButtonBox,
                                  QLabel,
@@ -30,6 +31,8 @@ from qgis.core import QgsSettings
 from qgis.gui import (QgsAuthConfigSelect,
                       QgsFileWidget)
 
+from redistrict.core.dissolve import (SETTINGS_DISSOLVE_WORKERS_KEY,
+                                      get_dissolve_worker_count)
 from redistrict.linz.nz_electoral_api import get_api_connector
 from redistrict.gui.playsound import playsound
 
@@ -97,6 +100,15 @@ class DistrictSettingsDialog(QDialog):
             QgsSettings().value('redistrict/show_overlays', False, bool, QgsSettings.Plugins))
         layout.addWidget(self.use_overlays_checkbox)
 
+        h_layout = QHBoxLayout()
+        h_layout.addWidget(QLabel(self.tr('Worker processes for electorate dissolves')))
+        self.dissolve_workers_spin = QSpinBox()
+        self.dissolve_workers_spin.setMinimum(1)
+        self.dissolve_workers_spin.setMaximum(max(os.cpu_count() or 1, 1))
+        self.dissolve_workers_spin.setValue(get_dissolve_worker_count())
+        h_layout.addWidget(self.dissolve_workers_spin)
+        layout.addLayout(h_layout)
+
         self.use_sound_group_box = QGroupBox(self.tr('Use audio feedback'))
         self.use_sound_group_box.setCheckable(True)
         self.use_sound_group_box.setChecked(
@@ -133,6 +145,8 @@ class DistrictSettingsDialog(QDialog):
         QgsSettings().setValue('redistrict/base_url', self.base_url_edit.text(), QgsSettings.Plugins)
         QgsSettings().setValue('redistrict/check_every', self.check_every_spin.value(), QgsSettings.Plugins)
         QgsSettings().setValue('redistrict/show_overlays', self.use_overlays_checkbox.isChecked(), QgsSettings.Plugins)
+        QgsSettings().setValue(SETTINGS_DISSOLVE_WORKERS_KEY, self.dissolve_workers_spin.value(),
+                               QgsSettings.Plugins)
         QgsSettings().setValue('redistrict/use_audio_feedback', self.use_sound_group_box.isChecked(),
                                QgsSettings.Plugins)
         QgsSettings().setValue('redistrict/on_redistrict', self.on_redistrict_file_widget.filePath(),
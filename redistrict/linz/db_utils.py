@@ -13,8 +13,17 @@ __copyright__ = 'Copyright 2018, LINZ'
 # This will get replaced with a git SHA1 when you do a git archive
 __revision__ = '$Format:%H$'
 
+import sqlite3
+import struct
+from typing import (Dict,
+                    List,
+                    Optional,
+                    Tuple)
 from qgis.PyQt.QtCore import QFile
-from qgis.core import QgsTask
+from qgis.core import (QgsTask,
+                       QgsMessageLog,
+                       QgsVectorLayer,
+                       QgsProviderRegistry)
 
 
 class DbUtils:
@@ -22,6 +31,221 @@ class DbUtils:
     Utilities for Database plugin components
     """
 
+    # composite indexes required by the common meshblock_electorates queries
+    MESHBLOCK_ELECTORATE_INDEXES = {
+        'meshblock_electorates_scenario_meshblock_idx': ('scenario_id', 'meshblock_number'),
+        'meshblock_electorates_scenario_gn_idx': ('scenario_id', 'gn_id'),
+        'meshblock_electorates_scenario_gs_idx': ('scenario_id', 'gs_id'),
+        'meshblock_electorates_scenario_m_idx': ('scenario_id', 'm_id'),
+    }
+
+    # clustered row order for the meshblock_electorates table
+    MESHBLOCK_ELECTORATE_CLUSTER_COLUMNS = ('scenario_id', 'meshblock_number')
+
+    @staticmethod
+    def database_path_for_layer(layer: QgsVectorLayer) -> Optional[str]:
+        """
+        Returns the path to the GeoPackage database containing a layer, or None
+        if the layer is not stored in a GeoPackage
+        :param layer: layer to get database for
+        """
+        if layer is None or layer.dataProvider() is None or layer.dataProvider().name() != 'ogr':
+            return None
+
+        path = QgsProviderRegistry.instance().decodeUri('ogr', layer.source())['path']
+        if not path.lower().endswith('.gpkg'):
+            return None
+        return path
+
+    @staticmethod
+    def table_name_for_layer(layer: QgsVectorLayer) -> Optional[str]:
+        """
+        Returns the name of the GeoPackage table containing a layer, or None
+        if the layer is not stored in a GeoPackage
+        :param layer: layer to get table name for
+        """
+        if DbUtils.database_path_for_layer(layer) is None:
+            return None
+
+        return QgsProviderRegistry.instance().decodeUri('ogr', layer.source()).get('layerName') or None
+
+    @staticmethod
+    def connect(database_path: str) -> sqlite3.Connection:
+        """
+        Opens a new sqlite connection to a database. Connections must not be
+        shared between threads.
+        :param database_path: path to database
+        """
+        return sqlite3.connect(database_path, timeout=30)
+
+    @staticmethod
+    def geopackage_envelope(blob) -> Optional[Tuple[float, float, float, float]]:
+        """
+        Returns the (x min, x max, y min, y max) envelope of a GeoPackage geometry blob,
+        or None if the blob is empty or its envelope could not be determined
+        :param blob: GeoPackage binary geometry
+        """
+        if blob is None or len(blob) < 8 or blob[:2] != b'GP':
+            return None
+        flags = blob[3]
+        if flags & 0x10:
+            # empty geometry
+            return None
+        byte_order = '<' if flags & 0x01 else '>'
+        if (flags >> 1) & 0x07:
+            return struct.unpack_from(byte_order + 'dddd', blob, 8)
+
+        # envelopes are only omitted for points, so take the extent from the point's WKB
+        if len(blob) < 29:
+            return None
+        wkb_byte_order = '<' if blob[8] == 1 else '>'
+        geometry_type = struct.unpack_from(wkb_byte_order + 'I', blob, 9)[0]
+        if geometry_type % 1000 != 1:
+            return None
+        x, y = struct.unpack_from(wkb_byte_order + 'dd', blob, 13)
+        return x, x, y, y
+
+    @staticmethod
+    def register_geopackage_functions(connection: sqlite3.Connection):
+        """
+        Registers the GeoPackage geometry functions used by spatial index triggers
+        (ST_IsEmpty, ST_MinX, ST_MaxX, ST_MinY and ST_MaxY) on a plain sqlite connection,
+        so that rows in GeoPackage tables with spatial indexes can be updated outside of OGR
+        :param connection: database connection
+        """
+
+        def envelope_value(index: int):
+            """
+            Returns a function which extracts a single envelope value from a geometry blob
+            """
+            def value(blob):  # pylint: disable=missing-docstring
+                envelope = DbUtils.geopackage_envelope(blob)
+                return envelope[index] if envelope is not None else None
+
+            return value
+
+        connection.create_function('ST_IsEmpty', 1,
+                                   lambda blob: 1 if DbUtils.geopackage_envelope(blob) is None else 0)
+        for index, name in enumerate(('ST_MinX', 'ST_MaxX', 'ST_MinY', 'ST_MaxY')):
+            connection.create_function(name, 1, envelope_value(index))
+
+    @staticmethod
+    def ensure_indexes(database_path: str, table: str, indexes: Dict[str, Tuple[str, ...]]) -> Optional[List[str]]:
+        """
+        Ensures that a set of indexes exist for a table, creating any which are missing
+        :param database_path: path to database
+        :param table: table name
+        :param indexes: dictionary of index name to indexed columns
+        :returns: list of created index names, or None if the indexes could not be created
+        """
+        created = []
+        try:
+            connection = DbUtils.connect(database_path)
+            try:
+                existing = {r[0] for r in connection.execute(
+                    "SELECT name FROM sqlite_master WHERE type='index' AND tbl_name=?", (table,))}
+                for name, columns in indexes.items():
+                    if name in existing:
+                        continue
+                    connection.execute('CREATE INDEX IF NOT EXISTS "{}" ON "{}" ({})'.format(
+                        name, table, ', '.join('"{}"'.format(c) for c in columns)))
+                    created.append(name)
+                if created:
+                    connection.execute('ANALYZE "{}"'.format(table))
+                connection.commit()
+            finally:
+                connection.close()
+        except sqlite3.Error as e:
+            QgsMessageLog.logMessage('Could not create indexes for {}: {}'.format(table, e), "REDISTRICT")
+            return None
+        return created
+
+    @staticmethod
+    def primary_key_column(connection: sqlite3.Connection, table: str) -> Optional[str]:
+        """
+        Returns the name of a table's integer primary key (feature id) column
+        :param connection: database connection
+        :param table: table name
+        """
+        for row in connection.execute('PRAGMA table_info("{}")'.format(table)):
+            if row[5]:
+                return row[1]
+        return None
+
+    @staticmethod
+    def is_clustered(database_path: str, table: str, columns: Tuple[str, ...]) -> bool:
+        """
+        Returns True if a table's rows are physically stored in the order of the specified columns
+        :param database_path: path to database
+        :param table: table name
+        :param columns: cluster columns
+        """
+        connection = DbUtils.connect(database_path)
+        try:
+            return DbUtils.table_is_clustered(connection, table, columns)
+        finally:
+            connection.close()
+
+    @staticmethod
+    def table_is_clustered(connection: sqlite3.Connection, table: str, columns: Tuple[str, ...]) -> bool:
+        """
+        Returns True if a table's rows are physically stored in the order of the specified columns.
+        This requires full scans of the table, so should not be called from the main thread.
+        :param connection: database connection
+        :param table: table name
+        :param columns: cluster columns
+        """
+        pk = DbUtils.primary_key_column(connection, table)
+        if pk is None:
+            return False
+        storage_order = connection.execute('SELECT "{0}" FROM "{1}" ORDER BY "{0}"'.format(pk, table))
+        cluster_order = connection.execute('SELECT "{0}" FROM "{1}" ORDER BY {2}, "{0}"'.format(
+            pk, table, ', '.join('"{}"'.format(c) for c in columns)))
+        for a, b in zip(storage_order, cluster_order):
+            if a != b:
+                return False
+        return True
+
+    @staticmethod
+    def cluster_table(connection: sqlite3.Connection, table: str, columns: Tuple[str, ...]):
+        """
+        Rewrites a table's rows so that they are physically stored (and numbered) in the
+        order of the specified columns. The table definition, indexes and triggers are left
+        untouched, but feature ids will be renumbered. Changes are not committed.
+        :param connection: database connection
+        :param table: table name
+        :param columns: cluster columns
+        """
+        pk = DbUtils.primary_key_column(connection, table)
+        assert pk is not None
+        value_columns = ', '.join('"{}"'.format(r[1]) for r in
+                                  connection.execute('PRAGMA table_info("{}")'.format(table)) if r[1] != pk)
+
+        connection.execute('DROP TABLE IF EXISTS temp.clustered_rows')
+        connection.execute('CREATE TEMP TABLE clustered_rows AS SELECT {0} FROM "{1}" ORDER BY {2}, "{3}"'.format(
+            value_columns, table, ', '.join('"{}"'.format(c) for c in columns), pk))
+        connection.execute('DELETE FROM "{}"'.format(table))
+        # restart feature id numbering for AUTOINCREMENT tables
+        if connection.execute("SELECT name FROM sqlite_master WHERE type='table' "
+                              "AND name='sqlite_sequence'").fetchone() is not None:
+            connection.execute('DELETE FROM sqlite_sequence WHERE name=?', (table,))
+        connection.execute('INSERT INTO "{0}" ({1}) SELECT {1} FROM temp.clustered_rows ORDER BY rowid'.format(
+            table, value_columns))
+        connection.execute('DROP TABLE temp.clustered_rows')
+
+    @staticmethod
+    def invalidate_feature_count(connection: sqlite3.Connection, table: str):
+        """
+        Clears the cached GeoPackage feature count for a table, after rows have been
+        inserted or deleted outside of OGR
+        :param connection: database connection
+        :param table: table name
+        """
+        if connection.execute("SELECT name FROM sqlite_master WHERE type='table' "
+                              "AND name='gpkg_ogr_contents'").fetchone() is not None:
+            connection.execute('UPDATE gpkg_ogr_contents SET feature_count=NULL '
+                               'WHERE lower(table_name)=lower(?)', (table,))
+
     @staticmethod
     def export_database(database, destination):
         """
@@ -70,3 +294,59 @@ class CopyFileTask(QgsTask):
         self.setProgress(100)
 
         return True
+
+
+class ClusterTableTask(QgsTask):
+    """
+    QgsTask subclass for rewriting a table so that its rows are clustered
+    by a set of columns, with cancelation support. Tables which are already
+    clustered are left untouched.
+    """
+
+    def __init__(self, description: str, database_path: str, table: str, columns: Tuple[str, ...]):
+        """
+        Constructor for ClusterTableTask
+        :param description: task description
+        :param database_path: path to database
+        :param table: table name
+        :param columns: cluster columns
+        """
+        super().__init__(description)
+        self.database_path = database_path
+        self.table = table
+        self.columns = columns
+        self.error = None
+        self.already_clustered = False
+
+    def run(self):  # pylint: disable=missing-docstring
+        try:
+            connection = DbUtils.connect(self.database_path)
+            try:
+                connection.set_progress_handler(lambda: 1 if self.isCanceled() else 0, 10000)
+                if DbUtils.table_is_clustered(connection, self.table, self.columns):
+                    self.already_clustered = True
+                    self.setProgress(100)
+                    return True
+                self.setProgress(20)
+
+                connection.isolation_level = None
+                connection.execute('BEGIN')
+                try:
+                    DbUtils.cluster_table(connection, self.table, self.columns)
+                    self.setProgress(80)
+                    DbUtils.invalidate_feature_count(connection, self.table)
+                    connection.execute('COMMIT')
+                except sqlite3.Error:
+                    connection.execute('ROLLBACK')
+                    raise
+                connection.set_progress_handler(None, 0)
+                connection.execute('ANALYZE "{}"'.format(self.table))
+            finally:
+                connection.close()
+        except sqlite3.Error as e:
+            if not self.isCanceled():
+                self.error = str(e)
+            return False
+
+        self.setProgress(100)
+        return True
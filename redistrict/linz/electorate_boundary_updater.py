@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""LINZ Redistricting Plugin - Deferred electorate boundary updates
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+from functools import partial
+from typing import (Dict,
+                    Iterable,
+                    List,
+                    Optional)
+from qgis.PyQt.QtCore import (QObject,
+                              pyqtSignal)
+from qgis.core import (QgsApplication,
+                       QgsExpression,
+                       QgsFeatureRequest,
+                       QgsGeometry,
+                       QgsTask,
+                       QgsVectorLayer,
+                       QgsVectorLayerFeatureSource)
+from redistrict.core.dissolve import dissolve_geometries
+from redistrict.linz.meshblock_topology import (ElectorateBoundary,
+                                                MeshblockTopology)
+
+
+class BoundaryRecalculationTask(QgsTask):
+    """
+    A background task for recalculating electorate boundaries from their
+    assigned meshblocks
+    """
+
+    def __init__(self, task_name: str, meshblock_layer: QgsVectorLayer, target_field: str,
+                 electorates: Dict[int, object], versions: Dict[int, int],
+                 topology: Optional[MeshblockTopology] = None,
+                 boundaries: Optional[Dict[int, ElectorateBoundary]] = None):
+        """
+        Constructor for BoundaryRecalculationTask
+        :param task_name: user-visible, translated name for task
+        :param meshblock_layer: meshblock layer
+        :param target_field: meshblock field containing assigned electorate
+        :param electorates: dictionary of electorate feature id to electorate id, for
+        electorates to recalculate
+        :param versions: dictionary of electorate feature id to version stamp at the time
+        the task was created
+        :param topology: optional meshblock topology. If not already built, the topology will be
+        built by the task so that it is available for later recalculations.
+        :param boundaries: optional dictionary of electorate feature id to boundary arcs from the
+        topology. If set, geometries are assembled from these arcs instead of dissolving meshblocks.
+        """
+        super().__init__(task_name)
+        self.target_field = target_field
+        self.electorates = electorates
+        self.versions = versions
+        self.topology = topology
+        self.boundaries = boundaries
+        self.geometries = {}
+
+        # snapshot of meshblock layer, including any edits made so far
+        self.source = QgsVectorLayerFeatureSource(meshblock_layer)
+        self.target_field_idx = meshblock_layer.fields().lookupField(target_field)
+        assert self.target_field_idx >= 0
+
+    def run(self):  # pylint: disable=missing-docstring
+        if self.boundaries is not None:
+            # boundaries which can't be assembled from the topology are dissolved instead
+            unassembled = {}
+            for feature_id, boundary in self.boundaries.items():
+                if self.isCanceled():
+                    return False
+                geometry = self.topology.assemble_boundary(boundary)
+                if geometry is None:
+                    unassembled[feature_id] = self.electorates[feature_id]
+                else:
+                    self.geometries[feature_id] = geometry
+            return self.dissolve_electorates(unassembled)
+
+        if self.topology is not None and not self.topology.ensure_built(self):
+            return False
+
+        return self.dissolve_electorates(self.electorates)
+
+    def dissolve_electorates(self, electorates: Dict[int, object]) -> bool:
+        """
+        Calculates electorate geometries by dissolving their assigned meshblocks
+        :param electorates: dictionary of electorate feature id to electorate id
+        :returns: False if the task was canceled
+        """
+        if not electorates:
+            return True
+
+        request = QgsFeatureRequest()
+        request.setFilterExpression('{} IN ({})'.format(
+            QgsExpression.quotedColumnRef(self.target_field),
+            ','.join(QgsExpression.quotedValue(e) for e in electorates.values())))
+        request.setSubsetOfAttributes([self.target_field_idx])
+
+        parts = {electorate: [] for electorate in electorates.values()}
+        for f in self.source.getFeatures(request):
+            if self.isCanceled():
+                return False
+            if f.hasGeometry():
+                parts[f[self.target_field_idx]].append(f.geometry())
+
+        for i, (feature_id, electorate) in enumerate(electorates.items()):
+            if self.isCanceled():
+                return False
+            self.setProgress(100 * i / len(electorates))
+            self.geometries[feature_id] = dissolve_geometries(parts[electorate]) if parts[electorate] else \
+                QgsGeometry()
+
+        self.setProgress(100)
+        return True
+
+
+class ElectorateBoundaryUpdater(QObject):
+    """
+    Recalculates electorate boundaries in the background after redistricting
+    operations.
+
+    Each electorate has a version stamp, which is incremented whenever the
+    electorate is marked as dirty or has its geometry set directly. Results
+    from background tasks are only applied if the electorate's version is
+    unchanged since the task was created, so results made stale by further
+    edits or undo operations are discarded.
+    """
+
+    boundaries_updated = pyqtSignal(list)
+
+    def __init__(self, electorate_layer: QgsVectorLayer, electorate_layer_field: str,
+                 meshblock_layer: QgsVectorLayer, target_field: str, run_in_background: bool = True,
+                 topology: Optional[MeshblockTopology] = None):
+        """
+        Constructor for ElectorateBoundaryUpdater
+        :param electorate_layer: electorate layer
+        :param electorate_layer_field: electorate id field in electorate layer
+        :param meshblock_layer: meshblock layer
+        :param target_field: meshblock field containing assigned electorate
+        :param run_in_background: set to False to queue tasks without starting them. Queued tasks
+        can then be run on the calling thread by process_pending_tasks().
+        :param topology: optional meshblock topology, used to assemble boundaries from shared
+        meshblock arcs instead of dissolving all meshblocks in the electorates
+        """
+        super().__init__()
+        self.electorate_layer = electorate_layer
+        self.electorate_layer_field = electorate_layer_field
+        self.meshblock_layer = meshblock_layer
+        self.target_field = target_field
+        self.run_in_background = run_in_background
+        self.topology = topology
+
+        self.electorate_id_idx = electorate_layer.fields().lookupField(electorate_layer_field)
+        assert self.electorate_id_idx >= 0
+
+        # version stamp for each electorate feature id
+        self.versions = {}
+        # electorate feature ids awaiting recalculated boundaries
+        self.dirty = set()
+        self.tasks = []
+        self.pending_tasks = []
+
+    def set_target_field(self, target_field: str):
+        """
+        Sets the meshblock field containing assigned electorates, e.g. after
+        the current task is changed. Any pending recalculations are completed
+        first, using the previous field.
+        :param target_field: meshblock field name
+        """
+        self.flush()
+        self.target_field = target_field
+
+    def version(self, electorate_feature_id: int) -> int:
+        """
+        Returns the current version stamp for an electorate
+        :param electorate_feature_id: electorate feature id
+        """
+        return self.versions.get(electorate_feature_id, 0)
+
+    def is_dirty(self, electorate_feature_id: int) -> bool:
+        """
+        Returns True if an electorate is awaiting a recalculated boundary
+        :param electorate_feature_id: electorate feature id
+        """
+        return electorate_feature_id in self.dirty
+
+    def has_pending_updates(self) -> bool:
+        """
+        Returns True if any electorates are awaiting recalculated boundaries
+        """
+        return bool(self.dirty)
+
+    def invalidate(self, electorate_feature_ids: Iterable[int]):
+        """
+        Discards any pending recalculations for electorates, e.g. because their
+        geometries are being set directly
+        :param electorate_feature_ids: electorate feature ids
+        """
+        for feature_id in electorate_feature_ids:
+            self.versions[feature_id] = self.version(feature_id) + 1
+            self.dirty.discard(feature_id)
+        self.cancel_stale_tasks()
+
+    def mark_dirty(self, electorate_feature_ids: Iterable[int]):
+        """
+        Marks electorates as dirty, and starts a task to recalculate their boundaries
+        from the current meshblock assignments
+        :param electorate_feature_ids: electorate feature ids
+        """
+        electorate_feature_ids = list(electorate_feature_ids)
+        if not electorate_feature_ids:
+            return
+
+        for feature_id in electorate_feature_ids:
+            self.versions[feature_id] = self.version(feature_id) + 1
+            self.dirty.add(feature_id)
+        self.cancel_stale_tasks()
+
+        task = self.create_task(electorate_feature_ids)
+        task.taskCompleted.connect(partial(self.task_completed, task))
+        task.taskTerminated.connect(partial(self.task_terminated, task))
+        self.tasks.append(task)
+        if self.run_in_background:
+            QgsApplication.taskManager().addTask(task)
+        else:
+            self.pending_tasks.append(task)
+
+    def create_task(self, electorate_feature_ids: List[int],
+                    build_topology: bool = True) -> BoundaryRecalculationTask:
+        """
+        Creates a task to recalculate electorate boundaries from the current meshblock
+        assignments, using the current version stamps for the electorates
+        :param electorate_feature_ids: electorate feature ids
+        :param build_topology: set to False to avoid building the meshblock topology
+        within the task if it is not yet available
+        """
+        request = QgsFeatureRequest().setFilterFids(electorate_feature_ids)
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([self.electorate_id_idx])
+        electorates = {f.id(): f[self.electorate_id_idx] for f in self.electorate_layer.getFeatures(request)}
+
+        boundaries = None
+        if self.topology is not None and self.topology.is_available():
+            # boundaries are snapshotted here, as the topology tracks later edits
+            boundaries = {feature_id: self.topology.electorate_boundary(electorate) for feature_id, electorate in
+                          electorates.items()}
+
+        return BoundaryRecalculationTask(self.tr('Updating electorate boundaries'),
+                                         meshblock_layer=self.meshblock_layer,
+                                         target_field=self.target_field,
+                                         electorates=electorates,
+                                         versions={feature_id: self.versions[feature_id] for feature_id in
+                                                   electorates},
+                                         topology=self.topology if boundaries is not None or build_topology else None,
+                                         boundaries=boundaries)
+
+    def flush(self) -> List[int]:
+        """
+        Recalculates the boundaries of all dirty electorates on the calling thread,
+        superseding any background recalculations. Used before changes which would
+        prevent pending recalculations from completing correctly, e.g. switching task.
+        :returns: list of electorate feature ids with updated boundaries
+        """
+        dirty = list(self.dirty)
+        if not dirty:
+            return []
+
+        for feature_id in dirty:
+            self.versions[feature_id] = self.version(feature_id) + 1
+        self.cancel_stale_tasks()
+
+        task = self.create_task(dirty, build_topology=False)
+        if task.run():
+            return self.task_completed(task)
+
+        self.task_terminated(task)
+        return []
+
+    def is_stale(self, task: BoundaryRecalculationTask) -> bool:
+        """
+        Returns True if all results from a task would be discarded
+        :param task: boundary recalculation task
+        """
+        return all(self.version(feature_id) != version for feature_id, version in task.versions.items())
+
+    def cancel_stale_tasks(self):
+        """
+        Cancels any tasks whose results would be discarded
+        """
+        for task in self.tasks:
+            if self.is_stale(task):
+                task.cancel()
+
+    def task_completed(self, task: BoundaryRecalculationTask) -> List[int]:
+        """
+        Triggered when a recalculation task completes, applying any results which
+        are still current
+        :param task: completed task
+        :returns: list of electorate feature ids with updated boundaries
+        """
+        if task in self.tasks:
+            self.tasks.remove(task)
+
+        current = {feature_id: geometry for feature_id, geometry in task.geometries.items()
+                   if self.version(feature_id) == task.versions[feature_id]}
+        if not current:
+            return []
+
+        self.electorate_layer.dataProvider().changeGeometryValues(current)
+        self.dirty.difference_update(current.keys())
+        self.electorate_layer.triggerRepaint()
+        self.boundaries_updated.emit(list(current.keys()))
+        return list(current.keys())
+
+    def task_terminated(self, task: BoundaryRecalculationTask):
+        """
+        Triggered when a recalculation task is canceled or fails
+        :param task: terminated task
+        """
+        if task in self.tasks:
+            self.tasks.remove(task)
+
+    def process_pending_tasks(self) -> List[int]:
+        """
+        Runs all queued tasks on the calling thread, applying their results. Only
+        used when tasks are not run in the background.
+        :returns: list of electorate feature ids with updated boundaries
+        """
+        updated = []
+        while self.pending_tasks:
+            task = self.pending_tasks.pop(0)
+            if not task.isCanceled() and task.run():
+                updated.extend(self.task_completed(task))
+            else:
+                self.task_terminated(task)
+        return updated
+
+    def discard_pending(self):
+        """
+        Cancels all pending recalculations. Dirty electorates will keep their
+        current geometries, so this is only safe when all dirty electorates are
+        about to be rebuilt or the electorate layer is being released.
+        """
+        self.invalidate(list(self.dirty))
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        self.pending_tasks = []
@@ -13,24 +13,50 @@ __copyright__ = 'Copyright 2018, LINZ'
 # This will get replaced with a git SHA1 when you do a git archive
 __revision__ = '$Format:%H$'
 
-from typing import List
+import zlib
+from typing import (Callable,
+                    Dict,
+                    List,
+                    Optional)
 from qgis.core import (QgsVectorLayer,
                        QgsFeatureRequest,
-                       QgsFeature)
+                       QgsFeature,
+                       QgsGeometry)
 from qgis.PyQt.QtWidgets import (QUndoCommand,
                                  QUndoStack)
+from redistrict.linz.population_ledger import PopulationLedgerChange
+from redistrict.linz.electorate_boundary_updater import ElectorateBoundaryUpdater
+
+
+# callable which rebuilds electorate geometries from the current meshblock assignments. Accepts
+# a list of electorate feature ids and a flag indicating whether the committed (rather than
+# edited) meshblock assignments should be used, and returns a dictionary of feature id to geometry
+GeometryBuilder = Callable[[List[int], bool], Dict[int, QgsGeometry]]
 
 
 class QueueItem(QUndoCommand):
     """
-    Item within an ElectorateEditQueue
+    Item within an ElectorateEditQueue.
+
+    Geometries are held as compressed WKB, in order to reduce the memory consumed
+    by long undo histories. Items may also be evicted from memory entirely, after
+    which only the affected electorate ids are kept and the geometries are rebuilt
+    from meshblocks on demand. If a boundary updater is set, evicted geometries
+    are rebuilt in the background instead.
     """
 
+    # compression level for stored geometries - favors speed over size
+    COMPRESSION_LEVEL = 1
+
     def __init__(self, electorate_layer: QgsVectorLayer,
                  previous_attributes: dict, previous_geometries: dict,
                  new_attributes: dict, new_geometries: dict,
                  user_log_layer: QgsVectorLayer,
-                 user_log_entries: List[QgsFeature]):
+                 user_log_entries: List[QgsFeature],
+                 geometry_builder: Optional[GeometryBuilder] = None,
+                 population_change: Optional[PopulationLedgerChange] = None,
+                 boundary_updater: Optional[ElectorateBoundaryUpdater] = None,
+                 deferred_geometry_ids: Optional[List[int]] = None):
         """
         Constructor
         :param electorate_layer: associated electorate layer
@@ -40,19 +66,129 @@ class QueueItem(QUndoCommand):
         :param new_geometries: dictionary of geometry edits
         :param user_log_layer: user log layer
         :param user_log_entries: user log entries associated with this change
+        :param geometry_builder: optional callable for rebuilding electorate geometries
+        from meshblocks. Items without a geometry builder cannot be evicted.
+        :param population_change: optional population ledger change, which is reverted
+        and reapplied as the item is undone and redone
+        :param boundary_updater: optional boundary updater, used to rebuild evicted geometries
+        in the background
+        :param deferred_geometry_ids: optional list of electorate feature ids whose geometries
+        are always rebuilt by the boundary updater, instead of being stored by the item. Requires
+        both a geometry builder and a boundary updater.
         """
         super().__init__()
         self.electorate_layer = electorate_layer
         self.previous_attributes = previous_attributes
-        self.previous_geometries = previous_geometries
+        self.previous_geometries = self.compress_geometries(previous_geometries)
         self.new_attributes = new_attributes
-        self.new_geometries = new_geometries
+        self.new_geometries = self.compress_geometries(new_geometries)
+        self.geometry_feature_ids = list(new_geometries.keys())
         self.user_log_layer = user_log_layer
         self.user_log_entries = user_log_entries
         self.user_log_entry_fids = []
+        self.geometry_builder = geometry_builder
+        self.boundary_updater = boundary_updater
+        self.evicted = False
+        if deferred_geometry_ids:
+            assert geometry_builder is not None and boundary_updater is not None
+            self.geometry_feature_ids = list(deferred_geometry_ids)
+            self.evicted = True
+        # set while rolling back to the committed meshblock assignments, in which case
+        # evicted geometries must be rebuilt from the committed assignments
+        self.rolling_back = False
+        # set while the queue is coalescing multiple steps, in which case changes are
+        # collected instead of being applied directly
+        self.pending_changes = None
+        self.population_change = population_change
+
+    @staticmethod
+    def compress_geometries(geometries: Dict[int, QgsGeometry]) -> Dict[int, bytes]:
+        """
+        Compresses a dictionary of geometries
+        :param geometries: dictionary of feature id to geometry
+        :returns: dictionary of feature id to compressed WKB
+        """
+        return {feature_id: zlib.compress(bytes(geometry.asWkb()) if not geometry.isNull() else b'',
+                                          QueueItem.COMPRESSION_LEVEL)
+                for feature_id, geometry in geometries.items()}
+
+    @staticmethod
+    def decompress_geometries(geometries: Dict[int, bytes]) -> Dict[int, QgsGeometry]:
+        """
+        Decompresses a dictionary of geometries compressed by compress_geometries()
+        :param geometries: dictionary of feature id to compressed WKB
+        :returns: dictionary of feature id to geometry
+        """
+        result = {}
+        for feature_id, compressed in geometries.items():
+            wkb = zlib.decompress(compressed)
+            geometry = QgsGeometry()
+            if wkb:
+                geometry.fromWkb(wkb)
+            result[feature_id] = geometry
+        return result
+
+    def memory_size(self) -> int:
+        """
+        Returns the approximate memory used by the stored geometries, in bytes
+        """
+        return sum(len(g) for g in self.previous_geometries.values()) + sum(
+            len(g) for g in self.new_geometries.values())
+
+    def can_evict(self) -> bool:
+        """
+        Returns True if the item's geometries can be evicted from memory
+        """
+        return not self.evicted and self.geometry_builder is not None
+
+    def evict(self):
+        """
+        Discards the stored geometries for the item. Geometries will be rebuilt
+        from meshblocks when the item is next undone or redone.
+        """
+        assert self.geometry_builder is not None
+        self.previous_geometries = {}
+        self.new_geometries = {}
+        self.evicted = True
+
+    def geometries(self, undo: bool) -> Dict[int, QgsGeometry]:
+        """
+        Returns the electorate geometries to apply when undoing or redoing the item
+        :param undo: True to return the geometries for undoing the item, False for redoing
+        """
+        if self.evicted:
+            if self.boundary_updater is not None and not self.rolling_back:
+                # geometries will be set by the boundary updater when ready
+                self.boundary_updater.mark_dirty(self.geometry_feature_ids)
+                return {}
+            geometries = self.geometry_builder(self.geometry_feature_ids, self.rolling_back)
+        else:
+            geometries = self.decompress_geometries(self.previous_geometries if undo else self.new_geometries)
+
+        if self.boundary_updater is not None:
+            # any background results for these electorates are now stale
+            self.boundary_updater.invalidate(geometries.keys())
+        return geometries
+
+    def geometry(self, feature_id: int, undo: bool) -> QgsGeometry:
+        """
+        Returns a single stored geometry. Must not be called for evicted items.
+        :param feature_id: electorate feature id
+        :param undo: True to return the geometry for undoing the item, False for redoing
+        """
+        assert not self.evicted
+        return self.decompress_geometries(
+            {feature_id: (self.previous_geometries if undo else self.new_geometries)[feature_id]})[feature_id]
 
     def redo(self):  # pylint: disable=missing-docstring
-        self.electorate_layer.dataProvider().changeGeometryValues(self.new_geometries)
+        if self.population_change is not None:
+            self.population_change.redo()
+
+        if self.pending_changes is not None:
+            self.pending_changes.add_step(self, undo=False)
+            return
+
+        self.electorate_layer.dataProvider().changeGeometryValues(self.geometries(undo=False))
         self.electorate_layer.dataProvider().changeAttributeValues(self.new_attributes)
         self.electorate_layer.triggerRepaint()
 
@@ -60,7 +196,14 @@ class QueueItem(QUndoCommand):
                                     self.user_log_layer.dataProvider().addFeatures(self.user_log_entries)[1]]
 
     def undo(self):  # pylint: disable=missing-docstring
-        self.electorate_layer.dataProvider().changeGeometryValues(self.previous_geometries)
+        if self.population_change is not None:
+            self.population_change.undo()
+
+        if self.pending_changes is not None:
+            self.pending_changes.add_step(self, undo=True)
+            return
+
+        self.electorate_layer.dataProvider().changeGeometryValues(self.geometries(undo=True))
         self.electorate_layer.dataProvider().changeAttributeValues(self.previous_attributes)
 
         self.user_log_layer.dataProvider().deleteFeatures(self.user_log_entry_fids)
@@ -75,6 +218,104 @@ class QueueItem(QUndoCommand):
         return False
 
 
+class CoalescedChanges:
+    """
+    Collects the net change from undoing or redoing a sequence of queue items, so
+    that it can be applied to the electorate and user log layers in a single step
+    """
+
+    def __init__(self, boundary_updater: Optional[ElectorateBoundaryUpdater] = None):
+        """
+        Constructor
+        :param boundary_updater: optional boundary updater, used to rebuild evicted geometries
+        in the background
+        """
+        self.boundary_updater = boundary_updater
+        # dictionary of feature id to net attribute changes
+        self.attributes = {}
+        # dictionary of feature id to the (item, undo) step which last set the feature's geometry
+        self.geometry_steps = {}
+        # user log feature ids to delete
+        self.log_deletes = []
+        # items whose user log entries must be added
+        self.log_adds = []
+        # feature ids whose geometries must be rebuilt by the boundary updater
+        self.deferred_feature_ids = []
+
+    def add_step(self, item: QueueItem, undo: bool):
+        """
+        Adds the changes from undoing or redoing an item. Steps must be added in the
+        order in which they would have been applied.
+        :param item: queue item
+        :param undo: True if the item is being undone, False if it is being redone
+        """
+        for feature_id, changes in (item.previous_attributes if undo else item.new_attributes).items():
+            if feature_id not in self.attributes:
+                self.attributes[feature_id] = {}
+            self.attributes[feature_id].update(changes)
+        for feature_id in item.geometry_feature_ids:
+            self.geometry_steps[feature_id] = (item, undo)
+        if undo:
+            if item in self.log_adds:
+                self.log_adds.remove(item)
+            else:
+                self.log_deletes.extend(item.user_log_entry_fids)
+            item.user_log_entry_fids = []
+        else:
+            self.log_adds.append(item)
+
+    def geometries(self) -> Dict[int, QgsGeometry]:
+        """
+        Returns the net geometry changes. Only the final geometry for each feature is
+        decompressed, and evicted geometries are rebuilt in a single call for each item.
+        Evicted geometries which will be rebuilt by the boundary updater are instead
+        collected in deferred_feature_ids.
+        """
+        result = {}
+        rebuild = {}
+        self.deferred_feature_ids = []
+        for feature_id, (item, undo) in self.geometry_steps.items():
+            if item.evicted and self.boundary_updater is not None and not item.rolling_back:
+                self.deferred_feature_ids.append(feature_id)
+            elif item.evicted:
+                if item not in rebuild:
+                    rebuild[item] = []
+                rebuild[item].append(feature_id)
+            else:
+                result[feature_id] = item.geometry(feature_id, undo)
+        for item, feature_ids in rebuild.items():
+            result.update(item.geometry_builder(feature_ids, item.rolling_back))
+        return result
+
+    def apply(self, electorate_layer: QgsVectorLayer, user_log_layer: QgsVectorLayer):
+        """
+        Applies the net changes to the electorate and user log layers
+        :param electorate_layer: electorate layer
+        :param user_log_layer: user log layer
+        """
+        if self.geometry_steps:
+            geometries = self.geometries()
+            electorate_layer.dataProvider().changeGeometryValues(geometries)
+            if self.boundary_updater is not None:
+                self.boundary_updater.invalidate(geometries.keys())
+                self.boundary_updater.mark_dirty(self.deferred_feature_ids)
+        if self.attributes:
+            electorate_layer.dataProvider().changeAttributeValues(self.attributes)
+
+        if self.log_deletes:
+            user_log_layer.dataProvider().deleteFeatures(self.log_deletes)
+        entries = [f for item in self.log_adds for f in item.user_log_entries]
+        if entries:
+            added = user_log_layer.dataProvider().addFeatures(entries)[1]
+            start = 0
+            for item in self.log_adds:
+                item.user_log_entry_fids = [f.id() for f in added[start:start + len(item.user_log_entries)]]
+                start += len(item.user_log_entries)
+
+        if self.geometry_steps or self.attributes:
+            electorate_layer.triggerRepaint()
+
+
 class ElectorateEditQueue(QUndoStack):
     """
     Queue for staged electorate edits, used when
@@ -82,47 +323,124 @@ class ElectorateEditQueue(QUndoStack):
     to restore electorate layer to a matching state
     """
 
-    def __init__(self, electorate_layer: QgsVectorLayer, user_log_layer: QgsVectorLayer):
+    # default cap on memory used by stored geometries, in bytes
+    DEFAULT_MEMORY_LIMIT = 64 * 1024 * 1024
+
+    def __init__(self, electorate_layer: QgsVectorLayer, user_log_layer: QgsVectorLayer,
+                 memory_limit: int = DEFAULT_MEMORY_LIMIT,
+                 boundary_updater: Optional[ElectorateBoundaryUpdater] = None):
         """
         Constructor
         :param electorate_layer: target electorate layer
         :param user_log_layer: user log layer
+        :param memory_limit: maximum memory to use for stored geometries, in bytes. If
+        exceeded, the geometries for the oldest items in the queue are evicted.
+        :param boundary_updater: optional boundary updater. If set, electorate boundaries
+        can be recalculated in the background instead of being stored in the queue.
         """
         super().__init__()
         self.electorate_layer = electorate_layer
         self.user_log_layer = user_log_layer
         self.meshblock_undo_index = 0
         self.blocked = False
+        self.memory_limit = memory_limit
+        self.boundary_updater = boundary_updater
+        # items in the queue, in the same order as the undo stack
+        self.items = []
+
+    def clear(self):  # pylint: disable=missing-docstring
+        super().clear()
+        self.items = []
+
+    def memory_size(self) -> int:
+        """
+        Returns the approximate memory used by geometries stored in the queue, in bytes
+        """
+        return sum(item.memory_size() for item in self.items)
+
+    def set_memory_limit(self, limit: int):
+        """
+        Sets the maximum memory to use for stored geometries, in bytes
+        :param limit: memory limit
+        """
+        self.memory_limit = limit
+        self.evict_items()
+
+    def evict_items(self):
+        """
+        Evicts the stored geometries for the oldest items in the queue, until the queue's
+        memory use is within the memory limit. The current item is never evicted.
+        """
+        current_item = self.items[self.index() - 1] if self.index() > 0 else None
+        size = self.memory_size()
+        for item in self.items:
+            if size <= self.memory_limit:
+                break
+            if item is not current_item and item.can_evict():
+                size -= item.memory_size()
+                item.evict()
 
     def sync_to_meshblock_undostack_index(self, index: int):
         """
         Rollbacks the buffer (or rolls forward) to sync its state
         with the meshblock layer's undo buffer
         """
-        if self.blocked:
+        if self.blocked or index == self.meshblock_undo_index:
             return
 
-        is_back = index < self.meshblock_undo_index
-        while self.meshblock_undo_index != index:
-            if is_back:
-                self.back()
-                self.meshblock_undo_index -= 1
-            else:
-                self.forward()
-                self.meshblock_undo_index += 1
+        # intermediate steps are coalesced, so that the net change is applied once
+        pending = CoalescedChanges(self.boundary_updater)
+        for item in self.items:
+            item.pending_changes = pending
+        self.blockSignals(True)
+        try:
+            is_back = index < self.meshblock_undo_index
+            while self.meshblock_undo_index != index:
+                if is_back:
+                    self.back()
+                    self.meshblock_undo_index -= 1
+                else:
+                    self.forward()
+                    self.meshblock_undo_index += 1
+        finally:
+            for item in self.items:
+                item.pending_changes = None
+            self.blockSignals(False)
+
+        pending.apply(self.electorate_layer, self.user_log_layer)
+        self.indexChanged.emit(self.index())
+        self.canUndoChanged.emit(self.canUndo())
+        self.canRedoChanged.emit(self.canRedo())
 
     def rollback(self):
         """
         Rolls back the buffer to the start of the meshblock changes
         """
-        self.sync_to_meshblock_undostack_index(0)
+        # rollback is triggered before the meshblock layer edits are discarded
+        for item in self.items:
+            item.rolling_back = True
+        try:
+            self.sync_to_meshblock_undostack_index(0)
+        finally:
+            for item in self.items:
+                item.rolling_back = False
 
-    def push_changes(self, attribute_edits: dict, geometry_edits: dict, log_entries: List[QgsFeature]):
+    def push_changes(self, attribute_edits: dict, geometry_edits: dict, log_entries: List[QgsFeature],
+                     geometry_builder: Optional[GeometryBuilder] = None,
+                     population_change: Optional[PopulationLedgerChange] = None,
+                     deferred_geometry_ids: Optional[List[int]] = None):
         """
         Pushes a new set of electorate layer changes to the end of the queue
         :param attribute_edits: dictionary of attribute edits
         :param geometry_edits: dictionary of geometry edits
         :param log_entries: user log entries associated with this change
+        :param geometry_builder: optional callable for rebuilding the electorate geometries from
+        meshblocks, required if the change is to be evicted from memory
+        :param population_change: optional population ledger change associated with this
+        change, which must already have been applied to the ledger
+        :param deferred_geometry_ids: optional list of electorate feature ids whose geometries
+        should be recalculated in the background by the queue's boundary updater, instead of
+        being set directly
         """
 
         self.meshblock_undo_index += 1
@@ -140,9 +458,17 @@ class ElectorateEditQueue(QUndoStack):
         geometries = {f.id(): f.geometry() for f in self.electorate_layer.getFeatures(request)}
         prev_geometries = {feature_id: geometries[feature_id] for feature_id, v in geometry_edits.items()}
 
-        self.push(QueueItem(self.electorate_layer, prev_attributes, prev_geometries, attribute_edits, geometry_edits,
-                            self.user_log_layer,
-                            log_entries))
+        item = QueueItem(self.electorate_layer, prev_attributes, prev_geometries, attribute_edits, geometry_edits,
+                         self.user_log_layer,
+                         log_entries,
+                         geometry_builder,
+                         population_change,
+                         self.boundary_updater,
+                         deferred_geometry_ids)
+        # pushing discards any items which were undone
+        self.items = self.items[:self.index()] + [item]
+        self.push(item)
+        self.evict_items()
 
     def back(self) -> bool:
         """
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""LINZ Redistricting Plugin - Electorate geometry cache
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import hashlib
+import sqlite3
+import threading
+from typing import (Dict,
+                    Iterable,
+                    Optional,
+                    Tuple)
+from qgis.core import (QgsGeometry,
+                       QgsMessageLog)
+from redistrict.linz.db_utils import DbUtils
+
+
+class ElectorateGeometryCache:
+    """
+    A persistent cache of dissolved electorate geometries and populations.
+
+    Entries are keyed by scenario, electorate and a hash of the electorate's
+    content (type, population and assigned meshblocks), so a cached geometry
+    can be reused by any scenario in which the electorate has an identical
+    meshblock assignment. When a database path is set the cache is stored in
+    a table within the database, otherwise it is held in memory only.
+    """
+
+    TABLE_NAME = 'electorate_geometry_cache'
+
+    def __init__(self, database_path: Optional[str] = None):
+        """
+        Constructor for ElectorateGeometryCache
+        :param database_path: path to GeoPackage database to store cache within. If not
+        set, the cache will be held in memory.
+        """
+        self.database_path = database_path
+        self.lock = threading.Lock()
+        self.table_ready = False
+        # in-memory cache of (electorate id, content hash) to (scenario, wkb, population)
+        self.memory_cache = {}
+        # in-memory lookup of (scenario, electorate id) to content hash
+        self.memory_keys = {}
+
+    @staticmethod
+    def content_hash(electorate_type: str, meshblocks: Iterable[int], population: int) -> str:
+        """
+        Calculates a hash of an electorate's content
+        :param electorate_type: electorate type, e.g. 'GN','GS','M'
+        :param meshblocks: meshblock numbers assigned to electorate
+        :param population: electorate's estimated population
+        """
+        content = '{}|{}|{}'.format(electorate_type, population,
+                                    ','.join(str(m) for m in sorted(int(m) for m in meshblocks)))
+        return hashlib.sha1(content.encode()).hexdigest()
+
+    def _ensure_table(self, connection: sqlite3.Connection):
+        """
+        Creates the cache table, if it does not already exist
+        :param connection: database connection
+        """
+        if self.table_ready:
+            return
+
+        connection.execute('CREATE TABLE IF NOT EXISTS {} ('
+                           'scenario_id INTEGER NOT NULL, '
+                           'electorate_id INTEGER NOT NULL, '
+                           'content_hash TEXT NOT NULL, '
+                           'estimated_pop INTEGER, '
+                           'geometry BLOB, '
+                           'PRIMARY KEY (scenario_id, electorate_id))'.format(self.TABLE_NAME))
+        connection.execute('CREATE INDEX IF NOT EXISTS {0}_content_idx ON {0} (electorate_id, content_hash)'.format(
+            self.TABLE_NAME))
+        connection.commit()
+        self.table_ready = True
+
+    @staticmethod
+    def _geometry_from_wkb(wkb: bytes) -> QgsGeometry:
+        """
+        Creates a geometry from WKB
+        """
+        geometry = QgsGeometry()
+        if wkb:
+            geometry.fromWkb(wkb)
+        return geometry
+
+    def lookup(self, content_hashes: Dict[object, str]) -> Dict[object, Tuple[QgsGeometry, int]]:
+        """
+        Looks up cached electorate geometries
+        :param content_hashes: dictionary of electorate id to electorate content hash
+        :returns: dictionary of electorate id to cached geometry and population, for
+        electorates present in the cache
+        """
+        results = {}
+        with self.lock:
+            if self.database_path is None:
+                for electorate_id, content_hash in content_hashes.items():
+                    entry = self.memory_cache.get((electorate_id, content_hash))
+                    if entry is not None:
+                        results[electorate_id] = (self._geometry_from_wkb(entry[1]), entry[2])
+                return results
+
+            try:
+                connection = DbUtils.connect(self.database_path)
+                try:
+                    self._ensure_table(connection)
+                    for electorate_id, content_hash in content_hashes.items():
+                        row = connection.execute(
+                            'SELECT geometry, estimated_pop FROM {} WHERE electorate_id=? AND content_hash=? '
+                            'LIMIT 1'.format(self.TABLE_NAME), (electorate_id, content_hash)).fetchone()
+                        if row is not None:
+                            results[electorate_id] = (self._geometry_from_wkb(row[0]), row[1])
+                finally:
+                    connection.close()
+            except sqlite3.Error as e:
+                QgsMessageLog.logMessage('Could not read electorate geometry cache: {}'.format(e), "REDISTRICT")
+                return {}
+
+        return results
+
+    def store(self, scenario_id, entries: Dict[object, Tuple[str, QgsGeometry, int]]):
+        """
+        Stores electorate geometries in the cache
+        :param scenario_id: scenario the electorates were calculated for
+        :param entries: dictionary of electorate id to content hash, geometry and population
+        """
+        with self.lock:
+            if self.database_path is None:
+                for electorate_id, (content_hash, geometry, population) in entries.items():
+                    previous = self.memory_keys.get((scenario_id, electorate_id))
+                    self.memory_keys[(scenario_id, electorate_id)] = content_hash
+                    if previous is not None and previous != content_hash and previous not in [
+                            h for (_, e), h in self.memory_keys.items() if e == electorate_id]:
+                        self.memory_cache.pop((electorate_id, previous), None)
+                    self.memory_cache[(electorate_id, content_hash)] = (scenario_id, bytes(geometry.asWkb()),
+                                                                       population)
+                return
+
+            try:
+                connection = DbUtils.connect(self.database_path)
+                try:
+                    self._ensure_table(connection)
+                    connection.executemany(
+                        'INSERT OR REPLACE INTO {} (scenario_id, electorate_id, content_hash, estimated_pop, geometry) '
+                        'VALUES (?, ?, ?, ?, ?)'.format(self.TABLE_NAME),
+                        [(scenario_id, electorate_id, content_hash, population, bytes(geometry.asWkb()))
+                         for electorate_id, (content_hash, geometry, population) in entries.items()])
+                    connection.commit()
+                finally:
+                    connection.close()
+            except sqlite3.Error as e:
+                QgsMessageLog.logMessage('Could not write electorate geometry cache: {}'.format(e), "REDISTRICT")
+
+    def clear(self):
+        """
+        Removes all entries from the cache
+        """
+        with self.lock:
+            self.memory_cache = {}
+            self.memory_keys = {}
+            if self.database_path is None:
+                return
+
+            try:
+                connection = DbUtils.connect(self.database_path)
+                try:
+                    connection.execute('DROP TABLE IF EXISTS {}'.format(self.TABLE_NAME))
+                    connection.commit()
+                finally:
+                    connection.close()
+                self.table_ready = False
+            except sqlite3.Error as e:
+                QgsMessageLog.logMessage('Could not clear electorate geometry cache: {}'.format(e), "REDISTRICT")
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""LINZ Redistricting Plugin - Electorate validation result cache
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import hashlib
+import json
+import sqlite3
+import threading
+from typing import (Dict,
+                    Iterable,
+                    List,
+                    Optional,
+                    Tuple)
+from qgis.core import QgsMessageLog
+from redistrict.linz.db_utils import DbUtils
+
+
+class ElectorateValidationCache:
+    """
+    A persistent cache of electorate validation results.
+
+    Results are keyed by electorate and a hash of everything which affects the
+    validation outcome (assigned meshblocks, population, quota, expected regions
+    and deprecation state), so that unchanged electorates do not need to be
+    re-checked. When a database path is set the cache is stored in a table
+    within the database, otherwise it is held in memory only.
+    """
+
+    TABLE_NAME = 'electorate_validation_cache'
+
+    def __init__(self, database_path: Optional[str] = None):
+        """
+        Constructor for ElectorateValidationCache
+        :param database_path: path to GeoPackage database to store cache within. If not
+        set, the cache will be held in memory.
+        """
+        self.database_path = database_path
+        self.lock = threading.Lock()
+        self.table_ready = False
+        # in-memory cache of electorate id to (content hash, errors, parts)
+        self.memory_cache = {}
+
+    @staticmethod
+    def content_hash(electorate_type: str, meshblocks: Iterable[int], population: int,  # pylint: disable=too-many-arguments
+                     quota: int, expected_regions: int, deprecated: bool) -> str:
+        """
+        Calculates a hash of the electorate properties which affect validation
+        :param electorate_type: electorate type, e.g. 'GN','GS','M'
+        :param meshblocks: meshblock numbers assigned to electorate
+        :param population: population used for quota checks
+        :param quota: quota for electorate type
+        :param expected_regions: expected number of contiguous regions
+        :param deprecated: True if electorate is deprecated
+        """
+        content = '{}|{}|{}|{}|{}|{}'.format(electorate_type, population, quota, expected_regions,
+                                             1 if deprecated else 0,
+                                             ','.join(str(m) for m in sorted(int(m) for m in meshblocks)))
+        return hashlib.sha1(content.encode()).hexdigest()
+
+    def _ensure_table(self, connection: sqlite3.Connection):
+        """
+        Creates the cache table, if it does not already exist
+        :param connection: database connection
+        """
+        if self.table_ready:
+            return
+
+        connection.execute('CREATE TABLE IF NOT EXISTS {} ('
+                           'electorate_id INTEGER NOT NULL PRIMARY KEY, '
+                           'content_hash TEXT NOT NULL, '
+                           'errors TEXT, '
+                           'parts TEXT)'.format(self.TABLE_NAME))
+        connection.commit()
+        self.table_ready = True
+
+    def lookup(self, content_hashes: Dict[object, str]) -> Dict[object, Tuple[List[str], List[List[int]]]]:
+        """
+        Looks up cached validation results
+        :param content_hashes: dictionary of electorate id to electorate content hash
+        :returns: dictionary of electorate id to list of validation errors and list of
+        contiguous parts (as lists of meshblock numbers), for electorates with a matching cached result
+        """
+        results = {}
+        with self.lock:
+            if self.database_path is None:
+                for electorate_id, content_hash in content_hashes.items():
+                    entry = self.memory_cache.get(electorate_id)
+                    if entry is not None and entry[0] == content_hash:
+                        results[electorate_id] = (list(entry[1]), [list(p) for p in entry[2]])
+                return results
+
+            try:
+                connection = DbUtils.connect(self.database_path)
+                try:
+                    self._ensure_table(connection)
+                    for electorate_id, content_hash in content_hashes.items():
+                        row = connection.execute(
+                            'SELECT errors, parts FROM {} WHERE electorate_id=? AND content_hash=?'.format(
+                                self.TABLE_NAME), (electorate_id, content_hash)).fetchone()
+                        if row is not None:
+                            results[electorate_id] = (json.loads(row[0]), json.loads(row[1]))
+                finally:
+                    connection.close()
+            except (sqlite3.Error, ValueError) as e:
+                QgsMessageLog.logMessage('Could not read electorate validation cache: {}'.format(e), "REDISTRICT")
+                return {}
+
+        return results
+
+    def store(self, entries: Dict[object, Tuple[str, List[str], List[List[int]]]]):
+        """
+        Stores electorate validation results in the cache
+        :param entries: dictionary of electorate id to content hash, list of validation errors
+        and list of contiguous parts (as lists of meshblock numbers)
+        """
+        if not entries:
+            return
+
+        with self.lock:
+            if self.database_path is None:
+                for electorate_id, (content_hash, errors, parts) in entries.items():
+                    self.memory_cache[electorate_id] = (content_hash, list(errors), [list(p) for p in parts])
+                return
+
+            try:
+                connection = DbUtils.connect(self.database_path)
+                try:
+                    self._ensure_table(connection)
+                    connection.executemany(
+                        'INSERT OR REPLACE INTO {} (electorate_id, content_hash, errors, parts) '
+                        'VALUES (?, ?, ?, ?)'.format(self.TABLE_NAME),
+                        [(electorate_id, content_hash, json.dumps(errors), json.dumps(parts))
+                         for electorate_id, (content_hash, errors, parts) in entries.items()])
+                    connection.commit()
+                finally:
+                    connection.close()
+            except sqlite3.Error as e:
+                QgsMessageLog.logMessage('Could not write electorate validation cache: {}'.format(e), "REDISTRICT")
+
+    def clear(self):
+        """
+        Removes all entries from the cache
+        """
+        with self.lock:
+            self.memory_cache = {}
+            if self.database_path is None:
+                return
+
+            try:
+                connection = DbUtils.connect(self.database_path)
+                try:
+                    connection.execute('DROP TABLE IF EXISTS {}'.format(self.TABLE_NAME))
+                    connection.commit()
+                finally:
+                    connection.close()
+                self.table_ready = False
+            except sqlite3.Error as e:
+                QgsMessageLog.logMessage('Could not clear electorate validation cache: {}'.format(e), "REDISTRICT")
@@ -13,13 +13,23 @@ __copyright__ = 'Copyright 2018, LINZ'
 # This will get replaced with a git SHA1 when you do a git archive
 __revision__ = '$Format:%H$'
 
+from typing import (Iterable,
+                    Optional)
+from qgis.PyQt.QtCore import QVariant
 from qgis.core import (QgsVectorLayer,
+                       QgsVectorLayerFeatureSource,
+                       QgsCoordinateReferenceSystem,
                        QgsFeature,
-                       QgsVectorFileWriter,
-                       QgsFeedback,
+                       QgsFeatureRequest,
+                       QgsField,
+                       QgsFields,
+                       QgsWkbTypes,
                        NULL)
+from redistrict.core.gpkg_writer import GeoPackageWriter
 from redistrict.linz.linz_district_registry import LinzElectoralDistrictRegistry
 from redistrict.linz.scenario_registry import ScenarioRegistry
+from redistrict.linz.meshblock_store import MeshblockStore
+from redistrict.linz.electorate_geometry_cache import ElectorateGeometryCache
 from redistrict.linz.scenario_base_task import (ScenarioBaseTask,
                                                 CanceledException)
 
@@ -36,7 +46,9 @@ class ExportTask(ScenarioBaseTask):
     def __init__(self, task_name: str, dest_file: str, electorate_registry: LinzElectoralDistrictRegistry,
                  meshblock_layer: QgsVectorLayer,
                  meshblock_number_field_name: str, scenario_registry: ScenarioRegistry, scenario,
-                 user_log_layer: QgsVectorLayer):
+                 user_log_layer: QgsVectorLayer, meshblock_store: Optional[MeshblockStore] = None,
+                 geometry_cache: Optional[ElectorateGeometryCache] = None,
+                 dirty_electorates: Optional[Iterable[int]] = None):
         """
         Constructor for ExportTask
         :param task_name: user-visible, translated name for task
@@ -47,116 +59,162 @@ class ExportTask(ScenarioBaseTask):
         :param scenario_registry: scenario registry
         :param scenario: target scenario id to switch to
         :param user_log_layer: user log layer
+        :param meshblock_store: optional session-wide meshblock store
+        :param geometry_cache: optional cache of dissolved electorate geometries
+        :param dirty_electorates: optional feature ids for electorates whose current geometry may not
+        match their meshblocks (e.g. electorates with pending boundary recalculations)
         """
         self.electorate_registry = electorate_registry
         super().__init__(task_name=task_name, electorate_layer=self.electorate_registry.source_layer,
                          meshblock_layer=meshblock_layer,
                          meshblock_number_field_name=meshblock_number_field_name, scenario_registry=scenario_registry,
-                         scenario=scenario, task=None)
+                         scenario=scenario, task=None, meshblock_store=meshblock_store,
+                         geometry_cache=geometry_cache)
         self.dest_file = dest_file
         self.message = None
         self.user_log_layer = user_log_layer
-
-        self.feedback = QgsFeedback()
-
-    def cancel(self):
+        self.user_log_source = QgsVectorLayerFeatureSource(user_log_layer)
+        self.user_log_fields = user_log_layer.fields()
+        self.user_log_wkb_type = user_log_layer.wkbType()
+        self.user_log_crs = user_log_layer.crs()
+
+        # existing electorate geometries can only be trusted if there are no pending edits
+        # or boundary recalculations. Meshblock reassignments are written directly to the
+        # providers, so the layers' modified state alone can't be relied on
+        self.has_pending_edits = bool(dirty_electorates) or any(
+            layer.isModified() for layer in (self.electorate_layer,
+                                             meshblock_layer,
+                                             scenario_registry.meshblock_electorate_layer))
+
+    def current_electorate_geometries(self, electorate_attributes: dict) -> Optional[dict]:
         """
-        Cancels the export
+        Returns the existing geometries from the electorate layer, if these are
+        already up to date for the export scenario. This is the case immediately
+        after a scenario switch or rebuild, so the electorates do not need to be
+        dissolved again.
+        :param electorate_attributes: electorate attributes, as returned by calculate_electorate_attributes
+        :returns: dictionary of electorate feature id to electorate geometry, or None if
+        the existing geometries are not current
         """
-        super().cancel()
-        self.feedback.cancel()
+        if self.has_pending_edits:
+            return None
+
+        for params in self.electorates_to_process.values():
+            if params[self.CURRENT_SCENARIO] != self.scenario:
+                return None
+
+        request = QgsFeatureRequest().setFilterFids(list(electorate_attributes.keys()))
+        request.setSubsetOfAttributes([])
+        electorate_geometries = {}
+        for f in self.electorate_source.getFeatures(request):
+            if self.isCanceled():
+                raise CanceledException
+
+            geometry = f.geometry()
+            if (geometry.isNull() or geometry.isEmpty()) and electorate_attributes[f.id()][self.MESHBLOCKS]:
+                # electorate has not been built
+                return None
+            electorate_geometries[f.id()] = geometry
+
+        if len(electorate_geometries) != len(electorate_attributes):
+            return None
+
+        return electorate_geometries
 
     def run(self):  # pylint: disable=missing-docstring,too-many-locals,too-many-return-statements,too-many-branches,too-many-statements
         try:
-            electorate_geometries, electorate_attributes = self.calculate_new_electorates()
+            self.prepare()
+            electorate_attributes = self.calculate_electorate_attributes()
+            electorate_geometries = self.current_electorate_geometries(electorate_attributes)
+            if electorate_geometries is None:
+                electorate_geometries = self.calculate_electorate_geometries(electorate_attributes)
         except CanceledException:
             return False
 
+        writer = GeoPackageWriter(self.dest_file)
+        try:
+            if not self.write_layers(writer, electorate_geometries, electorate_attributes):
+                self.message = writer.error_message
+                return False
+
+            if not writer.commit():
+                self.message = writer.error_message
+                return False
+        finally:
+            writer.close()
+
+        return True
+
+    def write_layers(self, writer: GeoPackageWriter, electorate_geometries: dict,  # pylint: disable=too-many-return-statements
+                     electorate_attributes: dict) -> bool:
+        """
+        Streams the electorates, meshblock assignments and user log to the destination
+        :param writer: destination writer
+        :param electorate_geometries: dictionary of electorate feature id to geometry
+        :param electorate_attributes: dictionary of electorate feature id to attributes
+        :returns: True if all layers were written
+        """
+        electorate_fields = QgsFields()
+        electorate_fields.append(QgsField('type', QVariant.String, len=2))
+        electorate_fields.append(QgsField('code', QVariant.String))
+        electorate_fields.append(QgsField('name', QVariant.String))
+        if not writer.create_layer('electorates', QgsWkbTypes.Polygon, electorate_fields,
+                                   QgsCoordinateReferenceSystem('EPSG:2193')):
+            return False
+
         # we also need a dictionary of meshblock number to all electorate types
         meshblock_electorates = {}
 
-        electorate_features = []
-
         for electorate_feature_id, attributes in electorate_attributes.items():
             if self.isCanceled():
                 return False
 
             electorate_code = attributes[self.ELECTORATE_CODE]
-            geometry = electorate_geometries[electorate_feature_id]
+            # release each geometry once written, to keep memory use down
+            geometry = electorate_geometries.pop(electorate_feature_id)
 
             meshblocks = attributes[self.MESHBLOCKS]
             electorate_type = attributes[self.ELECTORATE_TYPE]
             name = attributes[self.ELECTORATE_NAME]
 
-            for m in meshblocks:
-                meshblock_number = m[self.meshblock_number_idx]
+            for meshblock_number in meshblocks:
                 if meshblock_number not in meshblock_electorates:
                     meshblock_electorates[meshblock_number] = {}
                 meshblock_electorates[meshblock_number][electorate_type] = electorate_code
 
-                if self.isCanceled():
-                    return False
-
             electorate_feature = QgsFeature()
             electorate_feature.setGeometry(geometry)
             electorate_feature.setAttributes([electorate_type, electorate_code, name])
-            electorate_features.append(electorate_feature)
-
-        electorate_layer = QgsVectorLayer(
-            "Polygon?crs=EPSG:2193&field=type:string(2)&field=code:string&field=name:string",
-            "source", "memory")
-        if not electorate_layer.dataProvider().addFeatures(electorate_features):
-            return False
-
-        if self.isCanceled():
-            return False
+            if not writer.add_feature('electorates', electorate_feature):
+                return False
 
-        options = QgsVectorFileWriter.SaveVectorOptions()
-        options.driverName = 'GPKG'
-        options.layerName = 'electorates'
-        options.actionOnExistingFile = QgsVectorFileWriter.CreateOrOverwriteFile
-        options.feedback = self.feedback
-        error, self.message = QgsVectorFileWriter.writeAsVectorFormat(electorate_layer, self.dest_file, options)
-        if error:
-            return False
-        if self.isCanceled():
+        meshblock_fields = QgsFields()
+        meshblock_fields.append(QgsField('meshblock_number', QVariant.Int))
+        meshblock_fields.append(QgsField('gn_code', QVariant.String))
+        meshblock_fields.append(QgsField('gs_code', QVariant.String))
+        meshblock_fields.append(QgsField('m_code', QVariant.String))
+        if not writer.create_layer('meshblocks', QgsWkbTypes.NoGeometry, meshblock_fields):
             return False
 
-        layer = QgsVectorLayer(
-            "NoGeometry?field=meshblock_number:int&field=gn_code:string&field=gs_code:string&field=m_code:string",
-            "source", "memory")
-        meshblock_features = []
         for meshblock_number, electorates in meshblock_electorates.items():
+            if self.isCanceled():
+                return False
+
             f = QgsFeature()
             gn = electorates[self.GN] if self.GN in electorates else NULL
             gs = electorates[self.GS] if self.GS in electorates else NULL
             m = electorates[self.M] if self.M in electorates else NULL
             f.setAttributes([meshblock_number, gn, gs, m])
-            meshblock_features.append(f)
-            if self.isCanceled():
+            if not writer.add_feature('meshblocks', f):
                 return False
 
-        layer.dataProvider().addFeatures(meshblock_features)
-        options = QgsVectorFileWriter.SaveVectorOptions()
-        options.driverName = 'GPKG'
-        options.layerName = 'meshblocks'
-        options.feedback = self.feedback
-        options.actionOnExistingFile = QgsVectorFileWriter.CreateOrOverwriteLayer
-
-        error, self.message = QgsVectorFileWriter.writeAsVectorFormat(layer, self.dest_file, options)
-        if error:
+        if not writer.create_layer('user_log', self.user_log_wkb_type, self.user_log_fields, self.user_log_crs):
             return False
-        if self.isCanceled():
-            return False
-
-        options = QgsVectorFileWriter.SaveVectorOptions()
-        options.driverName = 'GPKG'
-        options.layerName = 'user_log'
-        options.feedback = self.feedback
-        options.actionOnExistingFile = QgsVectorFileWriter.CreateOrOverwriteLayer
 
-        error, self.message = QgsVectorFileWriter.writeAsVectorFormat(self.user_log_layer, self.dest_file, options)
-        if error:
-            return False
+        for f in self.user_log_source.getFeatures():
+            if self.isCanceled():
+                return False
+            if not writer.add_feature('user_log', f):
+                return False
 
         return True
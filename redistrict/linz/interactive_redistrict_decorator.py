@@ -61,6 +61,8 @@ class CentroidDecorator(QgsMapCanvasItem):
         self.quota = quota
         self.original_populations = {}
         self.new_populations = {}
+        # electorate feature ids, by electorate id
+        self.electorate_feature_ids = {}
 
     def redraw(self, handler):
         """
@@ -79,6 +81,16 @@ class CentroidDecorator(QgsMapCanvasItem):
                     # otherwise just use existing estimated pop as starting point
                     estimated_pop = f.attribute(handler.estimated_pop_idx)
                 self.original_populations[f.id()] = estimated_pop
+                self.electorate_feature_ids[f[handler.electorate_layer_field]] = f.id()
+
+        if handler.population_ledger is not None:
+            # ledger already tracks the populations of all affected electorates
+            self.new_populations = {}
+            for district in handler.pending_affected_districts.keys():  # pylint: disable=consider-iterating-dictionary
+                if district in self.electorate_feature_ids:
+                    self.new_populations[self.electorate_feature_ids[district]] = \
+                        handler.population_ledger.population(district)
+            return
 
         # step 1: get all electorate features corresponding to affected electorates
         electorate_features = {f[handler.electorate_layer_field]: f for f in
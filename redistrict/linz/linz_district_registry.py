@@ -269,6 +269,27 @@ class LinzElectoralDistrictRegistry(VectorLayerDistrictRegistry):
 
         return True, None
 
+    def relabel_electorate_scenario(self, previous_scenario, new_scenario) -> bool:
+        """
+        Updates the scenario recorded against electorates whose geometries were built for
+        a previous scenario, e.g. after branching that scenario to an identical new scenario.
+        All electorates in the layer are updated, regardless of their type. Electorates built
+        for other scenarios are left untouched.
+        :param previous_scenario: scenario the electorates were built for
+        :param new_scenario: scenario to record against the electorates
+        :returns: True if the electorates were updated
+        """
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([])
+        request.setFilterExpression(QgsExpression.createFieldEqualityExpression(self.scenario_id_field,
+                                                                                previous_scenario))
+        attribute_change_map = {f.id(): {self.scenario_id_field_index: new_scenario} for f in
+                                self.source_layer.dataProvider().getFeatures(request)}
+        if not attribute_change_map:
+            return True
+        return self.source_layer.dataProvider().changeAttributeValues(attribute_change_map)
+
     def toggle_electorate_deprecation(self, electorate):
         """
         Toggles the deprecation flag for an electorate
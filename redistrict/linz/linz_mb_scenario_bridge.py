@@ -13,11 +13,13 @@ __copyright__ = 'Copyright 2018, LINZ'
 # This will get replaced with a git SHA1 when you do a git archive
 __revision__ = '$Format:%H$'
 
-from typing import Dict, List
+from typing import Dict, List, Optional
 from qgis.PyQt.QtCore import QObject
 from qgis.core import (QgsFeatureRequest,
                        QgsExpression,
                        QgsVectorLayer)
+from redistrict.linz.scenario_registry import ScenarioRegistry
+from redistrict.linz.staged_electorate_update_task import UpdateStagedElectoratesTask
 
 
 class LinzMeshblockScenarioBridge(QObject):
@@ -26,19 +28,20 @@ class LinzMeshblockScenarioBridge(QObject):
     and the meshblock-scenario table
     """
 
-    def __init__(self, meshblock_layer: QgsVectorLayer, meshblock_scenario_layer: QgsVectorLayer, meshblock_number_field_name: str):
+    def __init__(self, meshblock_layer: QgsVectorLayer, meshblock_scenario_layer: QgsVectorLayer, meshblock_number_field_name: str,
+                 scenario_registry: Optional[ScenarioRegistry] = None):
         """
         Constructor
         :param meshblock_layer: meshblock layer
         :param meshblock_scenario_layer: meshblock-scenario table
         :param meshblock_number_field_name: name of meshblock number field
+        :param scenario_registry: optional scenario registry, required for delta scenario support
         """
         super().__init__()
         self.meshblock_layer = meshblock_layer
         self.meshblock_scenario_layer = meshblock_scenario_layer
+        self.scenario_registry = scenario_registry
 
-        self.staged_electorate_idx = self.meshblock_layer.fields().lookupField('staged_electorate')
-        assert self.staged_electorate_idx >= 0
         self.meshblock_number_idx = self.meshblock_layer.fields().lookupField(meshblock_number_field_name)
         assert self.meshblock_number_idx >= 0
 
@@ -49,6 +52,11 @@ class LinzMeshblockScenarioBridge(QObject):
 
         self.meshblock_layer.beforeCommitChanges.connect(self.meshblock_layer_saved)
 
+        # index of scenario to dictionary of meshblock number to target feature id, maintained for the session
+        self.target_meshblock_ids = {}
+        self.meshblock_scenario_layer.committedFeaturesAdded.connect(self.invalidate_target_meshblock_ids)
+        self.meshblock_scenario_layer.committedFeaturesRemoved.connect(self.invalidate_target_meshblock_ids)
+
         self.scenario = None
         self.task = None
 
@@ -62,6 +70,10 @@ class LinzMeshblockScenarioBridge(QObject):
         electorate_field_idx = self.meshblock_scenario_layer.fields().lookupField(electorate_field_name)
         assert electorate_field_idx >= 0
 
+        staged_electorate_idx = self.meshblock_layer.fields().lookupField(
+            UpdateStagedElectoratesTask.staged_field_for_task(self.meshblock_layer, self.task))
+        assert staged_electorate_idx >= 0
+
         if self.meshblock_layer.editBuffer() is None:
             return {}
 
@@ -77,11 +89,35 @@ class LinzMeshblockScenarioBridge(QObject):
         # dict of meshblock number to new electorate
         new_electorates = {}
         for source_id, changes in changed_attribute_values.items():
-            new_electorate = changes[self.staged_electorate_idx]
+            if staged_electorate_idx not in changes:
+                continue
+            new_electorate = changes[staged_electorate_idx]
             meshblock_number = int(meshblock_features[source_id][self.meshblock_number_idx])
             new_electorates[meshblock_number] = new_electorate
         return new_electorates
 
+    def target_meshblock_ids_for_scenario(self, scenario) -> Dict[int, int]:
+        """
+        Returns the index of meshblock number to target meshblock feature ID for
+        a scenario, building it with a single pass over the scenario's rows if required
+        :param scenario: scenario id
+        """
+        if scenario not in self.target_meshblock_ids:
+            request = QgsFeatureRequest()
+            request.setSubsetOfAttributes([self.target_meshblock_number_idx])
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+            request.setFilterExpression(QgsExpression.createFieldEqualityExpression('scenario_id', scenario))
+            self.target_meshblock_ids[scenario] = {int(f[self.target_meshblock_number_idx]): f.id() for f in
+                                                   self.meshblock_scenario_layer.getFeatures(request)}
+        return self.target_meshblock_ids[scenario]
+
+    def invalidate_target_meshblock_ids(self, *_):
+        """
+        Clears the index of target meshblock feature IDs, e.g. after rows have been
+        added or removed from the meshblock-scenario table
+        """
+        self.target_meshblock_ids = {}
+
     def get_target_meshblock_ids_from_numbers(self, meshblock_numbers: List[int]) -> Dict[int, int]:
         """
         Returns a dictionary of target meshblock feature IDs corresponding to the
@@ -89,16 +125,13 @@ class LinzMeshblockScenarioBridge(QObject):
         :param meshblock_numbers: list of meshblock numbers to lookup
         """
         assert self.scenario is not None
-        request = QgsFeatureRequest()
-        request.setSubsetOfAttributes([self.target_meshblock_number_idx])
-        request.setFilterExpression(QgsExpression.createFieldEqualityExpression('scenario_id', self.scenario))
-        meshblock_filter = 'meshblock_number IN ({})'.format(','.join([str(mb) for mb in meshblock_numbers]))
-        request.combineFilterExpression(meshblock_filter)
-        # create dictionary of meshblock number to id
-        mb_number_to_target_id = {}
-        for f in self.meshblock_scenario_layer.getFeatures(request):
-            mb_number_to_target_id[f[self.target_meshblock_number_idx]] = f.id()
-        return mb_number_to_target_id
+        target_ids = self.target_meshblock_ids_for_scenario(self.scenario)
+        if any(int(mb) not in target_ids for mb in meshblock_numbers):
+            # index may be stale - rebuild it for this scenario
+            del self.target_meshblock_ids[self.scenario]
+            target_ids = self.target_meshblock_ids_for_scenario(self.scenario)
+
+        return {mb: target_ids[int(mb)] for mb in meshblock_numbers if int(mb) in target_ids}
 
     def meshblock_layer_saved(self):
         """
@@ -113,6 +146,15 @@ class LinzMeshblockScenarioBridge(QObject):
         # dict of meshblock number to new electorate
         new_electorates = self.get_new_electorates()
 
+        if self.scenario_registry is not None and new_electorates:
+            # delta scenarios branched from this scenario must keep the previous assignments
+            for child in self.scenario_registry.delta_children(self.scenario):
+                self.scenario_registry.materialize_meshblocks(child, list(new_electorates.keys()))
+            # and if this is a delta scenario, it needs its own copies of the affected records
+            added = self.scenario_registry.materialize_meshblocks(self.scenario, list(new_electorates.keys()))
+            if added and self.scenario in self.target_meshblock_ids:
+                self.target_meshblock_ids[self.scenario].update(added)
+
         # find feature ids of affected rows
         mb_number_to_target_id = self.get_target_meshblock_ids_from_numbers(list(new_electorates.keys()))
 
@@ -123,3 +165,6 @@ class LinzMeshblockScenarioBridge(QObject):
             target_changed_attributes[mb_id] = {electorate_field_idx: electorate}
 
         self.meshblock_scenario_layer.dataProvider().changeAttributeValues(target_changed_attributes)
+        if self.scenario_registry is not None and target_changed_attributes:
+            # packed copy of the scenario is now out of date
+            self.scenario_registry.invalidate_packed_scenario(self.scenario)
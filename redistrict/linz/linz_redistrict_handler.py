@@ -13,9 +13,13 @@ __copyright__ = 'Copyright 2018, LINZ'
 # This will get replaced with a git SHA1 when you do a git archive
 __revision__ = '$Format:%H$'
 
+from typing import (Dict,
+                    List,
+                    Optional)
 from qgis.PyQt.QtCore import (QDateTime,
                               QVariant)
 from qgis.core import (QgsApplication,
+                       QgsExpression,
                        QgsFeatureRequest,
                        QgsFeature,
                        QgsFeatureIterator,
@@ -24,7 +28,11 @@ from qgis.core import (QgsApplication,
                        NULL)
 from redistrict.core.redistrict_handler import RedistrictHandler
 from redistrict.core.core_utils import CoreUtils
+from redistrict.core.dissolve import dissolve_geometries
 from redistrict.linz.electorate_changes_queue import ElectorateEditQueue
+from redistrict.linz.population_ledger import (PopulationLedger,
+                                               PopulationLedgerChange)
+from redistrict.linz.meshblock_topology import MeshblockTopology
 
 
 class LinzRedistrictHandler(RedistrictHandler):
@@ -38,7 +46,9 @@ class LinzRedistrictHandler(RedistrictHandler):
     def __init__(self, meshblock_layer: QgsVectorLayer, meshblock_number_field_name: str, target_field: str,
                  electorate_changes_queue: ElectorateEditQueue,
                  electorate_layer: QgsVectorLayer,
-                 electorate_layer_field: str, task: str, user_log_layer: QgsVectorLayer, scenario):
+                 electorate_layer_field: str, task: str, user_log_layer: QgsVectorLayer, scenario,
+                 population_ledger: Optional[PopulationLedger] = None,
+                 meshblock_topology: Optional[MeshblockTopology] = None):
         """
         Constructor
         :param meshblock_layer: meshblock layer
@@ -50,6 +60,11 @@ class LinzRedistrictHandler(RedistrictHandler):
         :param task: current task
         :param user_log_layer: user log layer
         :param scenario: current scenario
+        :param population_ledger: optional population ledger. If set, electorate populations
+        are tracked in the ledger as meshblocks are reassigned, instead of being calculated
+        from the meshblock layer.
+        :param meshblock_topology: optional meshblock topology. If set, electorate boundaries
+        are assembled from shared meshblock arcs instead of by polygon overlay.
         """
         super().__init__(target_layer=meshblock_layer, target_field=target_field)
         self.electorate_changes_queue = electorate_changes_queue
@@ -57,6 +72,10 @@ class LinzRedistrictHandler(RedistrictHandler):
         self.electorate_layer_field = electorate_layer_field
         self.pending_affected_districts = {}
         self.pending_log_entries = []
+        self.population_ledger = population_ledger
+        self.meshblock_topology = meshblock_topology
+        # meshblock moves applied to the population ledger during the current edit group
+        self.pending_population_moves = []
         self.task = task
         self.user_log_layer = user_log_layer
         self.scenario = scenario
@@ -171,7 +190,7 @@ class LinzRedistrictHandler(RedistrictHandler):
         parts = [f.geometry() for f in self.get_added_meshblocks(district)]
         if parts:
             parts.append(original_district_geometry)
-            return QgsGeometry.unaryUnion(parts)
+            return dissolve_geometries(parts, make_valid=False)
 
         return original_district_geometry
 
@@ -182,6 +201,12 @@ class LinzRedistrictHandler(RedistrictHandler):
         :param district: district to grow
         :param original_pop: original population for district
         """
+        if self.population_ledger is not None:
+            if district not in self.pending_affected_districts:
+                return original_pop
+            return original_pop + self.population_ledger.meshblock_populations(
+                self.pending_affected_districts[district]['ADD'])
+
         request = self.get_added_meshblocks_request(district)
         if request is None:
             return original_pop
@@ -228,7 +253,7 @@ class LinzRedistrictHandler(RedistrictHandler):
         """
         parts = [f.geometry() for f in self.get_removed_meshblocks(district)]
         if parts:
-            to_remove = QgsGeometry.unaryUnion(parts)
+            to_remove = dissolve_geometries(parts, make_valid=False)
             return original_district_geometry.difference(to_remove)
 
         return original_district_geometry
@@ -240,6 +265,12 @@ class LinzRedistrictHandler(RedistrictHandler):
         :param district: district to shrink
         :param original_pop: original population for district
         """
+        if self.population_ledger is not None:
+            if district not in self.pending_affected_districts:
+                return original_pop
+            return original_pop - self.population_ledger.meshblock_populations(
+                self.pending_affected_districts[district]['REMOVE'])
+
         request = self.get_removed_meshblocks_request(district)
         if request is None:
             return original_pop
@@ -252,6 +283,46 @@ class LinzRedistrictHandler(RedistrictHandler):
 
         return pop
 
+    def rebuild_electorate_geometries(self, electorate_feature_ids: List[int],
+                                      committed: bool = False) -> Dict[int, QgsGeometry]:
+        """
+        Rebuilds electorate geometries by dissolving their assigned meshblocks. Used
+        to restore electorate geometries which were evicted from the undo history.
+        :param electorate_feature_ids: feature ids of electorates to rebuild
+        :param committed: set to True to use the committed meshblock assignments, ignoring
+        any edits in the meshblock layer's edit buffer
+        :returns: dictionary of electorate feature id to rebuilt geometry
+        """
+        request = QgsFeatureRequest().setFilterFids(electorate_feature_ids)
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([self.electorate_layer_field], self.electorate_layer.fields())
+        electorates = {f.id(): f[self.electorate_layer_field] for f in self.electorate_layer.getFeatures(request)}
+
+        result = {}
+        if not committed and self.has_topology():
+            for feature_id, electorate in electorates.items():
+                geometry = self.meshblock_topology.electorate_geometry(electorate)
+                if geometry is not None:
+                    result[feature_id] = geometry
+
+        source = self.target_layer.dataProvider() if committed else self.target_layer
+        for feature_id, electorate in electorates.items():
+            if feature_id in result:
+                continue
+            meshblock_request = QgsFeatureRequest().setFilterExpression(
+                QgsExpression.createFieldEqualityExpression(self.target_field, electorate))
+            meshblock_request.setSubsetOfAttributes([])
+            parts = [f.geometry() for f in source.getFeatures(meshblock_request) if f.hasGeometry()]
+            result[feature_id] = dissolve_geometries(parts) if parts else QgsGeometry()
+        return result
+
+    def has_topology(self) -> bool:
+        """
+        Returns True if a meshblock topology is available for assembling electorate boundaries
+        """
+        return self.meshblock_topology is not None and self.meshblock_topology.ensure_built() and \
+            self.meshblock_topology.is_available()
+
     def begin_operation(self):
         CoreUtils.enable_labels_for_layer(self.electorate_layer, False)
 
@@ -264,31 +335,49 @@ class LinzRedistrictHandler(RedistrictHandler):
             super().end_edit_group()
             return
 
+        # if a boundary updater is available the boundaries are redissolved from meshblocks
+        # in the background, so that the UI isn't blocked
+        defer_geometries = self.electorate_changes_queue.boundary_updater is not None
+
         # step 1: get all electorate features corresponding to affected electorates
         electorate_features = {f[self.electorate_layer_field]: f for f in
-                               self.get_affected_districts([self.electorate_layer_field, self.stats_nz_pop_field, 'estimated_pop'])}
+                               self.get_affected_districts([self.electorate_layer_field, self.stats_nz_pop_field, 'estimated_pop'],
+                                                           needs_geometry=not defer_geometries)}
+
+        population_change = None
+        if self.population_ledger is not None:
+            population_change = PopulationLedgerChange(self.population_ledger, self.pending_population_moves)
 
         # and update the electorate boundaries based on these changes.
         # Ideally we'd redissolve the whole boundary from meshblocks, but that's too
-        # slow. So instead we adjust piece-by-piece by adding or chomping away
-        # the affected meshblocks only.
+        # slow to do here. So instead we either reassemble the boundary from the meshblock
+        # topology, or adjust piece-by-piece by adding or chomping away the affected meshblocks only.
+        use_topology = not defer_geometries and self.has_topology()
         new_geometries = {}
         new_attributes = {}
         for district in self.pending_affected_districts.keys():  # pylint: disable=consider-iterating-dictionary
-            district_geometry = electorate_features[district].geometry()
-            # use stats nz pop as initial estimate, if available
-            estimated_pop = electorate_features[district].attribute(self.stats_nz_pop_field_index)
-            if estimated_pop is None or estimated_pop == NULL:
-                # otherwise just use existing estimated pop as starting point
-                estimated_pop = electorate_features[district].attribute(self.estimated_pop_idx)
-            # add new bits
-            district_geometry = self.grow_district_with_added_meshblocks(district, district_geometry)
-            estimated_pop = self.grow_population_with_added_meshblocks(district, estimated_pop)
-            # minus lost bits
-            district_geometry = self.shrink_district_by_removed_meshblocks(district, district_geometry)
-            estimated_pop = self.shrink_population_by_removed_meshblocks(district, estimated_pop)
-
-            new_geometries[electorate_features[district].id()] = district_geometry
+            district_geometry = self.meshblock_topology.electorate_geometry(district) if use_topology else None
+            if district_geometry is not None:
+                new_geometries[electorate_features[district].id()] = district_geometry
+            elif not defer_geometries:
+                district_geometry = electorate_features[district].geometry()
+                # add new bits
+                district_geometry = self.grow_district_with_added_meshblocks(district, district_geometry)
+                # minus lost bits
+                district_geometry = self.shrink_district_by_removed_meshblocks(district, district_geometry)
+                new_geometries[electorate_features[district].id()] = district_geometry
+
+            if self.population_ledger is not None:
+                # the ledger already reflects all the moves made during this edit group
+                estimated_pop = self.population_ledger.population(district)
+            else:
+                # use stats nz pop as initial estimate, if available
+                estimated_pop = electorate_features[district].attribute(self.stats_nz_pop_field_index)
+                if estimated_pop is None or estimated_pop == NULL:
+                    # otherwise just use existing estimated pop as starting point
+                    estimated_pop = electorate_features[district].attribute(self.estimated_pop_idx)
+                estimated_pop = self.grow_population_with_added_meshblocks(district, estimated_pop)
+                estimated_pop = self.shrink_population_by_removed_meshblocks(district, estimated_pop)
 
             new_attributes[electorate_features[district].id()] = {self.estimated_pop_idx: estimated_pop,
                                                                   self.stats_nz_pop_field_index: NULL,
@@ -296,7 +385,11 @@ class LinzRedistrictHandler(RedistrictHandler):
                                                                   self.stats_nz_var_23_field_index: NULL,
                                                                   self.invalid_field_index: NULL,
                                                                   self.invalid_reason_field_index: NULL}
-        self.electorate_changes_queue.push_changes(new_attributes, new_geometries, self.pending_log_entries)
+        self.electorate_changes_queue.push_changes(new_attributes, new_geometries, self.pending_log_entries,
+                                                   geometry_builder=self.rebuild_electorate_geometries,
+                                                   population_change=population_change,
+                                                   deferred_geometry_ids=list(
+                                                       new_attributes.keys()) if defer_geometries else None)
 
         self.electorate_changes_queue.blocked = True
         super().end_edit_group()
@@ -304,37 +397,53 @@ class LinzRedistrictHandler(RedistrictHandler):
 
         self.pending_affected_districts = {}
         self.pending_log_entries = []
+        self.pending_population_moves = []
         self.redistrict_occured.emit()
 
     def discard_edit_group(self):
         self.electorate_changes_queue.blocked = True
         super().discard_edit_group()
         self.electorate_changes_queue.blocked = False
+        if self.population_ledger is not None:
+            self.population_ledger.revert_moves(self.pending_population_moves)
         self.pending_affected_districts = {}
         self.pending_log_entries = []
+        self.pending_population_moves = []
 
-    def assign_district(self, target_ids, new_district):
+    def assign_district(self, target_ids, new_district, previous_districts=None):  # pylint: disable=unused-argument
         """
         Queue up changes
-        :param target_ids:
-        :param new_district:
-        :return:
+        :param target_ids: feature IDs for meshblocks to redistrict
+        :param new_district: new district for meshblocks
+        :param previous_districts: unused, as current districts are always fetched for the user log
+        :return: True if redistrict was successful
         """
+        target_field_idx = self.target_layer.fields().lookupField(self.target_field)
+        assert target_field_idx >= 0
+
+        # log entries share a single timestamp and user for the operation
+        timestamp = QDateTime.currentDateTime()
+        username = QgsApplication.userFullName()
+
         staged_log_entries = []
+        current_districts = {}
+        moved_from = {}
+        unchanged = set()
         # first, record the previous districts, before they get changed by the super method
-        request = QgsFeatureRequest().setFilterFids(target_ids)
+        request = QgsFeatureRequest().setFilterFids(list(target_ids))
         request.setFlags(QgsFeatureRequest.NoGeometry)
-        request.setSubsetOfAttributes(
-            [self.target_layer.fields().lookupField(self.target_field), self.meshblock_number_idx])
+        request.setSubsetOfAttributes([target_field_idx, self.meshblock_number_idx])
         for f in self.target_layer.getFeatures(request):
-            district = f[self.target_field]
+            district = f[target_field_idx]
+            current_districts[f.id()] = district
             if district == NULL:
                 continue
 
             if district == new_district:
-                target_ids = [t for t in target_ids if t != f.id()]
+                unchanged.add(f.id())
                 continue
 
+            moved_from[f.id()] = district
             meshblock_number = f[self.meshblock_number_idx]
 
             if district not in self.pending_affected_districts:
@@ -342,9 +451,11 @@ class LinzRedistrictHandler(RedistrictHandler):
             self.pending_affected_districts[district]['REMOVE'].append(f.id())
 
             staged_log_entries.append(self.create_log_entry(meshblock_number=meshblock_number, old_district=district,
-                                                            new_district=new_district))
+                                                            new_district=new_district, timestamp=timestamp,
+                                                            username=username))
 
-        if not super().assign_district(target_ids, new_district):
+        target_ids = [t for t in target_ids if t not in unchanged]
+        if not super().assign_district(target_ids, new_district, previous_districts=current_districts):
             return False
 
         self.pending_log_entries.extend(staged_log_entries)
@@ -356,20 +467,28 @@ class LinzRedistrictHandler(RedistrictHandler):
             self.pending_affected_districts[new_district] = {'ADD': [], 'REMOVE': []}
 
         self.pending_affected_districts[new_district]['ADD'].extend(target_ids)
+
+        if self.population_ledger is not None:
+            moves = [(t, moved_from.get(t), new_district) for t in target_ids]
+            self.population_ledger.move_meshblocks(moves)
+            self.pending_population_moves.extend(moves)
         return True
 
-    def create_log_entry(self, meshblock_number, old_district, new_district) -> QgsFeature:
+    def create_log_entry(self, meshblock_number, old_district, new_district,  # pylint: disable=too-many-arguments
+                         timestamp: Optional[QDateTime] = None, username: Optional[str] = None) -> QgsFeature:
         """
         Returns a feature corresponding to a new log entry
         :param meshblock_number: meshblock number
         :param old_district: previous district
         :param new_district: new district
+        :param timestamp: optional timestamp for entry. If not set, the current date time will be used.
+        :param username: optional user name for entry. If not set, the current user's full name will be used.
         """
         f = QgsFeature(self.user_log_layer.fields())
         f.initAttributes(len(self.user_log_layer.fields()))
 
-        f[self.user_log_timestamp_idx] = QDateTime.currentDateTime()
-        f[self.user_log_username_idx] = QgsApplication.userFullName()
+        f[self.user_log_timestamp_idx] = timestamp if timestamp is not None else QDateTime.currentDateTime()
+        f[self.user_log_username_idx] = username if username is not None else QgsApplication.userFullName()
         f[self.user_log_scenario_idx] = self.scenario
         f[self.user_log_mb_number_idx] = meshblock_number
         f[self.user_log_type_idx] = self.task
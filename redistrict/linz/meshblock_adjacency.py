@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""LINZ Redistricting Plugin - Meshblock adjacency graph
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import sqlite3
+import threading
+from typing import (Iterable,
+                    List,
+                    Optional,
+                    Tuple)
+from qgis.core import (QgsFeature,
+                       QgsFeedback,
+                       QgsGeometry,
+                       QgsMessageLog,
+                       QgsSpatialIndex)
+from redistrict.linz.db_utils import DbUtils
+from redistrict.linz.meshblock_store import MeshblockStore
+
+
+class MeshblockAdjacency:
+    """
+    A graph of meshblock parts which share a common boundary.
+
+    Each polygon part of a meshblock is a separate node in the graph, so that
+    multipart meshblocks (such as offshore islands) count as multiple parts
+    of an electorate. Nodes are considered adjacent when they share at least one
+    edge, matching the way a dissolve merges meshblocks into a single part (parts
+    which touch only at a vertex remain separate parts). The graph allows the
+    contiguity of an electorate to be determined without dissolving the
+    electorate's meshblocks. When a database path is set the graph is persisted
+    in tables within the database, so it only needs to be calculated once.
+    """
+
+    TABLE_NAME = 'meshblock_adjacency'
+    PARTS_TABLE_NAME = 'meshblock_parts'
+
+    # DE-9IM pattern for geometries with disjoint interiors which share a linear boundary
+    SHARED_EDGE_PATTERN = 'F***1****'
+
+    def __init__(self, meshblock_store: MeshblockStore, database_path: Optional[str] = None):
+        """
+        Constructor for MeshblockAdjacency
+        :param meshblock_store: meshblock store
+        :param database_path: optional path to GeoPackage database in which to persist the graph
+        """
+        self.meshblock_store = meshblock_store
+        self.database_path = database_path
+        # adjacent nodes for each node
+        self.neighbours = None
+        # meshblock store row for each node
+        self.node_rows = None
+        # first node for each meshblock store row, with a trailing entry for the total node count
+        self.row_nodes = None
+        self.lock = threading.Lock()
+
+    def ensure_built(self, feedback: Optional[QgsFeedback] = None) -> bool:
+        """
+        Ensures that the adjacency graph is ready, either by loading it from the
+        database or by calculating it. This method is thread safe.
+        :param feedback: optional feedback object for cancellation
+        :returns: True if the graph is ready, False if it was canceled
+        """
+        with self.lock:
+            if self.neighbours is not None:
+                return True
+
+            if not self.meshblock_store.ensure_loaded(feedback):
+                return False
+
+            graph = self.load()
+            if graph is None:
+                graph = self.build(feedback)
+                if graph is None:
+                    return False
+                self.save(*graph)
+
+            self.set_graph(*graph)
+            return True
+
+    def set_graph(self, part_counts: List[int], neighbours: List[List[int]]):
+        """
+        Sets the current adjacency graph
+        :param part_counts: number of polygon parts for each meshblock store row
+        :param neighbours: list of adjacent nodes for each node
+        """
+        row_nodes = [0]
+        node_rows = []
+        for row, count in enumerate(part_counts):
+            node_rows.extend([row] * count)
+            row_nodes.append(row_nodes[-1] + count)
+        self.row_nodes = row_nodes
+        self.node_rows = node_rows
+        self.neighbours = neighbours
+
+    @staticmethod
+    def polygon_parts(geometry: QgsGeometry) -> List[QgsGeometry]:
+        """
+        Returns the individual polygon parts of a geometry
+        :param geometry: meshblock geometry
+        """
+        if geometry is None or geometry.isNull() or geometry.isEmpty():
+            return []
+        return [part for part in geometry.asGeometryCollection() if not part.isEmpty()]
+
+    def build(self, feedback: Optional[QgsFeedback] = None) -> Optional[Tuple[List[int], List[List[int]]]]:
+        """
+        Calculates the adjacency graph from the meshblock geometries
+        :param feedback: optional feedback object for cancellation
+        :returns: tuple of the number of polygon parts for each meshblock store row and
+        the list of adjacent nodes for each node, or None if canceled
+        """
+        # geometries are only required while building, and are not retained
+        geometries = self.meshblock_store.all_geometries(feedback)
+        if geometries is None:
+            return None
+
+        part_counts = []
+        parts = []
+        for geometry in geometries:
+            row_parts = self.polygon_parts(geometry)
+            part_counts.append(len(row_parts))
+            parts.extend(row_parts)
+
+        index = QgsSpatialIndex()
+        for node, part in enumerate(parts):
+            f = QgsFeature(node)
+            f.setGeometry(part)
+            index.insertFeature(f)
+
+        neighbours = [[] for _ in range(len(parts))]
+        for node, part in enumerate(parts):
+            if feedback is not None and feedback.isCanceled():
+                return None
+
+            engine = QgsGeometry.createGeometryEngine(part.constGet())
+            engine.prepareGeometry()
+            for candidate in index.intersects(part.boundingBox()):
+                if candidate <= node:
+                    continue
+                if engine.relatePattern(parts[candidate].constGet(), self.SHARED_EDGE_PATTERN):
+                    neighbours[node].append(candidate)
+                    neighbours[candidate].append(node)
+
+        return part_counts, neighbours
+
+    def load(self) -> Optional[Tuple[List[int], List[List[int]]]]:
+        """
+        Loads a previously calculated adjacency graph from the database
+        :returns: tuple of the number of polygon parts for each meshblock store row and
+        the list of adjacent nodes for each node, or None if no graph is stored
+        """
+        if self.database_path is None:
+            return None
+
+        store = self.meshblock_store
+        part_counts = [0] * store.meshblock_count()
+        try:
+            connection = DbUtils.connect(self.database_path)
+            try:
+                if connection.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?",
+                                      (self.PARTS_TABLE_NAME,)).fetchone() is None:
+                    return None
+
+                found = False
+                for meshblock, parts in connection.execute(
+                        'SELECT meshblock, parts FROM {}'.format(self.PARTS_TABLE_NAME)):
+                    found = True
+                    row = store.row_for_meshblock.get(meshblock)
+                    if row is not None:
+                        part_counts[row] = parts
+                if not found:
+                    return None
+
+                row_nodes = [0]
+                for count in part_counts:
+                    row_nodes.append(row_nodes[-1] + count)
+                neighbours = [[] for _ in range(row_nodes[-1])]
+                for meshblock_a, part_a, meshblock_b, part_b in connection.execute(
+                        'SELECT meshblock_a, part_a, meshblock_b, part_b FROM {}'.format(self.TABLE_NAME)):
+                    row_a = store.row_for_meshblock.get(meshblock_a)
+                    row_b = store.row_for_meshblock.get(meshblock_b)
+                    if row_a is None or row_b is None or part_a >= part_counts[row_a] or \
+                            part_b >= part_counts[row_b]:
+                        continue
+                    node_a = row_nodes[row_a] + part_a
+                    node_b = row_nodes[row_b] + part_b
+                    neighbours[node_a].append(node_b)
+                    neighbours[node_b].append(node_a)
+            finally:
+                connection.close()
+        except sqlite3.Error as e:
+            QgsMessageLog.logMessage('Could not read meshblock adjacency: {}'.format(e), "REDISTRICT")
+            return None
+
+        return part_counts, neighbours
+
+    def save(self, part_counts: List[int], neighbours: List[List[int]]):
+        """
+        Persists the adjacency graph to the database
+        :param part_counts: number of polygon parts for each meshblock store row
+        :param neighbours: list of adjacent nodes for each node
+        """
+        if self.database_path is None:
+            return
+
+        meshblock_numbers = self.meshblock_store.meshblock_numbers
+        nodes = [(meshblock_numbers[row], part) for row, count in enumerate(part_counts) for part in range(count)]
+        pairs = [nodes[node] + nodes[neighbour]
+                 for node, node_neighbours in enumerate(neighbours)
+                 for neighbour in node_neighbours if neighbour > node]
+        try:
+            connection = DbUtils.connect(self.database_path)
+            try:
+                connection.execute('DROP TABLE IF EXISTS {}'.format(self.TABLE_NAME))
+                connection.execute('DROP TABLE IF EXISTS {}'.format(self.PARTS_TABLE_NAME))
+                connection.execute('CREATE TABLE {} (meshblock_a INTEGER NOT NULL, part_a INTEGER NOT NULL, '
+                                   'meshblock_b INTEGER NOT NULL, part_b INTEGER NOT NULL, '
+                                   'PRIMARY KEY (meshblock_a, part_a, meshblock_b, part_b))'.format(self.TABLE_NAME))
+                connection.execute('CREATE TABLE {} (meshblock INTEGER PRIMARY KEY, parts INTEGER NOT NULL)'.format(
+                    self.PARTS_TABLE_NAME))
+                connection.executemany(
+                    'INSERT INTO {} (meshblock_a, part_a, meshblock_b, part_b) VALUES (?, ?, ?, ?)'.format(
+                        self.TABLE_NAME), pairs)
+                connection.executemany('INSERT INTO {} (meshblock, parts) VALUES (?, ?)'.format(
+                    self.PARTS_TABLE_NAME), zip(meshblock_numbers, part_counts))
+                connection.commit()
+            finally:
+                connection.close()
+        except sqlite3.Error as e:
+            QgsMessageLog.logMessage('Could not store meshblock adjacency: {}'.format(e), "REDISTRICT")
+
+    @staticmethod
+    def clear_database(database_path: str):
+        """
+        Removes any stored adjacency graph from a database, e.g. after
+        the meshblocks have been replaced
+        :param database_path: path to database
+        """
+        try:
+            connection = DbUtils.connect(database_path)
+            try:
+                connection.execute('DROP TABLE IF EXISTS {}'.format(MeshblockAdjacency.TABLE_NAME))
+                connection.execute('DROP TABLE IF EXISTS {}'.format(MeshblockAdjacency.PARTS_TABLE_NAME))
+                connection.commit()
+            finally:
+                connection.close()
+        except sqlite3.Error as e:
+            QgsMessageLog.logMessage('Could not clear meshblock adjacency: {}'.format(e), "REDISTRICT")
+
+    def components(self, rows: Iterable[int]) -> List[List[int]]:
+        """
+        Returns the connected components (contiguous parts) formed by a set of meshblocks,
+        using a union-find over the adjacency graph. Each polygon part of a multipart
+        meshblock is considered separately, so a meshblock may belong to more than one
+        component. Meshblocks without geometry are ignored.
+        :param rows: meshblock store rows
+        :returns: list of components, each a sorted list of rows. Components are
+        ordered by their first node.
+        """
+        assert self.neighbours is not None
+
+        parent = {node: node for row in rows for node in range(self.row_nodes[row], self.row_nodes[row + 1])}
+
+        def find(node):
+            """
+            Finds the root for a node, compressing the path as it goes
+            """
+            root = node
+            while parent[root] != root:
+                root = parent[root]
+            while parent[node] != root:
+                parent[node], node = root, parent[node]
+            return root
+
+        for node in parent:
+            for neighbour in self.neighbours[node]:
+                if neighbour not in parent:
+                    continue
+                root_a = find(node)
+                root_b = find(neighbour)
+                if root_a != root_b:
+                    parent[max(root_a, root_b)] = min(root_a, root_b)
+
+        components = {}
+        for node in sorted(parent):
+            components.setdefault(find(node), set()).add(self.node_rows[node])
+        return [sorted(components[root]) for root in sorted(components)]
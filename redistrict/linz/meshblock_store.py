@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""LINZ Redistricting Plugin - Columnar meshblock attribute store
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import threading
+from array import array
+from typing import (Dict,
+                    Iterable,
+                    List,
+                    Optional)
+from qgis.core import (QgsFeatureRequest,
+                       QgsFeedback,
+                       QgsGeometry,
+                       QgsVectorLayer,
+                       QgsVectorLayerFeatureSource,
+                       NULL)
+
+
+class MeshblockStore:
+    """
+    A session-wide, array backed store of meshblock attributes.
+
+    Each meshblock is allocated a stable row number, and all attributes
+    are stored in parallel arrays indexed by this row. This allows
+    whole-scenario aggregates (such as electorate populations) to be
+    calculated in a single grouped pass, without holding complete
+    QgsFeature objects in memory.
+
+    Stores can be constructed on the main thread with loading deferred,
+    in which case the meshblocks are read from a thread-safe snapshot of
+    the meshblock layer on the first call to ensure_loaded(), e.g. from
+    within a background task.
+
+    Meshblock geometries are not held in the store by default. Instead,
+    consumers which require geometries fetch them for the rows they need
+    from the layer snapshot via geometries_for_rows() or all_geometries().
+    """
+
+    UNASSIGNED = -1
+
+    def __init__(self, meshblock_layer: QgsVectorLayer, meshblock_number_field_name: str,
+                 load_geometries: bool = False, defer_load: bool = False):
+        """
+        Constructor for MeshblockStore
+        :param meshblock_layer: meshblock layer
+        :param meshblock_number_field_name: name of meshblock number field
+        :param load_geometries: set to True to keep all meshblock geometries resident
+        in the store
+        :param defer_load: set to True to defer loading meshblocks until ensure_loaded()
+        is called
+        """
+        self.meshblock_layer = meshblock_layer
+        self.meshblock_number_field_name = meshblock_number_field_name
+        self.load_geometries = load_geometries
+        # snapshot of meshblock layer, safe for use in background threads
+        self.source = QgsVectorLayerFeatureSource(meshblock_layer)
+        self.loaded = False
+        self.load_lock = threading.Lock()
+
+        self.meshblock_number_idx = meshblock_layer.fields().lookupField(meshblock_number_field_name)
+        assert self.meshblock_number_idx >= 0
+        self.off_pop_m_idx = meshblock_layer.fields().lookupField('offline_pop_m')
+        assert self.off_pop_m_idx >= 0
+        self.off_pop_gn_idx = meshblock_layer.fields().lookupField('offline_pop_gn')
+        assert self.off_pop_gn_idx >= 0
+        self.off_pop_gs_idx = meshblock_layer.fields().lookupField('offline_pop_gs')
+        assert self.off_pop_gs_idx >= 0
+        self.offshore_idx = meshblock_layer.fields().lookupField('offshore')
+        assert self.offshore_idx >= 0
+
+        self.meshblock_numbers = None
+        self.feature_ids = None
+        self.populations = None
+        self.offshore = None
+        self.geometries = None
+        self.row_for_meshblock = None
+        self.row_for_feature_id = None
+        self.clear()
+
+        if not defer_load:
+            self.ensure_loaded()
+
+    def clear(self):
+        """
+        Clears all meshblocks from the store
+        """
+        # meshblock number for each row
+        self.meshblock_numbers = array('q')
+        # feature id for each row
+        self.feature_ids = array('q')
+        # offline populations for each row, by electorate type
+        self.populations = {'GN': array('q'),
+                            'GS': array('q'),
+                            'M': array('q')}
+        self.offshore = array('b')
+        self.geometries = [] if self.load_geometries else None
+
+        # lookup of meshblock number to row
+        self.row_for_meshblock = {}
+        # feature id to row
+        self.row_for_feature_id = {}
+        self.loaded = False
+
+    @staticmethod
+    def _to_int(value) -> int:
+        """
+        Converts an attribute value to an integer, treating NULL values as 0
+        :param value: value to convert
+        """
+        if value is None or value == NULL:
+            return 0
+        return int(value)
+
+    def ensure_loaded(self, feedback: Optional[QgsFeedback] = None) -> bool:
+        """
+        Ensures that meshblocks have been loaded into the store, loading
+        them if required. This method is thread safe.
+        :param feedback: optional feedback object for cancellation
+        :returns: True if the store is loaded, False if loading was canceled
+        """
+        with self.load_lock:
+            if self.loaded:
+                return True
+            return self.load(feedback)
+
+    def load(self, feedback: Optional[QgsFeedback] = None) -> bool:
+        """
+        Loads all meshblocks from the meshblock layer snapshot into the store
+        :param feedback: optional feedback object for cancellation
+        :returns: True if loading was successful, False if it was canceled
+        """
+        self.clear()
+
+        request = QgsFeatureRequest()
+        attributes = [self.meshblock_number_idx, self.off_pop_m_idx, self.off_pop_gn_idx, self.off_pop_gs_idx,
+                      self.offshore_idx]
+        request.setSubsetOfAttributes(attributes)
+        if not self.load_geometries:
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+
+        for f in self.source.getFeatures(request):
+            if feedback is not None and feedback.isCanceled():
+                break
+            self.add_meshblock(f, self.load_geometries)
+
+        if feedback is not None and feedback.isCanceled():
+            self.clear()
+            return False
+
+        self.loaded = True
+        return True
+
+    def add_meshblock(self, feature, store_geometry: bool = True):
+        """
+        Appends a meshblock feature to the store
+        :param feature: meshblock feature
+        :param store_geometry: set to True to also store the meshblock geometry
+        """
+        row = len(self.meshblock_numbers)
+        meshblock_number = int(feature[self.meshblock_number_idx])
+        self.meshblock_numbers.append(meshblock_number)
+        self.feature_ids.append(feature.id())
+        self.populations['M'].append(self._to_int(feature[self.off_pop_m_idx]))
+        self.populations['GN'].append(self._to_int(feature[self.off_pop_gn_idx]))
+        self.populations['GS'].append(self._to_int(feature[self.off_pop_gs_idx]))
+        self.offshore.append(1 if feature[self.offshore_idx] and feature[self.offshore_idx] != NULL else 0)
+        if store_geometry and self.geometries is not None:
+            self.geometries.append(feature.geometry())
+        self.row_for_meshblock[meshblock_number] = row
+        self.row_for_feature_id[feature.id()] = row
+
+    def meshblock_count(self) -> int:
+        """
+        Returns the number of meshblocks in the store
+        """
+        return len(self.meshblock_numbers)
+
+    def rows_for_meshblocks(self, meshblock_numbers: Iterable[int]) -> array:
+        """
+        Returns an array of store rows corresponding to a list of meshblock numbers
+        :param meshblock_numbers: meshblock numbers to lookup
+        """
+        return array('q', (self.row_for_meshblock[int(m)] for m in meshblock_numbers))
+
+    def geometries_for_rows(self, rows: Iterable[int],
+                            feedback: Optional[QgsFeedback] = None) -> Optional[List[QgsGeometry]]:
+        """
+        Returns the meshblock geometries for a set of rows. If geometries are not
+        resident in the store, they are fetched from the meshblock layer snapshot.
+        This method is thread safe.
+        :param rows: store rows
+        :param feedback: optional feedback object for cancellation
+        :returns: list of geometries corresponding to rows, or None if canceled
+        """
+        rows = list(rows)
+        if self.geometries is not None:
+            return [self.geometries[r] for r in rows]
+
+        request = QgsFeatureRequest().setFilterFids([self.feature_ids[r] for r in rows])
+        request.setSubsetOfAttributes([])
+        geometries = {}
+        for f in self.source.getFeatures(request):
+            if feedback is not None and feedback.isCanceled():
+                return None
+            geometries[f.id()] = f.geometry()
+        return [geometries.get(self.feature_ids[r], QgsGeometry()) for r in rows]
+
+    def all_geometries(self, feedback: Optional[QgsFeedback] = None) -> Optional[List[QgsGeometry]]:
+        """
+        Returns the geometries for all meshblocks, indexed by store row. If geometries are
+        not resident in the store, they are fetched from the meshblock layer snapshot.
+        This method is thread safe.
+        :param feedback: optional feedback object for cancellation
+        :returns: list of geometries for each row, or None if canceled
+        """
+        if self.geometries is not None:
+            return self.geometries
+
+        geometries = [QgsGeometry()] * self.meshblock_count()
+        request = QgsFeatureRequest().setSubsetOfAttributes([])
+        for f in self.source.getFeatures(request):
+            if feedback is not None and feedback.isCanceled():
+                return None
+            row = self.row_for_feature_id.get(f.id())
+            if row is not None:
+                geometries[row] = f.geometry()
+        return geometries
+
+    def build_assignment(self, electorate_meshblocks: Dict[object, Iterable[int]]) -> (array, list):
+        """
+        Builds a compact assignment array from a dictionary of electorate id to
+        assigned meshblock numbers.
+
+        Electorates are allocated dense integer codes, and the returned array
+        contains the code of the assigned electorate for each row in the store
+        (or UNASSIGNED).
+        :param electorate_meshblocks: dictionary of electorate id to meshblock numbers
+        :returns: assignment array and list of electorate ids (indexed by code)
+        """
+        assignment = array('q', [self.UNASSIGNED]) * len(self.meshblock_numbers)
+        electorate_ids = []
+        for code, (electorate_id, meshblocks) in enumerate(electorate_meshblocks.items()):
+            electorate_ids.append(electorate_id)
+            for m in meshblocks:
+                assignment[self.row_for_meshblock[int(m)]] = code
+        return assignment, electorate_ids
+
+    def group_sum(self, values: array, assignment: array, group_count: int) -> array:
+        """
+        Sums a value column for each group in an assignment in a single pass
+        (analogous to a weighted bincount)
+        :param values: value column to sum, indexed by row
+        :param assignment: group code for each row
+        :param group_count: number of groups
+        """
+        sums = array('q', [0]) * group_count
+        for code, value in zip(assignment, values):
+            if code >= 0:
+                sums[code] += value
+        return sums
+
+    def electorate_populations(self, electorate_type: str, assignment: array,
+                               electorate_ids: List) -> Dict[object, int]:
+        """
+        Returns a dictionary of electorate id to offline population for a complete assignment
+        :param electorate_type: electorate type, e.g. 'GN', 'GS' or 'M'
+        :param assignment: assignment array, as returned by build_assignment
+        :param electorate_ids: electorate ids corresponding to assignment codes
+        """
+        sums = self.group_sum(self.populations[electorate_type], assignment, len(electorate_ids))
+        return {electorate_id: sums[code] for code, electorate_id in enumerate(electorate_ids)}
@@ -0,0 +1,546 @@
+# -*- coding: utf-8 -*-
+"""LINZ Redistricting Plugin - Meshblock boundary arc topology
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import threading
+from array import array
+from typing import (Dict,
+                    List,
+                    Optional,
+                    Tuple)
+from qgis.core import (QgsFeature,
+                       QgsFeatureRequest,
+                       QgsFeedback,
+                       QgsGeometry,
+                       QgsMessageLog,
+                       QgsPointXY,
+                       QgsRectangle,
+                       QgsSpatialIndex,
+                       QgsVectorLayer,
+                       NULL)
+from redistrict.linz.meshblock_store import MeshblockStore
+
+# an electorate boundary, as a list of arc ids and a flag indicating whether each arc is reversed
+ElectorateBoundary = List[Tuple[int, bool]]
+
+
+class MeshblockTopology:
+    """
+    A topology of the boundary arcs shared between meshblocks.
+
+    Each arc is a chain of vertices separating exactly two meshblocks (or a
+    meshblock and the outside of the coverage), oriented so that its "left"
+    meshblock lies to the left of the arc. An electorate's outline consists
+    of the arcs whose left and right meshblocks are assigned to different
+    electorates, so moving a meshblock between electorates only flips the
+    ownership of that meshblock's own arcs. Electorate geometries are then
+    reassembled by chaining their boundary arcs, without any polygon overlay.
+
+    The topology requires meshblocks to form a clean polygonal coverage, where
+    neighbouring meshblocks share identical vertices along their common edges.
+    Coverages with overlapping edges, T-junctions or mismatched vertices along
+    shared edges are detected when the topology is built, and the topology is
+    disabled for them. Boundaries which still can't be assembled into closed rings
+    are reported by assemble_boundary(), so that callers can fall back to
+    dissolving meshblocks.
+
+    Meshblock assignments are read from the meshblock layer's target field, and
+    are kept in sync with edits (including undo, redo and rollback of edits) via
+    the layer's attributeValueChanged signal. The assignments must be reset
+    after the target field is changed outside of the layer's edit buffer.
+    """
+
+    OUTSIDE = -1
+
+    # relative tolerance for vertices lying on a segment, as a fraction of the segment length
+    JUNCTION_TOLERANCE = 1e-7
+
+    def __init__(self, meshblock_store: MeshblockStore, meshblock_layer: QgsVectorLayer, target_field: str):
+        """
+        Constructor for MeshblockTopology
+        :param meshblock_store: meshblock store
+        :param meshblock_layer: meshblock layer
+        :param target_field: meshblock field containing assigned electorate
+        """
+        self.meshblock_store = meshblock_store
+        self.meshblock_layer = meshblock_layer
+        self.target_field = target_field
+        self.target_field_idx = meshblock_layer.fields().lookupField(target_field)
+        assert self.target_field_idx >= 0
+        self.lock = threading.Lock()
+
+        # flat x, y vertex coordinates for each arc
+        self.arc_points = None
+        # meshblock store rows on the left and right of each arc
+        self.arc_left = None
+        self.arc_right = None
+        # arc ids for each meshblock store row
+        self.meshblock_arcs = None
+        # False if the meshblocks do not form a valid coverage
+        self.valid = True
+
+        # assigned electorate for each meshblock store row
+        self.assignment = None
+        # boundary arc ids for each electorate
+        self.boundaries = None
+
+        self.meshblock_layer.attributeValueChanged.connect(self.attribute_value_changed)
+
+    def detach(self):
+        """
+        Stops tracking changes to the meshblock layer
+        """
+        self.meshblock_layer.attributeValueChanged.disconnect(self.attribute_value_changed)
+
+    def set_target_field(self, target_field: str):
+        """
+        Sets the meshblock field containing assigned electorates, e.g. after
+        the current task is changed
+        :param target_field: meshblock field name
+        """
+        self.target_field = target_field
+        self.target_field_idx = self.meshblock_layer.fields().lookupField(target_field)
+        assert self.target_field_idx >= 0
+        self.reset_assignment()
+
+    def reset_assignment(self):
+        """
+        Discards the current meshblock assignments, forcing them to be reloaded
+        from the meshblock layer when next required
+        """
+        self.assignment = None
+        self.boundaries = None
+
+    def is_built(self) -> bool:
+        """
+        Returns True if the arc topology has been built
+        """
+        return self.arc_points is not None
+
+    def is_available(self) -> bool:
+        """
+        Returns True if the topology can be used to assemble electorate boundaries,
+        loading the meshblock assignments if required. The topology must already
+        have been built.
+        """
+        return self.is_built() and self.valid and self.ensure_assignment_loaded()
+
+    def ensure_built(self, feedback: Optional[QgsFeedback] = None) -> bool:
+        """
+        Ensures that the arc topology has been built. This method is thread safe.
+        :param feedback: optional feedback object for cancellation
+        :returns: True if the topology is ready, False if it was canceled
+        """
+        with self.lock:
+            if self.arc_points is not None:
+                return True
+
+            if not self.meshblock_store.ensure_loaded(feedback):
+                return False
+
+            # geometries are only required while building, and are not retained
+            geometries = self.meshblock_store.all_geometries(feedback)
+            if geometries is None:
+                return False
+            return self.build(geometries, feedback)
+
+    @staticmethod
+    def signed_area(points: List[Tuple[float, float]]) -> float:
+        """
+        Returns the signed area of a closed ring, which is positive for counter-clockwise rings
+        :param points: ring vertices, with the first vertex repeated at the end
+        """
+        return sum(x0 * y1 - x1 * y0 for (x0, y0), (x1, y1) in zip(points, points[1:])) / 2
+
+    @staticmethod
+    def oriented_rings(geometry: QgsGeometry) -> List[List[Tuple[float, float]]]:
+        """
+        Returns the rings of a polygon geometry, oriented so that the polygon's
+        interior lies to the left of every ring
+        :param geometry: polygon or multipolygon geometry
+        """
+        if geometry is None or geometry.isNull() or geometry.isEmpty():
+            return []
+
+        polygons = geometry.asMultiPolygon() if geometry.isMultipart() else [geometry.asPolygon()]
+        rings = []
+        for polygon in polygons:
+            for ring_index, ring in enumerate(polygon):
+                points = []
+                for p in ring:
+                    point = (p.x(), p.y())
+                    if not points or points[-1] != point:
+                        points.append(point)
+                if len(points) < 4 or points[0] != points[-1]:
+                    continue
+                area = MeshblockTopology.signed_area(points)
+                if area == 0:
+                    continue
+                # exterior rings must be counter-clockwise, interior rings clockwise
+                if (ring_index == 0) != (area > 0):
+                    points.reverse()
+                rings.append(points)
+        return rings
+
+    def build(self, geometries: List[QgsGeometry], feedback: Optional[QgsFeedback] = None) -> bool:  # pylint: disable=too-many-locals,too-many-branches
+        """
+        Builds the arc topology from the meshblock geometries
+        :param geometries: meshblock geometries, indexed by meshblock store row
+        :param feedback: optional feedback object for cancellation
+        :returns: True if the topology was built, False if it was canceled
+        """
+        meshblock_count = len(geometries)
+
+        # first pass - find the meshblocks on either side of each segment
+        rings = []
+        segment_owners = {}
+        for row, geometry in enumerate(geometries):
+            if feedback is not None and feedback.isCanceled():
+                return False
+            for points in self.oriented_rings(geometry):
+                rings.append((row, points))
+                for a, b in zip(points, points[1:]):
+                    key = (a, b) if a < b else (b, a)
+                    if key in segment_owners:
+                        segment_owners[key].append(row)
+                    else:
+                        segment_owners[key] = [row]
+
+        valid = all(len(owners) <= 2 for owners in segment_owners.values())
+        if valid:
+            has_junctions = self.has_unmatched_junctions(segment_owners, feedback)
+            if has_junctions is None:
+                return False
+            valid = not has_junctions
+
+        # second pass - split each ring into runs of segments shared with the same neighbour
+        arc_points = []
+        arc_left = array('q')
+        arc_right = array('q')
+        meshblock_arcs = [[] for _ in range(meshblock_count)]
+        for row, points in rings:
+            if feedback is not None and feedback.isCanceled():
+                return False
+
+            segment_count = len(points) - 1
+            neighbours = []
+            for a, b in zip(points, points[1:]):
+                owners = segment_owners[(a, b) if a < b else (b, a)]
+                others = [o for o in owners if o != row]
+                neighbours.append(others[0] if others else (row if len(owners) > 1 else self.OUTSIDE))
+
+            # start at a change of neighbour, so that runs don't wrap around the ring's closing vertex
+            start = next((i for i in range(segment_count) if neighbours[i] != neighbours[i - 1]), 0)
+            i = 0
+            while i < segment_count:
+                neighbour = neighbours[(start + i) % segment_count]
+                run_start = i
+                while i < segment_count and neighbours[(start + i) % segment_count] == neighbour:
+                    i += 1
+                # shared arcs are recorded once, from the side of the lower row. Arcs
+                # within a single meshblock can never form part of a boundary.
+                if neighbour == row or self.OUTSIDE < neighbour < row:
+                    continue
+
+                arc_id = len(arc_points)
+                coordinates = array('d')
+                for k in range(run_start, i + 1):
+                    coordinates.extend(points[(start + k) % segment_count])
+                arc_points.append(coordinates)
+                arc_left.append(row)
+                arc_right.append(neighbour)
+                meshblock_arcs[row].append(arc_id)
+                if neighbour != self.OUTSIDE:
+                    meshblock_arcs[neighbour].append(arc_id)
+
+        if not valid:
+            QgsMessageLog.logMessage('Meshblocks do not form a valid coverage, boundary arc topology disabled',
+                                     "REDISTRICT")
+
+        self.meshblock_arcs = meshblock_arcs
+        self.arc_left = arc_left
+        self.arc_right = arc_right
+        self.valid = valid
+        self.arc_points = arc_points
+        return True
+
+    @staticmethod
+    def point_on_segment(point: Tuple[float, float], start: Tuple[float, float], end: Tuple[float, float]) -> bool:
+        """
+        Returns True if a point lies on a segment, excluding the segment's end points
+        :param point: point to test
+        :param start: segment start
+        :param end: segment end
+        """
+        if point in (start, end):
+            return False
+        dx = end[0] - start[0]
+        dy = end[1] - start[1]
+        length_squared = dx * dx + dy * dy
+        if length_squared == 0:
+            return False
+        cross = dx * (point[1] - start[1]) - dy * (point[0] - start[0])
+        if cross * cross > MeshblockTopology.JUNCTION_TOLERANCE ** 2 * length_squared * length_squared:
+            return False
+        dot = dx * (point[0] - start[0]) + dy * (point[1] - start[1])
+        return 0 < dot < length_squared
+
+    @staticmethod
+    def has_unmatched_junctions(segment_owners: Dict[tuple, List[int]],
+                                feedback: Optional[QgsFeedback] = None) -> Optional[bool]:
+        """
+        Returns True if any segment which is not shared with a neighbouring meshblock
+        has a vertex of another meshblock lying along it. This indicates a T-junction
+        or mismatched vertices along a common edge, where the meshblocks are neighbours
+        but don't share identical segments. In a clean coverage, unshared segments
+        only occur along the outside of the coverage.
+        :param segment_owners: dictionary of segment to meshblock store rows containing the segment
+        :param feedback: optional feedback object for cancellation
+        :returns: True if junctions were found, or None if canceled
+        """
+        unmatched = [(segment, owners[0]) for segment, owners in segment_owners.items() if len(owners) == 1]
+
+        index = QgsSpatialIndex()
+        vertex_owners = {}
+        for i, ((a, b), owner) in enumerate(unmatched):
+            f = QgsFeature(i)
+            f.setGeometry(QgsGeometry.fromPolylineXY([QgsPointXY(*a), QgsPointXY(*b)]))
+            index.insertFeature(f)
+            for vertex in (a, b):
+                if vertex in vertex_owners:
+                    vertex_owners[vertex].add(owner)
+                else:
+                    vertex_owners[vertex] = {owner}
+
+        for vertex, owners in vertex_owners.items():
+            if feedback is not None and feedback.isCanceled():
+                return None
+            for candidate in index.intersects(QgsRectangle(vertex[0], vertex[1], vertex[0], vertex[1])):
+                (a, b), owner = unmatched[candidate]
+                if owners != {owner} and MeshblockTopology.point_on_segment(vertex, a, b):
+                    return True
+        return False
+
+    def arc_count(self) -> int:
+        """
+        Returns the number of arcs in the topology
+        """
+        return len(self.arc_points) if self.arc_points is not None else 0
+
+    def ensure_assignment_loaded(self) -> bool:
+        """
+        Ensures that the meshblock assignments have been loaded from the meshblock layer
+        """
+        if self.assignment is not None:
+            return True
+        if not self.is_built():
+            return False
+
+        assignment = [None] * self.meshblock_store.meshblock_count()
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([self.target_field_idx])
+        for f in self.meshblock_layer.getFeatures(request):
+            row = self.meshblock_store.row_for_feature_id.get(f.id())
+            if row is None:
+                continue
+            electorate = f[self.target_field_idx]
+            assignment[row] = None if electorate == NULL else electorate
+
+        boundaries = {}
+        for arc_id in range(len(self.arc_points)):
+            self._add_boundary_arc(arc_id, assignment, boundaries)
+
+        self.assignment = assignment
+        self.boundaries = boundaries
+        return True
+
+    def _arc_electorates(self, arc_id: int, assignment: List) -> Tuple[object, object]:
+        """
+        Returns the electorates on the left and right of an arc
+        :param arc_id: arc id
+        :param assignment: meshblock assignments
+        """
+        right = self.arc_right[arc_id]
+        return assignment[self.arc_left[arc_id]], assignment[right] if right != self.OUTSIDE else None
+
+    def _add_boundary_arc(self, arc_id: int, assignment: List, boundaries: Dict[object, set]):
+        """
+        Adds an arc to the boundaries of the electorates it separates
+        """
+        left, right = self._arc_electorates(arc_id, assignment)
+        if left == right:
+            return
+        for electorate in (left, right):
+            if electorate is None:
+                continue
+            if electorate in boundaries:
+                boundaries[electorate].add(arc_id)
+            else:
+                boundaries[electorate] = {arc_id}
+
+    def _remove_boundary_arc(self, arc_id: int, assignment: List, boundaries: Dict[object, set]):
+        """
+        Removes an arc from the boundaries of the electorates it separates
+        """
+        left, right = self._arc_electorates(arc_id, assignment)
+        if left == right:
+            return
+        for electorate in (left, right):
+            if electorate is not None and electorate in boundaries:
+                boundaries[electorate].discard(arc_id)
+
+    def assign_meshblock(self, row: int, electorate):
+        """
+        Assigns a meshblock to an electorate, updating the boundaries of the affected
+        electorates. The cost is proportional to the number of arcs of the meshblock.
+        :param row: meshblock store row
+        :param electorate: new electorate, or None for unassigned
+        """
+        if self.assignment is None or self.assignment[row] == electorate:
+            return
+
+        arcs = self.meshblock_arcs[row]
+        for arc_id in arcs:
+            self._remove_boundary_arc(arc_id, self.assignment, self.boundaries)
+        self.assignment[row] = electorate
+        for arc_id in arcs:
+            self._add_boundary_arc(arc_id, self.assignment, self.boundaries)
+
+    def attribute_value_changed(self, feature_id: int, field_index: int, value):
+        """
+        Triggered when an attribute value in the meshblock layer changes
+        :param feature_id: meshblock feature id
+        :param field_index: changed field index
+        :param value: new value
+        """
+        if field_index != self.target_field_idx or self.assignment is None:
+            return
+
+        row = self.meshblock_store.row_for_feature_id.get(feature_id)
+        if row is None:
+            return
+        self.assign_meshblock(row, None if value is None or value == NULL else value)
+
+    def electorate_boundary(self, electorate) -> ElectorateBoundary:
+        """
+        Returns the boundary arcs for an electorate, oriented so that the electorate
+        lies to the left of each arc. The returned boundary is a snapshot, which can be
+        assembled by assemble_boundary() from a background thread.
+        :param electorate: electorate id
+        """
+        if not self.is_available():
+            return []
+
+        return [(arc_id, self.assignment[self.arc_left[arc_id]] != electorate) for arc_id in
+                self.boundaries.get(electorate, set())]
+
+    def arc_vertices(self, arc_id: int, reverse: bool) -> List[Tuple[float, float]]:
+        """
+        Returns the vertices of an arc
+        :param arc_id: arc id
+        :param reverse: set to True to return the vertices in reverse order
+        """
+        coordinates = self.arc_points[arc_id]
+        vertices = list(zip(coordinates[::2], coordinates[1::2]))
+        if reverse:
+            vertices.reverse()
+        return vertices
+
+    @staticmethod
+    def contains_point(ring: List[Tuple[float, float]], point: Tuple[float, float]) -> bool:
+        """
+        Returns True if a point lies inside a ring
+        :param ring: closed ring vertices
+        :param point: point to test
+        """
+        x, y = point
+        inside = False
+        for (x0, y0), (x1, y1) in zip(ring, ring[1:]):
+            if (y0 > y) != (y1 > y) and x < (x1 - x0) * (y - y0) / (y1 - y0) + x0:
+                inside = not inside
+        return inside
+
+    def assemble_boundary(self, boundary: ElectorateBoundary) -> Optional[QgsGeometry]:
+        """
+        Assembles an electorate geometry by chaining its boundary arcs into rings.
+        The cost is proportional to the number of boundary vertices. This method
+        is thread safe.
+        :param boundary: electorate boundary, as returned by electorate_boundary()
+        :returns: assembled geometry, or None if the arcs could not be assembled into
+        a valid polygon (e.g. a ring doesn't close, or a hole lies outside of all exterior
+        rings). In this case the geometry must be calculated by dissolving meshblocks instead.
+        """
+        # arcs by start vertex
+        arcs_by_start = {}
+        for arc_id, reverse in boundary:
+            vertices = self.arc_vertices(arc_id, reverse)
+            if vertices[0] in arcs_by_start:
+                arcs_by_start[vertices[0]].append(vertices)
+            else:
+                arcs_by_start[vertices[0]] = [vertices]
+
+        exteriors = []
+        holes = []
+        while arcs_by_start:
+            start = next(iter(arcs_by_start))
+            ring = self._pop_arc(arcs_by_start, start)
+            while ring[-1] != ring[0] and ring[-1] in arcs_by_start:
+                ring.extend(self._pop_arc(arcs_by_start, ring[-1])[1:])
+            if ring[-1] != ring[0] or len(ring) < 4:
+                # not a closed ring - the topology doesn't match the meshblock assignments
+                return None
+            # electorate lies to the left, so exteriors are counter-clockwise and holes are clockwise
+            if self.signed_area(ring) > 0:
+                exteriors.append(ring)
+            else:
+                holes.append(ring)
+
+        if not exteriors:
+            return None if holes else QgsGeometry()
+
+        polygons = [[exterior] for exterior in exteriors]
+        areas = [self.signed_area(exterior) for exterior in exteriors]
+        for hole in holes:
+            # use the midpoint of the first segment, as holes may touch their exterior at a vertex
+            point = ((hole[0][0] + hole[1][0]) / 2, (hole[0][1] + hole[1][1]) / 2)
+            containing = [i for i, exterior in enumerate(exteriors) if self.contains_point(exterior, point)]
+            if not containing:
+                # orphaned hole
+                return None
+            polygons[min(containing, key=lambda i: areas[i])].append(hole)
+
+        polygons = [[[QgsPointXY(x, y) for x, y in ring] for ring in polygon] for polygon in polygons]
+        if len(polygons) == 1:
+            return QgsGeometry.fromPolygonXY(polygons[0])
+        return QgsGeometry.fromMultiPolygonXY(polygons)
+
+    @staticmethod
+    def _pop_arc(arcs_by_start: dict, start: Tuple[float, float]) -> List[Tuple[float, float]]:
+        """
+        Removes and returns an arc starting at a vertex
+        """
+        arcs = arcs_by_start[start]
+        vertices = arcs.pop()
+        if not arcs:
+            del arcs_by_start[start]
+        return list(vertices)
+
+    def electorate_geometry(self, electorate) -> Optional[QgsGeometry]:
+        """
+        Assembles the current geometry for an electorate from its boundary arcs
+        :param electorate: electorate id
+        :returns: assembled geometry, or None if the boundary could not be assembled
+        """
+        return self.assemble_boundary(self.electorate_boundary(electorate))
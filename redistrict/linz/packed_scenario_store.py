@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+"""LINZ Redistricting Plugin - Packed scenario assignment store
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import sqlite3
+import sys
+import threading
+from array import array
+from collections import OrderedDict
+from typing import (Dict,
+                    Iterable,
+                    List,
+                    Optional)
+from qgis.core import (QgsMessageLog,
+                       QgsTask,
+                       QgsVectorLayerFeatureSource)
+from redistrict.linz.db_utils import DbUtils
+
+
+class PackedScenario:
+    """
+    The complete meshblock assignments for a scenario, as read from a PackedScenarioStore.
+
+    Assignments for each electorate type are held as an array of electorate ids,
+    indexed by the meshblock's position in the store's meshblock index.
+    """
+
+    def __init__(self, scenario_id, meshblock_numbers: array, assignments: Dict[str, object]):
+        """
+        Constructor for PackedScenario
+        :param scenario_id: scenario id
+        :param meshblock_numbers: meshblock number for each index position
+        :param assignments: dictionary of electorate type to array of electorate ids
+        """
+        self.scenario_id = scenario_id
+        self.meshblock_numbers = meshblock_numbers
+        self.assignments = assignments
+
+    def electorate_meshblocks(self, electorate_type: str) -> Dict[int, List[int]]:
+        """
+        Returns a dictionary of electorate id to assigned meshblock numbers
+        :param electorate_type: electorate type, e.g. 'GN','GS','M'
+        """
+        result = OrderedDict()
+        values = self.assignments.get(electorate_type)
+        if values is None:
+            return result
+        for meshblock_number, electorate_id in zip(self.meshblock_numbers, values):
+            if electorate_id == PackedScenarioStore.UNASSIGNED:
+                continue
+            if electorate_id not in result:
+                result[electorate_id] = []
+            result[electorate_id].append(meshblock_number)
+        return result
+
+
+class PackedScenarioStore:
+    """
+    A compact, per-scenario store of meshblock assignments.
+
+    Instead of one record per meshblock per scenario, each scenario is stored as a
+    single row containing a packed array of electorate ids for each electorate type.
+    Arrays are ordered by a stable meshblock index table, where each meshblock is
+    allocated a position when first encountered and positions are never reused.
+    Loading a complete scenario is then a single row read, with the packed arrays
+    exposed as views over the stored blobs without copying.
+
+    Packed scenarios are a read cache of the meshblock electorates table, which
+    remains the authoritative source of assignments. Packed copies must be
+    invalidated whenever a scenario's records are changed.
+
+    The store does not reduce the size of the database. The meshblock electorates
+    rows are still required by the per-meshblock and SQL based readers (meshblock
+    edits, staged electorate updates, branching, delta scenarios and imports), and
+    each packed copy adds roughly 12 bytes per meshblock on top of them. In exchange,
+    a whole scenario can be loaded with a single row read. The cache can be discarded
+    at any time with clear().
+    """
+
+    INDEX_TABLE_NAME = 'meshblock_index'
+    TABLE_NAME = 'packed_scenarios'
+
+    ELECTORATE_TYPES = ('GN', 'GS', 'M')
+
+    # stored in place of an electorate id for meshblocks without an assignment
+    UNASSIGNED = -1
+
+    # packed arrays are stored as little-endian 32 bit signed integers
+    TYPE_CODE = 'i'
+
+    def __init__(self, database_path: str):
+        """
+        Constructor for PackedScenarioStore
+        :param database_path: path to GeoPackage database to store packed scenarios within
+        """
+        self.database_path = database_path
+        self.lock = threading.Lock()
+        self.tables_ready = False
+        # the meshblock index is append-only, so can be safely cached
+        self.index_cache = array('q')
+
+    @staticmethod
+    def pack(electorate_ids: Iterable[int]) -> bytes:
+        """
+        Packs a sequence of integer electorate ids into a blob
+        :param electorate_ids: electorate ids, or UNASSIGNED
+        """
+        values = array(PackedScenarioStore.TYPE_CODE, electorate_ids)
+        assert values.itemsize == 4
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return values.tobytes()
+
+    @staticmethod
+    def unpack(blob: bytes):
+        """
+        Unpacks a blob created by pack(). On little-endian platforms the returned
+        sequence is a read-only view over the blob, so no copy of the data is made.
+        :param blob: packed blob
+        """
+        if sys.byteorder != 'little':
+            values = array(PackedScenarioStore.TYPE_CODE)
+            values.frombytes(blob)
+            values.byteswap()
+            return values
+        return memoryview(blob).cast(PackedScenarioStore.TYPE_CODE)
+
+    @staticmethod
+    def column_for_type(electorate_type: str) -> str:
+        """
+        Returns the packed blob column for an electorate type
+        :param electorate_type: electorate type, e.g. 'GN','GS','M'
+        """
+        return '{}_ids'.format(electorate_type.lower())
+
+    def _ensure_tables(self, connection: sqlite3.Connection):
+        """
+        Creates the meshblock index and packed scenario tables, if they do not already exist
+        :param connection: database connection
+        """
+        if self.tables_ready:
+            return
+
+        connection.execute('CREATE TABLE IF NOT EXISTS {} ('
+                           'idx INTEGER NOT NULL PRIMARY KEY, '
+                           'meshblock_number INTEGER NOT NULL UNIQUE)'.format(self.INDEX_TABLE_NAME))
+        connection.execute('CREATE TABLE IF NOT EXISTS {} ('
+                           'scenario_id INTEGER NOT NULL PRIMARY KEY, '
+                           'meshblock_count INTEGER NOT NULL, '
+                           '{})'.format(self.TABLE_NAME,
+                                        ', '.join('{} BLOB'.format(self.column_for_type(t))
+                                                  for t in self.ELECTORATE_TYPES)))
+        connection.commit()
+        self.tables_ready = True
+
+    def _meshblock_index(self, connection: sqlite3.Connection) -> array:
+        """
+        Returns the meshblock number for each position in the meshblock index
+        :param connection: database connection
+        """
+        self.index_cache = array('q', (r[0] for r in connection.execute(
+            'SELECT meshblock_number FROM {} ORDER BY idx'.format(self.INDEX_TABLE_NAME))))
+        return array('q', self.index_cache)
+
+    def _extend_meshblock_index(self, connection: sqlite3.Connection, meshblock_numbers: Iterable[int]) -> array:
+        """
+        Appends any meshblocks not already present to the meshblock index. Existing
+        positions are never changed.
+        :param connection: database connection
+        :param meshblock_numbers: meshblock numbers which must be present in the index
+        :returns: updated meshblock index
+        """
+        index = self._meshblock_index(connection)
+        existing = set(index)
+        new_meshblocks = sorted({int(m) for m in meshblock_numbers} - existing)
+        if new_meshblocks:
+            connection.executemany('INSERT INTO {} (idx, meshblock_number) VALUES (?, ?)'.format(
+                self.INDEX_TABLE_NAME), ((len(index) + i, m) for i, m in enumerate(new_meshblocks)))
+            index.extend(new_meshblocks)
+        return index
+
+    def meshblock_index(self) -> array:
+        """
+        Returns the meshblock number for each position in the meshblock index
+        """
+        with self.lock:
+            try:
+                connection = DbUtils.connect(self.database_path)
+                try:
+                    self._ensure_tables(connection)
+                    return self._meshblock_index(connection)
+                finally:
+                    connection.close()
+            except sqlite3.Error as e:
+                QgsMessageLog.logMessage('Could not read meshblock index: {}'.format(e), "REDISTRICT")
+                return array('q')
+
+    def write_scenario(self, scenario_id, assignments: Dict[str, Dict[int, int]]) -> bool:
+        """
+        Writes the packed assignments for a scenario, replacing any existing packed copy
+        :param scenario_id: scenario id
+        :param assignments: dictionary of electorate type to dictionary of meshblock
+        number to integer electorate id
+        :returns: True if scenario was successfully written
+        """
+        with self.lock:
+            try:
+                connection = DbUtils.connect(self.database_path)
+                try:
+                    self._ensure_tables(connection)
+                    meshblocks = set()
+                    for type_assignments in assignments.values():
+                        meshblocks.update(type_assignments.keys())
+                    index = self._extend_meshblock_index(connection, meshblocks)
+
+                    blobs = []
+                    for electorate_type in self.ELECTORATE_TYPES:
+                        type_assignments = assignments.get(electorate_type)
+                        if type_assignments is None:
+                            blobs.append(None)
+                            continue
+                        blobs.append(self.pack(type_assignments.get(m, self.UNASSIGNED) for m in index))
+
+                    connection.execute('INSERT OR REPLACE INTO {} (scenario_id, meshblock_count, {}) '
+                                       'VALUES (?, ?, {})'.format(self.TABLE_NAME,
+                                                                  ', '.join(self.column_for_type(t) for t in
+                                                                            self.ELECTORATE_TYPES),
+                                                                  ', '.join('?' for _ in self.ELECTORATE_TYPES)),
+                                       [scenario_id, len(index)] + blobs)
+                    connection.commit()
+                finally:
+                    connection.close()
+            except (sqlite3.Error, OverflowError) as e:
+                QgsMessageLog.logMessage('Could not write packed scenario {}: {}'.format(scenario_id, e), "REDISTRICT")
+                return False
+
+        return True
+
+    def read_scenario(self, scenario_id, electorate_types: Optional[List[str]] = None) -> Optional[PackedScenario]:
+        """
+        Reads the packed assignments for a scenario
+        :param scenario_id: scenario id
+        :param electorate_types: list of electorate types to read. If not set, all types will be read.
+        :returns: packed scenario, or None if no packed copy of the scenario exists
+        """
+        if electorate_types is None:
+            electorate_types = self.ELECTORATE_TYPES
+
+        with self.lock:
+            try:
+                connection = DbUtils.connect(self.database_path)
+                try:
+                    self._ensure_tables(connection)
+                    row = connection.execute('SELECT meshblock_count, {} FROM {} WHERE scenario_id=?'.format(
+                        ', '.join(self.column_for_type(t) for t in electorate_types), self.TABLE_NAME),
+                                             (scenario_id,)).fetchone()
+                    if row is None:
+                        return None
+                    index = self.index_cache
+                    if len(index) < row[0]:
+                        index = self._meshblock_index(connection)
+                finally:
+                    connection.close()
+            except sqlite3.Error as e:
+                QgsMessageLog.logMessage('Could not read packed scenario {}: {}'.format(scenario_id, e), "REDISTRICT")
+                return None
+
+        # meshblocks appended to the index after the scenario was packed are unassigned
+        # in the scenario, so only the first meshblock_count index entries are required
+        meshblock_numbers = index[:row[0]]
+        assignments = {}
+        for electorate_type, blob in zip(electorate_types, row[1:]):
+            if blob is not None:
+                assignments[electorate_type] = self.unpack(blob)
+        return PackedScenario(scenario_id, meshblock_numbers, assignments)
+
+    def packed_scenarios(self) -> List[int]:
+        """
+        Returns a list of scenario ids with a packed copy in the store
+        """
+        with self.lock:
+            try:
+                connection = DbUtils.connect(self.database_path)
+                try:
+                    self._ensure_tables(connection)
+                    return [r[0] for r in connection.execute(
+                        'SELECT scenario_id FROM {} ORDER BY scenario_id'.format(self.TABLE_NAME))]
+                finally:
+                    connection.close()
+            except sqlite3.Error as e:
+                QgsMessageLog.logMessage('Could not read packed scenarios: {}'.format(e), "REDISTRICT")
+                return []
+
+    def remove_scenario(self, scenario_id):
+        """
+        Removes the packed copy of a scenario, e.g. after the scenario's records have changed
+        :param scenario_id: scenario id
+        """
+        with self.lock:
+            try:
+                connection = DbUtils.connect(self.database_path)
+                try:
+                    self._ensure_tables(connection)
+                    connection.execute('DELETE FROM {} WHERE scenario_id=?'.format(self.TABLE_NAME), (scenario_id,))
+                    connection.commit()
+                finally:
+                    connection.close()
+            except sqlite3.Error as e:
+                QgsMessageLog.logMessage('Could not remove packed scenario {}: {}'.format(scenario_id, e),
+                                         "REDISTRICT")
+
+    def clear(self):
+        """
+        Removes all packed scenarios and the meshblock index from the store
+        """
+        with self.lock:
+            try:
+                connection = DbUtils.connect(self.database_path)
+                try:
+                    connection.execute('DROP TABLE IF EXISTS {}'.format(self.TABLE_NAME))
+                    connection.execute('DROP TABLE IF EXISTS {}'.format(self.INDEX_TABLE_NAME))
+                    connection.commit()
+                finally:
+                    connection.close()
+                self.tables_ready = False
+                self.index_cache = array('q')
+            except sqlite3.Error as e:
+                QgsMessageLog.logMessage('Could not clear packed scenarios: {}'.format(e), "REDISTRICT")
+
+
+class PackScenariosTask(QgsTask):
+    """
+    A background task for writing packed copies of scenarios
+    """
+
+    def __init__(self, task_name: str, scenario_registry, scenario_ids: List[int]):
+        """
+        Constructor for PackScenariosTask
+        :param task_name: user-visible, translated name for task
+        :param scenario_registry: scenario registry, with a packed scenario store set
+        :param scenario_ids: scenarios to pack
+        """
+        super().__init__(task_name)
+        assert scenario_registry.packed_store is not None
+        self.scenario_registry = scenario_registry
+        self.scenario_ids = scenario_ids
+        # scenarios edited while the task is running must not be packed
+        self.scenario_versions = {s: scenario_registry.packed_version(s) for s in scenario_ids}
+        self.assignments = {}
+        self.packed_scenarios = []
+        self.skipped_scenarios = []
+
+        self.meshblock_electorate_source = QgsVectorLayerFeatureSource(scenario_registry.meshblock_electorate_layer)
+
+    def run(self):  # pylint: disable=missing-docstring
+        for i, scenario_id in enumerate(self.scenario_ids):
+            if self.isCanceled():
+                return False
+            self.setProgress(100 * i / len(self.scenario_ids))
+            assignments = self.scenario_registry.packable_assignments(scenario_id,
+                                                                      source=self.meshblock_electorate_source)
+            if assignments is None:
+                # e.g. scenarios with non-integer electorate ids can't be packed
+                self.skipped_scenarios.append(scenario_id)
+                continue
+            self.assignments[scenario_id] = assignments
+
+        self.setProgress(100)
+        return True
+
+    def finished(self, result: bool):  # pylint: disable=missing-docstring
+        if not result:
+            return
+
+        for scenario_id, assignments in self.assignments.items():
+            if self.scenario_registry.packed_version(scenario_id) != self.scenario_versions[scenario_id]:
+                self.skipped_scenarios.append(scenario_id)
+                continue
+            if self.scenario_registry.packed_store.write_scenario(scenario_id, assignments):
+                self.packed_scenarios.append(scenario_id)
+            else:
+                self.skipped_scenarios.append(scenario_id)
@@ -28,6 +28,7 @@ from qgis.gui import (QgsDockWidget,
 from qgis.utils import iface
 from redistrict.gui.district_selection_dialog import DistrictPicker
 from redistrict.linz.linz_district_registry import LinzElectoralDistrictRegistry
+from redistrict.linz.staged_electorate_update_task import UpdateStagedElectoratesTask
 
 
 class SelectedPopulationDockWidget(QgsDockWidget):
@@ -61,6 +62,7 @@ class SelectedPopulationDockWidget(QgsDockWidget):
         self.district_registry = None
         self.target_electorate = None
         self.quota = 0
+        self.population_ledger = None
 
     def reset(self):
         """
@@ -97,6 +99,15 @@ class SelectedPopulationDockWidget(QgsDockWidget):
 
         self.selection_changed()
 
+    def set_population_ledger(self, ledger):
+        """
+        Sets the population ledger to use for electorate and meshblock populations.
+        If not set, populations are read from the electorate and meshblock layers.
+        :param ledger: population ledger
+        """
+        self.population_ledger = ledger
+        self.selection_changed()
+
     def selection_changed(self):
         """
         Triggered when the selection in the meshblock layer changes
@@ -107,10 +118,15 @@ class SelectedPopulationDockWidget(QgsDockWidget):
         request = QgsFeatureRequest().setFilterFids(self.meshblock_layer.selectedFeatureIds()).setFlags(
             QgsFeatureRequest.NoGeometry)
 
+        staged_electorate_field = UpdateStagedElectoratesTask.staged_field_for_task(self.meshblock_layer, self.task)
+        if self.population_ledger is not None:
+            request.setSubsetOfAttributes([staged_electorate_field], self.meshblock_layer.fields())
         counts = defaultdict(int)
         for f in self.meshblock_layer.getFeatures(request):
-            electorate = f['staged_electorate']
-            if self.task == 'GN':
+            electorate = f[staged_electorate_field]
+            if self.population_ledger is not None:
+                pop = self.population_ledger.meshblock_population(f.id())
+            elif self.task == 'GN':
                 pop = f['offline_pop_gn']
             elif self.task == 'GS':
                 pop = f['offline_pop_gs']
@@ -121,18 +137,21 @@ class SelectedPopulationDockWidget(QgsDockWidget):
         html = """<h3>Target Electorate: <a href="#">{}</a></h3><p>""".format(
             self.district_registry.get_district_title(self.target_electorate))
 
-        request = QgsFeatureRequest()
-        request.setFilterExpression(QgsExpression.createFieldEqualityExpression('type', self.task))
-        request.setFlags(QgsFeatureRequest.NoGeometry)
-        request.setSubsetOfAttributes(['electorate_id', 'estimated_pop', 'stats_nz_pop'],
-                                      self.district_registry.source_layer.fields())
-        original_populations = {}
-        for f in self.district_registry.source_layer.getFeatures(request):
-            estimated_pop = f['stats_nz_pop']
-            if estimated_pop is None or estimated_pop == NULL:
-                # otherwise just use existing estimated pop as starting point
-                estimated_pop = f['estimated_pop']
-            original_populations[f['electorate_id']] = estimated_pop
+        if self.population_ledger is not None:
+            original_populations = self.population_ledger.electorate_populations()
+        else:
+            request = QgsFeatureRequest()
+            request.setFilterExpression(QgsExpression.createFieldEqualityExpression('type', self.task))
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+            request.setSubsetOfAttributes(['electorate_id', 'estimated_pop', 'stats_nz_pop'],
+                                          self.district_registry.source_layer.fields())
+            original_populations = {}
+            for f in self.district_registry.source_layer.getFeatures(request):
+                estimated_pop = f['stats_nz_pop']
+                if estimated_pop is None or estimated_pop == NULL:
+                    # otherwise just use existing estimated pop as starting point
+                    estimated_pop = f['estimated_pop']
+                original_populations[f['electorate_id']] = estimated_pop
 
         overall = 0
         for electorate, pop in counts.items():
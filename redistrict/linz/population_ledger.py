@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""LINZ Redistricting Plugin - Live electorate population ledger
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+from typing import (Dict,
+                    Iterable,
+                    List,
+                    Tuple)
+from qgis.core import (QgsExpression,
+                       QgsFeatureRequest,
+                       QgsVectorLayer,
+                       NULL)
+from redistrict.linz.meshblock_store import MeshblockStore
+
+# a single meshblock reassignment, as a tuple of meshblock feature id, previous electorate and new electorate
+MeshblockMove = Tuple[int, object, object]
+
+
+class PopulationLedger:
+    """
+    A running tally of the estimated population of each electorate for a task.
+
+    The ledger is initialized from the electorate layer, and then updated
+    in-memory as meshblocks are moved between electorates (including when
+    moves are undone or redone), using the offline meshblock populations
+    from a MeshblockStore. This allows electorate populations to be read
+    during editing without any provider requests.
+    """
+
+    def __init__(self, electorate_layer: QgsVectorLayer, electorate_layer_field: str,
+                 meshblock_store: MeshblockStore, task: str):
+        """
+        Constructor for PopulationLedger
+        :param electorate_layer: electorate layer
+        :param electorate_layer_field: electorate id field in electorate layer
+        :param meshblock_store: meshblock store, used for meshblock populations
+        :param task: current task, e.g. 'GN','GS' or 'M'
+        """
+        self.electorate_layer = electorate_layer
+        self.electorate_layer_field = electorate_layer_field
+        self.meshblock_store = meshblock_store
+        self.task = task
+
+        self.electorate_id_idx = electorate_layer.fields().lookupField(electorate_layer_field)
+        assert self.electorate_id_idx >= 0
+        self.estimated_pop_idx = electorate_layer.fields().lookupField('estimated_pop')
+        assert self.estimated_pop_idx >= 0
+        self.stats_nz_pop_idx = electorate_layer.fields().lookupField('stats_nz_pop')
+        assert self.stats_nz_pop_idx >= 0
+        # type is optional - if missing, all electorates are loaded
+        self.type_idx = electorate_layer.fields().lookupField('type')
+
+        self.populations = None
+
+    def reset(self):
+        """
+        Discards the current populations, forcing them to be reloaded from the electorate
+        layer when next required. Must be called after the electorate populations are
+        changed outside of the ledger.
+        """
+        self.populations = None
+
+    def ensure_loaded(self):
+        """
+        Ensures that the initial electorate populations have been loaded
+        """
+        if self.populations is not None:
+            return
+
+        self.meshblock_store.ensure_loaded()
+
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        attributes = [self.electorate_id_idx, self.estimated_pop_idx, self.stats_nz_pop_idx]
+        if self.type_idx >= 0:
+            request.setFilterExpression(QgsExpression.createFieldEqualityExpression('type', self.task))
+            attributes.append(self.type_idx)
+        request.setSubsetOfAttributes(attributes)
+
+        self.populations = {}
+        for f in self.electorate_layer.getFeatures(request):
+            # use stats nz pop as initial estimate, if available
+            estimated_pop = f[self.stats_nz_pop_idx]
+            if estimated_pop is None or estimated_pop == NULL:
+                # otherwise just use existing estimated pop as starting point
+                estimated_pop = f[self.estimated_pop_idx]
+            if estimated_pop is None or estimated_pop == NULL:
+                estimated_pop = 0
+            self.populations[f[self.electorate_id_idx]] = estimated_pop
+
+    def population(self, electorate_id) -> int:
+        """
+        Returns the current estimated population for an electorate
+        :param electorate_id: electorate id
+        """
+        self.ensure_loaded()
+        return self.populations.get(electorate_id, 0)
+
+    def electorate_populations(self) -> Dict[object, int]:
+        """
+        Returns a dictionary of electorate id to current estimated population
+        """
+        self.ensure_loaded()
+        return dict(self.populations)
+
+    def meshblock_population(self, meshblock_feature_id: int) -> int:
+        """
+        Returns the offline population for a meshblock, for the ledger's task
+        :param meshblock_feature_id: meshblock feature id
+        """
+        self.ensure_loaded()
+        row = self.meshblock_store.row_for_feature_id.get(meshblock_feature_id)
+        if row is None:
+            return 0
+        return self.meshblock_store.populations[self.task][row]
+
+    def meshblock_populations(self, meshblock_feature_ids: Iterable[int]) -> int:
+        """
+        Returns the total offline population for a set of meshblocks
+        :param meshblock_feature_ids: meshblock feature ids
+        """
+        return sum(self.meshblock_population(m) for m in meshblock_feature_ids)
+
+    def move_meshblocks(self, moves: List[MeshblockMove]):
+        """
+        Updates the ledger for a list of meshblock moves
+        :param moves: list of meshblock feature id, previous electorate and new electorate
+        """
+        self.ensure_loaded()
+        for meshblock_feature_id, from_electorate, to_electorate in moves:
+            pop = self.meshblock_population(meshblock_feature_id)
+            if from_electorate is not None and from_electorate != NULL:
+                self.populations[from_electorate] = self.populations.get(from_electorate, 0) - pop
+            if to_electorate is not None and to_electorate != NULL:
+                self.populations[to_electorate] = self.populations.get(to_electorate, 0) + pop
+
+    def revert_moves(self, moves: List[MeshblockMove]):
+        """
+        Reverts the changes made by move_meshblocks() for a list of meshblock moves
+        :param moves: list of meshblock feature id, previous electorate and new electorate
+        """
+        self.move_meshblocks([(m, to_electorate, from_electorate) for m, from_electorate, to_electorate in
+                              reversed(moves)])
+
+
+class PopulationLedgerChange:
+    """
+    A set of meshblock moves applied to a population ledger, which can be
+    reverted and reapplied as the corresponding edits are undone and redone
+    """
+
+    def __init__(self, ledger: PopulationLedger, moves: List[MeshblockMove]):
+        """
+        Constructor for PopulationLedgerChange
+        :param ledger: population ledger
+        :param moves: meshblock moves. These must already have been applied to the ledger.
+        """
+        self.ledger = ledger
+        self.moves = moves
+        self.applied = True
+
+    def undo(self):
+        """
+        Reverts the moves from the ledger
+        """
+        if self.applied:
+            self.ledger.revert_moves(self.moves)
+            self.applied = False
+
+    def redo(self):
+        """
+        Reapplies the moves to the ledger
+        """
+        if not self.applied:
+            self.ledger.move_meshblocks(self.moves)
+            self.applied = True
@@ -13,12 +13,18 @@ __copyright__ = 'Copyright 2018, LINZ'
 # This will get replaced with a git SHA1 when you do a git archive
 __revision__ = '$Format:%H$'
 
+from collections import OrderedDict
 from typing import Optional
 from qgis.core import (QgsTask,
                        QgsFeatureRequest,
+                       QgsFeedback,
                        QgsVectorLayer,
-                       QgsGeometry)
+                       QgsVectorLayerFeatureSource)
+from redistrict.core.dissolve import (ElectorateDissolver,
+                                      get_dissolve_worker_count)
 from redistrict.linz.scenario_registry import ScenarioRegistry
+from redistrict.linz.meshblock_store import MeshblockStore
+from redistrict.linz.electorate_geometry_cache import ElectorateGeometryCache
 
 
 class CanceledException(Exception):
@@ -38,17 +44,20 @@ class ScenarioBaseTask(QgsTask):
     ELECTORATE_CODE = 'ELECTORATE_CODE'
     ELECTORATE_NAME = 'ELECTORATE_NAME'
     MESHBLOCKS = 'MESHBLOCKS'
+    MESHBLOCK_ROWS = 'MESHBLOCK_ROWS'
     OFFSHORE_MESHBLOCKS = 'OFFSHORE_MESHBLOCKS'
     NON_OFFSHORE_MESHBLOCKS = 'NON_OFFSHORE_MESHBLOCKS'
     ESTIMATED_POP = 'ESTIMATED_POP'
     EXPECTED_REGIONS = 'EXPECTED_REGIONS'
     DEPRECATED = 'DEPRECATED'
     STATS_NZ_POP = 'STATS_NZ_POP'
+    CURRENT_SCENARIO = 'CURRENT_SCENARIO'
 
     def __init__(self,  # pylint: disable=too-many-locals, too-many-statements
                  task_name: str, electorate_layer: QgsVectorLayer, meshblock_layer: QgsVectorLayer,
                  meshblock_number_field_name: str, scenario_registry: ScenarioRegistry, scenario,
-                 task: Optional[str] = None):
+                 task: Optional[str] = None, meshblock_store: Optional[MeshblockStore] = None,
+                 geometry_cache: Optional[ElectorateGeometryCache] = None):
         """
         Constructor for ScenarioSwitchTask
         :param task_name: user-visible, translated name for task
@@ -58,6 +67,9 @@ class ScenarioBaseTask(QgsTask):
         :param scenario_registry: scenario registry
         :param scenario: target scenario id to switch to
         :param task: current redistricting task
+        :param meshblock_store: optional session-wide meshblock store. If not set,
+        a new store will be created from the meshblock layer
+        :param geometry_cache: optional cache of dissolved electorate geometries
         """
         super().__init__(task_name)
 
@@ -73,14 +85,6 @@ class ScenarioBaseTask(QgsTask):
         assert self.estimated_pop_idx >= 0
         self.mb_number_idx = scenario_registry.meshblock_electorate_layer.fields().lookupField('meshblock_number')
         assert self.mb_number_idx >= 0
-        self.mb_off_pop_m_idx = meshblock_layer.fields().lookupField('offline_pop_m')
-        assert self.mb_off_pop_m_idx >= 0
-        self.mb_off_pop_ni_idx = meshblock_layer.fields().lookupField('offline_pop_gn')
-        assert self.mb_off_pop_ni_idx >= 0
-        self.mb_off_pop_si_idx = meshblock_layer.fields().lookupField('offline_pop_gs')
-        assert self.mb_off_pop_si_idx >= 0
-        self.mb_offshore_idx = meshblock_layer.fields().lookupField('offshore')
-        assert self.mb_offshore_idx >= 0
 
         self.stats_nz_pop_idx = electorate_layer.fields().lookupField('stats_nz_pop')
         assert self.stats_nz_pop_idx >= 0
@@ -90,8 +94,8 @@ class ScenarioBaseTask(QgsTask):
         self.invalid_idx = self.electorate_layer.fields().lookupField('invalid')
         assert self.invalid_idx >= 0
 
-        electorate_id_idx = electorate_layer.fields().lookupField('electorate_id')
-        assert electorate_id_idx >= 0
+        self.electorate_id_idx = electorate_layer.fields().lookupField('electorate_id')
+        assert self.electorate_id_idx >= 0
         self.code_idx = electorate_layer.fields().lookupField('code')
         assert self.code_idx >= 0
         self.name_idx = electorate_layer.fields().lookupField('name')
@@ -103,36 +107,81 @@ class ScenarioBaseTask(QgsTask):
         self.deprecated_idx = electorate_layer.fields().lookupField('deprecated')
         assert self.deprecated_idx >= 0
 
-        # do a bit of preparatory processing on the main thread for safety
+        # only take thread-safe snapshots of the layers here - all the heavy
+        # preparation is deferred to prepare(), which is called from the task thread
+        self.scenario_registry = scenario_registry
+        self.electorate_source = QgsVectorLayerFeatureSource(electorate_layer)
+        self.meshblock_electorate_source = QgsVectorLayerFeatureSource(scenario_registry.meshblock_electorate_layer)
 
-        # dict of meshblock number to feature
-        meshblocks = {}
-        for m in meshblock_layer.getFeatures():
-            meshblocks[int(m[self.meshblock_number_idx])] = m
+        if meshblock_store is None:
+            meshblock_store = MeshblockStore(meshblock_layer=meshblock_layer,
+                                             meshblock_number_field_name=meshblock_number_field_name,
+                                             defer_load=True)
+        self.meshblock_store = meshblock_store
 
-        # dict of electorates to process (by id)
-        self.electorates_to_process = {}
+        # dict of electorates to process (by id), populated by prepare()
+        self.electorates_to_process = OrderedDict()
+
+        self.feedback = QgsFeedback()
+        self.dissolve_workers = get_dissolve_worker_count()
+
+        self.geometry_cache = geometry_cache
+        # can be set to False to always dissolve electorates, ignoring cached geometries
+        self.use_cached_geometries = True
+
+        self.setDependentLayers([electorate_layer])
+
+    def cancel(self):
+        """
+        Cancels the task
+        """
+        super().cancel()
+        self.feedback.cancel()
+
+    def prepare(self):
+        """
+        Prepares the electorates to process, loading the meshblock store and
+        the meshblock assignments for the target scenario. Should be called
+        at the start of run().
+        :raises CanceledException: if the task is canceled during preparation
+        """
+        if not self.meshblock_store.ensure_loaded(self.feedback):
+            raise CanceledException
+        if self.isCanceled():
+            raise CanceledException
+
+        # fetch the complete meshblock assignment for the target scenario in a single pass
+        scenario_meshblocks = self.scenario_registry.scenario_electorate_meshblocks(
+            scenario_id=self.scenario, electorate_types=[self.task] if self.task else None,
+            source=self.meshblock_electorate_source)
+        if self.isCanceled():
+            raise CanceledException
+
+        self.electorates_to_process = OrderedDict()
         request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
-        request.setSubsetOfAttributes([electorate_id_idx, self.type_idx, self.code_idx, self.name_idx, self.expected_regions_idx, self.deprecated_idx, self.stats_nz_pop_idx])
-        for electorate in electorate_layer.getFeatures(request):
+        request.setSubsetOfAttributes([self.electorate_id_idx, self.type_idx, self.code_idx, self.name_idx,
+                                       self.expected_regions_idx, self.deprecated_idx, self.stats_nz_pop_idx,
+                                       self.scenario_id_idx])
+        for electorate in self.electorate_source.getFeatures(request):
+            if self.isCanceled():
+                raise CanceledException
+
             # get meshblocks for this electorate in the target scenario
-            electorate_id = electorate[electorate_id_idx]
+            electorate_id = electorate[self.electorate_id_idx]
             electorate_type = electorate[self.type_idx]
             electorate_code = electorate[self.code_idx]
             electorate_name = electorate[self.name_idx]
             expected_regions = electorate[self.expected_regions_idx]
             deprecated = electorate[self.deprecated_idx]
             stats_nz_pop = electorate[self.stats_nz_pop_idx]
+            current_scenario = electorate[self.scenario_id_idx]
             if self.task and electorate_type != self.task:
                 continue
 
-            electorate_meshblocks = scenario_registry.electorate_meshblocks(electorate_id=electorate_id,
-                                                                            electorate_type=electorate_type,
-                                                                            scenario_id=scenario)
-            assigned_meshblock_numbers = [m[self.mb_number_idx] for m in electorate_meshblocks]
-            matching_meshblocks = [meshblocks[m] for m in assigned_meshblock_numbers]
-            offshore_meshblocks = [m for m in matching_meshblocks if m[self.mb_offshore_idx]]
-            non_offshore_meshblocks = [m for m in matching_meshblocks if not m[self.mb_offshore_idx]]
+            assigned_meshblock_numbers = scenario_meshblocks.get(electorate_type, {}).get(electorate_id, [])
+            rows = self.meshblock_store.rows_for_meshblocks(assigned_meshblock_numbers)
+            offshore_rows = [r for r in rows if self.meshblock_store.offshore[r]]
+            non_offshore_rows = [r for r in rows if not self.meshblock_store.offshore[r]]
 
             self.electorates_to_process[electorate_id] = {self.ELECTORATE_FEATURE_ID: electorate.id(),
                                                           self.ELECTORATE_TYPE: electorate_type,
@@ -140,58 +189,134 @@ class ScenarioBaseTask(QgsTask):
                                                           self.ELECTORATE_NAME: electorate_name,
                                                           self.EXPECTED_REGIONS: expected_regions,
                                                           self.DEPRECATED: deprecated,
-                                                          self.MESHBLOCKS: matching_meshblocks,
-                                                          self.OFFSHORE_MESHBLOCKS: offshore_meshblocks,
-                                                          self.NON_OFFSHORE_MESHBLOCKS: non_offshore_meshblocks,
-                                                          self.STATS_NZ_POP: stats_nz_pop}
+                                                          self.MESHBLOCKS: assigned_meshblock_numbers,
+                                                          self.MESHBLOCK_ROWS: rows,
+                                                          self.OFFSHORE_MESHBLOCKS: offshore_rows,
+                                                          self.NON_OFFSHORE_MESHBLOCKS: non_offshore_rows,
+                                                          self.STATS_NZ_POP: stats_nz_pop,
+                                                          self.CURRENT_SCENARIO: current_scenario}
 
-        self.setDependentLayers([electorate_layer])
+    def calculate_electorate_populations(self) -> dict:
+        """
+        Calculates the estimated populations for all electorates to process, using
+        a single grouped pass over the meshblock store for each electorate type
+        :returns: dictionary of electorate id to estimated population
+        """
+        electorate_meshblocks_by_type = OrderedDict()
+        for electorate_id, params in self.electorates_to_process.items():
+            electorate_type = params[self.ELECTORATE_TYPE]
+            if electorate_type not in electorate_meshblocks_by_type:
+                electorate_meshblocks_by_type[electorate_type] = OrderedDict()
+            electorate_meshblocks_by_type[electorate_type][electorate_id] = params[self.MESHBLOCKS]
 
-    def calculate_new_electorates(self):
+        populations = {}
+        for electorate_type, electorate_meshblocks in electorate_meshblocks_by_type.items():
+            assignment, electorate_ids = self.meshblock_store.build_assignment(electorate_meshblocks)
+            populations.update(self.meshblock_store.electorate_populations(electorate_type=electorate_type,
+                                                                           assignment=assignment,
+                                                                           electorate_ids=electorate_ids))
+        return populations
+
+    def calculate_electorate_attributes(self) -> dict:
         """
-        Calculates the new electorate geometry and populations for the associated scenario
+        Calculates the new electorate attributes (including populations) for the associated scenario
+        :returns: dictionary of electorate feature id to electorate attributes
         """
-        electorate_geometries = {}
-        electorate_attributes = {}
-        i = 0
+        electorate_attributes = OrderedDict()
+
+        populations = self.calculate_electorate_populations()
+
         for electorate_id, params in self.electorates_to_process.items():
             if self.isCanceled():
                 raise CanceledException
 
-            self.setProgress(100 * i / len(self.electorates_to_process))
-
             electorate_feature_id = params[self.ELECTORATE_FEATURE_ID]
             electorate_type = params[self.ELECTORATE_TYPE]
-            matching_meshblocks = params[self.MESHBLOCKS]
-            offshore_meshblocks = params[self.OFFSHORE_MESHBLOCKS]
-            non_offshore_meshblocks = params[self.NON_OFFSHORE_MESHBLOCKS]
-
-            if electorate_type == 'M':
-                estimated_pop = sum(
-                    [mbf[self.mb_off_pop_m_idx] for mbf in matching_meshblocks if mbf[self.mb_off_pop_m_idx]])
-            elif electorate_type == 'GN':
-                estimated_pop = sum(
-                    [mbf[self.mb_off_pop_ni_idx] for mbf in matching_meshblocks if mbf[self.mb_off_pop_ni_idx]])
-            else:
-                estimated_pop = sum(
-                    [mbf[self.mb_off_pop_si_idx] for mbf in matching_meshblocks if mbf[self.mb_off_pop_si_idx]])
 
-            electorate_attributes[electorate_feature_id] = {self.ESTIMATED_POP: estimated_pop,
+            electorate_attributes[electorate_feature_id] = {self.ESTIMATED_POP: populations[electorate_id],
                                                             self.ELECTORATE_ID: electorate_id,
                                                             self.ELECTORATE_TYPE: electorate_type,
                                                             self.ELECTORATE_NAME: params[self.ELECTORATE_NAME],
                                                             self.ELECTORATE_CODE: params[self.ELECTORATE_CODE],
                                                             self.EXPECTED_REGIONS: params[self.EXPECTED_REGIONS],
                                                             self.DEPRECATED: params[self.DEPRECATED],
-                                                            self.MESHBLOCKS: matching_meshblocks,
-                                                            self.OFFSHORE_MESHBLOCKS: offshore_meshblocks,
-                                                            self.NON_OFFSHORE_MESHBLOCKS: non_offshore_meshblocks,
+                                                            self.MESHBLOCKS: params[self.MESHBLOCKS],
+                                                            self.MESHBLOCK_ROWS: params[self.MESHBLOCK_ROWS],
+                                                            self.OFFSHORE_MESHBLOCKS: params[self.OFFSHORE_MESHBLOCKS],
+                                                            self.NON_OFFSHORE_MESHBLOCKS: params[
+                                                                self.NON_OFFSHORE_MESHBLOCKS],
                                                             self.STATS_NZ_POP: params[self.STATS_NZ_POP]}
 
-            meshblock_parts = [m.geometry() for m in matching_meshblocks]
-            electorate_geometry = QgsGeometry.unaryUnion(meshblock_parts)
-            electorate_geometry = electorate_geometry.makeValid()
-            electorate_geometries[electorate_feature_id] = electorate_geometry
-            i += 1
+        return electorate_attributes
+
+    def calculate_electorate_geometries(self, electorate_attributes: dict, electorate_feature_ids=None) -> dict:
+        """
+        Calculates the new electorate geometries for the associated scenario, using
+        cached geometries where available
+        :param electorate_attributes: electorate attributes, as returned by calculate_electorate_attributes
+        :param electorate_feature_ids: optional list of electorate feature ids to calculate geometries for.
+        If not set, geometries will be calculated for all electorates.
+        :returns: dictionary of electorate feature id to electorate geometry
+        """
+        if electorate_feature_ids is None:
+            electorate_feature_ids = list(electorate_attributes.keys())
+
+        content_hashes = {}
+        for electorate_feature_id in electorate_feature_ids:
+            attributes = electorate_attributes[electorate_feature_id]
+            content_hashes[attributes[self.ELECTORATE_ID]] = ElectorateGeometryCache.content_hash(
+                electorate_type=attributes[self.ELECTORATE_TYPE], meshblocks=attributes[self.MESHBLOCKS],
+                population=attributes[self.ESTIMATED_POP])
+
+        cached = {}
+        if self.geometry_cache is not None and self.use_cached_geometries and content_hashes:
+            cached = self.geometry_cache.lookup(content_hashes)
 
+        electorate_geometries = {}
+        dissolve_rows = OrderedDict()
+        for electorate_feature_id in electorate_feature_ids:
+            if self.isCanceled():
+                raise CanceledException
+
+            attributes = electorate_attributes[electorate_feature_id]
+            electorate_id = attributes[self.ELECTORATE_ID]
+            if electorate_id in cached:
+                electorate_geometries[electorate_feature_id] = cached[electorate_id][0]
+            else:
+                dissolve_rows[electorate_feature_id] = attributes[self.MESHBLOCK_ROWS]
+
+        # fetch the geometries for all electorates to dissolve in a single request
+        geometries = self.meshblock_store.geometries_for_rows(
+            [r for rows in dissolve_rows.values() for r in rows], self.feedback)
+        if geometries is None:
+            raise CanceledException
+        dissolve_jobs = OrderedDict()
+        offset = 0
+        for electorate_feature_id, rows in dissolve_rows.items():
+            dissolve_jobs[electorate_feature_id] = geometries[offset:offset + len(rows)]
+            offset += len(rows)
+
+        dissolver = ElectorateDissolver(worker_count=self.dissolve_workers)
+        dissolved = dissolver.dissolve(dissolve_jobs, feedback=self.feedback,
+                                       progress_callback=self.setProgress)
+        if dissolved is None or self.isCanceled():
+            raise CanceledException
+        electorate_geometries.update(dissolved)
+
+        if self.geometry_cache is not None and dissolved:
+            entries = {}
+            for electorate_feature_id, geometry in dissolved.items():
+                attributes = electorate_attributes[electorate_feature_id]
+                electorate_id = attributes[self.ELECTORATE_ID]
+                entries[electorate_id] = (content_hashes[electorate_id], geometry, attributes[self.ESTIMATED_POP])
+            self.geometry_cache.store(self.scenario, entries)
+
+        return electorate_geometries
+
+    def calculate_new_electorates(self):
+        """
+        Calculates the new electorate geometry and populations for the associated scenario
+        """
+        electorate_attributes = self.calculate_electorate_attributes()
+        electorate_geometries = self.calculate_electorate_geometries(electorate_attributes)
         return electorate_geometries, electorate_attributes
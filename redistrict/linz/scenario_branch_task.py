@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""LINZ Redistricting Plugin - Scenario branching task
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import sqlite3
+from qgis.core import (NULL,
+                       QgsTask,
+                       QgsFeatureRequest,
+                       QgsMessageLog,
+                       QgsVectorLayerFeatureSource,
+                       QgsExpression)
+from redistrict.linz.db_utils import DbUtils
+from redistrict.linz.scenario_registry import ScenarioRegistry
+
+
+class BranchScenarioTask(QgsTask):
+    """
+    A background task for copying the meshblock records from one scenario
+    to a newly branched scenario
+    """
+
+    # number of records to add in each batch, when copying through the layer
+    CHUNK_SIZE = 5000
+
+    def __init__(self, task_name: str, scenario_registry: ScenarioRegistry, source_scenario_id, new_scenario_id):
+        """
+        Constructor for BranchScenarioTask
+        :param task_name: user-visible, translated name for task
+        :param scenario_registry: scenario registry
+        :param source_scenario_id: scenario to copy records from
+        :param new_scenario_id: id of new scenario, as returned by ScenarioRegistry.create_branch_scenario()
+        """
+        super().__init__(task_name)
+        self.scenario_registry = scenario_registry
+        self.source_scenario_id = source_scenario_id
+        self.new_scenario_id = new_scenario_id
+        self.meshblock_electorate_layer = scenario_registry.meshblock_electorate_layer
+
+        # if the records are stored in a GeoPackage, they can be copied with a single statement
+        self.database_path = DbUtils.database_path_for_layer(self.meshblock_electorate_layer)
+        self.table = DbUtils.table_name_for_layer(self.meshblock_electorate_layer)
+        if self.table is None:
+            self.database_path = None
+        # set to True if the database was updated directly, and the layer must be reloaded
+        self.updated_database = False
+
+        self.meshblock_electorate_source = QgsVectorLayerFeatureSource(self.meshblock_electorate_layer)
+        self.scenario_id_idx = self.meshblock_electorate_layer.fields().lookupField('scenario_id')
+        assert self.scenario_id_idx >= 0
+        self.fid_idx = self.meshblock_electorate_layer.fields().lookupField('fid')
+        self.error = None
+
+        self.setDependentLayers([self.meshblock_electorate_layer])
+
+    def run(self):  # pylint: disable=missing-docstring
+        if self.database_path is not None:
+            if self.copy_in_database():
+                self.updated_database = True
+                return True
+            if self.isCanceled():
+                return False
+
+        return self.copy_through_layer()
+
+    def copy_in_database(self) -> bool:
+        """
+        Copies the records via a single INSERT...SELECT within the database
+        :returns: True if copy was successful
+        """
+        try:
+            connection = DbUtils.connect(self.database_path)
+            try:
+                connection.set_progress_handler(lambda: 1 if self.isCanceled() else 0, 10000)
+                pk = DbUtils.primary_key_column(connection, self.table)
+                columns = [r[1] for r in connection.execute('PRAGMA table_info("{}")'.format(self.table))
+                           if r[1] != pk]
+                self.setProgress(10)
+                # delta source scenarios are copied in full
+                sql, params = self.scenario_registry.scenario_rows_sql(
+                    self.source_scenario_id, '"{}"'.format(self.table),
+                    ', '.join('?' if c == 'scenario_id' else '"{}"'.format(c) for c in columns),
+                    [self.new_scenario_id])
+                connection.execute('INSERT INTO "{}" ({}) {}'.format(
+                    self.table, ', '.join('"{}"'.format(c) for c in columns), sql), params)
+                self.setProgress(90)
+                DbUtils.invalidate_feature_count(connection, self.table)
+                connection.commit()
+            finally:
+                connection.close()
+        except sqlite3.Error as e:
+            if not self.isCanceled():
+                QgsMessageLog.logMessage('Could not branch scenario in database: {}'.format(e), "REDISTRICT")
+            return False
+
+        self.setProgress(100)
+        return True
+
+    def copy_through_layer(self) -> bool:
+        """
+        Copies the records through the meshblock electorate layer's data provider,
+        in cancelable batches
+        :returns: True if copy was successful
+        """
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        features = []
+        for f in self.scenario_registry.scenario_features(self.source_scenario_id, request=request,
+                                                          source=self.meshblock_electorate_source):
+            if self.isCanceled():
+                return False
+            f[self.scenario_id_idx] = self.new_scenario_id
+            if self.fid_idx >= 0:
+                f[self.fid_idx] = NULL
+            features.append(f)
+
+        for i in range(0, len(features), self.CHUNK_SIZE):
+            if self.isCanceled():
+                # remove any partially copied records
+                self.remove_copied_records()
+                return False
+            if not self.meshblock_electorate_layer.dataProvider().addFeatures(features[i:i + self.CHUNK_SIZE]):
+                self.remove_copied_records()
+                self.error = self.tr('Could not copy scenario records')
+                return False
+            self.setProgress(100 * (i + self.CHUNK_SIZE) / len(features))
+
+        self.setProgress(100)
+        return True
+
+    def remove_copied_records(self):
+        """
+        Removes any records already copied to the new scenario
+        """
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([])
+        request.setFilterExpression(QgsExpression.createFieldEqualityExpression('scenario_id',
+                                                                                self.new_scenario_id))
+        self.meshblock_electorate_layer.dataProvider().deleteFeatures(
+            [f.id() for f in self.meshblock_electorate_layer.dataProvider().getFeatures(request)])
+
+    def finished(self, result: bool):  # pylint: disable=missing-docstring
+        if result and self.updated_database:
+            # layer must be reloaded to pick up the records added directly to the database
+            self.meshblock_electorate_layer.reload()
+        elif not result:
+            # don't leave an empty scenario behind
+            self.scenario_registry.remove_scenario(self.new_scenario_id)
+
+
+class CompactScenarioTask(QgsTask):
+    """
+    A background task for materializing a delta scenario in full, by copying all
+    records which it currently inherits from its parent scenarios
+    """
+
+    def __init__(self, task_name: str, scenario_registry: ScenarioRegistry, scenario_id):
+        """
+        Constructor for CompactScenarioTask
+        :param task_name: user-visible, translated name for task
+        :param scenario_registry: scenario registry
+        :param scenario_id: delta scenario to compact
+        """
+        super().__init__(task_name)
+        self.scenario_registry = scenario_registry
+        self.scenario_id = scenario_id
+        self.chain = scenario_registry.scenario_chain(scenario_id)
+        self.meshblock_electorate_layer = scenario_registry.meshblock_electorate_layer
+
+        self.database_path = DbUtils.database_path_for_layer(self.meshblock_electorate_layer)
+        self.table = DbUtils.table_name_for_layer(self.meshblock_electorate_layer)
+        if self.table is None:
+            self.database_path = None
+        # set to True if the database was updated directly, and the layer must be reloaded
+        self.updated_database = False
+
+        self.meshblock_electorate_source = QgsVectorLayerFeatureSource(self.meshblock_electorate_layer)
+        self.scenario_id_idx = self.meshblock_electorate_layer.fields().lookupField('scenario_id')
+        assert self.scenario_id_idx >= 0
+        self.meshblock_number_idx = self.meshblock_electorate_layer.fields().lookupField('meshblock_number')
+        assert self.meshblock_number_idx >= 0
+        self.fid_idx = self.meshblock_electorate_layer.fields().lookupField('fid')
+        self.error = None
+
+        self.setDependentLayers([self.meshblock_electorate_layer])
+
+    def run(self):  # pylint: disable=missing-docstring
+        if len(self.chain) == 1:
+            # not a delta scenario, nothing to do
+            return True
+
+        if self.database_path is not None:
+            if self.compact_in_database():
+                self.updated_database = True
+                return True
+            if self.isCanceled():
+                return False
+
+        return self.compact_through_layer()
+
+    def compact_in_database(self) -> bool:
+        """
+        Copies the inherited records via a single INSERT...SELECT within the database
+        :returns: True if compaction was successful
+        """
+        try:
+            connection = DbUtils.connect(self.database_path)
+            try:
+                connection.set_progress_handler(lambda: 1 if self.isCanceled() else 0, 10000)
+                pk = DbUtils.primary_key_column(connection, self.table)
+                columns = [r[1] for r in connection.execute('PRAGMA table_info("{}")'.format(self.table))
+                           if r[1] != pk]
+                self.setProgress(10)
+                sql, params = self.scenario_registry.scenario_rows_sql(
+                    self.chain[1], '"{}"'.format(self.table),
+                    ', '.join('? AS scenario_id' if c == 'scenario_id' else '"{}"'.format(c) for c in columns),
+                    [self.scenario_id])
+                connection.execute('INSERT INTO "{0}" ({1}) SELECT {1} FROM ({2}) WHERE meshblock_number NOT IN '
+                                   '(SELECT meshblock_number FROM "{0}" WHERE scenario_id=?)'.format(
+                                       self.table, ', '.join('"{}"'.format(c) for c in columns), sql),
+                                   params + [self.scenario_id])
+                self.setProgress(90)
+                DbUtils.invalidate_feature_count(connection, self.table)
+                connection.commit()
+            finally:
+                connection.close()
+        except sqlite3.Error as e:
+            if not self.isCanceled():
+                QgsMessageLog.logMessage('Could not compact scenario in database: {}'.format(e), "REDISTRICT")
+            return False
+
+        self.setProgress(100)
+        return True
+
+    def compact_through_layer(self) -> bool:
+        """
+        Copies the inherited records through the meshblock electorate layer's data provider
+        :returns: True if compaction was successful
+        """
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([self.meshblock_number_idx])
+        request.setFilterExpression(QgsExpression.createFieldEqualityExpression('scenario_id', self.scenario_id))
+        existing = {int(f[self.meshblock_number_idx]) for f in self.meshblock_electorate_source.getFeatures(request)}
+
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        features = []
+        for f in self.scenario_registry.scenario_features(self.chain[1], request=request,
+                                                          source=self.meshblock_electorate_source):
+            if self.isCanceled():
+                return False
+            if int(f[self.meshblock_number_idx]) in existing:
+                continue
+            f[self.scenario_id_idx] = self.scenario_id
+            if self.fid_idx >= 0:
+                f[self.fid_idx] = NULL
+            features.append(f)
+
+        if features and not self.meshblock_electorate_layer.dataProvider().addFeatures(features):
+            self.error = self.tr('Could not copy scenario records')
+            return False
+
+        self.setProgress(100)
+        return True
+
+    def finished(self, result: bool):  # pylint: disable=missing-docstring
+        if not result:
+            return
+
+        if self.updated_database:
+            # layer must be reloaded to pick up the records added directly to the database
+            self.meshblock_electorate_layer.reload()
+        self.scenario_registry.set_parent_scenario(self.scenario_id, None)
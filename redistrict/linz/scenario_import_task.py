@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+"""LINZ Redistricting Plugin - Scenario import task
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import hashlib
+import sqlite3
+from collections import defaultdict
+from typing import (Dict,
+                    Iterable,
+                    List,
+                    Optional)
+from qgis.PyQt.QtCore import QDateTime
+from qgis.core import (NULL,
+                       QgsTask,
+                       QgsFeature,
+                       QgsFeatureRequest,
+                       QgsMessageLog,
+                       QgsVectorLayerFeatureSource,
+                       QgsExpression)
+from redistrict.linz.db_utils import DbUtils
+from redistrict.linz.scenario_registry import ScenarioRegistry
+
+
+class ImportedScenario:
+    """
+    Details of a scenario to import from another database
+    """
+
+    def __init__(self, source_scenario_id, name: str, created: QDateTime = None, created_by: str = None,
+                 source_scenario_chain: Optional[list] = None):
+        """
+        Constructor for ImportedScenario
+        :param source_scenario_id: scenario id within source database
+        :param name: name for imported scenario
+        :param created: original scenario creation date time
+        :param created_by: original scenario creator
+        :param source_scenario_chain: chain of scenarios to resolve the scenario's records through,
+        if the source scenario is a delta scenario. See ScenarioRegistry.scenario_chain().
+        """
+        self.source_scenario_id = source_scenario_id
+        self.source_scenario_chain = source_scenario_chain or [source_scenario_id]
+        self.name = name
+        self.created = created
+        self.created_by = created_by
+        # set by the import task
+        self.new_scenario_id = None
+        self.duplicate_of = None
+
+
+class ImportScenariosTask(QgsTask):
+    """
+    A background task for importing scenarios from another database. Scenarios with
+    meshblock assignments identical to an existing scenario are skipped.
+    """
+
+    SOURCE_TABLE = 'meshblock_electorates'
+    # fields compared when checking for duplicate scenarios
+    ASSIGNMENT_FIELDS = ('meshblock_number', 'gn_id', 'gs_id', 'm_id')
+    # number of records to add in each batch, when importing through the layer
+    CHUNK_SIZE = 5000
+
+    def __init__(self, task_name: str, scenario_registry: ScenarioRegistry, source_database_path: str,
+                 scenarios: List[ImportedScenario]):
+        """
+        Constructor for ImportScenariosTask
+        :param task_name: user-visible, translated name for task
+        :param scenario_registry: destination scenario registry
+        :param source_database_path: path to database to import scenarios from
+        :param scenarios: scenarios to import
+        """
+        super().__init__(task_name)
+        self.scenario_registry = scenario_registry
+        self.source_database_path = source_database_path
+        self.scenarios = scenarios
+        self.meshblock_electorate_layer = scenario_registry.meshblock_electorate_layer
+        # new scenario ids are reserved in the registry up front, so that they can't be taken by
+        # scenarios created while the task is running. The registry entries are created once the
+        # task completes, and any unused ids released.
+        self.reserved_scenario_ids = scenario_registry.reserve_scenario_ids(len(scenarios))
+        self.first_scenario_id = self.reserved_scenario_ids[0] if self.reserved_scenario_ids else None
+        # delta scenarios only store partial records, and can't be compared to imported scenarios
+        self.delta_scenarios = list(scenario_registry.scenario_parents.keys())
+
+        # if the destination records are stored in a GeoPackage, the source database can be
+        # attached and the records copied within the database
+        self.database_path = DbUtils.database_path_for_layer(self.meshblock_electorate_layer)
+        self.table = DbUtils.table_name_for_layer(self.meshblock_electorate_layer)
+        if self.table is None:
+            self.database_path = None
+        # set to True if the database was updated directly, and the layer must be reloaded
+        self.updated_database = False
+
+        self.meshblock_electorate_source = QgsVectorLayerFeatureSource(self.meshblock_electorate_layer)
+        self.fields = self.meshblock_electorate_layer.fields()
+        self.error = None
+
+        self.setDependentLayers([self.meshblock_electorate_layer])
+
+    @staticmethod
+    def assignment_digests(rows: Iterable) -> Dict[object, str]:
+        """
+        Calculates a digest of the meshblock assignments for each scenario
+        :param rows: iterable of (scenario id, meshblock number, assignment values...), ordered by
+        scenario and meshblock number
+        :returns: dictionary of scenario id to digest
+        """
+        digests = {}
+        current = None
+        digest = None
+        for row in rows:
+            if row[0] != current:
+                if digest is not None:
+                    digests[current] = digest.hexdigest()
+                current = row[0]
+                digest = hashlib.sha1()
+            digest.update(repr([None if v is None or v == NULL else v for v in row[1:]]).encode())
+        if digest is not None:
+            digests[current] = digest.hexdigest()
+        return digests
+
+    def source_digests(self, connection: sqlite3.Connection, table: str, assignment_columns: str) -> Dict[object, str]:
+        """
+        Calculates the assignment digests for the scenarios to import, resolving
+        delta source scenarios in full
+        :param connection: database connection
+        :param table: source table name, including schema
+        :param assignment_columns: SQL list of assignment columns
+        """
+        digests = {}
+        for scenario in self.scenarios:
+            sql, params = ScenarioRegistry.chain_rows_sql(scenario.source_scenario_chain, table, assignment_columns)
+            digests.update(self.assignment_digests(
+                (scenario.source_scenario_id,) + tuple(row) for row in
+                connection.execute('SELECT * FROM ({}) ORDER BY meshblock_number'.format(sql), params)))
+        return digests
+
+    def imported_scenarios(self) -> List[ImportedScenario]:
+        """
+        Returns the list of scenarios which were imported by the task
+        """
+        return [s for s in self.scenarios if s.new_scenario_id is not None]
+
+    def skipped_scenarios(self) -> List[ImportedScenario]:
+        """
+        Returns the list of scenarios which were skipped as duplicates of an existing scenario
+        """
+        return [s for s in self.scenarios if s.duplicate_of is not None]
+
+    def assign_scenario_ids(self, source_digests: Dict[object, str], existing_digests: Dict[object, str]):
+        """
+        Assigns new scenario ids to the scenarios to import, skipping duplicates
+        :param source_digests: assignment digests for source scenarios
+        :param existing_digests: assignment digests for existing scenarios
+        """
+        existing = {digest: scenario_id for scenario_id, digest in existing_digests.items()}
+        next_id = self.first_scenario_id
+        for scenario in self.scenarios:
+            digest = source_digests.get(scenario.source_scenario_id)
+            if digest is not None and digest in existing:
+                scenario.duplicate_of = existing[digest]
+                continue
+            scenario.new_scenario_id = next_id
+            if digest is not None:
+                existing[digest] = next_id
+            next_id += 1
+
+    def run(self):  # pylint: disable=missing-docstring
+        if self.database_path is not None:
+            if self.import_in_database():
+                self.updated_database = True
+                return True
+            if self.isCanceled():
+                return False
+            for scenario in self.scenarios:
+                scenario.new_scenario_id = None
+                scenario.duplicate_of = None
+
+        return self.import_through_layer()
+
+    def import_in_database(self) -> bool:
+        """
+        Imports the records by attaching the source database and copying with
+        INSERT...SELECT statements
+        :returns: True if import was successful
+        """
+        try:
+            connection = DbUtils.connect(self.database_path)
+            try:
+                connection.set_progress_handler(lambda: 1 if self.isCanceled() else 0, 10000)
+                connection.execute('ATTACH DATABASE ? AS source', (self.source_database_path,))
+
+                pk = DbUtils.primary_key_column(connection, self.table)
+                source_columns = [r[1] for r in
+                                  connection.execute('PRAGMA source.table_info("{}")'.format(self.SOURCE_TABLE))]
+                columns = [r[1] for r in connection.execute('PRAGMA main.table_info("{}")'.format(self.table))
+                           if r[1] != pk and r[1] in source_columns]
+                assignment_columns = ', '.join(
+                    '"{}"'.format(c) for c in self.ASSIGNMENT_FIELDS if c in columns)
+
+                existing_digests = self.assignment_digests(connection.execute(
+                    'SELECT scenario_id, {} FROM main."{}" WHERE scenario_id NOT IN ({}) '
+                    'ORDER BY scenario_id, meshblock_number'.format(
+                        assignment_columns, self.table, ', '.join('?' for _ in self.delta_scenarios)),
+                    self.delta_scenarios))
+                self.setProgress(20)
+                source_digests = self.source_digests(connection, 'source."{}"'.format(self.SOURCE_TABLE),
+                                                     assignment_columns)
+                self.setProgress(40)
+                self.assign_scenario_ids(source_digests, existing_digests)
+
+                to_import = self.imported_scenarios()
+                for i, scenario in enumerate(to_import):
+                    self.copy_scenario_in_database(connection, scenario, columns)
+                    self.setProgress(40 + 50 * (i + 1) / len(to_import))
+
+                DbUtils.invalidate_feature_count(connection, self.table)
+                connection.commit()
+                connection.execute('DETACH DATABASE source')
+            finally:
+                connection.close()
+        except sqlite3.Error as e:
+            if not self.isCanceled():
+                QgsMessageLog.logMessage('Could not import scenarios in database: {}'.format(e), "REDISTRICT")
+            return False
+
+        self.setProgress(100)
+        return True
+
+    def copy_scenario_in_database(self, connection: sqlite3.Connection, scenario: ImportedScenario,
+                                  columns: List[str]):
+        """
+        Copies the records for a single scenario from the attached source database
+        :param connection: database connection, with the source database attached as 'source'
+        :param scenario: scenario to copy
+        :param columns: columns to copy
+        """
+        sql, params = ScenarioRegistry.chain_rows_sql(
+            scenario.source_scenario_chain, 'source."{}"'.format(self.SOURCE_TABLE),
+            ', '.join('?' if c == 'scenario_id' else '"{}"'.format(c) for c in columns),
+            [scenario.new_scenario_id])
+        connection.execute('INSERT INTO main."{}" ({}) {}'.format(
+            self.table, ', '.join('"{}"'.format(c) for c in columns), sql), params)
+
+    def existing_layer_digests(self, assignment_fields: List[str]) -> Optional[Dict[object, str]]:
+        """
+        Calculates the assignment digests for the existing scenarios in the meshblock electorate layer
+        :param assignment_fields: names of assignment fields
+        :returns: dictionary of scenario id to digest, or None if the task was canceled
+        """
+        scenario_id_idx = self.fields.lookupField('scenario_id')
+        assert scenario_id_idx >= 0
+        assignment_idx = [self.fields.lookupField(f) for f in assignment_fields]
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([scenario_id_idx] + assignment_idx)
+        existing_rows = defaultdict(list)
+        for f in self.meshblock_electorate_source.getFeatures(request):
+            if self.isCanceled():
+                return None
+            if f[scenario_id_idx] in self.delta_scenarios:
+                continue
+            existing_rows[f[scenario_id_idx]].append(tuple(f[idx] for idx in assignment_idx))
+        return self.assignment_digests(
+            (scenario_id,) + row for scenario_id in sorted(existing_rows.keys()) for row in
+            sorted(existing_rows[scenario_id], key=lambda r: r[0]))
+
+    def copy_scenario_through_layer(self, connection: sqlite3.Connection, scenario: ImportedScenario,
+                                    columns: List[str]) -> bool:
+        """
+        Copies the records for a single scenario from the source database, adding them
+        through the meshblock electorate layer's data provider in cancelable batches
+        :param connection: source database connection
+        :param scenario: scenario to copy
+        :param columns: columns to copy
+        :returns: True if copy was successful
+        """
+        features = []
+        sql, params = ScenarioRegistry.chain_rows_sql(
+            scenario.source_scenario_chain, '"{}"'.format(self.SOURCE_TABLE),
+            ', '.join('"{}"'.format(c) for c in columns))
+        for row in connection.execute(sql, params):
+            if self.isCanceled():
+                return False
+            f = QgsFeature(self.fields)
+            for name, value in zip(columns, row):
+                f[name] = scenario.new_scenario_id if name == 'scenario_id' else value
+            features.append(f)
+            if len(features) >= self.CHUNK_SIZE:
+                if not self.meshblock_electorate_layer.dataProvider().addFeatures(features):
+                    return False
+                features = []
+        return not features or self.meshblock_electorate_layer.dataProvider().addFeatures(features)
+
+    def import_through_layer(self) -> bool:
+        """
+        Imports the records through the meshblock electorate layer's data provider,
+        in cancelable batches
+        :returns: True if import was successful
+        """
+        assignment_fields = [f for f in self.ASSIGNMENT_FIELDS if self.fields.lookupField(f) >= 0]
+        existing_digests = self.existing_layer_digests(assignment_fields)
+        if existing_digests is None:
+            return False
+
+        try:
+            connection = DbUtils.connect(self.source_database_path)
+            try:
+                source_columns = [r[1] for r in connection.execute(
+                    'PRAGMA table_info("{}")'.format(self.SOURCE_TABLE))]
+                columns = [f.name() for f in self.fields if f.name() in source_columns and f.name() != 'fid']
+                source_digests = self.source_digests(connection, '"{}"'.format(self.SOURCE_TABLE),
+                                                     ', '.join('"{}"'.format(c) for c in assignment_fields))
+                self.assign_scenario_ids(source_digests, existing_digests)
+
+                to_import = self.imported_scenarios()
+                for i, scenario in enumerate(to_import):
+                    if not self.copy_scenario_through_layer(connection, scenario, columns):
+                        self.remove_imported_records()
+                        return False
+                    self.setProgress(100 * (i + 1) / len(to_import))
+            finally:
+                connection.close()
+        except sqlite3.Error as e:
+            self.remove_imported_records()
+            self.error = str(e)
+            return False
+
+        self.setProgress(100)
+        return True
+
+    def remove_imported_records(self):
+        """
+        Removes any records already imported
+        """
+        new_ids = [s.new_scenario_id for s in self.imported_scenarios()]
+        if not new_ids:
+            return
+
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([])
+        request.setFilterExpression('{} IN ({})'.format(QgsExpression.quotedColumnRef('scenario_id'),
+                                                        ', '.join(str(i) for i in new_ids)))
+        self.meshblock_electorate_layer.dataProvider().deleteFeatures(
+            [f.id() for f in self.meshblock_electorate_layer.dataProvider().getFeatures(request)])
+
+    def finished(self, result: bool):  # pylint: disable=missing-docstring
+        self.scenario_registry.release_scenario_ids(self.reserved_scenario_ids)
+        if not result:
+            return
+
+        if self.updated_database:
+            # layer must be reloaded to pick up the records added directly to the database
+            self.meshblock_electorate_layer.reload()
+
+        for scenario in self.imported_scenarios():
+            res, error = self.scenario_registry.create_scenario(scenario_id=scenario.new_scenario_id,
+                                                                new_scenario_name=scenario.name,
+                                                                created_datetime=scenario.created,
+                                                                created_by=scenario.created_by)
+            if not res:
+                QgsMessageLog.logMessage(error, "REDISTRICT")
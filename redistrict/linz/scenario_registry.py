@@ -14,33 +14,54 @@ __copyright__ = 'Copyright 2018, LINZ'
 __revision__ = '$Format:%H$'
 
 from collections import OrderedDict
-from typing import Optional
+from typing import (Dict,
+                    Iterable,
+                    List,
+                    Optional)
 from qgis.PyQt.QtCore import (QCoreApplication,
-                              QDateTime)
+                              QDateTime,
+                              QVariant)
 from qgis.core import (QgsFeatureRequest,
                        QgsExpression,
+                       QgsField,
+                       QgsVectorDataProvider,
                        QgsVectorLayer,
                        QgsFeature,
                        QgsApplication,
-                       QgsFeatureIterator,
+                       QgsFeatureSource,
                        NULL)
+from redistrict.linz.packed_scenario_store import (PackedScenario,
+                                                   PackedScenarioStore)
 
 
 class ScenarioRegistry():
     """
-    A registry for handling available scenarios
+    A registry for handling available scenarios.
+
+    Scenarios may optionally be stored as deltas against a parent scenario, in which
+    case the meshblock electorates table only contains records for meshblocks whose
+    assignments differ from the parent. All other meshblocks are resolved through
+    the chain of parent scenarios.
+
+    A PackedScenarioStore may also be attached to the registry as a read cache, in which
+    case complete scenarios are read from their packed copies where available. The
+    meshblock electorates table remains the authoritative store of assignments.
     """
 
+    PARENT_FIELD = 'parent_scenario_id'
+
     def __init__(self, source_layer: QgsVectorLayer,
                  id_field: str,
                  name_field: str,
-                 meshblock_electorate_layer: Optional[QgsVectorLayer]):
+                 meshblock_electorate_layer: Optional[QgsVectorLayer],
+                 packed_store: Optional[PackedScenarioStore] = None):
         """
         Constructor for ScenarioRegistry
         :param source_layer: source layer for registry
         :param id_field: name of scenario id field
         :param name_field: name of scenario name field
         :param meshblock_electorate_layer: layer containing meshblock to electorate mapping for each scenario
+        :param packed_store: optional store of packed scenario assignments
         """
         self.source_layer = source_layer
         self.id_field = id_field
@@ -55,6 +76,112 @@ class ScenarioRegistry():
         self.created_by_field_index = source_layer.fields().lookupField(self.created_by_field)
         self.meshblock_electorate_layer = meshblock_electorate_layer
 
+        # dictionary of delta scenario to parent scenario. This is cached so that it can be
+        # safely used from background tasks.
+        self.parent_field_index = source_layer.fields().lookupField(self.PARENT_FIELD)
+        self.scenario_parents = {}
+        self.refresh_scenario_parents()
+
+        self.packed_store = packed_store
+        # incremented whenever a scenario's records change, so that packed copies
+        # built from older records can be discarded
+        self.packed_versions = {}
+
+        # scenario ids reserved for scenarios whose registry entries will be created later,
+        # e.g. by a running import task
+        self.reserved_scenario_ids = set()
+
+    @staticmethod
+    def add_parent_field(scenario_layer: QgsVectorLayer) -> bool:
+        """
+        Adds the parent scenario field, required for delta scenarios, to a scenario layer
+        if it is missing and the layer's provider allows it
+        :param scenario_layer: scenario layer
+        :returns: True if the layer has a parent scenario field
+        """
+        if scenario_layer.fields().lookupField(ScenarioRegistry.PARENT_FIELD) >= 0:
+            return True
+
+        if not scenario_layer.dataProvider().capabilities() & QgsVectorDataProvider.AddAttributes:
+            return False
+        if not scenario_layer.dataProvider().addAttributes([QgsField(ScenarioRegistry.PARENT_FIELD, QVariant.Int)]):
+            return False
+        scenario_layer.updateFields()
+        return scenario_layer.fields().lookupField(ScenarioRegistry.PARENT_FIELD) >= 0
+
+    def supports_delta_scenarios(self) -> bool:
+        """
+        Returns True if the registry can store scenarios as deltas against a parent scenario
+        """
+        return self.parent_field_index >= 0
+
+    def refresh_scenario_parents(self):
+        """
+        Refreshes the cached parents of delta scenarios from the source layer
+        """
+        self.scenario_parents = {}
+        if self.parent_field_index < 0:
+            return
+
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([self.id_field_index, self.parent_field_index])
+        for f in self.source_layer.getFeatures(request):
+            parent = f[self.parent_field_index]
+            if parent is not None and parent != NULL and f[self.id_field_index] != NULL:
+                self.scenario_parents[f[self.id_field_index]] = parent
+
+    def is_delta_scenario(self, scenario_id) -> bool:
+        """
+        Returns True if a scenario is stored as a delta against a parent scenario
+        :param scenario_id: scenario id
+        """
+        return scenario_id in self.scenario_parents
+
+    def scenario_chain(self, scenario_id) -> list:
+        """
+        Returns the list of scenarios which must be consulted to resolve a scenario's
+        meshblock assignments, starting with the scenario itself and followed by its
+        parent, grandparent, etc.
+        :param scenario_id: scenario id
+        """
+        chain = [scenario_id]
+        while chain[-1] in self.scenario_parents:
+            parent = self.scenario_parents[chain[-1]]
+            if parent in chain:
+                # circular reference - shouldn't happen!
+                break
+            chain.append(parent)
+        return chain
+
+    def delta_children(self, scenario_id) -> list:
+        """
+        Returns a list of the delta scenarios whose direct parent is the specified scenario
+        :param scenario_id: scenario id
+        """
+        return [child for child, parent in self.scenario_parents.items() if parent == scenario_id]
+
+    def set_parent_scenario(self, scenario_id, parent_scenario_id) -> bool:
+        """
+        Sets the parent of a scenario. Setting the parent to None marks the scenario
+        as complete, e.g. after its records have been materialized in full.
+        :param scenario_id: scenario id
+        :param parent_scenario_id: parent scenario id, or None
+        :returns: True if parent was successfully set
+        """
+        if self.parent_field_index < 0:
+            return parent_scenario_id is None
+
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([])
+        request.setFilterExpression(QgsExpression.createFieldEqualityExpression(self.id_field, scenario_id))
+        value = NULL if parent_scenario_id is None else parent_scenario_id
+        res = self.source_layer.dataProvider().changeAttributeValues(
+            {f.id(): {self.parent_field_index: value} for f in self.source_layer.getFeatures(request)})
+        self.refresh_scenario_parents()
+        return res
+
     def get_scenario_name(self, scenario) -> str:
         """
         Returns a user-friendly name corresponding to the given scenario
@@ -149,19 +276,72 @@ class ScenarioRegistry():
 
     def next_scenario_id(self) -> int:
         """
-        Returns the next available scenario ID
+        Returns the next available scenario ID, skipping any reserved IDs
+        """
+        return max([self.source_layer.maximumValue(self.id_field_index), 0] + list(self.reserved_scenario_ids)) + 1
+
+    def reserve_scenario_ids(self, count: int) -> List[int]:
+        """
+        Reserves a consecutive range of scenario IDs, so that they won't be used for any
+        other new scenarios until they are released. Reserved IDs can still be used when
+        explicitly creating a scenario via create_scenario().
+        :param count: number of IDs to reserve
+        :returns: list of reserved IDs
+        """
+        first = self.next_scenario_id()
+        reserved = list(range(first, first + count))
+        self.reserved_scenario_ids.update(reserved)
+        return reserved
+
+    def release_scenario_ids(self, scenario_ids: Iterable[int]):
+        """
+        Releases previously reserved scenario IDs
+        :param scenario_ids: IDs to release
         """
-        return max(self.source_layer.maximumValue(self.id_field_index), 0) + 1
+        self.reserved_scenario_ids.difference_update(scenario_ids)
 
-    def __insert_new_scenario(self, new_scenario_name: str, created_datetime: QDateTime = None, created_by: str = None):
+    def unique_scenario_name(self, scenario_name: str, reserved_names: Optional[List[str]] = None) -> str:
+        """
+        Returns a scenario name based on the specified name which does not already exist
+        :param scenario_name: preferred scenario name
+        :param reserved_names: optional list of additional names which must not be used
+        """
+        reserved_names = reserved_names or []
+        candidate = scenario_name
+        suffix = 2
+        while candidate in reserved_names or self.scenario_name_exists(candidate):
+            candidate = '{} ({})'.format(scenario_name, suffix)
+            suffix += 1
+        return candidate
+
+    def create_scenario(self, scenario_id, new_scenario_name: str, created_datetime: QDateTime = None,
+                        created_by: str = None):
+        """
+        Creates the registry entry for a scenario with a specific ID, e.g. for a scenario
+        whose meshblock records have already been imported
+        :param scenario_id: ID for new scenario
+        :param new_scenario_name: name for new scenario
+        :param created_datetime: optional datetime for scenario, if not set will be set to current date time
+        :param created_by: creator user name, if not set will be set to current user name
+        :return: scenario id if successful, and error message
+        """
+        if self.scenario_exists(scenario_id):
+            return False, QCoreApplication.translate('LinzRedistrict', 'Scenario {} already exists').format(scenario_id)
+        return self.__insert_new_scenario(new_scenario_name=new_scenario_name, created_datetime=created_datetime,
+                                          created_by=created_by, scenario_id=scenario_id)
+
+    def __insert_new_scenario(self, new_scenario_name: str, created_datetime: QDateTime = None, created_by: str = None,
+                              scenario_id=None, parent_scenario_id=None):
         """
         Inserts a scenario into the registry
         :param new_scenario_name: name for new scenario
         :param created_datetime: optional datetime for scenario, if not set will be set to current date time
         :param created_by: creator user name, if not set will be set to current user name
+        :param scenario_id: optional ID for scenario, if not set the next available ID will be used
+        :param parent_scenario_id: optional parent scenario, for delta scenarios
         :return: scenario id if successful, and error message
         """
-        next_id = self.next_scenario_id()
+        next_id = self.next_scenario_id() if scenario_id is None else scenario_id
 
         scenario_feature = QgsFeature()
         scenario_feature.initAttributes(self.source_layer.fields().count())
@@ -172,29 +352,31 @@ class ScenarioRegistry():
         scenario_feature[
             self.created_by_field_index] = QgsApplication.userFullName() if created_by is None else created_by
 
+        if self.parent_field_index >= 0 and parent_scenario_id is not None:
+            scenario_feature[self.parent_field_index] = parent_scenario_id
+
         if not self.source_layer.dataProvider().addFeatures([scenario_feature]):
             return False, QCoreApplication.translate('LinzRedistrict', 'Could not create scenario')
 
+        self.refresh_scenario_parents()
         return next_id, None
 
     @staticmethod
-    def __copy_records_from_scenario(source_meshblock_electorate_layer: QgsVectorLayer,
+    def __copy_records_from_scenario(source_registry: 'ScenarioRegistry',
                                      source_scenario_id,
                                      dest_meshblock_electorate_layer: QgsVectorLayer,
                                      new_scenario_id):
         """
         Copies the records associated with a scenario from one table to
-        another
-        :param source_meshblock_electorate_layer: layer containing source meshblock->electorate mappings
+        another. Delta scenarios are copied in full.
+        :param source_registry: registry containing source meshblock->electorate mappings
         :param source_scenario_id: source scenario id
         :param dest_meshblock_electorate_layer: destination layer for copied meshblock->electorate mappings
         :param new_scenario_id: new scenario id for copied records
         """
-        request = QgsFeatureRequest()
-        request.setFilterExpression(QgsExpression.createFieldEqualityExpression('scenario_id', source_scenario_id))
-        current_meshblocks = source_meshblock_electorate_layer.getFeatures(request)
-        scenario_id_idx = source_meshblock_electorate_layer.fields().lookupField('scenario_id')
-        fid_idx = source_meshblock_electorate_layer.fields().lookupField('fid')
+        current_meshblocks = source_registry.scenario_features(source_scenario_id)
+        scenario_id_idx = source_registry.meshblock_electorate_layer.fields().lookupField('scenario_id')
+        fid_idx = source_registry.meshblock_electorate_layer.fields().lookupField('fid')
         new_features = []
         for f in current_meshblocks:
             f[scenario_id_idx] = new_scenario_id
@@ -206,24 +388,56 @@ class ScenarioRegistry():
         dest_meshblock_electorate_layer.addFeatures(new_features)
         dest_meshblock_electorate_layer.commitChanges()
 
-    def branch_scenario(self, scenario_id, new_scenario_name: str):
+    def create_branch_scenario(self, scenario_id, new_scenario_name: str, delta: bool = False):
         """
-        Branches a scenario to a new scenario
+        Creates the registry entry for a new scenario branched from an existing scenario.
+        The meshblock records for the branch are NOT copied, see branch_scenario() and
+        BranchScenarioTask.
         :param scenario_id: scenario to branch
         :param new_scenario_name: name for new scenario
-        :returns New scenario ID if branch was successful, and error message if not
+        :param delta: set to True to create the branch as a delta scenario, which stores only
+        the records which differ from its parent scenario. In this case no records need to
+        be copied.
+        :returns New scenario ID if successful, and error message if not
         """
         if self.scenario_name_exists(new_scenario_name):
             return False, QCoreApplication.translate('LinzRedistrict', '{} already exists').format(new_scenario_name)
         if not self.scenario_exists(scenario_id):
             return False, QCoreApplication.translate('LinzRedistrict', 'Scenario {} does not exist').format(scenario_id)
+        if delta and not self.supports_delta_scenarios():
+            return False, QCoreApplication.translate('LinzRedistrict', 'Delta scenarios are not supported by this database')
 
-        # all good to go
-        new_id, error = self.__insert_new_scenario(new_scenario_name=new_scenario_name)
+        return self.__insert_new_scenario(new_scenario_name=new_scenario_name,
+                                          parent_scenario_id=scenario_id if delta else None)
+
+    def remove_scenario(self, scenario_id) -> bool:
+        """
+        Removes the registry entry for a scenario, e.g. after a failed branch. Meshblock
+        records associated with the scenario are not removed.
+        :param scenario_id: scenario to remove
+        :returns True if scenario was removed
+        """
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([])
+        request.setFilterExpression(QgsExpression.createFieldEqualityExpression(self.id_field, scenario_id))
+        res = self.source_layer.dataProvider().deleteFeatures([f.id() for f in self.source_layer.getFeatures(request)])
+        self.refresh_scenario_parents()
+        self.invalidate_packed_scenario(scenario_id)
+        return res
+
+    def branch_scenario(self, scenario_id, new_scenario_name: str):
+        """
+        Branches a scenario to a new scenario
+        :param scenario_id: scenario to branch
+        :param new_scenario_name: name for new scenario
+        :returns New scenario ID if branch was successful, and error message if not
+        """
+        new_id, error = self.create_branch_scenario(scenario_id, new_scenario_name)
         if not new_id:
             return False, error
 
-        ScenarioRegistry.__copy_records_from_scenario(source_meshblock_electorate_layer=self.meshblock_electorate_layer,
+        ScenarioRegistry.__copy_records_from_scenario(source_registry=self,
                                                       source_scenario_id=scenario_id,
                                                       dest_meshblock_electorate_layer=self.meshblock_electorate_layer,
                                                       new_scenario_id=new_id)
@@ -254,13 +468,215 @@ class ScenarioRegistry():
             return False, error
 
         ScenarioRegistry.__copy_records_from_scenario(
-            source_meshblock_electorate_layer=source_registry.meshblock_electorate_layer,
+            source_registry=source_registry,
             source_scenario_id=source_scenario_id,
             dest_meshblock_electorate_layer=self.meshblock_electorate_layer,
             new_scenario_id=new_id)
         return new_id, None
 
-    def electorate_meshblocks(self, electorate_id, electorate_type: str, scenario_id) -> QgsFeatureIterator:
+    def scenario_features(self, scenario_id, request: Optional[QgsFeatureRequest] = None,
+                          source: Optional[QgsFeatureSource] = None,
+                          meshblock_numbers: Optional[List[int]] = None) -> Iterable[QgsFeature]:
+        """
+        Returns the meshblock electorate features for a scenario. For delta scenarios, the
+        features are resolved through the chain of parent scenarios, so that each meshblock
+        is returned once using the record from the nearest scenario in the chain.
+        :param scenario_id: scenario id
+        :param request: optional feature request, e.g. to restrict the fetched attributes. Any
+        filter set on the request will be replaced.
+        :param source: optional feature source to read from, e.g. a thread-safe snapshot
+        of the meshblock electorates layer. If not set, the layer will be read directly.
+        :param meshblock_numbers: optional list of meshblock numbers to restrict the results to
+        """
+        request = QgsFeatureRequest(request) if request is not None else QgsFeatureRequest()
+        if source is None:
+            source = self.meshblock_electorate_layer
+        chain = self.scenario_chain(scenario_id)
+
+        if len(chain) == 1:
+            filter_expression = QgsExpression.createFieldEqualityExpression('scenario_id', scenario_id)
+        else:
+            filter_expression = '{} IN ({})'.format(QgsExpression.quotedColumnRef('scenario_id'),
+                                                    ', '.join(QgsExpression.quotedValue(s) for s in chain))
+        if meshblock_numbers is not None:
+            filter_expression += ' AND {} IN ({})'.format(QgsExpression.quotedColumnRef('meshblock_number'),
+                                                          ', '.join(str(int(m)) for m in meshblock_numbers))
+        request.setFilterExpression(filter_expression)
+
+        if len(chain) == 1:
+            return source.getFeatures(request)
+
+        fields = self.meshblock_electorate_layer.fields()
+        scenario_id_idx = fields.lookupField('scenario_id')
+        meshblock_number_idx = fields.lookupField('meshblock_number')
+        if request.flags() & QgsFeatureRequest.SubsetOfAttributes:
+            request.setSubsetOfAttributes(
+                list(set(request.subsetOfAttributes()) | {scenario_id_idx, meshblock_number_idx}))
+
+        rank = {s: i for i, s in enumerate(chain)}
+        resolved = OrderedDict()
+        for f in source.getFeatures(request):
+            meshblock_number = int(f[meshblock_number_idx])
+            feature_rank = rank[f[scenario_id_idx]]
+            if meshblock_number not in resolved or feature_rank < resolved[meshblock_number][0]:
+                resolved[meshblock_number] = (feature_rank, f)
+        return [f for _, f in resolved.values()]
+
+    def scenario_rows_sql(self, scenario_id, table: str, select: str, select_params: Optional[list] = None):
+        """
+        Returns a SQL query, and its parameters, for the meshblock electorate records of a scenario
+        stored within a database. For delta scenarios, the records are resolved through the chain of
+        parent scenarios.
+        :param scenario_id: scenario id
+        :param table: meshblock electorates table name, optionally prefixed with a schema name
+        :param select: SQL select list
+        :param select_params: optional parameters for the select list
+        """
+        return ScenarioRegistry.chain_rows_sql(self.scenario_chain(scenario_id), table, select, select_params)
+
+    @staticmethod
+    def chain_rows_sql(chain: list, table: str, select: str, select_params: Optional[list] = None):
+        """
+        Returns a SQL query, and its parameters, for the meshblock electorate records resolved
+        through a chain of scenarios
+        :param chain: scenario chain, as returned by scenario_chain()
+        :param table: meshblock electorates table name, optionally prefixed with a schema name
+        :param select: SQL select list
+        :param select_params: optional parameters for the select list
+        """
+        select_params = select_params or []
+        parts = []
+        params = []
+        for i, layer_scenario in enumerate(chain):
+            sql = 'SELECT {} FROM {} WHERE scenario_id=?'.format(select, table)
+            params.extend(select_params + [layer_scenario])
+            if i > 0:
+                sql += ' AND meshblock_number NOT IN (SELECT meshblock_number FROM {} WHERE scenario_id IN ({}))'.format(
+                    table, ', '.join('?' for _ in chain[:i]))
+                params.extend(chain[:i])
+            parts.append(sql)
+        return ' UNION ALL '.join(parts), params
+
+    def materialize_meshblocks(self, scenario_id, meshblock_numbers: List[int]) -> Dict[int, int]:
+        """
+        Ensures that a delta scenario has its own records for the specified meshblocks, by
+        copying any missing records from its parent scenarios
+        :param scenario_id: scenario id
+        :param meshblock_numbers: meshblock numbers
+        :returns: dictionary of meshblock number to feature id for newly created records
+        """
+        chain = self.scenario_chain(scenario_id)
+        if len(chain) == 1 or not meshblock_numbers:
+            return {}
+
+        fields = self.meshblock_electorate_layer.fields()
+        scenario_id_idx = fields.lookupField('scenario_id')
+        meshblock_number_idx = fields.lookupField('meshblock_number')
+        fid_idx = fields.lookupField('fid')
+
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([meshblock_number_idx])
+        request.setFilterExpression(QgsExpression.createFieldEqualityExpression('scenario_id', scenario_id))
+        existing = {int(f[meshblock_number_idx]) for f in self.meshblock_electorate_layer.getFeatures(request)}
+        missing = [int(m) for m in meshblock_numbers if int(m) not in existing]
+        if not missing:
+            return {}
+
+        new_features = []
+        for f in self.scenario_features(chain[1], meshblock_numbers=missing):
+            f[scenario_id_idx] = scenario_id
+            if fid_idx >= 0:
+                f[fid_idx] = NULL
+            new_features.append(f)
+
+        res, added = self.meshblock_electorate_layer.dataProvider().addFeatures(new_features)
+        if not res:
+            return {}
+        return {int(f[meshblock_number_idx]): f.id() for f in added}
+
+    def packed_version(self, scenario_id) -> int:
+        """
+        Returns the current version of a scenario's records, which is incremented
+        whenever the packed copy of the scenario is invalidated
+        :param scenario_id: scenario id
+        """
+        return self.packed_versions.get(scenario_id, 0)
+
+    def invalidate_packed_scenario(self, scenario_id):
+        """
+        Discards the packed copy of a scenario. Must be called whenever the
+        meshblock records for the scenario are changed.
+        :param scenario_id: scenario id
+        """
+        self.packed_versions[scenario_id] = self.packed_version(scenario_id) + 1
+        if self.packed_store is not None:
+            self.packed_store.remove_scenario(scenario_id)
+
+    def packable_assignments(self, scenario_id,
+                             source: Optional[QgsFeatureSource] = None) -> Optional[Dict[str, Dict[int, int]]]:
+        """
+        Returns the complete assignments for a scenario in the form required by
+        PackedScenarioStore.write_scenario()
+        :param scenario_id: scenario id
+        :param source: optional feature source to read from, e.g. a thread-safe snapshot
+        of the meshblock electorates layer. If not set, the layer will be read directly.
+        :returns: dictionary of electorate type to dictionary of meshblock number to
+        electorate id, or None if the scenario has non-integer electorate ids and
+        cannot be packed
+        """
+        fields = self.meshblock_electorate_layer.fields()
+        meshblock_number_idx = fields.lookupField('meshblock_number')
+        assert meshblock_number_idx >= 0
+        type_field_indices = OrderedDict()
+        for electorate_type in PackedScenarioStore.ELECTORATE_TYPES:
+            type_field_index = fields.lookupField('{}_id'.format(electorate_type.lower()))
+            if type_field_index >= 0:
+                type_field_indices[electorate_type] = type_field_index
+
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([meshblock_number_idx] + list(type_field_indices.values()))
+
+        result = OrderedDict([(electorate_type, {}) for electorate_type in type_field_indices])
+        for f in self.scenario_features(scenario_id, request=request, source=source):
+            meshblock_number = int(f[meshblock_number_idx])
+            for electorate_type, type_field_index in type_field_indices.items():
+                electorate_id = f[type_field_index]
+                if electorate_id is None or electorate_id == NULL:
+                    continue
+                if not isinstance(electorate_id, int):
+                    return None
+                result[electorate_type][meshblock_number] = electorate_id
+        return result
+
+    def pack_scenario(self, scenario_id, source: Optional[QgsFeatureSource] = None) -> bool:
+        """
+        Writes a packed copy of a scenario to the registry's packed store
+        :param scenario_id: scenario id
+        :param source: optional feature source to read from, e.g. a thread-safe snapshot
+        of the meshblock electorates layer. If not set, the layer will be read directly.
+        :returns: True if scenario was packed
+        """
+        assert self.packed_store is not None
+        assignments = self.packable_assignments(scenario_id, source=source)
+        if assignments is None:
+            return False
+        return self.packed_store.write_scenario(scenario_id, assignments)
+
+    def read_packed_scenario(self, scenario_id,
+                             electorate_types: Optional[List[str]] = None) -> Optional[PackedScenario]:
+        """
+        Reads the packed copy of a scenario from the registry's packed store
+        :param scenario_id: scenario id
+        :param electorate_types: list of electorate types to read. If not set, all types will be read.
+        :returns: packed scenario, or None if no packed copy is available
+        """
+        if self.packed_store is None:
+            return None
+        return self.packed_store.read_scenario(scenario_id, electorate_types)
+
+    def electorate_meshblocks(self, electorate_id, electorate_type: str, scenario_id) -> Iterable[QgsFeature]:
         """
         Returns meshblock features currently assigned to an electorate in a
         given scenario
@@ -274,11 +690,68 @@ class ScenarioRegistry():
         type_field_index = self.meshblock_electorate_layer.fields().lookupField(type_field)
         assert type_field_index >= 0
 
+        if self.is_delta_scenario(scenario_id):
+            # assignments may be overridden further down the chain, so can't filter by electorate upfront
+            return [f for f in self.scenario_features(scenario_id) if f[type_field_index] == electorate_id]
+
         request.setFilterExpression(QgsExpression.createFieldEqualityExpression('scenario_id', scenario_id))
         request.combineFilterExpression(QgsExpression.createFieldEqualityExpression(type_field, electorate_id))
 
         return self.meshblock_electorate_layer.getFeatures(request)
 
+    def scenario_electorate_meshblocks(self, scenario_id, electorate_types: Optional[List[str]] = None,
+                                       source: Optional[QgsFeatureSource] = None) -> Dict[
+                                           str, Dict[object, List[int]]]:
+        """
+        Returns the complete electorate to meshblock mapping for a scenario,
+        using a single read of the meshblock electorates table.
+        :param scenario_id: scenario id
+        :param electorate_types: list of electorate types to retrieve, e.g. ['GN','GS'].
+        If not set, all electorate types present in the table will be retrieved.
+        :param source: optional feature source to read from, e.g. a thread-safe snapshot
+        of the meshblock electorates layer. If not set, the layer will be read directly.
+        :returns: dictionary of electorate type to dictionary of electorate id to list
+        of assigned meshblock numbers
+        """
+        fields = self.meshblock_electorate_layer.fields()
+        meshblock_number_idx = fields.lookupField('meshblock_number')
+        assert meshblock_number_idx >= 0
+
+        type_field_indices = OrderedDict()
+        if electorate_types is None:
+            for electorate_type in ('GN', 'GS', 'M'):
+                type_field_index = fields.lookupField('{}_id'.format(electorate_type.lower()))
+                if type_field_index >= 0:
+                    type_field_indices[electorate_type] = type_field_index
+        else:
+            for electorate_type in electorate_types:
+                type_field_index = fields.lookupField('{}_id'.format(electorate_type.lower()))
+                assert type_field_index >= 0
+                type_field_indices[electorate_type] = type_field_index
+
+        packed = self.read_packed_scenario(scenario_id, list(type_field_indices.keys()))
+        if packed is not None and all(t in packed.assignments for t in type_field_indices):
+            return OrderedDict([(electorate_type, packed.electorate_meshblocks(electorate_type))
+                                for electorate_type in type_field_indices])
+
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([meshblock_number_idx] + list(type_field_indices.values()))
+
+        result = OrderedDict([(electorate_type, OrderedDict()) for electorate_type in type_field_indices])
+        for f in self.scenario_features(scenario_id, request=request, source=source):
+            meshblock_number = int(f[meshblock_number_idx])
+            for electorate_type, type_field_index in type_field_indices.items():
+                electorate_id = f[type_field_index]
+                if electorate_id is None or electorate_id == NULL:
+                    continue
+                type_result = result[electorate_type]
+                if electorate_id not in type_result:
+                    type_result[electorate_id] = []
+                type_result[electorate_id].append(meshblock_number)
+
+        return result
+
     def electorate_has_meshblocks(self, electorate_id, electorate_type: str, scenario_id) -> bool:
         """
         Returns true if the given electorate has meshblocks within the specified scenario
@@ -287,8 +760,8 @@ class ScenarioRegistry():
         :param scenario_id: scenario id
         """
         try:
-            next(self.electorate_meshblocks(electorate_id=electorate_id, electorate_type=electorate_type,
-                                            scenario_id=scenario_id))
+            next(iter(self.electorate_meshblocks(electorate_id=electorate_id, electorate_type=electorate_type,
+                                                 scenario_id=scenario_id)))
         except StopIteration:
             return False
 
@@ -16,6 +16,7 @@ __revision__ = '$Format:%H$'
 from qgis.PyQt.QtCore import Qt
 from qgis.PyQt.QtWidgets import (QDialog,
                                  QDialogButtonBox,
+                                 QAbstractItemView,
                                  QListWidget,
                                  QListWidgetItem,
                                  QVBoxLayout)
@@ -28,11 +29,12 @@ class ScenarioSelectionDialog(QDialog):
     A dialog used for selecting from available scenarios
     """
 
-    def __init__(self, scenario_registry: ScenarioRegistry, parent=None):
+    def __init__(self, scenario_registry: ScenarioRegistry, parent=None, allow_multiple_selection: bool = False):
         """
         Constructor for ScenarioSelectionDialog
         :param scenario_registry: linked scenario registry
         :param parent: parent widget
+        :param allow_multiple_selection: set to True to allow selection of multiple scenarios
         """
         super().__init__(parent)
 
@@ -53,6 +55,8 @@ class ScenarioSelectionDialog(QDialog):
             item = QListWidgetItem(title)
             item.setData(Qt.UserRole, scenario_id)
             self.list.addItem(item)
+        if allow_multiple_selection:
+            self.list.setSelectionMode(QAbstractItemView.ExtendedSelection)
 
         layout.addWidget(self.list, 10)
 
@@ -90,6 +94,14 @@ class ScenarioSelectionDialog(QDialog):
 
         return None
 
+    def selected_scenarios(self) -> list:
+        """
+        Returns a list of all scenarios selected in the dialog, in the order
+        they are listed
+        """
+        return [self.list.item(i).data(Qt.UserRole) for i in range(self.list.count())
+                if self.list.item(i).isSelected()]
+
     def filter_changed(self, filter_text):
         """
         Handles search filter changes
@@ -13,9 +13,13 @@ __copyright__ = 'Copyright 2018, LINZ'
 # This will get replaced with a git SHA1 when you do a git archive
 __revision__ = '$Format:%H$'
 
+from typing import (Iterable,
+                    Optional)
 from qgis.core import (QgsVectorLayer,
                        NULL)
 from redistrict.linz.scenario_registry import ScenarioRegistry
+from redistrict.linz.meshblock_store import MeshblockStore
+from redistrict.linz.electorate_geometry_cache import ElectorateGeometryCache
 from redistrict.linz.scenario_base_task import (ScenarioBaseTask,
                                                 CanceledException)
 
@@ -30,7 +34,10 @@ class ScenarioSwitchTask(ScenarioBaseTask):
     MESHBLOCKS = 'MESHBLOCKS'
 
     def __init__(self, task_name: str, electorate_layer: QgsVectorLayer, meshblock_layer: QgsVectorLayer,
-                 meshblock_number_field_name: str, scenario_registry: ScenarioRegistry, scenario):
+                 meshblock_number_field_name: str, scenario_registry: ScenarioRegistry, scenario,
+                 meshblock_store: Optional[MeshblockStore] = None,
+                 geometry_cache: Optional[ElectorateGeometryCache] = None, full_rebuild: bool = False,
+                 dirty_electorates: Optional[Iterable[int]] = None):
         """
         Constructor for ScenarioSwitchTask
         :param task_name: user-visible, translated name for task
@@ -39,10 +46,19 @@ class ScenarioSwitchTask(ScenarioBaseTask):
         :param meshblock_number_field_name: name of meshblock number field
         :param scenario_registry: scenario registry
         :param scenario: target scenario id to switch to
+        :param meshblock_store: optional session-wide meshblock store
+        :param geometry_cache: optional cache of dissolved electorate geometries
+        :param full_rebuild: set to True to rebuild all electorates from scratch. If False, only electorates
+        whose meshblocks differ from their current scenario will be rebuilt, using cached geometries
+        where available.
+        :param dirty_electorates: optional feature ids for electorates whose current geometry may not
+        match their meshblocks (e.g. electorates with pending boundary recalculations). These electorates
+        are always rebuilt.
         """
         super().__init__(task_name=task_name, electorate_layer=electorate_layer, meshblock_layer=meshblock_layer,
                          meshblock_number_field_name=meshblock_number_field_name, scenario_registry=scenario_registry,
-                         scenario=scenario, task=None)
+                         scenario=scenario, task=None, meshblock_store=meshblock_store,
+                         geometry_cache=geometry_cache)
 
         self.stats_nz_pop_field = 'stats_nz_pop'
         self.stats_nz_var_20_field = 'stats_nz_var_20'
@@ -55,14 +71,69 @@ class ScenarioSwitchTask(ScenarioBaseTask):
         self.stats_nz_var_23_field_index = self.electorate_layer.fields().lookupField(self.stats_nz_var_23_field)
         assert self.stats_nz_var_23_field_index >= 0
 
+        self.full_rebuild = full_rebuild
+        # full rebuilds are used to repair stale electorates, so cannot trust the cache
+        self.use_cached_geometries = not full_rebuild
+        self.dirty_electorates = set(dirty_electorates) if dirty_electorates is not None else set()
+        # feature ids for electorates which do not need to be rebuilt
+        self.unchanged_electorates = []
+
+    def prepare(self):
+        """
+        Prepares the electorates to process. Unless a full rebuild was requested,
+        electorates with identical meshblocks in their current scenario and the
+        target scenario are excluded from processing, unless they are dirty.
+        """
+        super().prepare()
+
+        self.unchanged_electorates = []
+        if self.full_rebuild:
+            return
+
+        current_assignments = {}
+        for params in self.electorates_to_process.values():
+            current_scenario = params[self.CURRENT_SCENARIO]
+            if current_scenario is None or current_scenario == NULL or current_scenario in current_assignments:
+                continue
+            if self.isCanceled():
+                raise CanceledException
+
+            current_assignments[current_scenario] = self.scenario_registry.scenario_electorate_meshblocks(
+                scenario_id=current_scenario, source=self.meshblock_electorate_source)
+
+        for electorate_id in list(self.electorates_to_process.keys()):
+            params = self.electorates_to_process[electorate_id]
+            if params[self.ELECTORATE_FEATURE_ID] in self.dirty_electorates:
+                # current geometry can't be trusted
+                continue
+
+            current_scenario = params[self.CURRENT_SCENARIO]
+            if current_scenario not in current_assignments:
+                continue
+
+            current_assignment = current_assignments[current_scenario]
+            if not any(current_assignment.values()):
+                # current scenario has no assigned meshblocks - e.g. it has been deleted
+                continue
+
+            current_meshblocks = current_assignment.get(params[self.ELECTORATE_TYPE], {}).get(electorate_id, [])
+            if set(current_meshblocks) == set(params[self.MESHBLOCKS]):
+                self.unchanged_electorates.append(params[self.ELECTORATE_FEATURE_ID])
+                del self.electorates_to_process[electorate_id]
+
     def run(self):  # pylint: disable=missing-docstring
         try:
+            self.prepare()
             electorate_geometries, electorate_attributes = self.calculate_new_electorates()
         except CanceledException:
             return False
 
         attribute_change_map = {}
         geometry_change_map = {}
+        # unchanged electorates keep their existing geometry, population and statistics
+        for electorate_feature_id in self.unchanged_electorates:
+            attribute_change_map[electorate_feature_id] = {self.scenario_id_idx: self.scenario}
+
         for params in self.electorates_to_process.values():
             electorate_feature_id = params[self.ELECTORATE_FEATURE_ID]
 
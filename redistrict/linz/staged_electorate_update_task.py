@@ -13,11 +13,18 @@ __copyright__ = 'Copyright 2018, LINZ'
 # This will get replaced with a git SHA1 when you do a git archive
 __revision__ = '$Format:%H$'
 
+import sqlite3
+from typing import Optional
+from qgis.PyQt.QtCore import QVariant
 from qgis.core import (NULL,
+                       QgsField,
                        QgsTask,
+                       QgsVectorDataProvider,
                        QgsFeatureRequest,
+                       QgsMessageLog,
                        QgsVectorLayer,
-                       QgsExpression)
+                       QgsVectorLayerFeatureSource)
+from redistrict.linz.db_utils import DbUtils
 from redistrict.linz.scenario_registry import ScenarioRegistry
 
 
@@ -26,8 +33,56 @@ class UpdateStagedElectoratesTask(QgsTask):
     A background task for updating staged electorates
     """
 
+    STAGED_ELECTORATE_FIELD = 'staged_electorate'
+    # per-task staged electorate fields
+    TASK_STAGED_FIELDS = {'GN': 'staged_gn',
+                          'GS': 'staged_gs',
+                          'M': 'staged_m'}
+
+    @staticmethod
+    def has_task_fields(meshblock_layer: QgsVectorLayer) -> bool:
+        """
+        Returns True if the meshblock layer has separate staged electorate fields for each task
+        :param meshblock_layer: meshblock layer
+        """
+        return all(meshblock_layer.fields().lookupField(f) >= 0
+                   for f in UpdateStagedElectoratesTask.TASK_STAGED_FIELDS.values())
+
+    @staticmethod
+    def add_task_fields(meshblock_layer: QgsVectorLayer) -> bool:
+        """
+        Adds any missing per-task staged electorate fields to the meshblock layer, if the
+        layer's provider allows it. The new fields will be empty until the staged electorates
+        are next updated.
+        :param meshblock_layer: meshblock layer
+        :returns: True if the layer has per-task staged electorate fields
+        """
+        missing = [f for f in UpdateStagedElectoratesTask.TASK_STAGED_FIELDS.values() if
+                   meshblock_layer.fields().lookupField(f) < 0]
+        if not missing:
+            return True
+
+        if not meshblock_layer.dataProvider().capabilities() & QgsVectorDataProvider.AddAttributes:
+            return False
+        if not meshblock_layer.dataProvider().addAttributes([QgsField(f, QVariant.Int) for f in missing]):
+            return False
+        meshblock_layer.updateFields()
+        return UpdateStagedElectoratesTask.has_task_fields(meshblock_layer)
+
+    @staticmethod
+    def staged_field_for_task(meshblock_layer: QgsVectorLayer, task: str) -> str:
+        """
+        Returns the name of the meshblock layer field containing staged electorates for a task
+        :param meshblock_layer: meshblock layer
+        :param task: task, e.g. 'GN', 'GS' or 'M'
+        """
+        if task and UpdateStagedElectoratesTask.has_task_fields(meshblock_layer):
+            return UpdateStagedElectoratesTask.TASK_STAGED_FIELDS[task.upper()]
+        return UpdateStagedElectoratesTask.STAGED_ELECTORATE_FIELD
+
     def __init__(self, task_name: str, meshblock_layer: QgsVectorLayer,  # pylint: disable=too-many-locals
-                 meshblock_number_field_name: str, scenario_registry: ScenarioRegistry, scenario, task: str):
+                 meshblock_number_field_name: str, scenario_registry: ScenarioRegistry, scenario,
+                 task: Optional[str] = None):
         """
         Constructor for ScenarioSwitchTask
         :param task_name: user-visible, translated name for task
@@ -36,53 +91,156 @@ class UpdateStagedElectoratesTask(QgsTask):
         :param meshblock_number_field_name: name of meshblock number field
         :param scenario_registry: scenario registry
         :param scenario: target scenario id to switch to
-        :param task: current task
+        :param task: current task. This is ignored if the meshblock layer has separate
+        staged electorate fields for each task, in which case the staged electorates
+        for all tasks are updated.
         """
         super().__init__(task_name)
 
         self.scenario = scenario
+        self.scenario_registry = scenario_registry
 
         self.mb_number_idx = scenario_registry.meshblock_electorate_layer.fields().lookupField('meshblock_number')
-
-        electorate_field_name = '{}_id'.format(task.lower())
-        self.electorate_field_idx = scenario_registry.meshblock_electorate_layer.fields().lookupField(
-            electorate_field_name)
-        assert self.electorate_field_idx >= 0
         self.scenario_id_field_idx = scenario_registry.meshblock_electorate_layer.fields().lookupField('scenario_id')
         assert self.scenario_id_field_idx >= 0
-        self.staged_electorate_field_idx = meshblock_layer.fields().lookupField('staged_electorate')
-        assert self.staged_electorate_field_idx >= 0
+
+        # list of (electorate field name, electorate field index, staged field name, staged field index) to update
+        if self.has_task_fields(meshblock_layer):
+            tasks = list(self.TASK_STAGED_FIELDS.keys())
+        else:
+            assert task
+            tasks = [task.upper()]
+        self.targets = []
+        for t in tasks:
+            electorate_field_name = '{}_id'.format(t.lower())
+            electorate_field_idx = scenario_registry.meshblock_electorate_layer.fields().lookupField(
+                electorate_field_name)
+            assert electorate_field_idx >= 0
+            staged_field_name = self.staged_field_for_task(meshblock_layer, t)
+            staged_field_idx = meshblock_layer.fields().lookupField(staged_field_name)
+            assert staged_field_idx >= 0
+            self.targets.append((electorate_field_name, electorate_field_idx, staged_field_name, staged_field_idx))
+
         self.meshblock_number_idx = meshblock_layer.fields().lookupField(meshblock_number_field_name)
         assert self.meshblock_number_idx >= 0
+        self.meshblock_number_field_name = meshblock_number_field_name
         self.meshblock_layer = meshblock_layer
 
-        request = QgsFeatureRequest()
-        request.setFilterExpression(QgsExpression.createFieldEqualityExpression('scenario_id', scenario))
-        request.setSubsetOfAttributes([self.mb_number_idx, self.electorate_field_idx])
-        self.meshblocks_for_scenario = scenario_registry.meshblock_electorate_layer.getFeatures(request)
+        # if the meshblocks and scenario assignments are stored in the same database, the
+        # staged electorates can be updated directly within the database
+        self.database_path = DbUtils.database_path_for_layer(meshblock_layer)
+        self.meshblock_table = DbUtils.table_name_for_layer(meshblock_layer)
+        self.meshblock_electorate_table = DbUtils.table_name_for_layer(scenario_registry.meshblock_electorate_layer)
+        if self.database_path != DbUtils.database_path_for_layer(scenario_registry.meshblock_electorate_layer) \
+                or self.meshblock_table is None or self.meshblock_electorate_table is None:
+            self.database_path = None
+        # set to True if the database was updated directly, and the layer must be reloaded
+        self.updated_database = False
+
+        self.meshblock_electorate_source = QgsVectorLayerFeatureSource(scenario_registry.meshblock_electorate_layer)
+        self.meshblock_source = QgsVectorLayerFeatureSource(meshblock_layer)
 
         self.setDependentLayers([meshblock_layer])
 
     def run(self):  # pylint: disable=missing-docstring
-        # build dictionary of meshblock number to electorate field
-        meshblock_electorate = {m[self.mb_number_idx]: m[self.electorate_field_idx] for m in
-                                self.meshblocks_for_scenario}
+        if self.database_path is not None:
+            if self.update_database():
+                self.updated_database = True
+                return True
+            if self.isCanceled():
+                return False
+
+        return self.update_layer()
+
+    def update_database(self) -> bool:
+        """
+        Updates the staged electorates via a single joined UPDATE within the database
+        :returns: True if update was successful
+        """
+        try:
+            connection = DbUtils.connect(self.database_path)
+            try:
+                # the meshblock table's spatial index triggers require the GeoPackage functions
+                DbUtils.register_geopackage_functions(connection)
+                connection.set_progress_handler(lambda: 1 if self.isCanceled() else 0, 10000)
+                electorate_columns = ['electorate_{}'.format(i) for i in range(len(self.targets))]
+                connection.execute('CREATE TEMP TABLE staged_electorates '
+                                   '(meshblock_number INTEGER PRIMARY KEY, {})'.format(
+                                       ', '.join('{} INTEGER'.format(c) for c in electorate_columns)))
+                self.setProgress(10)
+                sql, params = self.scenario_registry.scenario_rows_sql(
+                    self.scenario, '"{}"'.format(self.meshblock_electorate_table),
+                    'meshblock_number, {}'.format(', '.join('"{}"'.format(t[0]) for t in self.targets)))
+                connection.execute('INSERT OR REPLACE INTO staged_electorates (meshblock_number, {}) {}'.format(
+                    ', '.join(electorate_columns), sql), params)
+                self.setProgress(40)
+                connection.execute('UPDATE "{0}" SET {1}'.format(
+                    self.meshblock_table,
+                    ', '.join('"{0}"=(SELECT {1} FROM staged_electorates WHERE '
+                              'staged_electorates.meshblock_number=CAST("{2}"."{3}" AS INTEGER))'.format(
+                                  target[2], column, self.meshblock_table, self.meshblock_number_field_name)
+                              for target, column in zip(self.targets, electorate_columns))))
+                self.setProgress(90)
+                connection.commit()
+            finally:
+                connection.close()
+        except sqlite3.Error as e:
+            if not self.isCanceled():
+                QgsMessageLog.logMessage('Could not update staged electorates in database: {}'.format(e),
+                                         "REDISTRICT")
+            return False
+
+        self.setProgress(100)
+        return True
 
+    def update_layer(self) -> bool:
+        """
+        Updates the staged electorates through the meshblock layer's data provider,
+        writing only changed values. All changes are written in a single call, so
+        canceling the task leaves the staged electorates untouched.
+        :returns: True if update was successful
+        """
+        # build dictionary of meshblock number to electorate fields
+        request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([self.mb_number_idx] + [t[1] for t in self.targets])
+        meshblock_electorates = {m[self.mb_number_idx]: [m[t[1]] for t in self.targets] for m in
+                                 self.scenario_registry.scenario_features(self.scenario, request=request,
+                                                                          source=self.meshblock_electorate_source)}
+        if self.isCanceled():
+            return False
+
+        no_electorates = [NULL] * len(self.targets)
         attribute_change_map = {}
         request = QgsFeatureRequest()
-        request.setSubsetOfAttributes([self.meshblock_number_idx])
+        request.setSubsetOfAttributes([self.meshblock_number_idx] + [t[3] for t in self.targets])
         request.setFlags(QgsFeatureRequest.NoGeometry)
         to_process = self.meshblock_layer.featureCount()
-        for i, m in enumerate(self.meshblock_layer.getFeatures(request)):
-            self.setProgress(80 * i / to_process)
-            if not int(m[self.meshblock_number_idx]) in meshblock_electorate:
-                electorate = NULL
-            else:
-                electorate = meshblock_electorate[int(m[self.meshblock_number_idx])]
-            attribute_change_map[m.id()] = {self.staged_electorate_field_idx: electorate}
+        for i, m in enumerate(self.meshblock_source.getFeatures(request)):
+            if self.isCanceled():
+                return False
+
+            electorates = meshblock_electorates.get(int(m[self.meshblock_number_idx]), no_electorates)
+            changes = {target[3]: electorate for target, electorate in zip(self.targets, electorates)
+                       if m[target[3]] != electorate}
+            if changes:
+                attribute_change_map[m.id()] = changes
+
+            if to_process:
+                self.setProgress(100 * i / to_process)
+
+        if self.isCanceled():
+            return False
 
         # commit changes
-        if not self.meshblock_layer.dataProvider().changeAttributeValues(attribute_change_map):
+        if attribute_change_map and not self.meshblock_layer.dataProvider().changeAttributeValues(
+                attribute_change_map):
             return False
 
+        self.setProgress(100)
         return True
+
+    def finished(self, result: bool):  # pylint: disable=missing-docstring
+        if result and self.updated_database:
+            # layer must be reloaded to pick up the changes made directly to the database
+            self.meshblock_layer.reload()
+            self.meshblock_layer.triggerRepaint()
@@ -13,12 +13,22 @@ __copyright__ = 'Copyright 2018, LINZ'
 # This will get replaced with a git SHA1 when you do a git archive
 __revision__ = '$Format:%H$'
 
+from collections import OrderedDict
+from typing import (List,
+                    Optional,
+                    Tuple)
 from qgis.PyQt.QtCore import QCoreApplication
 from qgis.core import (QgsVectorLayer,
-                       QgsGeometry,
+                       QgsExpression,
+                       QgsFeatureRequest,
                        NULL)
+from redistrict.core.dissolve import dissolve_geometries
 from redistrict.linz.linz_district_registry import LinzElectoralDistrictRegistry
 from redistrict.linz.scenario_registry import ScenarioRegistry
+from redistrict.linz.meshblock_store import MeshblockStore
+from redistrict.linz.electorate_geometry_cache import ElectorateGeometryCache
+from redistrict.linz.meshblock_adjacency import MeshblockAdjacency
+from redistrict.linz.electorate_validation_cache import ElectorateValidationCache
 from redistrict.linz.scenario_base_task import (ScenarioBaseTask,
                                                 CanceledException)
 
@@ -34,7 +44,11 @@ class ValidationTask(ScenarioBaseTask):
 
     def __init__(self, task_name: str, electorate_registry: LinzElectoralDistrictRegistry,
                  meshblock_layer: QgsVectorLayer,
-                 meshblock_number_field_name: str, scenario_registry: ScenarioRegistry, scenario, task: str):
+                 meshblock_number_field_name: str, scenario_registry: ScenarioRegistry, scenario, task: str,
+                 meshblock_store: Optional[MeshblockStore] = None,
+                 geometry_cache: Optional[ElectorateGeometryCache] = None,
+                 adjacency: Optional[MeshblockAdjacency] = None,
+                 validation_cache: Optional[ElectorateValidationCache] = None):
         """
         Constructor for ScenarioSwitchTask
         :param task_name: user-visible, translated name for task
@@ -44,92 +58,159 @@ class ValidationTask(ScenarioBaseTask):
         :param scenario_registry: scenario registry
         :param scenario: target scenario id to switch to
         :param task: current task
+        :param meshblock_store: optional session-wide meshblock store
+        :param geometry_cache: optional cache of dissolved electorate geometries
+        :param adjacency: optional session-wide meshblock adjacency graph. If not set,
+        the graph will be calculated from the meshblock geometries
+        :param validation_cache: optional cache of electorate validation results. If set,
+        only electorates which have changed since they were last validated will be re-checked
         """
         self.electorate_registry = electorate_registry
         super().__init__(task_name=task_name, electorate_layer=self.electorate_registry.source_layer,
                          meshblock_layer=meshblock_layer,
                          meshblock_number_field_name=meshblock_number_field_name, scenario_registry=scenario_registry,
-                         scenario=scenario, task=task)
+                         scenario=scenario, task=task, meshblock_store=meshblock_store,
+                         geometry_cache=geometry_cache)
         self.results = []
 
+        if adjacency is None:
+            adjacency = MeshblockAdjacency(meshblock_store=self.meshblock_store)
+        self.adjacency = adjacency
+        self.validation_cache = validation_cache
+
         # immediately clear existing validation results
+        request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([self.type_idx])
+        if self.task:
+            request.setFilterExpression(QgsExpression.createFieldEqualityExpression('type', self.task))
         attribute_change_map = {}
-        for e in self.electorates_to_process.values():
-            attribute_change_map[e[self.ELECTORATE_FEATURE_ID]] = {
+        for f in self.electorate_layer.getFeatures(request):
+            attribute_change_map[f.id()] = {
                 self.invalid_idx: NULL,
                 self.invalid_reason_idx: NULL
             }
         self.electorate_layer.dataProvider().changeAttributeValues(attribute_change_map)
 
-    def run(self):  # pylint: disable=missing-docstring, too-many-locals
+    def validate_electorate(self, attributes: dict, quota: int, population: int) -> Tuple[List[str], List[List[int]]]:
+        """
+        Validates a single electorate
+        :param attributes: electorate attributes, as returned by calculate_electorate_attributes
+        :param quota: quota for electorate type
+        :param population: population to use for quota checks
+        :returns: list of validation errors, and list of contiguous parts (as meshblock
+        store rows) if the electorate is non-contiguous
+        """
+        expected_regions = attributes[self.EXPECTED_REGIONS]
+        deprecated = attributes[self.DEPRECATED]
+
+        # meshblocks without geometry have no parts in the adjacency graph
+        parts = self.adjacency.components(attributes[self.MESHBLOCK_ROWS])
+
+        errors = []
+        # quota check
+        if not deprecated and self.electorate_registry.variation_exceeds_allowance(quota=quota, population=population):
+            errors.append(QCoreApplication.translate('LinzRedistrict', 'Outside quota tolerance'))
+
+        # contiguity check
+        if deprecated and parts:
+            errors.append(QCoreApplication.translate('LinzRedistrict', 'Deprecated electorate has meshblocks assigned'))
+        elif len(parts) > 1 and len(parts) > expected_regions:
+            errors.append(QCoreApplication.translate('LinzRedistrict', 'Electorate is non-contiguous'))
+            return errors, parts
+        elif len(parts) <= 1 and expected_regions > 1:
+            errors.append(QCoreApplication.translate('LinzRedistrict', 'Electorate has less parts than expected'))
+
+        return errors, []
+
+    def run(self):  # pylint: disable=missing-docstring, too-many-locals, too-many-branches
         try:
-            electorate_geometries, electorate_attributes = self.calculate_new_electorates()
+            self.prepare()
+            electorate_attributes = self.calculate_electorate_attributes()
         except CanceledException:
             return False
 
+        # determine which electorates have changed since they were last validated
+        content_hashes = {}
+        validation_params = {}
+        for electorate_feature_id, attributes in electorate_attributes.items():
+            # prefer stats nz pop if available
+            pop = attributes[self.STATS_NZ_POP] if attributes[self.STATS_NZ_POP] is not None and attributes[self.STATS_NZ_POP] != NULL else attributes[self.ESTIMATED_POP]
+            quota = self.electorate_registry.get_quota_for_district_type(attributes[self.ELECTORATE_TYPE])
+            validation_params[electorate_feature_id] = (quota, pop)
+            content_hashes[attributes[self.ELECTORATE_ID]] = ElectorateValidationCache.content_hash(
+                electorate_type=attributes[self.ELECTORATE_TYPE], meshblocks=attributes[self.MESHBLOCKS],
+                population=pop, quota=quota, expected_regions=attributes[self.EXPECTED_REGIONS],
+                deprecated=attributes[self.DEPRECATED])
+
+        cached = self.validation_cache.lookup(content_hashes) if self.validation_cache is not None else {}
+
+        # the adjacency graph is only required if some electorates need re-checking
+        if len(cached) < len(content_hashes) and not self.adjacency.ensure_built(self.feedback):
+            return False
+
+        # first pass - determine validation errors, using the meshblock adjacency graph to
+        # determine contiguous parts without dissolving any geometries
+        electorate_errors = OrderedDict()
+        electorate_parts = {}
         attribute_change_map = {}
+        cache_entries = {}
         for electorate_feature_id, attributes in electorate_attributes.items():
             if self.isCanceled():
                 return False
 
             electorate_id = attributes[self.ELECTORATE_ID]
-            # prefer stats nz pop if available
-            pop = attributes[self.STATS_NZ_POP] if attributes[self.STATS_NZ_POP] is not None and attributes[self.STATS_NZ_POP] != NULL else attributes[self.ESTIMATED_POP]
-            electorate_type = attributes[self.ELECTORATE_TYPE]
-            expected_regions = attributes[self.EXPECTED_REGIONS]
-            deprecated = attributes[self.DEPRECATED]
-
-            quota = self.electorate_registry.get_quota_for_district_type(electorate_type)
-            name = self.electorate_registry.get_district_title(electorate_id)
-            geometry = electorate_geometries[electorate_feature_id]
+            if electorate_id in cached:
+                errors, part_meshblocks = cached[electorate_id]
+                parts = [self.meshblock_store.rows_for_meshblocks(p) for p in part_meshblocks]
+            else:
+                quota, pop = validation_params[electorate_feature_id]
+                errors, parts = self.validate_electorate(attributes, quota=quota, population=pop)
+                cache_entries[electorate_id] = (content_hashes[electorate_id], errors,
+                                                [[self.meshblock_store.meshblock_numbers[r] for r in p] for p in parts])
 
             # clear any existing validation result
             attribute_change_map[electorate_feature_id] = {self.invalid_idx: 0,
                                                            self.invalid_reason_idx: NULL,
                                                            self.scenario_id_idx: self.scenario,
                                                            self.estimated_pop_idx: attributes[self.ESTIMATED_POP]}
-            # quota check
-            if not deprecated and self.electorate_registry.variation_exceeds_allowance(quota=quota, population=pop):
-                error = QCoreApplication.translate('LinzRedistrict', 'Outside quota tolerance')
-                self.results.append({self.ELECTORATE_ID: electorate_id,
-                                     self.ELECTORATE_NAME: name,
-                                     self.ELECTORATE_GEOMETRY: geometry,
-                                     self.ERROR: error})
+            if errors:
+                electorate_errors[electorate_feature_id] = errors
+                if parts:
+                    electorate_parts[electorate_feature_id] = parts
                 attribute_change_map[electorate_feature_id] = {self.invalid_idx: 1,
-                                                               self.invalid_reason_idx: error}
+                                                               self.invalid_reason_idx: errors[-1]}
 
-            # contiguity check
-            if deprecated and not geometry.isEmpty():
-                error = QCoreApplication.translate('LinzRedistrict', 'Deprecated electorate has meshblocks assigned')
-                self.results.append({self.ELECTORATE_ID: electorate_id,
-                                     self.ELECTORATE_NAME: name,
-                                     self.ELECTORATE_GEOMETRY: geometry,
-                                     self.ERROR: error})
-                attribute_change_map[electorate_feature_id] = {self.invalid_idx: 1,
-                                                               self.invalid_reason_idx: error}
-            elif geometry.isMultipart() and geometry.constGet().numGeometries() > expected_regions:
-                error = QCoreApplication.translate('LinzRedistrict', 'Electorate is non-contiguous')
+        if self.validation_cache is not None:
+            self.validation_cache.store(cache_entries)
+
+        # second pass - geometries are only required for invalid electorates, so that
+        # the results can be zoomed to
+        try:
+            electorate_geometries = self.calculate_electorate_geometries(electorate_attributes,
+                                                                         list(electorate_errors.keys()))
+        except CanceledException:
+            return False
+
+        for electorate_feature_id, errors in electorate_errors.items():
+            if self.isCanceled():
+                return False
+
+            electorate_id = electorate_attributes[electorate_feature_id][self.ELECTORATE_ID]
+            name = self.electorate_registry.get_district_title(electorate_id)
+            geometry = electorate_geometries[electorate_feature_id]
+            for error in errors:
                 self.results.append({self.ELECTORATE_ID: electorate_id,
                                      self.ELECTORATE_NAME: name,
                                      self.ELECTORATE_GEOMETRY: geometry,
                                      self.ERROR: error})
-                attribute_change_map[electorate_feature_id] = {self.invalid_idx: 1,
-                                                               self.invalid_reason_idx: error}
-                for p in range(geometry.constGet().numGeometries()):
-                    part = QgsGeometry(geometry.constGet().geometryN(p).clone())
-                    error = 'Contiguous part {}'.format(p + 1)
-                    self.results.append({self.ELECTORATE_ID: electorate_id,
-                                         self.ELECTORATE_NAME: name,
-                                         self.ELECTORATE_GEOMETRY: part,
-                                         self.ERROR: error})
-            elif not geometry.isMultipart() and expected_regions > 1:
-                error = QCoreApplication.translate('LinzRedistrict', 'Electorate has less parts than expected')
+
+            for p, part_rows in enumerate(electorate_parts.get(electorate_feature_id, [])):
+                part = dissolve_geometries(self.meshblock_store.geometries_for_rows(part_rows))
+                error = 'Contiguous part {}'.format(p + 1)
                 self.results.append({self.ELECTORATE_ID: electorate_id,
                                      self.ELECTORATE_NAME: name,
-                                     self.ELECTORATE_GEOMETRY: geometry,
+                                     self.ELECTORATE_GEOMETRY: part,
                                      self.ERROR: error})
-                attribute_change_map[electorate_feature_id] = {self.invalid_idx: 1,
-                                                               self.invalid_reason_idx: error}
 
         if self.isCanceled():
             return False
@@ -16,6 +16,7 @@ __copyright__ = 'Copyright 2018, LINZ'
 __revision__ = '$Format:%H$'
 
 import os.path
+import re
 from functools import partial
 from typing import Optional
 from qgis.PyQt import sip
@@ -44,6 +45,7 @@ from qgis.core import (NULL,
                        Qgis,
                        QgsSettings,
                        QgsTask,
+                       QgsRuleBasedRenderer,
                        QgsProviderRegistry)
 from qgis.gui import (QgisInterface,
                       QgsMapTool,
@@ -69,10 +71,16 @@ from .linz.linz_redistricting_dock_widget import LinzRedistrictingDockWidget
 from .linz.linz_validation_results_dock_widget import LinzValidationResultsDockWidget
 from .linz.linz_redistrict_gui_handler import LinzRedistrictGuiHandler
 from .linz.scenario_selection_dialog import ScenarioSelectionDialog
-from .linz.db_utils import CopyFileTask
+from .linz.db_utils import (ClusterTableTask,
+                           CopyFileTask,
+                           DbUtils)
 from .linz.create_electorate_dialog import CreateElectorateDialog
 from .linz.deprecate_electorate_dialog import DeprecateElectorateDialog
 from .linz.scenario_switch_task import ScenarioSwitchTask
+from .linz.scenario_branch_task import (BranchScenarioTask,
+                                        CompactScenarioTask)
+from .linz.scenario_import_task import (ImportedScenario,
+                                        ImportScenariosTask)
 from .linz.staged_electorate_update_task import UpdateStagedElectoratesTask
 from .linz.linz_mb_scenario_bridge import LinzMeshblockScenarioBridge
 from .linz.validation_task import ValidationTask
@@ -80,7 +88,16 @@ from .linz.export_task import ExportTask
 from .linz.nz_electoral_api import ConcordanceItem, BoundaryRequest, get_api_connector
 from .linz.api_request_queue import ApiRequestQueue
 from .linz.electorate_changes_queue import ElectorateEditQueue
+from .linz.electorate_boundary_updater import ElectorateBoundaryUpdater
 from .linz.population_dock_widget import SelectedPopulationDockWidget
+from .linz.electorate_geometry_cache import ElectorateGeometryCache
+from .linz.meshblock_adjacency import MeshblockAdjacency
+from .linz.electorate_validation_cache import ElectorateValidationCache
+from .linz.meshblock_store import MeshblockStore
+from .linz.population_ledger import PopulationLedger
+from .linz.meshblock_topology import MeshblockTopology
+from .linz.packed_scenario_store import (PackedScenarioStore,
+                                         PackScenariosTask)
 
 VERSION = '0.1'
 
@@ -160,11 +177,23 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         self.user_log_layer = None
         self.scenario_registry = None
         self.meshblock_scenario_bridge = None
+        self.meshblock_store = None
+        self.population_ledger = None
+        self.meshblock_topology = None
+        self.geometry_cache = None
+        self.meshblock_adjacency = None
+        self.validation_cache = None
         self.db_source = os.path.join(self.plugin_dir,
                                       'db', 'nz_db.gpkg')
         self.electorate_edit_queue = None
+        self.boundary_updater = None
         self.task = None
         self.copy_task = None
+        self.cluster_task = None
+        self.pack_task = None
+        self.branch_task = None
+        self.import_task = None
+        self.compact_task = None
         self.switch_task = None
         self.staged_task = None
         self.validation_task = None
@@ -336,6 +365,7 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         self.selected_population_dock = SelectedPopulationDockWidget(self.iface, self.meshblock_layer)
         self.selected_population_dock.set_task(self.context.task)
         self.selected_population_dock.set_district_registry(self.get_district_registry())
+        self.selected_population_dock.set_population_ledger(self.get_population_ledger())
         self.iface.addDockWidget(Qt.RightDockWidgetArea, self.selected_population_dock)
         self.selected_population_dock.setFloating(True)
         self.selected_population_dock.setUserVisible(False)
@@ -388,6 +418,16 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         import_scenario_action.triggered.connect(self.import_scenario)
         self.scenarios_menu.addAction(import_scenario_action)
 
+        self.scenarios_menu.addSeparator()
+        delta_branches_action = QAction(self.tr('Store Branches as Changes Only'), parent=self.scenarios_menu)
+        delta_branches_action.setCheckable(True)
+        delta_branches_action.setChecked(QgsSettings().value('redistricting/delta_branches', False, bool))
+        delta_branches_action.toggled.connect(partial(QgsSettings().setValue, 'redistricting/delta_branches'))
+        self.scenarios_menu.addAction(delta_branches_action)
+        compact_scenario_action = QAction(self.tr('Store Current Scenario in Full'), parent=self.scenarios_menu)
+        compact_scenario_action.triggered.connect(self.compact_scenario)
+        self.scenarios_menu.addAction(compact_scenario_action)
+
         self.scenarios_tool_button.setMenu(self.scenarios_menu)
         self.dock.dock_toolbar().addWidget(self.scenarios_tool_button)
 
@@ -419,6 +459,9 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         load_meshblocks_action = QAction(self.tr('Load New Meshblocks...'), parent=self.database_menu)
         load_meshblocks_action.triggered.connect(self.load_meshblocks)
         self.database_menu.addAction(load_meshblocks_action)
+        optimize_storage_action = QAction(self.tr('Optimize Scenario Storage...'), parent=self.database_menu)
+        optimize_storage_action.triggered.connect(self.optimize_scenario_storage)
+        self.database_menu.addAction(optimize_storage_action)
 
         options_menu.addMenu(self.database_menu)
 
@@ -445,7 +488,7 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
 
         self.dock.dock_toolbar().addAction(self.help_action)
 
-        self.set_task(QgsSettings().value('redistricting/last_task', self.TASK_GN))
+        self.set_task(QgsSettings().value('redistricting/last_task', self.TASK_GN), refresh_staged_electorates=True)
 
     def begin_redistricting(self, checked):
         """
@@ -497,15 +540,25 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
             self.begin_action.setChecked(False)
             return
 
+        # separate staged electorate fields for each task allow tasks to be switched
+        # without rewriting the staged electorates
+        UpdateStagedElectoratesTask.add_task_fields(self.meshblock_layer)
+        # allows scenarios to be stored as changes against a parent scenario
+        ScenarioRegistry.add_parent_field(self.scenario_layer)
+        self.ensure_meshblock_electorate_indexes()
+
         self.is_redistricting = True
         self.begin_action.setChecked(True)
 
         self.db_source = self.electorate_layer.dataProvider().dataSourceUri().split('|')[0]
 
+        meshblock_electorate_db = DbUtils.database_path_for_layer(self.meshblock_electorate_layer)
         self.scenario_registry = ScenarioRegistry(source_layer=self.scenario_layer,
                                                   id_field='scenario_id',
                                                   name_field='name',
-                                                  meshblock_electorate_layer=self.meshblock_electorate_layer)
+                                                  meshblock_electorate_layer=self.meshblock_electorate_layer,
+                                                  packed_store=PackedScenarioStore(
+                                                      meshblock_electorate_db) if meshblock_electorate_db else None)
 
         self.context = LinzRedistrictingContext(scenario_registry=self.scenario_registry)
         self.context.task = QgsSettings().value('redistricting/last_task', self.TASK_GN)
@@ -524,7 +577,8 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
 
         self.meshblock_scenario_bridge = LinzMeshblockScenarioBridge(meshblock_layer=self.meshblock_layer,
                                                                      meshblock_scenario_layer=self.meshblock_electorate_layer,
-                                                                     meshblock_number_field_name=self.MESHBLOCK_NUMBER_FIELD)
+                                                                     meshblock_number_field_name=self.MESHBLOCK_NUMBER_FIELD,
+                                                                     scenario_registry=self.scenario_registry)
         self.meshblock_scenario_bridge.scenario = self.context.scenario
 
         self.create_redistricting_ui()
@@ -536,8 +590,20 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         self.switch_task.taskCompleted.connect(self.progress_item.close)
         self.switch_task.taskCompleted.connect(partial(self.start_editing_action.setEnabled, True))
         self.switch_task.taskTerminated.connect(self.progress_item.close)
+        undo_memory_limit = QgsSettings().value('redistricting/undo_memory_limit_mb',
+                                                ElectorateEditQueue.DEFAULT_MEMORY_LIMIT // (1024 * 1024), int)
+        if QgsSettings().value('redistricting/background_boundary_updates', True, bool):
+            self.boundary_updater = ElectorateBoundaryUpdater(
+                electorate_layer=self.electorate_layer,
+                electorate_layer_field='electorate_id',
+                meshblock_layer=self.meshblock_layer,
+                target_field=UpdateStagedElectoratesTask.staged_field_for_task(self.meshblock_layer,
+                                                                               self.context.task),
+                topology=self.get_meshblock_topology())
         self.electorate_edit_queue = ElectorateEditQueue(electorate_layer=self.electorate_layer,
-                                                         user_log_layer=self.user_log_layer)
+                                                         user_log_layer=self.user_log_layer,
+                                                         memory_limit=undo_memory_limit * 1024 * 1024,
+                                                         boundary_updater=self.boundary_updater)
 
         self.meshblock_layer.undoStack().indexChanged.connect(
             self.electorate_edit_queue.sync_to_meshblock_undostack_index)
@@ -664,10 +730,12 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         except (AttributeError, RuntimeError):
             pass
 
-    def set_task(self, task: str) -> bool:
+    def set_task(self, task: str, refresh_staged_electorates: bool = False) -> bool:
         """
         Sets the current task
         :param task: task, eg 'GN','GS' or 'M'
+        :param refresh_staged_electorates: set to True to force a refresh of the
+        staged electorates in the meshblock layer
         :returns True if task switch was begun
         """
         if self.is_editing():
@@ -676,8 +744,15 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
                                     'Cannot switch task while editing meshblocks. Save or cancel the current edits and try again.'))
             return False
 
-        self.enable_task_switches(False)
         self.meshblock_scenario_bridge.task = task
+        if not refresh_staged_electorates and UpdateStagedElectoratesTask.has_task_fields(self.meshblock_layer):
+            # staged electorates for every task are already present, so we only need
+            # to change which field is used
+            self.switch_task = None
+            self.task_set(task)
+            return True
+
+        self.enable_task_switches(False)
         progress_dialog = BlockingDialog(self.tr('Switch Task'), self.tr('Preparing switch...'))
         progress_dialog.force_show_and_paint()
 
@@ -705,7 +780,7 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         """
         Sets the current task, showing a progress bar to report status
         """
-        if not self.set_task(task):
+        if not self.set_task(task) or self.switch_task is None:
             return
         self.progress_item = MessageBarProgressItem(
             self.tr('Switching to {}').format(self.context.get_name_for_task(task)), iface=self.iface)
@@ -719,9 +794,16 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         """
         self.context.task = task
         QgsExpressionContextUtils.setProjectVariable(QgsProject.instance(), 'task', self.context.task)
+        if self.boundary_updater is not None:
+            self.boundary_updater.set_target_field(
+                UpdateStagedElectoratesTask.staged_field_for_task(self.meshblock_layer, self.context.task))
+        if self.meshblock_topology is not None:
+            self.meshblock_topology.set_target_field(
+                UpdateStagedElectoratesTask.staged_field_for_task(self.meshblock_layer, self.context.task))
         QgsSettings().setValue('redistricting/last_task', self.context.task)
 
         # self.electorate_layer.renderer().rootRule().children()[0].setLabel(self.context.get_name_for_current_task())
+        self.update_meshblock_renderer_field()
 
         self.iface.layerTreeView().refreshLayerSymbology(self.electorate_layer.id())
         self.iface.layerTreeView().refreshLayerSymbology(self.meshblock_layer.id())
@@ -739,6 +821,27 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         if self.selected_population_dock:
             self.selected_population_dock.set_task(self.context.task)
             self.selected_population_dock.set_district_registry(self.get_district_registry())
+            self.selected_population_dock.set_population_ledger(self.get_population_ledger())
+
+    def update_meshblock_renderer_field(self):
+        """
+        Updates the meshblock layer's renderer to use the staged electorate field
+        for the current task
+        """
+        staged_field = UpdateStagedElectoratesTask.staged_field_for_task(self.meshblock_layer, self.context.task)
+        staged_fields = [UpdateStagedElectoratesTask.STAGED_ELECTORATE_FIELD] + list(
+            UpdateStagedElectoratesTask.TASK_STAGED_FIELDS.values())
+        field_pattern = re.compile(r'\b({})\b'.format('|'.join(staged_fields)))
+
+        renderer = self.meshblock_layer.renderer()
+        if renderer is None:
+            return
+        if hasattr(renderer, 'classAttribute'):
+            renderer.setClassAttribute(field_pattern.sub(staged_field, renderer.classAttribute()))
+        elif isinstance(renderer, QgsRuleBasedRenderer):
+            for rule in renderer.rootRule().descendants():
+                if rule.filterExpression():
+                    rule.setFilterExpression(field_pattern.sub(staged_field, rule.filterExpression()))
 
     def refresh_canvases(self):
         """
@@ -759,19 +862,104 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
             title_field='name',
             name='General NI')
 
+    def get_meshblock_store(self) -> MeshblockStore:
+        """
+        Returns the session-wide meshblock attribute store, creating it
+        if required
+        """
+        if self.meshblock_store is None:
+            self.meshblock_store = MeshblockStore(meshblock_layer=self.meshblock_layer,
+                                                  meshblock_number_field_name=self.MESHBLOCK_NUMBER_FIELD,
+                                                  defer_load=True)
+        return self.meshblock_store
+
+    def get_population_ledger(self) -> PopulationLedger:
+        """
+        Returns the population ledger for the current task, creating it
+        if required
+        """
+        if self.population_ledger is None or self.population_ledger.task != self.context.task:
+            self.population_ledger = PopulationLedger(electorate_layer=self.electorate_layer,
+                                                      electorate_layer_field='electorate_id',
+                                                      meshblock_store=self.get_meshblock_store(),
+                                                      task=self.context.task)
+        return self.population_ledger
+
+    def get_meshblock_topology(self) -> MeshblockTopology:
+        """
+        Returns the session-wide meshblock boundary arc topology, creating it
+        if required. The topology is built on first use.
+        """
+        if self.meshblock_topology is None:
+            self.meshblock_topology = MeshblockTopology(meshblock_store=self.get_meshblock_store(),
+                                                        meshblock_layer=self.meshblock_layer,
+                                                        target_field=UpdateStagedElectoratesTask.staged_field_for_task(
+                                                            self.meshblock_layer, self.context.task))
+        return self.meshblock_topology
+
+    def reset_meshblock_topology(self):
+        """
+        Resets the meshblock assignments tracked by the meshblock topology. Must be called
+        whenever the staged electorates are changed outside of the meshblock layer's edit buffer.
+        """
+        if self.meshblock_topology is not None:
+            self.meshblock_topology.reset_assignment()
+
+    def reset_population_ledger(self):
+        """
+        Resets the population ledger, forcing populations to be reloaded from the electorate
+        layer. Must be called whenever electorate populations are changed outside of
+        redistricting operations.
+        """
+        if self.population_ledger is not None:
+            self.population_ledger.reset()
+
+    def get_geometry_cache(self) -> ElectorateGeometryCache:
+        """
+        Returns the electorate geometry cache for the current database, creating it
+        if required
+        """
+        if self.geometry_cache is None:
+            self.geometry_cache = ElectorateGeometryCache(DbUtils.database_path_for_layer(self.electorate_layer))
+        return self.geometry_cache
+
+    def get_meshblock_adjacency(self) -> MeshblockAdjacency:
+        """
+        Returns the session-wide meshblock adjacency graph, creating it
+        if required
+        """
+        if self.meshblock_adjacency is None:
+            self.meshblock_adjacency = MeshblockAdjacency(meshblock_store=self.get_meshblock_store(),
+                                                          database_path=DbUtils.database_path_for_layer(
+                                                              self.meshblock_layer))
+        return self.meshblock_adjacency
+
+    def get_validation_cache(self) -> ElectorateValidationCache:
+        """
+        Returns the electorate validation result cache for the current database, creating it
+        if required
+        """
+        if self.validation_cache is None:
+            self.validation_cache = ElectorateValidationCache(
+                DbUtils.database_path_for_layer(self.electorate_layer))
+        return self.validation_cache
+
     def get_handler(self) -> LinzRedistrictHandler:
         """
         Returns the current redistricting handler
         """
         handler = LinzRedistrictHandler(meshblock_layer=self.meshblock_layer,
                                         meshblock_number_field_name=self.MESHBLOCK_NUMBER_FIELD,
-                                        target_field='staged_electorate',
+                                        target_field=UpdateStagedElectoratesTask.staged_field_for_task(
+                                            self.meshblock_layer, self.context.task),
                                         electorate_changes_queue=self.electorate_edit_queue,
                                         electorate_layer=self.electorate_layer,
                                         electorate_layer_field='electorate_id',
                                         task=self.context.task,
                                         user_log_layer=self.user_log_layer,
-                                        scenario=self.context.scenario)
+                                        scenario=self.context.scenario,
+                                        population_ledger=self.get_population_ledger(),
+                                        meshblock_topology=self.get_meshblock_topology())
         handler.redistrict_occured.connect(self.refresh_dock_stats)
         handler.operation_ended.connect(self.redistrict_occurred)
         return handler
@@ -981,10 +1169,12 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
             self.switch_scenario(dlg.selected_scenario())
         dlg.deleteLater()
 
-    def switch_scenario(self, scenario: int, title=None, description=None):
+    def switch_scenario(self, scenario: int, title=None, full_rebuild: bool = False):
         """
         Switches the current scenario to a new scenario
         :param scenario: new scenario ID
+        :param full_rebuild: set to True to rebuild all electorates, instead of
+        only electorates which differ from the current scenario
         """
         if self.is_editing():
             QMessageBox.warning(self.iface.mainWindow(), self.tr('Switch Scenario'),
@@ -994,25 +1184,28 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
 
         self.enable_task_switches(False)
         self.clear_current_views()
+        # complete any pending boundary recalculations, as electorates which are unchanged
+        # in the new scenario keep their current geometry. Electorates which were dirty
+        # are rebuilt by the switch regardless.
+        dirty_electorates = set()
+        if self.boundary_updater is not None:
+            dirty_electorates = set(self.boundary_updater.dirty)
+            self.boundary_updater.flush()
 
         electorate_registry = self.get_district_registry()
         scenario_name = self.scenario_registry.get_scenario_name(scenario)
         task_name = title if title is not None else self.tr('Switching to {}').format(scenario_name)
 
-        if title is None:
-            title = self.tr('Switch Scenario')
-        if description is None:
-            description = self.tr('Preparing switch...')
-
-        progress_dialog = BlockingDialog(title, description)
-        progress_dialog.force_show_and_paint()
-
         self.switch_task = ScenarioSwitchTask(task_name,
                                               electorate_layer=electorate_registry.source_layer,
                                               meshblock_layer=self.meshblock_layer,
                                               meshblock_number_field_name=self.MESHBLOCK_NUMBER_FIELD,
                                               scenario_registry=self.scenario_registry,
-                                              scenario=scenario)
+                                              scenario=scenario,
+                                              meshblock_store=self.get_meshblock_store(),
+                                              geometry_cache=self.get_geometry_cache(),
+                                              full_rebuild=full_rebuild,
+                                              dirty_electorates=dirty_electorates)
         self.staged_task = UpdateStagedElectoratesTask(task_name,
                                                        meshblock_layer=self.meshblock_layer,
                                                        meshblock_number_field_name=self.MESHBLOCK_NUMBER_FIELD,
@@ -1021,8 +1214,6 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
                                                        task=self.context.task)
         self.staged_task.addSubTask(self.switch_task, subTaskDependency=QgsTask.ParentDependsOnSubTask)
 
-        progress_dialog.deleteLater()
-
         def reenable_actions():
             """
             Reenables the disabled menu actions
@@ -1032,6 +1223,8 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         self.staged_task.taskCompleted.connect(
             partial(self.report_success, self.tr('Successfully switched to “{}”').format(scenario_name)))
         self.staged_task.taskCompleted.connect(reenable_actions)
+        self.staged_task.taskCompleted.connect(self.reset_population_ledger)
+        self.staged_task.taskCompleted.connect(self.reset_meshblock_topology)
         self.staged_task.taskTerminated.connect(
             partial(self.report_failure, self.tr('Error while switching to “{}”').format(scenario_name)))
         self.staged_task.taskTerminated.connect(reenable_actions)
@@ -1087,19 +1280,100 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         dlg = self.create_new_scenario_name_dlg(existing_name=current_scenario_name,
                                                 initial_scenario_name=self.tr('{} Copy').format(current_scenario_name))
         dlg.setWindowTitle(self.tr('Branch to New Scenario'))
-        if dlg.exec_():
-            self.clear_current_views()
+        if not dlg.exec_():
+            return
+
+        self.clear_current_views()
+
+        new_name = dlg.name()
+        delta = QgsSettings().value('redistricting/delta_branches', False,
+                                    bool) and self.scenario_registry.supports_delta_scenarios()
+        res, error = self.scenario_registry.create_branch_scenario(scenario_id=self.context.scenario,
+                                                                   new_scenario_name=new_name,
+                                                                   delta=delta)
+        if not res:
+            self.report_failure(error)
+            return
+
+        if delta:
+            # delta scenarios inherit all records from their parent, so nothing to copy
+            self.branch_task_completed(res, new_name)
+            return
+
+        self.branch_task = BranchScenarioTask(self.tr('Branching scenario'), scenario_registry=self.scenario_registry,
+                                              source_scenario_id=self.context.scenario, new_scenario_id=res)
+        self.branch_task.taskCompleted.connect(partial(self.branch_task_completed, res, new_name))
+        self.branch_task.taskTerminated.connect(self.branch_task_failed)
+        self.enable_task_switches(False)
+
+        QgsApplication.taskManager().addTask(self.branch_task)
+
+    def branch_task_completed(self, scenario, name: str):
+        """
+        Triggered when a scenario has been branched
+        :param scenario: new scenario id
+        :param name: new scenario name
+        """
+        self.branch_task = None
+        self.enable_task_switches(True)
+        # the branch is identical to the current scenario, so the existing electorate geometries
+        # now belong to the branch. This keeps later scenario switches and exports from treating
+        # edits made in the branch as belonging to the original scenario.
+        self.get_district_registry().relabel_electorate_scenario(self.context.scenario, scenario)
+        self.report_success(self.tr('Branched scenario to “{}”').format(name))
+        self.context.set_scenario(scenario)
+
+    def compact_scenario(self):
+        """
+        Stores the current delta scenario in full, so that it no longer depends on its parent scenario
+        """
+        if self.meshblock_layer.editBuffer() is not None and self.meshblock_layer.editBuffer().isModified():
+            self.report_failure(self.tr(
+                'Cannot store scenario while unsaved changes are present. Save or cancel the current edits and try again.'))
+            return
 
-            progress_dialog = BlockingDialog(self.tr('Branching Scenario'), self.tr('Branching scenario...'))
-            progress_dialog.force_show_and_paint()
+        if not self.scenario_registry.is_delta_scenario(self.context.scenario):
+            self.report_success(self.tr('Current scenario is already stored in full'))
+            return
 
-            res, error = self.scenario_registry.branch_scenario(scenario_id=self.context.scenario,
-                                                                new_scenario_name=dlg.name())
-            if not res:
-                self.report_failure(error)
-            else:
-                self.report_success(self.tr('Branched scenario to “{}”').format(dlg.name()))
-                self.context.set_scenario(res)
+        self.compact_task = CompactScenarioTask(self.tr('Storing scenario in full'),
+                                                scenario_registry=self.scenario_registry,
+                                                scenario_id=self.context.scenario)
+        self.compact_task.taskCompleted.connect(self.compact_task_completed)
+        self.compact_task.taskTerminated.connect(self.compact_task_failed)
+        self.enable_task_switches(False)
+
+        QgsApplication.taskManager().addTask(self.compact_task)
+
+    def compact_task_completed(self):
+        """
+        Triggered when a delta scenario has been stored in full
+        """
+        self.compact_task = None
+        if self.meshblock_scenario_bridge is not None:
+            self.meshblock_scenario_bridge.invalidate_target_meshblock_ids()
+        self.enable_task_switches(True)
+        self.report_success(self.tr('Stored “{}” in full').format(self.context.get_name_for_current_scenario()))
+
+    def compact_task_failed(self):
+        """
+        Triggered when storing a delta scenario in full fails or is canceled
+        """
+        error = self.compact_task.error
+        self.compact_task = None
+        self.enable_task_switches(True)
+        if error:
+            self.report_failure(self.tr('Error while storing scenario: {}').format(error))
+
+    def branch_task_failed(self):
+        """
+        Triggered when branching a scenario fails or is canceled
+        """
+        error = self.branch_task.error
+        self.branch_task = None
+        self.enable_task_switches(True)
+        if error:
+            self.report_failure(self.tr('Error while branching scenario: {}').format(error))
 
     def import_scenario(self):
         """
@@ -1130,35 +1404,78 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
                                            name_field='name',
                                            meshblock_electorate_layer=foreign_meshblock_electorates_layer)
         dlg = ScenarioSelectionDialog(scenario_registry=source_registry,
-                                      parent=self.iface.mainWindow())
+                                      parent=self.iface.mainWindow(), allow_multiple_selection=True)
         dlg.setWindowTitle(self.tr('Import Scenario from Database'))
         if not dlg.exec_():
             return
 
-        source_scenario_id = dlg.selected_scenario()
-        source_scenario_name = source_registry.get_scenario_name(source_scenario_id)
-
-        dlg = self.create_new_scenario_name_dlg(existing_name=None,
-                                                initial_scenario_name=source_scenario_name)
-        dlg.setWindowTitle(self.tr('Import Scenario from Database'))
-        dlg.setHintString(self.tr('Enter name for imported scenario'))
-        if not dlg.exec_():
+        source_scenario_ids = dlg.selected_scenarios()
+        if not source_scenario_ids:
             return
 
+        scenarios = []
+        if len(source_scenario_ids) == 1:
+            source_scenario = source_registry.get_scenario(source_scenario_ids[0])
+            dlg = self.create_new_scenario_name_dlg(existing_name=None,
+                                                    initial_scenario_name=source_scenario['name'])
+            dlg.setWindowTitle(self.tr('Import Scenario from Database'))
+            dlg.setHintString(self.tr('Enter name for imported scenario'))
+            if not dlg.exec_():
+                return
+            scenarios.append(ImportedScenario(source_scenario_ids[0], dlg.name(), source_scenario['created'],
+                                              source_scenario['created_by'],
+                                              source_registry.scenario_chain(source_scenario_ids[0])))
+        else:
+            # when importing multiple scenarios, keep the original names where possible
+            names = []
+            for source_scenario_id in source_scenario_ids:
+                source_scenario = source_registry.get_scenario(source_scenario_id)
+                name = self.scenario_registry.unique_scenario_name(source_scenario['name'], reserved_names=names)
+                names.append(name)
+                scenarios.append(ImportedScenario(source_scenario_id, name, source_scenario['created'],
+                                                  source_scenario['created_by'],
+                                                  source_registry.scenario_chain(source_scenario_id)))
+
         self.clear_current_views()
 
-        new_scenario_name = dlg.name()
+        self.import_task = ImportScenariosTask(self.tr('Importing scenarios'), scenario_registry=self.scenario_registry,
+                                               source_database_path=source, scenarios=scenarios)
+        self.import_task.taskCompleted.connect(self.import_task_completed)
+        self.import_task.taskTerminated.connect(self.import_task_failed)
+        self.enable_task_switches(False)
 
-        dlg = BlockingDialog(self.tr('Import Scenario'), self.tr('Importing scenario...'))
-        dlg.force_show_and_paint()
-        result, error = self.scenario_registry.import_scenario_from_other_registry(source_registry=source_registry,
-                                                                                   source_scenario_id=source_scenario_id,
-                                                                                   new_scenario_name=new_scenario_name)
-        if not result:
-            self.report_failure(error)
-        else:
-            self.report_success(
-                self.tr('Successfully imported “{}” to “{}”').format(source_scenario_name, new_scenario_name))
+        QgsApplication.taskManager().addTask(self.import_task)
+
+    def import_task_completed(self):
+        """
+        Triggered when scenarios have been imported
+        """
+        imported = self.import_task.imported_scenarios()
+        skipped = self.import_task.skipped_scenarios()
+        self.import_task = None
+        self.enable_task_switches(True)
+
+        if imported:
+            self.report_success(self.tr('Successfully imported {}').format(
+                ', '.join('“{}”'.format(s.name) for s in imported)))
+        for scenario in skipped:
+            QgsMessageLog.logMessage(
+                self.tr('Skipped “{}”, identical to existing scenario “{}”').format(
+                    scenario.name, self.scenario_registry.get_scenario_name(scenario.duplicate_of)), "REDISTRICT")
+        if skipped:
+            self.iface.messageBar().pushMessage(
+                self.tr('{} scenarios were not imported as they are identical to existing scenarios').format(
+                    len(skipped)), level=Qgis.Info)
+
+    def import_task_failed(self):
+        """
+        Triggered when importing scenarios fails or is canceled
+        """
+        error = self.import_task.error
+        self.import_task = None
+        self.enable_task_switches(True)
+        if error:
+            self.report_failure(self.tr('Error while importing scenarios: {}').format(error))
 
     def update_dock_title(self):
         """
@@ -1242,6 +1559,11 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
                     self.electorate_edit_queue.rollback)
             except TypeError:
                 pass
+            if self.meshblock_topology is not None:
+                try:
+                    self.meshblock_topology.detach()
+                except TypeError:
+                    pass
 
         self.api_request_queue.clear()
         if clear_project:
@@ -1263,6 +1585,12 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         self.scenario_registry = None
         self.context = None
         self.meshblock_scenario_bridge = None
+        self.meshblock_store = None
+        self.population_ledger = None
+        self.meshblock_topology = None
+        self.geometry_cache = None
+        self.meshblock_adjacency = None
+        self.validation_cache = None
         self.scenarios_menu = None
         self.electorate_menu = None
         self.database_menu = None
@@ -1271,6 +1599,9 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
 
         # TODO - block reset when changes in queue, edits enabled!!
         self.electorate_edit_queue = None
+        if self.boundary_updater is not None:
+            self.boundary_updater.discard_pending()
+        self.boundary_updater = None
 
         try:
             if self.dock:
@@ -1351,6 +1682,122 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         error = self.copy_task.error
         self.report_failure(self.tr('Error while exporting database: {}').format(error))
 
+    def ensure_meshblock_electorate_indexes(self):
+        """
+        Creates any missing indexes required for efficient queries against
+        the meshblock_electorates table
+        """
+        database_path = DbUtils.database_path_for_layer(self.meshblock_electorate_layer)
+        table = DbUtils.table_name_for_layer(self.meshblock_electorate_layer)
+        if database_path is None or table is None:
+            return
+
+        created = DbUtils.ensure_indexes(database_path, table, DbUtils.MESHBLOCK_ELECTORATE_INDEXES)
+        if created:
+            QgsMessageLog.logMessage('Created indexes on {}: {}'.format(table, ', '.join(created)), "REDISTRICT")
+
+    def optimize_scenario_storage(self):
+        """
+        Rewrites the meshblock_electorates table so that the rows for each scenario
+        are stored together, and caches packed copies of all scenarios for faster
+        scenario loading, using background tasks
+        """
+        if self.is_editing():
+            self.report_failure(self.tr(
+                'Cannot optimize scenario storage while unsaved changes are present. Save or cancel the current edits and try again.'))
+            return
+
+        database_path = DbUtils.database_path_for_layer(self.meshblock_electorate_layer)
+        table = DbUtils.table_name_for_layer(self.meshblock_electorate_layer)
+        if database_path is None or table is None:
+            self.report_failure(self.tr('Scenario storage can only be optimized for GeoPackage databases'))
+            return
+
+        if QMessageBox.question(self.iface.mainWindow(), self.tr('Optimize Scenario Storage'),
+                                self.tr(
+                                    'Optimizing scenario storage will rewrite all meshblock assignments so that each scenario is stored together, and cache a packed copy of each scenario for faster loading. The packed copies will slightly increase the size of the database. This may take some time.\n\nIt is recommended that you export a backup copy of the database first.\n\nContinue?'),
+                                QMessageBox.Yes | QMessageBox.No, QMessageBox.No) != QMessageBox.Yes:
+            return
+
+        self.ensure_meshblock_electorate_indexes()
+        self.enable_task_switches(False)
+
+        # checking whether the table is already clustered requires full table scans, so is left to the task
+        self.cluster_task = ClusterTableTask(self.tr('Optimizing scenario storage'), database_path, table,
+                                             DbUtils.MESHBLOCK_ELECTORATE_CLUSTER_COLUMNS)
+        self.cluster_task.taskCompleted.connect(self.cluster_task_completed)
+        self.cluster_task.taskTerminated.connect(self.cluster_task_failed)
+
+        QgsApplication.taskManager().addTask(self.cluster_task)
+
+    def cluster_task_completed(self):
+        """
+        Triggered when the scenario storage has been clustered
+        """
+        if self.cluster_task.already_clustered:
+            if not self.unpacked_scenarios():
+                self.enable_task_switches(True)
+                self.report_success(self.tr('Scenario storage is already optimized'))
+                return
+        else:
+            # feature ids have been renumbered
+            self.meshblock_electorate_layer.reload()
+            if self.meshblock_scenario_bridge is not None:
+                self.meshblock_scenario_bridge.invalidate_target_meshblock_ids()
+        self.pack_scenarios()
+
+    def cluster_task_failed(self):
+        """
+        Triggered on an error while optimizing scenario storage
+        """
+        self.enable_task_switches(True)
+        error = self.cluster_task.error
+        if error:
+            self.report_failure(self.tr('Error while optimizing scenario storage: {}').format(error))
+
+    def unpacked_scenarios(self) -> list:
+        """
+        Returns a list of scenarios without a cached packed copy
+        """
+        if self.scenario_registry.packed_store is None:
+            return []
+        packed = set(self.scenario_registry.packed_store.packed_scenarios())
+        return [s for s in self.scenario_registry.scenario_list() if s not in packed]
+
+    def pack_scenarios(self):
+        """
+        Caches packed copies of any unpacked scenarios, using a background task
+        """
+        scenarios = self.unpacked_scenarios()
+        if not scenarios:
+            self.enable_task_switches(True)
+            self.report_success(self.tr('Optimized scenario storage'))
+            return
+
+        self.pack_task = PackScenariosTask(self.tr('Caching packed scenarios'), self.scenario_registry, scenarios)
+        self.pack_task.taskCompleted.connect(self.pack_task_completed)
+        self.pack_task.taskTerminated.connect(self.pack_task_failed)
+
+        QgsApplication.taskManager().addTask(self.pack_task)
+
+    def pack_task_completed(self):
+        """
+        Triggered when scenarios have been packed
+        """
+        self.enable_task_switches(True)
+        if self.pack_task.skipped_scenarios:
+            self.report_success(self.tr('Optimized scenario storage ({} scenarios could not be packed)').format(
+                len(self.pack_task.skipped_scenarios)))
+        else:
+            self.report_success(self.tr('Optimized scenario storage'))
+
+    def pack_task_failed(self):
+        """
+        Triggered on an error while packing scenarios
+        """
+        self.enable_task_switches(True)
+        self.report_failure(self.tr('Scenario packing was canceled'))
+
     def current_db_path(self) -> str:
         """
         Returns the currently open database path
@@ -1438,6 +1885,7 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         if not res:
             self.report_failure(error)
         else:
+            self.reset_population_ledger()
             self.report_success(self.tr('Created electorate “{}”').format(new_name))
 
     def deprecate_electorate(self):
@@ -1483,17 +1931,17 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
 
         self.validation_results_dock.clear()
 
-        progress_dialog = BlockingDialog(self.tr('Validating Electorates'), self.tr('Preparing validation...'))
-        progress_dialog.force_show_and_paint()
-
         self.validation_task = ValidationTask(task_name,
                                               electorate_registry=electorate_registry,
                                               meshblock_layer=self.meshblock_layer,
                                               meshblock_number_field_name=self.MESHBLOCK_NUMBER_FIELD,
                                               scenario_registry=self.scenario_registry,
                                               scenario=self.context.scenario,
-                                              task=self.context.task)
-        progress_dialog.deleteLater()
+                                              task=self.context.task,
+                                              meshblock_store=self.get_meshblock_store(),
+                                              geometry_cache=self.get_geometry_cache(),
+                                              adjacency=self.get_meshblock_adjacency(),
+                                              validation_cache=self.get_validation_cache())
         # refresh views, in case any are showing invalid electorates view
         self.refresh_canvases()
 
@@ -1542,8 +1990,7 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
             return
 
         self.clear_current_views()
-        self.switch_scenario(self.context.scenario, title=self.tr('Rebuild Electorates'),
-                             description=self.tr('Preparing rebuild...'))
+        self.switch_scenario(self.context.scenario, title=self.tr('Rebuild Electorates'), full_rebuild=True)
 
     def export_electorates(self):
         """
@@ -1571,15 +2018,16 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         electorate_registry = self.get_district_registry()
         task_name = self.tr('Exporting Electorates')
 
-        progress_dialog = BlockingDialog(self.tr('Exporting Electorates'), self.tr('Preparing export...'))
-        progress_dialog.force_show_and_paint()
-
+        dirty_electorates = set(self.boundary_updater.dirty) if self.boundary_updater is not None else None
         self.export_task = ExportTask(task_name=task_name, dest_file=destination,
                                       electorate_registry=electorate_registry,
                                       meshblock_layer=self.meshblock_layer,
                                       meshblock_number_field_name=self.MESHBLOCK_NUMBER_FIELD,
                                       scenario_registry=self.scenario_registry,
-                                      scenario=self.context.scenario, user_log_layer=self.user_log_layer)
+                                      scenario=self.context.scenario, user_log_layer=self.user_log_layer,
+                                      meshblock_store=self.get_meshblock_store(),
+                                      geometry_cache=self.get_geometry_cache(),
+                                      dirty_electorates=dirty_electorates)
 
         self.export_task.taskCompleted.connect(self.__export_complete)
         self.export_task.taskTerminated.connect(self.__export_failed)
@@ -1709,6 +2157,12 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
             meshblocks.append(f)
 
         assert dest_layer.dataProvider().addFeatures(meshblocks)
+        # cached electorate geometries are no longer valid
+        ElectorateGeometryCache(prev_meshblock_layer_path).clear()
+        # as is the meshblock adjacency graph
+        MeshblockAdjacency.clear_database(prev_meshblock_layer_path)
+        ElectorateValidationCache(prev_meshblock_layer_path).clear()
+        PackedScenarioStore(prev_meshblock_layer_path).clear()
         QMessageBox.warning(self.iface.mainWindow(), self.tr('Load New Meshblocks'),
                             self.tr(
                                 'Please run a full scenario rebuild after re-loading the plugin'))
@@ -1723,16 +2177,17 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         district_registry = self.get_district_registry()
 
         district_registry.flag_stats_nz_updating(electorate_id)
+        self.reset_population_ledger()
         self.refresh_dock_stats()
 
         electorate_type = district_registry.get_district_type(electorate_id)
-        electorate_meshblocks = self.scenario_registry.electorate_meshblocks(electorate_id=electorate_id,
-                                                                             electorate_type=electorate_type,
-                                                                             scenario_id=self.context.scenario)
+        scenario_meshblocks = self.scenario_registry.scenario_electorate_meshblocks(
+            scenario_id=self.context.scenario, electorate_types=[electorate_type])
+        electorate_meshblocks = scenario_meshblocks[electorate_type].get(electorate_id, [])
 
         # TODO: track scenarios, reject responses on different scenarios
 
-        concordance = [ConcordanceItem(str(m['meshblock_number']), str(electorate_id), self.context.task) for m in
+        concordance = [ConcordanceItem(str(m), str(electorate_id), self.context.task) for m in
                        electorate_meshblocks]
         request = BoundaryRequest(concordance, area=self.context.task)
         connector = get_api_connector()
@@ -1750,6 +2205,7 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
             electorate_id = int(electorate_table['electorate'][1:])
             district_registry.update_stats_nz_values(electorate_id, electorate_table)
 
+        self.reset_population_ledger()
         self.refresh_dock_stats()
         self.refresh_canvases()
 
@@ -1766,16 +2222,16 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
 
         electorate_ids = [f['electorate_id'] for f in self.electorate_layer.getFeatures() if
                           f['type'] == self.context.task]
+        scenario_meshblocks = self.scenario_registry.scenario_electorate_meshblocks(
+            scenario_id=self.context.scenario, electorate_types=[self.context.task])[self.context.task]
         concordance = []
         for electorate_id in electorate_ids:
             district_registry.flag_stats_nz_updating(electorate_id)
-            electorate_meshblocks = self.scenario_registry.electorate_meshblocks(electorate_id=electorate_id,
-                                                                                 electorate_type=self.context.task,
-                                                                                 scenario_id=self.context.scenario)
             concordance.extend(
-                [ConcordanceItem(str(m['meshblock_number']), str(electorate_id), self.context.task) for m in
-                 electorate_meshblocks])
+                [ConcordanceItem(str(m), str(electorate_id), self.context.task) for m in
+                 scenario_meshblocks.get(electorate_id, [])])
 
+        self.reset_population_ledger()
         self.refresh_dock_stats()
 
         # TODO: track scenarios, reject responses on different scenarios
@@ -1806,6 +2262,7 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
                                                          'varianceYear1': NULL,
                                                          'varianceYear2': NULL
                                                      })
+        self.reset_population_ledger()
         self.refresh_dock_stats()
         self.refresh_canvases()
 
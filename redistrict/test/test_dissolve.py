@@ -0,0 +1,135 @@
+# coding=utf-8
+"""Dissolve Test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import multiprocessing
+import unittest
+from collections import OrderedDict
+from redistrict.core.dissolve import (ElectorateDissolver,
+                                      coverage_union,
+                                      dissolve_geometries,
+                                      dissolve_wkb)
+from qgis.core import (QgsGeometry,
+                       QgsFeedback)
+
+
+class DissolveTest(unittest.TestCase):
+    """Test dissolve utilities."""
+
+    def testDissolveGeometries(self):
+        """
+        Test dissolving geometries
+        """
+        res = dissolve_geometries([QgsGeometry.fromWkt('Polygon((0 0, 1 0, 1 1, 0 1, 0 0))'),
+                                   QgsGeometry.fromWkt('Polygon((1 0, 2 0, 2 1, 1 1, 1 0))')])
+        self.assertEqual(res.area(), 2)
+        self.assertFalse(res.isMultipart())
+
+        res = dissolve_geometries([])
+        self.assertTrue(res.isNull() or res.isEmpty())
+
+    def testCoverageUnion(self):
+        """
+        Test coverage union of meshblock-like polygons
+        """
+        if not hasattr(QgsGeometry, 'unionCoverage') or not hasattr(QgsGeometry, 'validateCoverage'):
+            self.assertIsNone(coverage_union([QgsGeometry.fromWkt('Polygon((0 0, 1 0, 1 1, 0 1, 0 0))')]))
+            return
+
+        res = coverage_union([QgsGeometry.fromWkt('Polygon((0 0, 1 0, 1 1, 0 1, 0 0))'),
+                              QgsGeometry.fromWkt('Polygon((1 0, 2 0, 2 1, 1 1, 1 0))'),
+                              QgsGeometry.fromWkt('MultiPolygon(((5 5, 6 5, 6 6, 5 6, 5 5)))')])
+        self.assertEqual(res.area(), 3)
+        self.assertEqual(res.constGet().numGeometries(), 2)
+
+        # overlapping inputs are not a valid coverage
+        self.assertIsNone(coverage_union([QgsGeometry.fromWkt('Polygon((0 0, 2 0, 2 1, 0 1, 0 0))'),
+                                          QgsGeometry.fromWkt('Polygon((1 0, 3 0, 3 1, 1 1, 1 0))')]))
+        # neighbours which share an edge without identical vertices are not a valid coverage
+        self.assertIsNone(coverage_union([QgsGeometry.fromWkt('Polygon((0 0, 2 0, 2 1, 0 1, 0 0))'),
+                                          QgsGeometry.fromWkt('Polygon((0 1, 1 1, 1 2, 0 2, 0 1))'),
+                                          QgsGeometry.fromWkt('Polygon((1 1, 2 1, 2 2, 1 2, 1 1))')]))
+        res = dissolve_geometries([QgsGeometry.fromWkt('Polygon((0 0, 2 0, 2 1, 0 1, 0 0))'),
+                                   QgsGeometry.fromWkt('Polygon((0 1, 1 1, 1 2, 0 2, 0 1))'),
+                                   QgsGeometry.fromWkt('Polygon((1 1, 2 1, 2 2, 1 2, 1 1))')])
+        self.assertEqual(res.area(), 4)
+        self.assertFalse(res.isMultipart())
+        # non polygon input
+        self.assertIsNone(coverage_union([QgsGeometry.fromWkt('Point(1 1)')]))
+        # generic fallback
+        res = dissolve_geometries([QgsGeometry.fromWkt('Polygon((0 0, 2 0, 2 1, 0 1, 0 0))'),
+                                   QgsGeometry.fromWkt('Polygon((1 0, 3 0, 3 1, 1 1, 1 0))')])
+        self.assertEqual(res.area(), 3)
+
+    def testDissolveWkb(self):
+        """
+        Test dissolving WKB geometries
+        """
+        res = dissolve_wkb([bytes(QgsGeometry.fromWkt('Polygon((0 0, 1 0, 1 1, 0 1, 0 0))').asWkb()),
+                            bytes(QgsGeometry.fromWkt('Polygon((3 0, 4 0, 4 1, 3 1, 3 0))').asWkb())])
+        geometry = QgsGeometry()
+        geometry.fromWkb(res)
+        self.assertEqual(geometry.area(), 2)
+        self.assertTrue(geometry.isMultipart())
+        self.assertEqual(geometry.constGet().numGeometries(), 2)
+
+    def testSerialDissolve(self):
+        """
+        Test dissolving without worker processes
+        """
+        jobs = OrderedDict()
+        jobs['a'] = [QgsGeometry.fromWkt('Polygon((0 0, 1 0, 1 1, 0 1, 0 0))'),
+                     QgsGeometry.fromWkt('Polygon((1 0, 2 0, 2 1, 1 1, 1 0))')]
+        jobs['b'] = [QgsGeometry.fromWkt('Polygon((5 5, 6 5, 6 6, 5 6, 5 5))')]
+
+        progress = []
+        dissolver = ElectorateDissolver(worker_count=1)
+        res = dissolver.dissolve(jobs, progress_callback=progress.append)
+        self.assertEqual(set(res.keys()), {'a', 'b'})
+        self.assertEqual(res['a'].area(), 2)
+        self.assertEqual(res['b'].area(), 1)
+        self.assertEqual(progress, [50, 100])
+
+        feedback = QgsFeedback()
+        feedback.cancel()
+        self.assertIsNone(dissolver.dissolve(jobs, feedback=feedback))
+
+    def testParallelDissolve(self):
+        """
+        Test dissolving with worker processes
+        """
+        jobs = OrderedDict()
+        jobs['a'] = [QgsGeometry.fromWkt('Polygon((0 0, 1 0, 1 1, 0 1, 0 0))'),
+                     QgsGeometry.fromWkt('Polygon((1 0, 2 0, 2 1, 1 1, 1 0))')]
+        jobs['b'] = [QgsGeometry.fromWkt('Polygon((5 5, 6 5, 6 6, 5 6, 5 5))')]
+
+        dissolver = ElectorateDissolver(worker_count=2)
+        res = dissolver.dissolve(jobs)
+        self.assertEqual(set(res.keys()), {'a', 'b'})
+        self.assertEqual(res['a'].area(), 2)
+        self.assertEqual(res['b'].area(), 1)
+        # worker processes must not outlive the dissolve
+        self.assertFalse(multiprocessing.active_children())
+
+        feedback = QgsFeedback()
+        feedback.cancel()
+        self.assertIsNone(dissolver.dissolve(jobs, feedback=feedback))
+        self.assertFalse(multiprocessing.active_children())
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(DissolveTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,98 @@
+# coding=utf-8
+"""GeoPackage Writer Test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import unittest
+from qgis.PyQt.QtCore import (QTemporaryDir,
+                              QVariant)
+from redistrict.core.gpkg_writer import GeoPackageWriter
+from qgis.core import (NULL,
+                       QgsCoordinateReferenceSystem,
+                       QgsFeature,
+                       QgsField,
+                       QgsFields,
+                       QgsGeometry,
+                       QgsVectorLayer,
+                       QgsWkbTypes)
+
+
+class GeoPackageWriterTest(unittest.TestCase):
+    """Test GeoPackageWriter."""
+
+    def testWrite(self):
+        """
+        Test writing multiple layers
+        """
+        temp_dir = QTemporaryDir()
+        path = os.path.join(temp_dir.path(), 'out.gpkg')
+
+        writer = GeoPackageWriter(path)
+        self.assertTrue(writer.is_valid())
+
+        fields = QgsFields()
+        fields.append(QgsField('name', QVariant.String))
+        fields.append(QgsField('value', QVariant.Int))
+        self.assertTrue(writer.create_layer('polys', QgsWkbTypes.Polygon, fields,
+                                            QgsCoordinateReferenceSystem('EPSG:2193')))
+        f = QgsFeature()
+        f.setAttributes(['a', 1])
+        f.setGeometry(QgsGeometry.fromWkt('Polygon((0 0, 1 0, 1 1, 0 0))'))
+        self.assertTrue(writer.add_feature('polys', f))
+        # empty geometry
+        f = QgsFeature()
+        f.setAttributes(['b', NULL])
+        self.assertTrue(writer.add_feature('polys', f))
+
+        self.assertTrue(writer.create_layer('table', QgsWkbTypes.NoGeometry, fields))
+        f = QgsFeature()
+        f.setAttributes([NULL, 5])
+        self.assertTrue(writer.add_feature('table', f))
+        self.assertTrue(writer.commit())
+
+        layer = QgsVectorLayer('{}|layername=polys'.format(path), 'polys', 'ogr')
+        self.assertTrue(layer.isValid())
+        self.assertEqual(layer.crs().authid(), 'EPSG:2193')
+        self.assertEqual([f.attributes() for f in layer.getFeatures()], [[1, 'a', 1], [2, 'b', NULL]])
+        self.assertEqual([f.geometry().asWkt() for f in layer.getFeatures()],
+                         ['Polygon ((0 0, 1 0, 1 1, 0 0))', ''])
+        layer = QgsVectorLayer('{}|layername=table'.format(path), 'table', 'ogr')
+        self.assertTrue(layer.isValid())
+        self.assertEqual([f.attributes() for f in layer.getFeatures()], [[1, NULL, 5]])
+
+    def testRollback(self):
+        """
+        Test that uncommitted features are discarded
+        """
+        temp_dir = QTemporaryDir()
+        path = os.path.join(temp_dir.path(), 'out.gpkg')
+
+        writer = GeoPackageWriter(path)
+        fields = QgsFields()
+        fields.append(QgsField('value', QVariant.Int))
+        self.assertTrue(writer.create_layer('table', QgsWkbTypes.NoGeometry, fields))
+        f = QgsFeature()
+        f.setAttributes([5])
+        self.assertTrue(writer.add_feature('table', f))
+        writer.close()
+
+        layer = QgsVectorLayer('{}|layername=table'.format(path), 'table', 'ogr')
+        self.assertEqual(layer.featureCount() if layer.isValid() else 0, 0)
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(GeoPackageWriterTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,150 @@
+# coding=utf-8
+"""LINZ Database Utilities Test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import unittest
+from qgis.PyQt.QtCore import (QTemporaryDir,
+                              QVariant)
+from qgis.core import (QgsCoordinateReferenceSystem,
+                       QgsFeature,
+                       QgsField,
+                       QgsGeometry,
+                       QgsFields,
+                       QgsVectorLayer,
+                       QgsWkbTypes)
+from redistrict.core.gpkg_writer import GeoPackageWriter
+from redistrict.linz.db_utils import (ClusterTableTask,
+                                      DbUtils)
+
+
+def make_meshblock_electorate_database(path: str):
+    """
+    Creates a GeoPackage containing an unclustered meshblock_electorates table
+    """
+    writer = GeoPackageWriter(path)
+    fields = QgsFields()
+    for name in ('scenario_id', 'meshblock_number', 'gn_id', 'gs_id', 'm_id'):
+        fields.append(QgsField(name, QVariant.Int))
+    assert writer.create_layer('meshblock_electorates', QgsWkbTypes.NoGeometry, fields)
+    for attributes in ([2, 12, 1, 4, 7], [1, 12, 2, 5, 7], [2, 11, 3, 6, 8], [1, 11, 3, 6, 8]):
+        f = QgsFeature()
+        f.setAttributes(attributes)
+        assert writer.add_feature('meshblock_electorates', f)
+    assert writer.commit()
+
+
+class DbUtilsTest(unittest.TestCase):
+    """Test DbUtils."""
+
+    def testEnsureIndexes(self):
+        """
+        Test creating missing indexes
+        """
+        temp_dir = QTemporaryDir()
+        path = os.path.join(temp_dir.path(), 'db.gpkg')
+        make_meshblock_electorate_database(path)
+
+        self.assertEqual(DbUtils.ensure_indexes(path, 'meshblock_electorates', DbUtils.MESHBLOCK_ELECTORATE_INDEXES),
+                         list(DbUtils.MESHBLOCK_ELECTORATE_INDEXES.keys()))
+        connection = DbUtils.connect(path)
+        indexes = {r[0] for r in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='meshblock_electorates'")}
+        connection.close()
+        self.assertTrue(set(DbUtils.MESHBLOCK_ELECTORATE_INDEXES.keys()).issubset(indexes))
+
+        # already exist
+        self.assertEqual(DbUtils.ensure_indexes(path, 'meshblock_electorates', DbUtils.MESHBLOCK_ELECTORATE_INDEXES),
+                         [])
+        # bad table
+        self.assertIsNone(DbUtils.ensure_indexes(path, 'xxx', DbUtils.MESHBLOCK_ELECTORATE_INDEXES))
+
+    def testCluster(self):
+        """
+        Test clustering a table
+        """
+        temp_dir = QTemporaryDir()
+        path = os.path.join(temp_dir.path(), 'db.gpkg')
+        make_meshblock_electorate_database(path)
+        DbUtils.ensure_indexes(path, 'meshblock_electorates', DbUtils.MESHBLOCK_ELECTORATE_INDEXES)
+        self.assertFalse(DbUtils.is_clustered(path, 'meshblock_electorates',
+                                              DbUtils.MESHBLOCK_ELECTORATE_CLUSTER_COLUMNS))
+
+        task = ClusterTableTask('', path, 'meshblock_electorates', DbUtils.MESHBLOCK_ELECTORATE_CLUSTER_COLUMNS)
+        self.assertTrue(task.run())
+        self.assertIsNone(task.error)
+        self.assertFalse(task.already_clustered)
+        self.assertTrue(DbUtils.is_clustered(path, 'meshblock_electorates',
+                                             DbUtils.MESHBLOCK_ELECTORATE_CLUSTER_COLUMNS))
+
+        # already clustered tables are left untouched
+        task = ClusterTableTask('', path, 'meshblock_electorates', DbUtils.MESHBLOCK_ELECTORATE_CLUSTER_COLUMNS)
+        self.assertTrue(task.run())
+        self.assertIsNone(task.error)
+        self.assertTrue(task.already_clustered)
+
+        # indexes must be retained
+        self.assertEqual(DbUtils.ensure_indexes(path, 'meshblock_electorates', DbUtils.MESHBLOCK_ELECTORATE_INDEXES),
+                         [])
+
+        layer = QgsVectorLayer('{}|layername=meshblock_electorates'.format(path), 'mb', 'ogr')
+        self.assertTrue(layer.isValid())
+        self.assertEqual(layer.featureCount(), 4)
+        self.assertEqual([f.attributes() for f in layer.getFeatures()],
+                         [[1, 1, 11, 3, 6, 8], [2, 1, 12, 2, 5, 7], [3, 2, 11, 3, 6, 8], [4, 2, 12, 1, 4, 7]])
+
+    def testGeoPackageFunctions(self):
+        """
+        Test updating a spatially indexed GeoPackage table outside of OGR
+        """
+        temp_dir = QTemporaryDir()
+        path = os.path.join(temp_dir.path(), 'db.gpkg')
+        writer = GeoPackageWriter(path)
+        fields = QgsFields()
+        fields.append(QgsField('staged_electorate', QVariant.Int))
+        self.assertTrue(writer.create_layer('meshblocks', QgsWkbTypes.Polygon, fields,
+                                            QgsCoordinateReferenceSystem('EPSG:4326')))
+        f = QgsFeature()
+        f.setAttributes([1])
+        f.setGeometry(QgsGeometry.fromWkt('Polygon((1 2, 3 2, 3 5, 1 5, 1 2))'))
+        self.assertTrue(writer.add_feature('meshblocks', f))
+        self.assertTrue(writer.commit())
+        writer.close()
+
+        connection = DbUtils.connect(path)
+        try:
+            DbUtils.register_geopackage_functions(connection)
+            blob = connection.execute('SELECT geom FROM meshblocks').fetchone()[0]
+            self.assertEqual(DbUtils.geopackage_envelope(blob), (1, 3, 2, 5))
+            self.assertEqual(connection.execute('SELECT ST_IsEmpty(geom), ST_MinX(geom), ST_MaxX(geom), '
+                                                'ST_MinY(geom), ST_MaxY(geom) FROM meshblocks').fetchone(),
+                             (0, 1, 3, 2, 5))
+            self.assertIsNone(DbUtils.geopackage_envelope(None))
+            self.assertIsNone(DbUtils.geopackage_envelope(b'xx'))
+
+            connection.execute('UPDATE meshblocks SET staged_electorate=2')
+            connection.commit()
+        finally:
+            connection.close()
+
+        layer = QgsVectorLayer('{}|layername=meshblocks'.format(path), 'mb', 'ogr')
+        self.assertTrue(layer.isValid())
+        self.assertEqual([f['staged_electorate'] for f in layer.getFeatures()], [2])
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(DbUtilsTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -457,6 +457,40 @@ class LinzDistrictRegistryTest(unittest.TestCase):
         self.assertEqual(reg.get_stats_nz_calculations(2),
                          {'currentPopulation': NULL, 'varianceYear1': NULL, 'varianceYear2': NULL})
 
+    def testRelabelElectorateScenario(self):
+        """
+        Test updating the scenario recorded against electorates
+        """
+        layer = QgsVectorLayer(
+            "Point?crs=EPSG:4326&field=electorate_id:int&field=code:string&field=fld1:string&field=type:string&field=estimated_pop:int&field=deprecated:int&field=stats_nz_pop:int&field=stats_nz_var_20:int&field=stats_nz_var_23:int&field=scenario_id:int&field=electorate_id_stats:string&field=expected_regions:int",
+            "source", "memory")
+        f = QgsFeature()
+        f.setAttributes([1, "code4", "test4", 'GN', 1000, True, NULL, NULL, NULL, 1])
+        f2 = QgsFeature()
+        f2.setAttributes([2, "code2", "test2", 'GS', 2000, False, NULL, NULL, NULL, 1])
+        f3 = QgsFeature()
+        f3.setAttributes([3, "code3", "test3", 'M', 3000, False, NULL, NULL, NULL, 2])
+        f4 = QgsFeature()
+        f4.setAttributes([4, "code5", "test5", 'GN', 4000, False, NULL, NULL, NULL, NULL])
+        layer.dataProvider().addFeatures([f, f2, f3, f4])
+        quota_layer = make_quota_layer()
+
+        reg = LinzElectoralDistrictRegistry(
+            source_layer=layer,
+            quota_layer=quota_layer,
+            electorate_type='GN',
+            source_field='electorate_id',
+            title_field='fld1')
+
+        # all electorate types should be updated, including deprecated electorates
+        self.assertTrue(reg.relabel_electorate_scenario(1, 5))
+        self.assertEqual([f['scenario_id'] for f in layer.getFeatures()], [5, 5, 2, NULL])
+        self.assertTrue(reg.relabel_electorate_scenario(2, 6))
+        self.assertEqual([f['scenario_id'] for f in layer.getFeatures()], [5, 5, 6, NULL])
+        # no matching electorates
+        self.assertTrue(reg.relabel_electorate_scenario(1, 7))
+        self.assertEqual([f['scenario_id'] for f in layer.getFeatures()], [5, 5, 6, NULL])
+
 
 if __name__ == "__main__":
     suite = unittest.makeSuite(LinzElectoralDistrictRegistry)
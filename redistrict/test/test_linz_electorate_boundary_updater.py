@@ -0,0 +1,219 @@
+# coding=utf-8
+"""LINZ Electorate Boundary Updater Test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import unittest
+from redistrict.linz.electorate_boundary_updater import ElectorateBoundaryUpdater
+from redistrict.linz.electorate_changes_queue import ElectorateEditQueue
+from redistrict.linz.linz_redistrict_handler import LinzRedistrictHandler
+from redistrict.test.test_linz_redistrict_handler import make_user_log_layer
+from qgis.core import (NULL,
+                       QgsVectorLayer,
+                       QgsGeometry,
+                       QgsRectangle,
+                       QgsFeature)
+
+
+def make_meshblock_layer() -> QgsVectorLayer:
+    """
+    Makes a dummy meshblock layer for testing boundary updates
+    """
+    layer = QgsVectorLayer(
+        "Polygon?crs=EPSG:4326&field=fld1:string&field=electorate:int&field=offline_pop_gn:int",
+        "source", "memory")
+    f = QgsFeature()
+    f.setAttributes(["11", 1, 10])
+    f.setGeometry(QgsGeometry.fromRect(QgsRectangle(0, 0, 5, 5)))
+    f2 = QgsFeature()
+    f2.setAttributes(["12", 1, 20])
+    f2.setGeometry(QgsGeometry.fromRect(QgsRectangle(5, 0, 10, 5)))
+    f3 = QgsFeature()
+    f3.setAttributes(["13", 2, 30])
+    f3.setGeometry(QgsGeometry.fromRect(QgsRectangle(0, 5, 5, 10)))
+    f4 = QgsFeature()
+    f4.setAttributes(["14", 2, 40])
+    f4.setGeometry(QgsGeometry.fromRect(QgsRectangle(5, 5, 10, 10)))
+    assert layer.dataProvider().addFeatures([f, f2, f3, f4])[0]
+    return layer
+
+
+def make_electorate_layer() -> QgsVectorLayer:
+    """
+    Makes a dummy electorate layer for testing boundary updates
+    """
+    layer = QgsVectorLayer(
+        "Polygon?crs=EPSG:4326&field=electorate_id:int&field=estimated_pop:int&field=stats_nz_pop:int&field=stats_nz_var_20:int&field=stats_nz_var_23:int&field=invalid:int&field=invalid_reason:string",
+        "source", "memory")
+    f = QgsFeature()
+    f.setAttributes([1, 30, NULL, NULL, NULL, NULL, NULL])
+    f.setGeometry(QgsGeometry.fromRect(QgsRectangle(0, 0, 10, 5)))
+    f2 = QgsFeature()
+    f2.setAttributes([2, 70, NULL, NULL, NULL, NULL, NULL])
+    f2.setGeometry(QgsGeometry.fromRect(QgsRectangle(0, 5, 10, 10)))
+    assert layer.dataProvider().addFeatures([f, f2])[0]
+    return layer
+
+
+class ElectorateBoundaryUpdaterTest(unittest.TestCase):
+    """Test ElectorateBoundaryUpdater."""
+
+    def testUpdater(self):
+        """
+        Test recalculating boundaries
+        """
+        meshblock_layer = make_meshblock_layer()
+        electorate_layer = make_electorate_layer()
+        updater = ElectorateBoundaryUpdater(electorate_layer=electorate_layer, electorate_layer_field='electorate_id',
+                                            meshblock_layer=meshblock_layer, target_field='electorate',
+                                            run_in_background=False)
+        self.assertFalse(updater.has_pending_updates())
+        self.assertEqual(updater.process_pending_tasks(), [])
+
+        self.assertTrue(meshblock_layer.startEditing())
+        self.assertTrue(meshblock_layer.changeAttributeValue(2, 1, 2))
+
+        updater.mark_dirty([1, 2])
+        self.assertTrue(updater.is_dirty(1))
+        self.assertTrue(updater.is_dirty(2))
+        self.assertTrue(updater.has_pending_updates())
+        # boundaries are not changed until the task completes
+        self.assertEqual(electorate_layer.getFeature(1).geometry().boundingBox(), QgsRectangle(0, 0, 10, 5))
+
+        self.assertCountEqual(updater.process_pending_tasks(), [1, 2])
+        self.assertFalse(updater.has_pending_updates())
+        self.assertEqual(electorate_layer.getFeature(1).geometry().boundingBox(), QgsRectangle(0, 0, 5, 5))
+        self.assertEqual(electorate_layer.getFeature(2).geometry().area(), 75)
+
+        # results made stale by later edits must be discarded
+        self.assertTrue(meshblock_layer.changeAttributeValue(2, 1, 1))
+        updater.mark_dirty([1, 2])
+        self.assertTrue(meshblock_layer.changeAttributeValue(3, 1, 1))
+        updater.mark_dirty([2])
+        self.assertEqual(len(updater.pending_tasks), 2)
+        self.assertEqual(updater.process_pending_tasks(), [1, 2])
+        self.assertEqual(electorate_layer.getFeature(1).geometry().area(), 75)
+        self.assertEqual(electorate_layer.getFeature(2).geometry().boundingBox(), QgsRectangle(5, 5, 10, 10))
+
+        # invalidated electorates are not updated
+        self.assertTrue(meshblock_layer.changeAttributeValue(3, 1, 2))
+        updater.mark_dirty([1, 2])
+        updater.invalidate([2])
+        self.assertTrue(updater.is_dirty(1))
+        self.assertFalse(updater.is_dirty(2))
+        self.assertEqual(updater.process_pending_tasks(), [1])
+        self.assertEqual(electorate_layer.getFeature(2).geometry().boundingBox(), QgsRectangle(5, 5, 10, 10))
+
+        updater.mark_dirty([1, 2])
+        updater.discard_pending()
+        self.assertFalse(updater.has_pending_updates())
+        self.assertEqual(updater.process_pending_tasks(), [])
+
+    def testFlush(self):
+        """
+        Test completing pending recalculations on the calling thread
+        """
+        meshblock_layer = make_meshblock_layer()
+        electorate_layer = make_electorate_layer()
+        updater = ElectorateBoundaryUpdater(electorate_layer=electorate_layer, electorate_layer_field='electorate_id',
+                                            meshblock_layer=meshblock_layer, target_field='electorate',
+                                            run_in_background=False)
+        self.assertEqual(updater.flush(), [])
+
+        self.assertTrue(meshblock_layer.startEditing())
+        self.assertTrue(meshblock_layer.changeAttributeValue(2, 1, 2))
+        updater.mark_dirty([1, 2])
+        self.assertCountEqual(updater.flush(), [1, 2])
+        self.assertFalse(updater.has_pending_updates())
+        self.assertEqual(electorate_layer.getFeature(1).geometry().boundingBox(), QgsRectangle(0, 0, 5, 5))
+        self.assertEqual(electorate_layer.getFeature(2).geometry().area(), 75)
+        # superseded background results are discarded
+        self.assertEqual(updater.process_pending_tasks(), [])
+
+        # changing the target field completes pending recalculations using the previous field
+        self.assertTrue(meshblock_layer.changeAttributeValue(2, 1, 1))
+        updater.mark_dirty([1, 2])
+        updater.set_target_field('fld1')
+        self.assertFalse(updater.has_pending_updates())
+        self.assertEqual(updater.target_field, 'fld1')
+        self.assertEqual(electorate_layer.getFeature(1).geometry().boundingBox(), QgsRectangle(0, 0, 10, 5))
+        self.assertEqual(electorate_layer.getFeature(2).geometry().area(), 50)
+
+    def testDeferredEdits(self):
+        """
+        Test deferring boundary updates for redistricting operations
+        """
+        meshblock_layer = make_meshblock_layer()
+        electorate_layer = make_electorate_layer()
+        user_log_layer = make_user_log_layer()
+        updater = ElectorateBoundaryUpdater(electorate_layer=electorate_layer, electorate_layer_field='electorate_id',
+                                            meshblock_layer=meshblock_layer, target_field='electorate',
+                                            run_in_background=False)
+        queue = ElectorateEditQueue(electorate_layer=electorate_layer, user_log_layer=user_log_layer,
+                                    boundary_updater=updater)
+        handler = LinzRedistrictHandler(meshblock_layer=meshblock_layer, meshblock_number_field_name='fld1',
+                                        target_field='electorate', electorate_changes_queue=queue,
+                                        electorate_layer=electorate_layer, electorate_layer_field='electorate_id',
+                                        task='GN', user_log_layer=user_log_layer, scenario=1)
+        self.assertTrue(meshblock_layer.startEditing())
+        meshblock_layer.undoStack().indexChanged.connect(queue.sync_to_meshblock_undostack_index)
+
+        handler.begin_edit_group('test')
+        self.assertTrue(handler.assign_district([2], 2))
+        handler.end_edit_group()
+
+        # populations are updated immediately, boundaries are deferred
+        self.assertEqual({f['electorate_id']: f['estimated_pop'] for f in electorate_layer.getFeatures()},
+                         {1: 10, 2: 90})
+        self.assertEqual(electorate_layer.getFeature(1).geometry().boundingBox(), QgsRectangle(0, 0, 10, 5))
+        self.assertTrue(updater.is_dirty(1))
+        self.assertEqual(queue.memory_size(), 0)
+
+        self.assertCountEqual(updater.process_pending_tasks(), [1, 2])
+        self.assertEqual(electorate_layer.getFeature(1).geometry().boundingBox(), QgsRectangle(0, 0, 5, 5))
+        self.assertEqual(electorate_layer.getFeature(2).geometry().area(), 75)
+
+        # undo before the recalculation completes - the pending result is stale
+        handler.begin_edit_group('test2')
+        self.assertTrue(handler.assign_district([1], 2))
+        handler.end_edit_group()
+        self.assertEqual({f['electorate_id']: f['estimated_pop'] for f in electorate_layer.getFeatures()},
+                         {1: 0, 2: 100})
+        meshblock_layer.undoStack().undo()
+        self.assertEqual({f['electorate_id']: f['estimated_pop'] for f in electorate_layer.getFeatures()},
+                         {1: 10, 2: 90})
+        self.assertEqual(len(updater.pending_tasks), 2)
+        self.assertCountEqual(updater.process_pending_tasks(), [1, 2])
+        self.assertEqual(electorate_layer.getFeature(1).geometry().boundingBox(), QgsRectangle(0, 0, 5, 5))
+        self.assertEqual(electorate_layer.getFeature(2).geometry().area(), 75)
+
+        meshblock_layer.undoStack().undo()
+        updater.process_pending_tasks()
+        self.assertEqual(electorate_layer.getFeature(1).geometry().boundingBox(), QgsRectangle(0, 0, 10, 5))
+        self.assertEqual(electorate_layer.getFeature(2).geometry().boundingBox(), QgsRectangle(0, 5, 10, 10))
+
+        # rollback rebuilds boundaries immediately, discarding pending results
+        meshblock_layer.undoStack().redo()
+        self.assertTrue(updater.has_pending_updates())
+        queue.rollback()
+        self.assertFalse(updater.has_pending_updates())
+        self.assertEqual(updater.process_pending_tasks(), [])
+        self.assertEqual(electorate_layer.getFeature(1).geometry().boundingBox(), QgsRectangle(0, 0, 10, 5))
+        self.assertEqual(electorate_layer.getFeature(2).geometry().area(), 50)
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(ElectorateBoundaryUpdaterTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
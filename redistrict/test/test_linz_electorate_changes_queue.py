@@ -21,7 +21,8 @@ from qgis.core import (QgsVectorLayer,
                        QgsRectangle,
                        NULL)
 from redistrict.linz.electorate_changes_queue import (
-    ElectorateEditQueue
+    ElectorateEditQueue,
+    QueueItem
 )
 from redistrict.test.test_linz_redistrict_handler import make_user_log_layer
 
@@ -245,6 +246,203 @@ class LINZElectorateQueueTest(unittest.TestCase):
                           ''])
         self.assertEqual([f['username'] for f in user_log_layer.getFeatures()], ['test user', 'test user2'])
 
+    def testCompressGeometries(self):
+        """
+        Test compressing stored geometries
+        """
+        geometries = {1: QgsGeometry.fromRect(QgsRectangle(5, 0, 10, 5)),
+                      2: QgsGeometry()}
+        compressed = QueueItem.compress_geometries(geometries)
+        self.assertEqual(list(compressed.keys()), [1, 2])
+        self.assertIsInstance(compressed[1], bytes)
+        restored = QueueItem.decompress_geometries(compressed)
+        self.assertEqual(restored[1].asWkt(), 'Polygon ((5 0, 10 0, 10 5, 5 5, 5 0))')
+        self.assertTrue(restored[2].isNull())
+
+    def testEviction(self):
+        """
+        Test evicting geometries from the queue
+        """
+        user_log_layer = make_user_log_layer()
+        district_layer = QgsVectorLayer(
+            "Polygon?crs=EPSG:4326&field=fld1:string&field=estimated_pop:int",
+            "source", "memory")
+        d = QgsFeature()
+        d.setAttributes(["test1", 1])
+        d.setGeometry(QgsGeometry.fromRect(QgsRectangle(5, 0, 10, 5)))
+        d2 = QgsFeature()
+        d2.setAttributes(["test2", 2])
+        d2.setGeometry(QgsGeometry.fromRect(QgsRectangle(0, 10, 10, 15)))
+        success, [d, d2] = district_layer.dataProvider().addFeatures([d, d2])
+        self.assertTrue(success)
+
+        builder_calls = []
+
+        def rebuild(feature_ids, committed):
+            """
+            Dummy geometry builder
+            """
+            builder_calls.append((feature_ids, committed))
+            return {feature_id: QgsGeometry.fromRect(QgsRectangle(0, 0, 1, 1)) for feature_id in feature_ids}
+
+        queue = ElectorateEditQueue(electorate_layer=district_layer, user_log_layer=user_log_layer,
+                                    memory_limit=0)
+        queue.push_changes({d.id(): {1: 11}},
+                           {d.id(): QgsGeometry.fromRect(QgsRectangle(105, 0, 110, 5))}, [],
+                           geometry_builder=rebuild)
+        # most recent item is never evicted
+        self.assertFalse(queue.items[0].evicted)
+        self.assertGreater(queue.memory_size(), 0)
+
+        queue.push_changes({d2.id(): {1: 22}},
+                           {d2.id(): QgsGeometry.fromRect(QgsRectangle(100, 10, 110, 15))}, [])
+        self.assertTrue(queue.items[0].evicted)
+        self.assertFalse(queue.items[1].evicted)
+        self.assertEqual(queue.memory_size(), queue.items[1].memory_size())
+        self.assertEqual(builder_calls, [])
+
+        # items without a geometry builder can't be evicted
+        queue.push_changes({d.id(): {1: 33}},
+                           {d.id(): QgsGeometry.fromRect(QgsRectangle(205, 0, 210, 5))}, [])
+        self.assertFalse(queue.items[1].evicted)
+        self.assertEqual(len(queue.items), 3)
+
+        self.assertTrue(queue.back())
+        self.assertTrue(queue.back())
+        self.assertEqual([f.attributes() for f in district_layer.getFeatures()], [['test1', 11], ['test2', 2]])
+        self.assertEqual([f.geometry().asWkt() for f in district_layer.getFeatures()],
+                         ['Polygon ((105 0, 110 0, 110 5, 105 5, 105 0))',
+                          'Polygon ((0 10, 10 10, 10 15, 0 15, 0 10))'])
+        self.assertEqual(builder_calls, [])
+
+        # evicted item must be rebuilt
+        self.assertTrue(queue.back())
+        self.assertEqual(builder_calls, [([d.id()], False)])
+        self.assertEqual([f.attributes() for f in district_layer.getFeatures()], [['test1', 1], ['test2', 2]])
+        self.assertEqual([f.geometry().asWkt() for f in district_layer.getFeatures()],
+                         ['Polygon ((0 0, 1 0, 1 1, 0 1, 0 0))',
+                          'Polygon ((0 10, 10 10, 10 15, 0 15, 0 10))'])
+
+        self.assertTrue(queue.forward())
+        self.assertEqual(builder_calls, [([d.id()], False), ([d.id()], False)])
+
+        # rollback must rebuild from committed meshblocks
+        builder_calls.clear()
+        queue.meshblock_undo_index = 1
+        queue.rollback()
+        self.assertEqual(builder_calls, [([d.id()], True)])
+        self.assertFalse(queue.items[0].rolling_back)
+
+        # pushing discards undone items
+        queue.push_changes({d.id(): {1: 44}},
+                           {d.id(): QgsGeometry.fromRect(QgsRectangle(305, 0, 310, 5))}, [])
+        self.assertEqual(len(queue.items), 1)
+        self.assertEqual(queue.count(), 1)
+
+        queue.clear()
+        self.assertEqual(queue.items, [])
+        self.assertEqual(queue.memory_size(), 0)
+
+    def testEvictionKeepsCurrentItem(self):
+        """
+        Test that the current item is never evicted, even when later items have been undone
+        """
+        user_log_layer = make_user_log_layer()
+        district_layer = QgsVectorLayer(
+            "Polygon?crs=EPSG:4326&field=fld1:string&field=estimated_pop:int",
+            "source", "memory")
+        d = QgsFeature()
+        d.setAttributes(["test1", 1])
+        d.setGeometry(QgsGeometry.fromRect(QgsRectangle(5, 0, 10, 5)))
+        success, [d] = district_layer.dataProvider().addFeatures([d])
+        self.assertTrue(success)
+
+        def rebuild(feature_ids, _):
+            """
+            Dummy geometry builder
+            """
+            return {feature_id: QgsGeometry.fromRect(QgsRectangle(0, 0, 1, 1)) for feature_id in feature_ids}
+
+        queue = ElectorateEditQueue(electorate_layer=district_layer, user_log_layer=user_log_layer,
+                                    memory_limit=1000000)
+        queue.push_changes({d.id(): {1: 11}},
+                           {d.id(): QgsGeometry.fromRect(QgsRectangle(105, 0, 110, 5))}, [],
+                           geometry_builder=rebuild)
+        queue.push_changes({d.id(): {1: 22}},
+                           {d.id(): QgsGeometry.fromRect(QgsRectangle(205, 0, 210, 5))}, [],
+                           geometry_builder=rebuild)
+        self.assertTrue(queue.back())
+
+        queue.set_memory_limit(0)
+        self.assertFalse(queue.items[0].evicted)
+        self.assertTrue(queue.items[1].evicted)
+
+    def testCoalescedSync(self):
+        """
+        Test that syncing multiple steps applies the net change once
+        """
+        user_log_layer = make_user_log_layer()
+        district_layer = QgsVectorLayer(
+            "Polygon?crs=EPSG:4326&field=fld1:string&field=estimated_pop:int",
+            "source", "memory")
+        d = QgsFeature()
+        d.setAttributes(["test1", 1])
+        d.setGeometry(QgsGeometry.fromRect(QgsRectangle(5, 0, 10, 5)))
+        d2 = QgsFeature()
+        d2.setAttributes(["test2", 2])
+        d2.setGeometry(QgsGeometry.fromRect(QgsRectangle(0, 10, 10, 15)))
+        success, [d, d2] = district_layer.dataProvider().addFeatures([d, d2])
+        self.assertTrue(success)
+
+        queue = ElectorateEditQueue(electorate_layer=district_layer, user_log_layer=user_log_layer)
+        for i in range(3):
+            log_entry = QgsFeature(user_log_layer.fields())
+            log_entry['username'] = 'user {}'.format(i)
+            queue.push_changes({d.id(): {1: 10 + i}, d2.id(): {0: 'x{}'.format(i)}},
+                               {d.id(): QgsGeometry.fromRect(QgsRectangle(100 + i, 0, 110, 5))}, [log_entry])
+        self.assertEqual(queue.meshblock_undo_index, 3)
+        self.assertEqual([f.attributes() for f in district_layer.getFeatures()], [['test1', 12], ['x2', 2]])
+        self.assertEqual(user_log_layer.featureCount(), 3)
+
+        repaints = []
+        district_layer.repaintRequested.connect(lambda: repaints.append(1))
+        index_changes = []
+        queue.indexChanged.connect(index_changes.append)
+
+        queue.sync_to_meshblock_undostack_index(0)
+        self.assertEqual(len(repaints), 1)
+        self.assertEqual(index_changes, [0])
+        self.assertEqual(queue.index(), 0)
+        self.assertEqual([f.attributes() for f in district_layer.getFeatures()], [['test1', 1], ['test2', 2]])
+        self.assertEqual([f.geometry().asWkt() for f in district_layer.getFeatures()],
+                         ['Polygon ((5 0, 10 0, 10 5, 5 5, 5 0))',
+                          'Polygon ((0 10, 10 10, 10 15, 0 15, 0 10))'])
+        self.assertEqual(user_log_layer.featureCount(), 0)
+
+        queue.sync_to_meshblock_undostack_index(3)
+        self.assertEqual(len(repaints), 2)
+        self.assertEqual(index_changes, [0, 3])
+        self.assertEqual([f.attributes() for f in district_layer.getFeatures()], [['test1', 12], ['x2', 2]])
+        self.assertEqual([f.geometry().asWkt() for f in district_layer.getFeatures()],
+                         ['Polygon ((102 0, 110 0, 110 5, 102 5, 102 0))',
+                          'Polygon ((0 10, 10 10, 10 15, 0 15, 0 10))'])
+        self.assertEqual(sorted([f['username'] for f in user_log_layer.getFeatures()]),
+                         ['user 0', 'user 1', 'user 2'])
+
+        # user log entries must be correctly associated with their items after a coalesced redo
+        queue.sync_to_meshblock_undostack_index(2)
+        self.assertEqual(sorted([f['username'] for f in user_log_layer.getFeatures()]), ['user 0', 'user 1'])
+        self.assertEqual([f.attributes() for f in district_layer.getFeatures()], [['test1', 11], ['x1', 2]])
+
+        # no change
+        queue.sync_to_meshblock_undostack_index(2)
+        self.assertEqual(len(repaints), 3)
+
+        queue.rollback()
+        self.assertEqual([f.attributes() for f in district_layer.getFeatures()], [['test1', 1], ['test2', 2]])
+        self.assertEqual(user_log_layer.featureCount(), 0)
+        self.assertEqual(len(repaints), 4)
+
 
 if __name__ == "__main__":
     suite = unittest.makeSuite(LINZElectorateQueueTest)
@@ -0,0 +1,100 @@
+# coding=utf-8
+"""LINZ Electorate Geometry Cache Test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import unittest
+from qgis.PyQt.QtCore import QTemporaryDir
+from redistrict.linz.electorate_geometry_cache import ElectorateGeometryCache
+from qgis.core import QgsGeometry
+
+
+class ElectorateGeometryCacheTest(unittest.TestCase):
+    """Test ElectorateGeometryCache."""
+
+    def testContentHash(self):
+        """
+        Test calculating electorate content hashes
+        """
+        self.assertEqual(ElectorateGeometryCache.content_hash('GN', [3, 1, 2], 50),
+                         ElectorateGeometryCache.content_hash('GN', ['1', 2, 3], 50))
+        self.assertNotEqual(ElectorateGeometryCache.content_hash('GN', [1, 2, 3], 50),
+                            ElectorateGeometryCache.content_hash('GS', [1, 2, 3], 50))
+        self.assertNotEqual(ElectorateGeometryCache.content_hash('GN', [1, 2, 3], 50),
+                            ElectorateGeometryCache.content_hash('GN', [1, 2, 3], 51))
+        self.assertNotEqual(ElectorateGeometryCache.content_hash('GN', [1, 2, 3], 50),
+                            ElectorateGeometryCache.content_hash('GN', [1, 2], 50))
+
+    def check_cache(self, cache: ElectorateGeometryCache):
+        """
+        Runs checks against a cache
+        """
+        hash_a = ElectorateGeometryCache.content_hash('GN', [1, 2], 10)
+        hash_b = ElectorateGeometryCache.content_hash('GN', [3], 20)
+        hash_c = ElectorateGeometryCache.content_hash('GN', [1], 5)
+        self.assertEqual(cache.lookup({1: hash_a, 2: hash_b}), {})
+
+        cache.store(1, {1: (hash_a, QgsGeometry.fromWkt('Point (1 2)'), 10),
+                        2: (hash_b, QgsGeometry.fromWkt('Point (3 4)'), 20)})
+        res = cache.lookup({1: hash_a, 2: hash_b})
+        self.assertEqual({k: (v[0].asWkt(), v[1]) for k, v in res.items()},
+                         {1: ('Point (1 2)', 10), 2: ('Point (3 4)', 20)})
+        # different content
+        self.assertEqual(cache.lookup({1: hash_c}), {})
+        # hashes are specific to an electorate
+        self.assertEqual(cache.lookup({2: hash_a}), {})
+
+        # entries can be reused by other scenarios with identical content
+        cache.store(2, {1: (hash_c, QgsGeometry.fromWkt('Point (5 6)'), 5)})
+        res = cache.lookup({1: hash_a})
+        self.assertEqual(res[1][0].asWkt(), 'Point (1 2)')
+        res = cache.lookup({1: hash_c})
+        self.assertEqual(res[1][0].asWkt(), 'Point (5 6)')
+
+        # replacing a scenario's entry
+        cache.store(1, {1: (hash_c, QgsGeometry.fromWkt('Point (5 6)'), 5)})
+        self.assertEqual(cache.lookup({1: hash_a}), {})
+
+        cache.clear()
+        self.assertEqual(cache.lookup({1: hash_c, 2: hash_b}), {})
+
+    def testMemoryCache(self):
+        """
+        Test in-memory cache
+        """
+        self.check_cache(ElectorateGeometryCache())
+
+    def testDatabaseCache(self):
+        """
+        Test database backed cache
+        """
+        temp_dir = QTemporaryDir()
+        database_path = os.path.join(temp_dir.path(), 'cache.gpkg')
+        self.check_cache(ElectorateGeometryCache(database_path))
+
+        # cache should persist
+        cache = ElectorateGeometryCache(database_path)
+        hash_a = ElectorateGeometryCache.content_hash('GN', [1, 2], 10)
+        cache.store(1, {1: (hash_a, QgsGeometry.fromWkt('Point (1 2)'), 10)})
+        cache = ElectorateGeometryCache(database_path)
+        res = cache.lookup({1: hash_a})
+        self.assertEqual(res[1][0].asWkt(), 'Point (1 2)')
+        self.assertEqual(res[1][1], 10)
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(ElectorateGeometryCacheTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,87 @@
+# coding=utf-8
+"""LINZ Electorate Validation Cache Test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import unittest
+from qgis.PyQt.QtCore import QTemporaryDir
+from redistrict.linz.electorate_validation_cache import ElectorateValidationCache
+
+
+class ElectorateValidationCacheTest(unittest.TestCase):
+    """Test ElectorateValidationCache."""
+
+    def testContentHash(self):
+        """
+        Test calculating electorate validation hashes
+        """
+        base = ElectorateValidationCache.content_hash('GN', [3, 1, 2], 50, 60, 1, False)
+        self.assertEqual(base, ElectorateValidationCache.content_hash('GN', ['1', 2, 3], 50, 60, 1, False))
+        self.assertNotEqual(base, ElectorateValidationCache.content_hash('GS', [1, 2, 3], 50, 60, 1, False))
+        self.assertNotEqual(base, ElectorateValidationCache.content_hash('GN', [1, 2], 50, 60, 1, False))
+        self.assertNotEqual(base, ElectorateValidationCache.content_hash('GN', [1, 2, 3], 51, 60, 1, False))
+        self.assertNotEqual(base, ElectorateValidationCache.content_hash('GN', [1, 2, 3], 50, 61, 1, False))
+        self.assertNotEqual(base, ElectorateValidationCache.content_hash('GN', [1, 2, 3], 50, 60, 2, False))
+        self.assertNotEqual(base, ElectorateValidationCache.content_hash('GN', [1, 2, 3], 50, 60, 1, True))
+
+    def check_cache(self, cache: ElectorateValidationCache):
+        """
+        Runs checks against a cache
+        """
+        hash_a = ElectorateValidationCache.content_hash('GN', [1, 2], 10, 20, 1, False)
+        hash_b = ElectorateValidationCache.content_hash('GN', [3], 20, 20, 1, False)
+        self.assertEqual(cache.lookup({1: hash_a, 2: hash_b}), {})
+
+        cache.store({1: (hash_a, ['Outside quota tolerance', 'Electorate is non-contiguous'], [[1], [2]]),
+                     2: (hash_b, [], [])})
+        self.assertEqual(cache.lookup({1: hash_a, 2: hash_b}),
+                         {1: (['Outside quota tolerance', 'Electorate is non-contiguous'], [[1], [2]]),
+                          2: ([], [])})
+        # changed electorate
+        self.assertEqual(cache.lookup({1: hash_b}), {})
+
+        # replacing an entry
+        cache.store({1: (hash_b, [], [])})
+        self.assertEqual(cache.lookup({1: hash_a}), {})
+        self.assertEqual(cache.lookup({1: hash_b}), {1: ([], [])})
+
+        cache.clear()
+        self.assertEqual(cache.lookup({1: hash_b, 2: hash_b}), {})
+
+    def testMemoryCache(self):
+        """
+        Test in-memory cache
+        """
+        self.check_cache(ElectorateValidationCache())
+
+    def testDatabaseCache(self):
+        """
+        Test database backed cache
+        """
+        temp_dir = QTemporaryDir()
+        database_path = os.path.join(temp_dir.path(), 'cache.gpkg')
+        self.check_cache(ElectorateValidationCache(database_path))
+
+        # cache should persist
+        hash_a = ElectorateValidationCache.content_hash('GN', [1, 2], 10, 20, 1, False)
+        ElectorateValidationCache(database_path).store({1: (hash_a, ['Outside quota tolerance'], [])})
+        self.assertEqual(ElectorateValidationCache(database_path).lookup({1: hash_a}),
+                         {1: (['Outside quota tolerance'], [])})
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(ElectorateValidationCacheTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -150,6 +150,73 @@ class ExportTaskTest(unittest.TestCase):
         self.assertEqual([f.attributes() for f in out_log_layer.getFeatures()],
                          [[1, 1, NULL, 'user', 'v1', 1, '11', 'GN', 1, 2]])
 
+        # electorate geometries are not current for the scenario
+        task = ExportTask(task_name='', dest_file=out_file, electorate_registry=electorate_registry,
+                          meshblock_layer=meshblock_layer,
+                          meshblock_number_field_name='MeshblockNumber', scenario_registry=reg, scenario=1,
+                          user_log_layer=user_log_layer)
+        task.prepare()
+        electorate_attributes = task.calculate_electorate_attributes()
+        self.assertIsNone(task.current_electorate_geometries(electorate_attributes))
+
+        # existing geometries are current, and can be reused
+        scenario_idx = electorate_layer.fields().lookupField('scenario_id')
+        electorate_layer.dataProvider().changeAttributeValues({f.id(): {scenario_idx: 1}
+                                                               for f in electorate_layer.getFeatures()})
+        electorate_layer.dataProvider().changeGeometryValues({f.id(): QgsGeometry.fromWkt('Point({} 1)'.format(f.id()))
+                                                              for f in electorate_layer.getFeatures()})
+        task = ExportTask(task_name='', dest_file=out_file, electorate_registry=electorate_registry,
+                          meshblock_layer=meshblock_layer,
+                          meshblock_number_field_name='MeshblockNumber', scenario_registry=reg, scenario=1,
+                          user_log_layer=user_log_layer)
+        task.prepare()
+        electorate_attributes = task.calculate_electorate_attributes()
+        res = task.current_electorate_geometries(electorate_attributes)
+        self.assertEqual({k: v.asWkt() for k, v in res.items()},
+                         {f.id(): 'Point ({} 1)'.format(f.id()) for f in electorate_layer.getFeatures()})
+
+        # but not while edits are pending
+        electorate_layer.startEditing()
+        electorate_layer.changeAttributeValue(1, electorate_layer.fields().lookupField('name'), 'new name')
+        task = ExportTask(task_name='', dest_file=out_file, electorate_registry=electorate_registry,
+                          meshblock_layer=meshblock_layer,
+                          meshblock_number_field_name='MeshblockNumber', scenario_registry=reg, scenario=1,
+                          user_log_layer=user_log_layer)
+        task.prepare()
+        electorate_attributes = task.calculate_electorate_attributes()
+        self.assertIsNone(task.current_electorate_geometries(electorate_attributes))
+        electorate_layer.rollBack()
+
+        # or while electorate boundaries are waiting to be recalculated
+        task = ExportTask(task_name='', dest_file=out_file, electorate_registry=electorate_registry,
+                          meshblock_layer=meshblock_layer,
+                          meshblock_number_field_name='MeshblockNumber', scenario_registry=reg, scenario=1,
+                          user_log_layer=user_log_layer, dirty_electorates=[1])
+        task.prepare()
+        electorate_attributes = task.calculate_electorate_attributes()
+        self.assertIsNone(task.current_electorate_geometries(electorate_attributes))
+
+        # after branching, the existing geometries belong to the branch and not the original scenario
+        branch, error = reg.branch_scenario(1, 'branch')
+        self.assertFalse(error)
+        self.assertTrue(electorate_registry.relabel_electorate_scenario(1, branch))
+        task = ExportTask(task_name='', dest_file=out_file, electorate_registry=electorate_registry,
+                          meshblock_layer=meshblock_layer,
+                          meshblock_number_field_name='MeshblockNumber', scenario_registry=reg, scenario=1,
+                          user_log_layer=user_log_layer)
+        task.prepare()
+        electorate_attributes = task.calculate_electorate_attributes()
+        self.assertIsNone(task.current_electorate_geometries(electorate_attributes))
+        task = ExportTask(task_name='', dest_file=out_file, electorate_registry=electorate_registry,
+                          meshblock_layer=meshblock_layer,
+                          meshblock_number_field_name='MeshblockNumber', scenario_registry=reg, scenario=branch,
+                          user_log_layer=user_log_layer)
+        task.prepare()
+        electorate_attributes = task.calculate_electorate_attributes()
+        res = task.current_electorate_geometries(electorate_attributes)
+        self.assertEqual({k: v.asWkt() for k, v in res.items()},
+                         {f.id(): 'Point ({} 1)'.format(f.id()) for f in electorate_layer.getFeatures()})
+
 
 if __name__ == "__main__":
     suite = unittest.makeSuite(ExportTaskTest)
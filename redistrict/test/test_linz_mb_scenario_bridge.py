@@ -56,6 +56,15 @@ class ScenarioMeshblockBridgeTest(unittest.TestCase):
         bridge.scenario = 2
         mb_ids = bridge.get_target_meshblock_ids_from_numbers([0, 1])
         self.assertEqual(mb_ids, {0: 1, 1: 2})
+        # indexes should be reused
+        self.assertEqual(set(bridge.target_meshblock_ids.keys()), {1, 2})
+        bridge.scenario = 1
+        mb_ids = bridge.get_target_meshblock_ids_from_numbers([1])
+        self.assertEqual(mb_ids, {1: 4})
+        bridge.invalidate_target_meshblock_ids()
+        self.assertEqual(bridge.target_meshblock_ids, {})
+        mb_ids = bridge.get_target_meshblock_ids_from_numbers([0, 1])
+        self.assertEqual(mb_ids, {0: 3, 1: 4})
 
     def testGetNewElectorates(self):
         """
@@ -0,0 +1,125 @@
+# coding=utf-8
+"""LINZ Meshblock Adjacency Test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import unittest
+from qgis.PyQt.QtCore import QTemporaryDir
+from redistrict.linz.meshblock_store import MeshblockStore
+from redistrict.linz.meshblock_adjacency import MeshblockAdjacency
+from qgis.core import (NULL,
+                       QgsFeedback,
+                       QgsVectorLayer,
+                       QgsGeometry,
+                       QgsFeature)
+
+
+def make_polygon_meshblock_layer() -> QgsVectorLayer:
+    """
+    Makes a dummy polygon meshblock layer for testing adjacency
+    """
+    layer = QgsVectorLayer(
+        "Polygon?crs=EPSG:2193&field=MeshblockNumber:string&field=offline_pop_m:int&field=offline_pop_gn:int&field=offline_pop_gs:int&field=staged_electorate:int&field=offshore:int",
+        "source", "memory")
+    features = []
+    for meshblock, wkt in [("11", 'Polygon((0 0, 1 0, 1 1, 0 1, 0 0))'),
+                           ("12", 'Polygon((1 0, 2 0, 2 1, 1 1, 1 0))'),
+                           # touches 12 at a vertex only
+                           ("13", 'Polygon((2 1, 3 1, 3 2, 2 2, 2 1))'),
+                           ("14", 'Polygon((3 1, 4 1, 4 2, 3 2, 3 1))'),
+                           # isolated
+                           ("15", 'Polygon((10 10, 11 10, 11 11, 10 11, 10 10))'),
+                           # multipart - an island touching 15, and an island touching 11
+                           ("16", 'MultiPolygon(((11 10, 12 10, 12 11, 11 11, 11 10)),((0 -1, 1 -1, 1 0, 0 0, 0 -1)))'),
+                           # no geometry
+                           ("17", None)]:
+        f = QgsFeature()
+        f.setAttributes([meshblock, 1, 1, 1, NULL, 0])
+        if wkt:
+            f.setGeometry(QgsGeometry.fromWkt(wkt))
+        features.append(f)
+    layer.dataProvider().addFeatures(features)
+    return layer
+
+
+class MeshblockAdjacencyTest(unittest.TestCase):
+    """Test MeshblockAdjacency."""
+
+    def testBuild(self):
+        """
+        Test building the adjacency graph
+        """
+        layer = make_polygon_meshblock_layer()
+        store = MeshblockStore(meshblock_layer=layer, meshblock_number_field_name='MeshblockNumber')
+        adjacency = MeshblockAdjacency(meshblock_store=store)
+        self.assertTrue(adjacency.ensure_built())
+        # one node per polygon part
+        self.assertEqual(adjacency.row_nodes, [0, 1, 2, 3, 4, 5, 7, 7])
+        self.assertEqual(adjacency.node_rows, [0, 1, 2, 3, 4, 5, 5])
+        self.assertEqual([sorted(n) for n in adjacency.neighbours], [[1, 6], [0], [3], [2], [5], [4], [0]])
+
+        feedback = QgsFeedback()
+        feedback.cancel()
+        adjacency = MeshblockAdjacency(meshblock_store=store)
+        self.assertFalse(adjacency.ensure_built(feedback))
+
+    def testComponents(self):
+        """
+        Test calculating contiguous components
+        """
+        layer = make_polygon_meshblock_layer()
+        store = MeshblockStore(meshblock_layer=layer, meshblock_number_field_name='MeshblockNumber')
+        adjacency = MeshblockAdjacency(meshblock_store=store)
+        self.assertTrue(adjacency.ensure_built())
+        self.assertEqual(adjacency.components([]), [])
+        self.assertEqual(adjacency.components([1, 0]), [[0, 1]])
+        self.assertEqual(adjacency.components([4, 2, 1, 0, 3]), [[0, 1], [2, 3], [4]])
+        self.assertEqual(adjacency.components([0, 2, 4]), [[0], [2], [4]])
+
+        # each part of a multipart meshblock is considered separately
+        self.assertEqual(adjacency.components([5]), [[5], [5]])
+        self.assertEqual(adjacency.components([0, 5]), [[0, 5], [5]])
+        self.assertEqual(adjacency.components([0, 4, 5]), [[0, 5], [4, 5]])
+        self.assertEqual(adjacency.components([0, 1, 4, 5]), [[0, 1, 5], [4, 5]])
+
+        # meshblocks without geometry are ignored
+        self.assertEqual(adjacency.components([6]), [])
+        self.assertEqual(adjacency.components([0, 6]), [[0]])
+
+    def testDatabase(self):
+        """
+        Test persisting the adjacency graph
+        """
+        temp_dir = QTemporaryDir()
+        database_path = os.path.join(temp_dir.path(), 'adjacency.gpkg')
+        layer = make_polygon_meshblock_layer()
+        store = MeshblockStore(meshblock_layer=layer, meshblock_number_field_name='MeshblockNumber')
+        adjacency = MeshblockAdjacency(meshblock_store=store, database_path=database_path)
+        self.assertIsNone(adjacency.load())
+        self.assertTrue(adjacency.ensure_built())
+
+        adjacency = MeshblockAdjacency(meshblock_store=store, database_path=database_path)
+        part_counts, neighbours = adjacency.load()
+        self.assertEqual(part_counts, [1, 1, 1, 1, 1, 2, 0])
+        self.assertEqual([sorted(n) for n in neighbours], [[1, 6], [0], [3], [2], [5], [4], [0]])
+
+        MeshblockAdjacency.clear_database(database_path)
+        self.assertIsNone(adjacency.load())
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(MeshblockAdjacencyTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
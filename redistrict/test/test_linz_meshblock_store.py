@@ -0,0 +1,137 @@
+# coding=utf-8
+"""LINZ Meshblock Store Test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import unittest
+from collections import OrderedDict
+from redistrict.linz.meshblock_store import MeshblockStore
+from qgis.core import (NULL,
+                       QgsFeedback,
+                       QgsVectorLayer,
+                       QgsGeometry,
+                       QgsPointXY,
+                       QgsFeature)
+
+
+def make_store_meshblock_layer() -> QgsVectorLayer:
+    """
+    Makes a dummy meshblock layer for testing the meshblock store
+    """
+    layer = QgsVectorLayer(
+        "Point?crs=EPSG:4326&field=MeshblockNumber:string&field=offline_pop_m:int&field=offline_pop_gn:int&field=offline_pop_gs:int&field=staged_electorate:int&field=offshore:int",
+        "source", "memory")
+    f = QgsFeature()
+    f.setAttributes(["11", 5, 58900, 0, NULL, 0])
+    f.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(1, 2)))
+    f2 = QgsFeature()
+    f2.setAttributes(["12", 6, 57000, 0, NULL, 0])
+    f2.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(2, 3)))
+    f3 = QgsFeature()
+    f3.setAttributes(["13", 7, 2000, NULL, NULL, 0])
+    f3.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(4, 5)))
+    f4 = QgsFeature()
+    f4.setAttributes(["14", 8, 0, 20, NULL, 0])
+    f4.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(6, 7)))
+    f5 = QgsFeature()
+    f5.setAttributes(["15", 9, NULL, 30, NULL, 0])
+    f5.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(8, 9)))
+    f6 = QgsFeature()
+    f6.setAttributes(["16", 10, 0, 40, NULL, 1])
+    f6.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(10, 11)))
+    layer.dataProvider().addFeatures([f, f2, f3, f4, f5, f6])
+    return layer
+
+
+class MeshblockStoreTest(unittest.TestCase):
+    """Test MeshblockStore."""
+
+    def testLoad(self):
+        """
+        Test loading meshblocks into the store
+        """
+        layer = make_store_meshblock_layer()
+        store = MeshblockStore(meshblock_layer=layer, meshblock_number_field_name='MeshblockNumber')
+        self.assertEqual(store.meshblock_count(), 6)
+        self.assertEqual(list(store.meshblock_numbers), [11, 12, 13, 14, 15, 16])
+        self.assertEqual(list(store.populations['M']), [5, 6, 7, 8, 9, 10])
+        self.assertEqual(list(store.populations['GN']), [58900, 57000, 2000, 0, 0, 0])
+        self.assertEqual(list(store.populations['GS']), [0, 0, 0, 20, 30, 40])
+        self.assertEqual(list(store.offshore), [0, 0, 0, 0, 0, 1])
+        self.assertEqual(list(store.rows_for_meshblocks([13, 11, '16'])), [2, 0, 5])
+
+        # geometries are not resident by default, and are fetched on demand
+        self.assertIsNone(store.geometries)
+        self.assertEqual([g.asWkt() for g in store.geometries_for_rows([3, 1])], ['Point (6 7)', 'Point (2 3)'])
+        self.assertEqual([g.asWkt() for g in store.all_geometries()],
+                         ['Point (1 2)', 'Point (2 3)', 'Point (4 5)', 'Point (6 7)', 'Point (8 9)', 'Point (10 11)'])
+        self.assertIsNone(store.geometries)
+        feedback = QgsFeedback()
+        feedback.cancel()
+        self.assertIsNone(store.geometries_for_rows([1, 3], feedback))
+        self.assertIsNone(store.all_geometries(feedback))
+
+        store = MeshblockStore(meshblock_layer=layer, meshblock_number_field_name='MeshblockNumber',
+                               load_geometries=True)
+        self.assertEqual(store.meshblock_count(), 6)
+        self.assertEqual(len(store.geometries), 6)
+        self.assertEqual([g.asWkt() for g in store.geometries_for_rows([1, 3])], ['Point (2 3)', 'Point (6 7)'])
+
+    def testDeferredLoad(self):
+        """
+        Test deferring the meshblock load
+        """
+        layer = make_store_meshblock_layer()
+        store = MeshblockStore(meshblock_layer=layer, meshblock_number_field_name='MeshblockNumber',
+                               defer_load=True)
+        self.assertFalse(store.loaded)
+        self.assertEqual(store.meshblock_count(), 0)
+
+        feedback = QgsFeedback()
+        feedback.cancel()
+        self.assertFalse(store.ensure_loaded(feedback))
+        self.assertFalse(store.loaded)
+        self.assertEqual(store.meshblock_count(), 0)
+
+        self.assertTrue(store.ensure_loaded())
+        self.assertTrue(store.loaded)
+        self.assertEqual(store.meshblock_count(), 6)
+        self.assertEqual(list(store.meshblock_numbers), [11, 12, 13, 14, 15, 16])
+        # already loaded
+        self.assertTrue(store.ensure_loaded(feedback))
+        self.assertEqual(store.meshblock_count(), 6)
+
+    def testPopulations(self):
+        """
+        Test calculating grouped electorate populations
+        """
+        layer = make_store_meshblock_layer()
+        store = MeshblockStore(meshblock_layer=layer, meshblock_number_field_name='MeshblockNumber',
+                               load_geometries=False)
+
+        assignment, electorate_ids = store.build_assignment(OrderedDict([(1, [11]),
+                                                                         (2, [12, 13, 16]),
+                                                                         (3, [])]))
+        self.assertEqual(list(assignment), [0, 1, 1, -1, -1, 1])
+        self.assertEqual(electorate_ids, [1, 2, 3])
+        self.assertEqual(store.electorate_populations('GN', assignment, electorate_ids),
+                         {1: 58900, 2: 59000, 3: 0})
+        self.assertEqual(store.electorate_populations('M', assignment, electorate_ids),
+                         {1: 5, 2: 23, 3: 0})
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(MeshblockStoreTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
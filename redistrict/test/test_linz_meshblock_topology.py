@@ -0,0 +1,277 @@
+# coding=utf-8
+"""LINZ Meshblock Topology Test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import unittest
+from redistrict.linz.meshblock_store import MeshblockStore
+from redistrict.linz.meshblock_topology import MeshblockTopology
+from redistrict.linz.electorate_boundary_updater import ElectorateBoundaryUpdater
+from qgis.core import (NULL,
+                       QgsVectorLayer,
+                       QgsGeometry,
+                       QgsRectangle,
+                       QgsFeature)
+
+
+def make_grid_meshblock_layer() -> QgsVectorLayer:
+    """
+    Makes a dummy meshblock layer consisting of a 3x3 grid of meshblocks. The center
+    meshblock is assigned to electorate 2, and all others to electorate 1.
+    """
+    layer = QgsVectorLayer(
+        "Polygon?crs=EPSG:4326&field=MeshblockNumber:string&field=offline_pop_m:int&field=offline_pop_gn:int&field=offline_pop_gs:int&field=offshore:int&field=electorate:int",
+        "source", "memory")
+    features = []
+    for row in range(3):
+        for column in range(3):
+            f = QgsFeature()
+            f.setAttributes([str(10 + row * 3 + column), 0, 1, 0, 0, 2 if (row, column) == (1, 1) else 1])
+            f.setGeometry(QgsGeometry.fromRect(QgsRectangle(column, row, column + 1, row + 1)))
+            features.append(f)
+    assert layer.dataProvider().addFeatures(features)[0]
+    return layer
+
+
+def dissolve_electorate(layer: QgsVectorLayer, electorate) -> QgsGeometry:
+    """
+    Dissolves the meshblocks assigned to an electorate
+    """
+    return QgsGeometry.unaryUnion([f.geometry() for f in layer.getFeatures() if f['electorate'] == electorate])
+
+
+class MeshblockTopologyTest(unittest.TestCase):
+    """Test MeshblockTopology."""
+
+    def testBuild(self):
+        """
+        Test building the arc topology
+        """
+        layer = make_grid_meshblock_layer()
+        store = MeshblockStore(meshblock_layer=layer, meshblock_number_field_name='MeshblockNumber')
+        topology = MeshblockTopology(meshblock_store=store, meshblock_layer=layer, target_field='electorate')
+        self.assertFalse(topology.is_built())
+        self.assertFalse(topology.is_available())
+        self.assertTrue(topology.ensure_built())
+        self.assertTrue(topology.valid)
+        # 12 arcs between neighbouring meshblocks, 8 arcs on the outside of the grid
+        self.assertEqual(topology.arc_count(), 20)
+        # center meshblock is surrounded by 4 neighbours
+        self.assertEqual(len(topology.meshblock_arcs[4]), 4)
+        # corner meshblocks have 2 neighbours and a single outside arc
+        self.assertEqual(len(topology.meshblock_arcs[0]), 3)
+        self.assertEqual(len([a for a in topology.meshblock_arcs[0] if
+                              topology.arc_right[a] == MeshblockTopology.OUTSIDE]), 1)
+        topology.detach()
+
+    def testInvalidCoverage(self):
+        """
+        Test that the topology is disabled for meshblocks which aren't a clean coverage
+        """
+        layer = make_grid_meshblock_layer()
+        f = QgsFeature()
+        f.setAttributes(['99', 0, 1, 0, 0, 1])
+        f.setGeometry(QgsGeometry.fromRect(QgsRectangle(0, 0, 1, 1)))
+        f2 = QgsFeature()
+        f2.setAttributes(['98', 0, 1, 0, 0, 1])
+        f2.setGeometry(QgsGeometry.fromRect(QgsRectangle(0, 0, 1, 1)))
+        self.assertTrue(layer.dataProvider().addFeatures([f, f2])[0])
+        store = MeshblockStore(meshblock_layer=layer, meshblock_number_field_name='MeshblockNumber')
+        topology = MeshblockTopology(meshblock_store=store, meshblock_layer=layer, target_field='electorate')
+        self.assertTrue(topology.ensure_built())
+        self.assertFalse(topology.valid)
+        self.assertFalse(topology.is_available())
+        self.assertEqual(topology.electorate_boundary(1), [])
+        topology.detach()
+
+    def testUnmatchedJunctions(self):
+        """
+        Test that the topology is disabled for coverages with T-junctions or mismatched vertices
+        """
+        self.assertTrue(MeshblockTopology.point_on_segment((1, 0), (0, 0), (2, 0)))
+        self.assertFalse(MeshblockTopology.point_on_segment((0, 0), (0, 0), (2, 0)))
+        self.assertFalse(MeshblockTopology.point_on_segment((3, 0), (0, 0), (2, 0)))
+        self.assertFalse(MeshblockTopology.point_on_segment((1, 0.1), (0, 0), (2, 0)))
+
+        # a large meshblock sitting over two smaller meshblocks, meeting at a T-junction
+        layer = QgsVectorLayer(
+            "Polygon?crs=EPSG:4326&field=MeshblockNumber:string&field=offline_pop_m:int&field=offline_pop_gn:int&field=offline_pop_gs:int&field=offshore:int&field=electorate:int",
+            "source", "memory")
+        features = []
+        for number, rect in (('10', QgsRectangle(0, 1, 2, 2)), ('11', QgsRectangle(0, 0, 1, 1)),
+                             ('12', QgsRectangle(1, 0, 2, 1))):
+            f = QgsFeature()
+            f.setAttributes([number, 0, 1, 0, 0, 1])
+            f.setGeometry(QgsGeometry.fromRect(rect))
+            features.append(f)
+        self.assertTrue(layer.dataProvider().addFeatures(features)[0])
+        store = MeshblockStore(meshblock_layer=layer, meshblock_number_field_name='MeshblockNumber')
+        topology = MeshblockTopology(meshblock_store=store, meshblock_layer=layer, target_field='electorate')
+        self.assertTrue(topology.ensure_built())
+        self.assertFalse(topology.valid)
+        self.assertFalse(topology.is_available())
+        topology.detach()
+
+        # neighbouring meshblocks with an extra vertex along one side of their common edge
+        layer = make_grid_meshblock_layer()
+        self.assertTrue(layer.dataProvider().changeGeometryValues(
+            {1: QgsGeometry.fromWkt('Polygon((0 0, 1 0, 1 0.5, 1 1, 0 1, 0 0))')}))
+        store = MeshblockStore(meshblock_layer=layer, meshblock_number_field_name='MeshblockNumber')
+        topology = MeshblockTopology(meshblock_store=store, meshblock_layer=layer, target_field='electorate')
+        self.assertTrue(topology.ensure_built())
+        self.assertFalse(topology.valid)
+        topology.detach()
+
+    def testUnassembledBoundaries(self):
+        """
+        Test boundaries which can't be assembled into valid polygons
+        """
+        layer = make_grid_meshblock_layer()
+        store = MeshblockStore(meshblock_layer=layer, meshblock_number_field_name='MeshblockNumber')
+        topology = MeshblockTopology(meshblock_store=store, meshblock_layer=layer, target_field='electorate')
+        self.assertTrue(topology.ensure_built())
+        self.assertTrue(topology.is_available())
+
+        boundary = topology.electorate_boundary(2)
+        self.assertIsNotNone(topology.assemble_boundary(boundary))
+        # missing an arc, so the ring can't be closed
+        self.assertIsNone(topology.assemble_boundary(boundary[:-1]))
+        # reversed arcs form a hole, without any exterior ring
+        self.assertIsNone(topology.assemble_boundary([(arc_id, not reverse) for arc_id, reverse in boundary]))
+        # reversing the surrounding electorate gives an exterior ring around the center meshblock,
+        # with a hole outside of it
+        self.assertIsNone(topology.assemble_boundary(
+            [(arc_id, not reverse) for arc_id, reverse in topology.electorate_boundary(1)]))
+        self.assertTrue(topology.assemble_boundary([]).isNull())
+        topology.detach()
+
+    def testElectorateGeometries(self):
+        """
+        Test assembling electorate geometries from the topology
+        """
+        layer = make_grid_meshblock_layer()
+        store = MeshblockStore(meshblock_layer=layer, meshblock_number_field_name='MeshblockNumber')
+        topology = MeshblockTopology(meshblock_store=store, meshblock_layer=layer, target_field='electorate')
+        self.assertTrue(topology.ensure_built())
+        self.assertTrue(topology.is_available())
+
+        self.assertEqual(len(topology.electorate_boundary(1)), 12)
+        self.assertEqual(len(topology.electorate_boundary(2)), 4)
+        self.assertEqual(topology.electorate_boundary(3), [])
+
+        # electorate 1 surrounds electorate 2, so must contain a hole
+        geometry = topology.electorate_geometry(1)
+        self.assertEqual(geometry.area(), 8)
+        self.assertEqual(len(geometry.asPolygon()), 2)
+        self.assertTrue(geometry.isGeosEqual(dissolve_electorate(layer, 1)))
+        geometry = topology.electorate_geometry(2)
+        self.assertTrue(geometry.isGeosEqual(QgsGeometry.fromRect(QgsRectangle(1, 1, 2, 2))))
+        self.assertTrue(topology.electorate_geometry(3).isNull())
+
+        # edits to the layer flip arc ownership
+        self.assertTrue(layer.startEditing())
+        field_index = layer.fields().lookupField('electorate')
+        self.assertTrue(layer.changeAttributeValue(5, field_index, 1))
+        self.assertEqual(topology.assignment[4], 1)
+        self.assertTrue(topology.electorate_geometry(1).isGeosEqual(QgsGeometry.fromRect(QgsRectangle(0, 0, 3, 3))))
+        self.assertTrue(topology.electorate_geometry(2).isNull())
+
+        self.assertTrue(layer.changeAttributeValue(1, field_index, 2))
+        self.assertTrue(layer.changeAttributeValue(3, field_index, 2))
+        # electorate 2 is now split into multiple parts
+        geometry = topology.electorate_geometry(1)
+        self.assertEqual(geometry.area(), 7)
+        self.assertTrue(geometry.isGeosEqual(dissolve_electorate(layer, 1)))
+        geometry = topology.electorate_geometry(2)
+        self.assertTrue(geometry.isMultipart())
+        self.assertEqual(geometry.area(), 2)
+        self.assertTrue(geometry.isGeosEqual(dissolve_electorate(layer, 2)))
+
+        self.assertTrue(layer.changeAttributeValue(2, field_index, NULL))
+        self.assertEqual(topology.electorate_geometry(1).area(), 6)
+
+        # undo is tracked
+        layer.undoStack().undo()
+        self.assertEqual(topology.electorate_geometry(1).area(), 7)
+        layer.undoStack().undo()
+        self.assertEqual(topology.electorate_geometry(2).area(), 1)
+
+        # as is rollback
+        layer.rollBack()
+        self.assertTrue(topology.electorate_geometry(1).isGeosEqual(dissolve_electorate(layer, 1)))
+        self.assertTrue(topology.electorate_geometry(2).isGeosEqual(QgsGeometry.fromRect(QgsRectangle(1, 1, 2, 2))))
+
+        # changes to other fields are ignored
+        self.assertTrue(layer.startEditing())
+        self.assertTrue(layer.changeAttributeValue(5, 0, 'x'))
+        self.assertEqual(topology.assignment[4], 2)
+
+        # changing the target field reloads the assignments
+        topology.set_target_field('offline_pop_gn')
+        self.assertIsNone(topology.assignment)
+        self.assertTrue(topology.electorate_geometry(1).isGeosEqual(QgsGeometry.fromRect(QgsRectangle(0, 0, 3, 3))))
+        layer.rollBack()
+        topology.detach()
+
+    def testUpdater(self):
+        """
+        Test recalculating boundaries from the topology in a boundary updater
+        """
+        layer = make_grid_meshblock_layer()
+        electorate_layer = QgsVectorLayer("Polygon?crs=EPSG:4326&field=electorate_id:int", "source", "memory")
+        f = QgsFeature()
+        f.setAttributes([1])
+        f2 = QgsFeature()
+        f2.setAttributes([2])
+        self.assertTrue(electorate_layer.dataProvider().addFeatures([f, f2])[0])
+
+        store = MeshblockStore(meshblock_layer=layer, meshblock_number_field_name='MeshblockNumber')
+        topology = MeshblockTopology(meshblock_store=store, meshblock_layer=layer, target_field='electorate')
+        updater = ElectorateBoundaryUpdater(electorate_layer=electorate_layer, electorate_layer_field='electorate_id',
+                                            meshblock_layer=layer, target_field='electorate',
+                                            run_in_background=False, topology=topology)
+
+        # first task builds the topology, by dissolving meshblocks
+        updater.mark_dirty([1, 2])
+        self.assertIsNone(updater.pending_tasks[0].boundaries)
+        self.assertCountEqual(updater.process_pending_tasks(), [1, 2])
+        self.assertTrue(topology.is_built())
+        self.assertTrue(electorate_layer.getFeature(1).geometry().isGeosEqual(dissolve_electorate(layer, 1)))
+
+        # later tasks use the topology
+        self.assertTrue(layer.startEditing())
+        self.assertTrue(layer.changeAttributeValue(5, layer.fields().lookupField('electorate'), 1))
+        updater.mark_dirty([1, 2])
+        self.assertIsNotNone(updater.pending_tasks[0].boundaries)
+        # boundaries are snapshotted when the task is created
+        self.assertTrue(layer.changeAttributeValue(1, layer.fields().lookupField('electorate'), 2))
+        self.assertCountEqual(updater.process_pending_tasks(), [1, 2])
+        self.assertTrue(electorate_layer.getFeature(1).geometry().isGeosEqual(
+            QgsGeometry.fromRect(QgsRectangle(0, 0, 3, 3))))
+        self.assertTrue(electorate_layer.getFeature(2).geometry().isNull())
+
+        # boundaries which can't be assembled are dissolved instead
+        updater.mark_dirty([1])
+        task = updater.pending_tasks[0]
+        task.boundaries[1] = task.boundaries[1][:-1]
+        self.assertCountEqual(updater.process_pending_tasks(), [1])
+        self.assertTrue(electorate_layer.getFeature(1).geometry().isGeosEqual(dissolve_electorate(layer, 1)))
+        layer.rollBack()
+        topology.detach()
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(MeshblockTopologyTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
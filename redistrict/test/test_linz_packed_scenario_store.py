@@ -0,0 +1,155 @@
+# coding=utf-8
+"""LINZ Packed Scenario Store Test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import unittest
+from qgis.PyQt.QtCore import QTemporaryDir
+from qgis.core import (NULL,
+                       QgsVectorLayer,
+                       QgsFeature)
+from redistrict.linz.packed_scenario_store import PackedScenarioStore
+from redistrict.linz.scenario_registry import ScenarioRegistry
+from redistrict.test.test_linz_scenario_registry import (make_scenario_layer,
+                                                         make_meshblock_electorate_layer)
+
+
+class PackedScenarioStoreTest(unittest.TestCase):
+    """Test PackedScenarioStore."""
+
+    def testPack(self):
+        """
+        Test packing and unpacking electorate ids
+        """
+        blob = PackedScenarioStore.pack([1, 5, PackedScenarioStore.UNASSIGNED, 70000])
+        self.assertEqual(len(blob), 16)
+        self.assertEqual(list(PackedScenarioStore.unpack(blob)), [1, 5, -1, 70000])
+        self.assertEqual(list(PackedScenarioStore.unpack(PackedScenarioStore.pack([]))), [])
+
+    def testStore(self):
+        """
+        Test writing and reading packed scenarios
+        """
+        temp_dir = QTemporaryDir()
+        store = PackedScenarioStore(os.path.join(temp_dir.path(), 'db.sqlite'))
+        self.assertEqual(list(store.meshblock_index()), [])
+        self.assertEqual(store.packed_scenarios(), [])
+        self.assertIsNone(store.read_scenario(1))
+
+        self.assertTrue(store.write_scenario(1, {'GN': {11: 1, 12: 2, 13: 1},
+                                                 'GS': {11: 3, 12: 3, 13: 4},
+                                                 'M': {11: 5, 12: 5}}))
+        self.assertEqual(list(store.meshblock_index()), [11, 12, 13])
+        self.assertEqual(store.packed_scenarios(), [1])
+
+        packed = store.read_scenario(1)
+        self.assertEqual(packed.scenario_id, 1)
+        self.assertEqual(list(packed.meshblock_numbers), [11, 12, 13])
+        self.assertEqual(list(packed.assignments['GN']), [1, 2, 1])
+        self.assertEqual(packed.electorate_meshblocks('GN'), {1: [11, 13], 2: [12]})
+        self.assertEqual(packed.electorate_meshblocks('GS'), {3: [11, 12], 4: [13]})
+        # unassigned meshblocks are skipped
+        self.assertEqual(packed.electorate_meshblocks('M'), {5: [11, 12]})
+
+        packed = store.read_scenario(1, ['GS'])
+        self.assertEqual(list(packed.assignments.keys()), ['GS'])
+        self.assertEqual(packed.electorate_meshblocks('GN'), {})
+
+        # new meshblocks are appended to the index, existing positions are stable
+        self.assertTrue(store.write_scenario(2, {'GN': {10: 7, 12: 8}}))
+        self.assertEqual(list(store.meshblock_index()), [11, 12, 13, 10])
+        self.assertEqual(store.packed_scenarios(), [1, 2])
+        packed = store.read_scenario(2)
+        self.assertEqual(list(packed.assignments['GN']), [-1, 8, -1, 7])
+        self.assertEqual(packed.electorate_meshblocks('GN'), {8: [12], 7: [10]})
+        self.assertNotIn('GS', packed.assignments)
+
+        # scenarios packed before the index was extended are still valid
+        packed = store.read_scenario(1)
+        self.assertEqual(list(packed.meshblock_numbers), [11, 12, 13])
+        self.assertEqual(packed.electorate_meshblocks('GN'), {1: [11, 13], 2: [12]})
+
+        # a fresh store must read the same index
+        store2 = PackedScenarioStore(store.database_path)
+        self.assertEqual(store2.read_scenario(2).electorate_meshblocks('GN'), {8: [12], 7: [10]})
+
+        # ids which don't fit in the packed format
+        self.assertFalse(store.write_scenario(3, {'GN': {11: 2 ** 40}}))
+        self.assertEqual(store.packed_scenarios(), [1, 2])
+
+        store.remove_scenario(1)
+        self.assertEqual(store.packed_scenarios(), [2])
+        self.assertIsNone(store.read_scenario(1))
+
+        store.clear()
+        self.assertEqual(store.packed_scenarios(), [])
+        self.assertEqual(list(store.meshblock_index()), [])
+
+    def testPackedScenarios(self):
+        """
+        Test reading scenarios from packed copies
+        """
+        layer = make_scenario_layer()
+        mb_electorate_layer = QgsVectorLayer(
+            "NoGeometry?field=id:int&field=scenario_id:int&field=meshblock_number:int&field=gn_id:int&field=gs_id:int",
+            "source", "memory")
+        for attributes in ([1, 1, 11, 1, 3], [2, 1, 12, 2, NULL], [3, 2, 11, 2, 4]):
+            f = QgsFeature()
+            f.setAttributes(attributes)
+            mb_electorate_layer.dataProvider().addFeatures([f])
+
+        temp_dir = QTemporaryDir()
+        store = PackedScenarioStore(os.path.join(temp_dir.path(), 'packed.sqlite'))
+        reg = ScenarioRegistry(
+            source_layer=layer,
+            id_field='id',
+            name_field='name',
+            meshblock_electorate_layer=mb_electorate_layer,
+            packed_store=store
+        )
+        self.assertIsNone(reg.read_packed_scenario(1))
+        self.assertEqual(reg.packable_assignments(1), {'GN': {11: 1, 12: 2}, 'GS': {11: 3}})
+        self.assertTrue(reg.pack_scenario(1))
+        self.assertEqual(store.packed_scenarios(), [1])
+        self.assertEqual(reg.read_packed_scenario(1).electorate_meshblocks('GN'), {1: [11], 2: [12]})
+
+        # change records without invalidating - packed copy should be used
+        mb_electorate_layer.dataProvider().changeAttributeValues({1: {3: 2}})
+        self.assertEqual(reg.scenario_electorate_meshblocks(1),
+                         {'GN': {1: [11], 2: [12]}, 'GS': {3: [11]}})
+        self.assertEqual(reg.scenario_electorate_meshblocks(1, electorate_types=['GS']), {'GS': {3: [11]}})
+        version = reg.packed_version(1)
+        reg.invalidate_packed_scenario(1)
+        self.assertEqual(reg.packed_version(1), version + 1)
+        self.assertEqual(store.packed_scenarios(), [])
+        self.assertEqual(reg.scenario_electorate_meshblocks(1),
+                         {'GN': {2: [11, 12]}, 'GS': {3: [11]}})
+
+        # scenarios with non-integer electorate ids can't be packed
+        reg = ScenarioRegistry(
+            source_layer=layer,
+            id_field='id',
+            name_field='name',
+            meshblock_electorate_layer=make_meshblock_electorate_layer(),
+            packed_store=store
+        )
+        self.assertIsNone(reg.packable_assignments(1))
+        self.assertFalse(reg.pack_scenario(1))
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(PackedScenarioStoreTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
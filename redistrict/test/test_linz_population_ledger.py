@@ -0,0 +1,194 @@
+# coding=utf-8
+"""LINZ Population Ledger Test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import unittest
+from redistrict.linz.population_ledger import (PopulationLedger,
+                                               PopulationLedgerChange)
+from redistrict.linz.meshblock_store import MeshblockStore
+from redistrict.linz.electorate_changes_queue import ElectorateEditQueue
+from redistrict.linz.linz_redistrict_handler import LinzRedistrictHandler
+from redistrict.test.test_linz_redistrict_handler import make_user_log_layer
+from qgis.core import (NULL,
+                       QgsVectorLayer,
+                       QgsGeometry,
+                       QgsRectangle,
+                       QgsFeature)
+
+
+def make_ledger_meshblock_layer() -> QgsVectorLayer:
+    """
+    Makes a dummy meshblock layer for testing the population ledger
+    """
+    layer = QgsVectorLayer(
+        "Polygon?crs=EPSG:4326&field=MeshblockNumber:string&field=offline_pop_m:int&field=offline_pop_gn:int&field=offline_pop_gs:int&field=staged_electorate:int&field=offshore:int",
+        "source", "memory")
+    f = QgsFeature()
+    f.setAttributes(["11", 1, 10, 0, 1, 0])
+    f.setGeometry(QgsGeometry.fromRect(QgsRectangle(0, 0, 5, 5)))
+    f2 = QgsFeature()
+    f2.setAttributes(["12", 2, 20, 0, 1, 0])
+    f2.setGeometry(QgsGeometry.fromRect(QgsRectangle(5, 0, 10, 5)))
+    f3 = QgsFeature()
+    f3.setAttributes(["13", 3, 40, 0, 2, 0])
+    f3.setGeometry(QgsGeometry.fromRect(QgsRectangle(0, 5, 5, 10)))
+    f4 = QgsFeature()
+    f4.setAttributes(["14", 4, NULL, 0, NULL, 0])
+    f4.setGeometry(QgsGeometry.fromRect(QgsRectangle(5, 5, 10, 10)))
+    f5 = QgsFeature()
+    f5.setAttributes(["15", 5, 80, 0, 2, 0])
+    f5.setGeometry(QgsGeometry.fromRect(QgsRectangle(0, 10, 5, 15)))
+    assert layer.dataProvider().addFeatures([f, f2, f3, f4, f5])[0]
+    return layer
+
+
+def make_ledger_electorate_layer() -> QgsVectorLayer:
+    """
+    Makes a dummy electorate layer for testing the population ledger
+    """
+    layer = QgsVectorLayer(
+        "Polygon?crs=EPSG:4326&field=electorate_id:int&field=type:string&field=estimated_pop:int&field=stats_nz_pop:int&field=stats_nz_var_20:int&field=stats_nz_var_23:int&field=invalid:int&field=invalid_reason:string",
+        "source", "memory")
+    f = QgsFeature()
+    f.setAttributes([1, 'GN', 25, 30, 1, 2, NULL, NULL])
+    f.setGeometry(QgsGeometry.fromRect(QgsRectangle(0, 0, 10, 5)))
+    f2 = QgsFeature()
+    f2.setAttributes([2, 'GN', 120, NULL, NULL, NULL, NULL, NULL])
+    f2.setGeometry(QgsGeometry.fromRect(QgsRectangle(0, 5, 5, 15)))
+    f3 = QgsFeature()
+    f3.setAttributes([3, 'GN', NULL, NULL, NULL, NULL, NULL, NULL])
+    f4 = QgsFeature()
+    f4.setAttributes([4, 'GS', 1000, 1000, NULL, NULL, NULL, NULL])
+    assert layer.dataProvider().addFeatures([f, f2, f3, f4])[0]
+    return layer
+
+
+class PopulationLedgerTest(unittest.TestCase):
+    """Test PopulationLedger."""
+
+    def testLedger(self):
+        """
+        Test tracking populations with the ledger
+        """
+        meshblock_layer = make_ledger_meshblock_layer()
+        electorate_layer = make_ledger_electorate_layer()
+        store = MeshblockStore(meshblock_layer=meshblock_layer, meshblock_number_field_name='MeshblockNumber',
+                               load_geometries=False, defer_load=True)
+        ledger = PopulationLedger(electorate_layer=electorate_layer, electorate_layer_field='electorate_id',
+                                  meshblock_store=store, task='GN')
+        self.assertIsNone(ledger.populations)
+
+        # stats nz population should be used in preference to estimated population
+        self.assertEqual(ledger.electorate_populations(), {1: 30, 2: 120, 3: 0})
+        self.assertTrue(store.loaded)
+        self.assertEqual(ledger.population(1), 30)
+        self.assertEqual(ledger.population(4), 0)
+        self.assertEqual(ledger.meshblock_population(1), 10)
+        self.assertEqual(ledger.meshblock_population(4), 0)
+        self.assertEqual(ledger.meshblock_population(99), 0)
+        self.assertEqual(ledger.meshblock_populations([1, 3, 5]), 130)
+
+        ledger.move_meshblocks([(1, 1, 2), (4, None, 3)])
+        self.assertEqual(ledger.electorate_populations(), {1: 20, 2: 130, 3: 0})
+        ledger.move_meshblocks([(3, 2, 3), (1, 2, 3)])
+        self.assertEqual(ledger.electorate_populations(), {1: 20, 2: 80, 3: 50})
+        ledger.revert_moves([(3, 2, 3), (1, 2, 3)])
+        self.assertEqual(ledger.electorate_populations(), {1: 20, 2: 130, 3: 0})
+
+        # reverting and reapplying a change
+        change = PopulationLedgerChange(ledger, [(1, 2, 1)])
+        ledger.move_meshblocks(change.moves)
+        self.assertEqual(ledger.electorate_populations(), {1: 30, 2: 120, 3: 0})
+        change.redo()
+        self.assertEqual(ledger.electorate_populations(), {1: 30, 2: 120, 3: 0})
+        change.undo()
+        self.assertEqual(ledger.electorate_populations(), {1: 20, 2: 130, 3: 0})
+        change.undo()
+        self.assertEqual(ledger.electorate_populations(), {1: 20, 2: 130, 3: 0})
+        change.redo()
+        self.assertEqual(ledger.electorate_populations(), {1: 30, 2: 120, 3: 0})
+
+        ledger.reset()
+        self.assertIsNone(ledger.populations)
+        self.assertEqual(ledger.population(1), 30)
+
+        ledger = PopulationLedger(electorate_layer=electorate_layer, electorate_layer_field='electorate_id',
+                                  meshblock_store=store, task='GS')
+        self.assertEqual(ledger.electorate_populations(), {4: 1000})
+
+    def testHandler(self):
+        """
+        Test that the redistrict handler and edit queue keep the ledger updated
+        """
+        meshblock_layer = make_ledger_meshblock_layer()
+        electorate_layer = make_ledger_electorate_layer()
+        user_log_layer = make_user_log_layer()
+        store = MeshblockStore(meshblock_layer=meshblock_layer, meshblock_number_field_name='MeshblockNumber',
+                               load_geometries=False)
+        ledger = PopulationLedger(electorate_layer=electorate_layer, electorate_layer_field='electorate_id',
+                                  meshblock_store=store, task='GN')
+        queue = ElectorateEditQueue(electorate_layer=electorate_layer, user_log_layer=user_log_layer)
+        handler = LinzRedistrictHandler(meshblock_layer=meshblock_layer, meshblock_number_field_name='MeshblockNumber',
+                                        target_field='staged_electorate', electorate_changes_queue=queue,
+                                        electorate_layer=electorate_layer, electorate_layer_field='electorate_id',
+                                        task='GN', user_log_layer=user_log_layer, scenario=1,
+                                        population_ledger=ledger)
+        self.assertTrue(meshblock_layer.startEditing())
+        meshblock_layer.undoStack().indexChanged.connect(queue.sync_to_meshblock_undostack_index)
+
+        handler.begin_edit_group('test')
+        self.assertTrue(handler.assign_district([1, 3], 3))
+        self.assertTrue(handler.assign_district([4], 3))
+        # ledger is updated immediately
+        self.assertEqual(ledger.electorate_populations(), {1: 20, 2: 80, 3: 50})
+        self.assertEqual(handler.grow_population_with_added_meshblocks(3, 0), 50)
+        self.assertEqual(handler.shrink_population_by_removed_meshblocks(2, 120), 80)
+        handler.end_edit_group()
+
+        self.assertEqual({f['electorate_id']: f['estimated_pop'] for f in electorate_layer.getFeatures()},
+                         {1: 20, 2: 80, 3: 50, 4: 1000})
+        self.assertEqual(ledger.electorate_populations(), {1: 20, 2: 80, 3: 50})
+
+        handler.begin_edit_group('test2')
+        self.assertTrue(handler.assign_district([3], 1))
+        handler.end_edit_group()
+        self.assertEqual(ledger.electorate_populations(), {1: 60, 2: 80, 3: 10})
+
+        meshblock_layer.undoStack().undo()
+        self.assertEqual(ledger.electorate_populations(), {1: 20, 2: 80, 3: 50})
+        meshblock_layer.undoStack().undo()
+        self.assertEqual(ledger.electorate_populations(), {1: 30, 2: 120, 3: 0})
+        meshblock_layer.undoStack().redo()
+        self.assertEqual(ledger.electorate_populations(), {1: 20, 2: 80, 3: 50})
+        meshblock_layer.undoStack().redo()
+        self.assertEqual(ledger.electorate_populations(), {1: 60, 2: 80, 3: 10})
+        self.assertEqual({f['electorate_id']: f['estimated_pop'] for f in electorate_layer.getFeatures()},
+                         {1: 60, 2: 80, 3: 10, 4: 1000})
+
+        # discarded edits are reverted from the ledger
+        handler.begin_edit_group('test3')
+        self.assertTrue(handler.assign_district([5], 1))
+        self.assertEqual(ledger.electorate_populations(), {1: 140, 2: 0, 3: 10})
+        handler.discard_edit_group()
+        self.assertEqual(ledger.electorate_populations(), {1: 60, 2: 80, 3: 10})
+
+        queue.rollback()
+        self.assertEqual(ledger.electorate_populations(), {1: 30, 2: 120, 3: 0})
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(PopulationLedgerTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
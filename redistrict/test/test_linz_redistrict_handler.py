@@ -131,6 +131,9 @@ class LINZRedistrictHandlerTest(unittest.TestCase):
                          [[1, 'test4', 'GN', 'test4', 'aaa'],
                           [1, 'test3', 'GN', 'test3', 'aaa'],
                           [1, 'test2', 'GN', 'test2', 'aaa']])
+        # entries from a single assignment share a timestamp
+        log_entries = [f for f in user_log_layer.getFeatures()]  # pylint: disable=unnecessary-comprehension
+        self.assertEqual(log_entries[0]['timestamp'], log_entries[1]['timestamp'])
 
         self.assertEqual([f['fld1'] for f in meshblock_layer.getFeatures()], ['aaa', 'test2', 'aaa', 'test1', 'aaa'])
         self.assertEqual([f['estimated_pop'] for f in district_layer.getFeatures()], [NULL, 11061, 11091, 11104, 11198])
@@ -14,23 +14,27 @@ __copyright__ = 'Copyright 2018, LINZ'
 # This will get replaced with a git SHA1 when you do a git archive
 __revision__ = '$Format:%H$'
 
+import os
 import unittest
 from collections import OrderedDict
 from redistrict.linz.scenario_registry import ScenarioRegistry
-from redistrict.linz.scenario_switch_task import ScenarioSwitchTask
-from redistrict.linz.staged_electorate_update_task import UpdateStagedElectoratesTask
+from redistrict.linz.scenario_branch_task import (BranchScenarioTask,
+                                                  CompactScenarioTask)
+from redistrict.linz.scenario_import_task import (ImportedScenario,
+                                                  ImportScenariosTask)
+from redistrict.core.gpkg_writer import GeoPackageWriter
 from qgis.PyQt.QtCore import (QDateTime,
                               QDate,
-                              QTime)
-from qgis.core import (NULL,
-                       QgsApplication,
+                              QTime,
+                              QTemporaryDir,
+                              QVariant)
+from qgis.core import (QgsApplication,
+                       QgsField,
+                       QgsFields,
+                       QgsWkbTypes,
                        QgsVectorLayer,
-                       QgsGeometry,
-                       QgsPointXY,
                        QgsFeature)
 
-EMPTY_GEOMETRY_COLLECTION_WKT = QgsGeometry.fromWkt('GeometryCollection ()').asWkt()
-
 
 def make_scenario_layer() -> QgsVectorLayer:
     """
@@ -68,6 +72,22 @@ def make_meshblock_electorate_layer() -> QgsVectorLayer:
     return layer
 
 
+def make_meshblock_electorate_database(path: str, rows: list):
+    """
+    Makes a dummy GeoPackage containing a meshblock-electorate table for testing
+    """
+    writer = GeoPackageWriter(path)
+    fields = QgsFields()
+    for name in ('scenario_id', 'meshblock_number', 'gn_id', 'gs_id', 'm_id'):
+        fields.append(QgsField(name, QVariant.Int))
+    assert writer.create_layer('meshblock_electorates', QgsWkbTypes.NoGeometry, fields)
+    for attributes in rows:
+        f = QgsFeature()
+        f.setAttributes(attributes)
+        assert writer.add_feature('meshblock_electorates', f)
+    assert writer.commit()
+
+
 def make_meshblock_layer() -> QgsVectorLayer:
     """
     Makes a dummy meshblock layer for testing
@@ -284,6 +304,308 @@ class ScenarioRegistryTest(unittest.TestCase):
                              [1, 5, 0, 'a', 'x'],
                              [2, 5, 1, 'b', 'y']])
 
+    def testBranchTask(self):
+        """
+        Test branching scenario using a background task
+        """
+        layer = make_scenario_layer()
+        mb_electorate_layer = make_meshblock_electorate_layer()
+
+        reg = ScenarioRegistry(
+            source_layer=layer,
+            id_field='id',
+            name_field='name',
+            meshblock_electorate_layer=mb_electorate_layer
+        )
+
+        res, error = reg.create_branch_scenario(1, 'Scenario 1')
+        self.assertFalse(res)
+        self.assertIn('already exists', error)
+        res, error = reg.create_branch_scenario(5, 'Scenario 5')
+        self.assertFalse(res)
+        self.assertIn('does not exist', error)
+
+        res, error = reg.create_branch_scenario(1, 'Scenario 5')
+        self.assertFalse(error)
+        self.assertEqual(res, 4)
+        task = BranchScenarioTask(task_name='', scenario_registry=reg, source_scenario_id=1, new_scenario_id=res)
+        self.assertIsNone(task.database_path)
+        self.assertTrue(task.run())
+        task.finished(True)
+        self.assertTrue(reg.scenario_exists(4))
+        f = [f.attributes() for f in mb_electorate_layer.getFeatures()]
+        self.assertEqual(f, [[1, 2, 0, 'a', 'x'],
+                             [2, 2, 1, 'b', 'y'],
+                             [3, 1, 0, 'c', 'z'],
+                             [4, 1, 1, 'd', 'zz'],
+                             [3, 4, 0, 'c', 'z'],
+                             [4, 4, 1, 'd', 'zz']])
+
+        # failed task must remove new scenario
+        res, error = reg.create_branch_scenario(2, 'Scenario 6')
+        self.assertEqual(res, 5)
+        task = BranchScenarioTask(task_name='', scenario_registry=reg, source_scenario_id=2, new_scenario_id=res)
+        task.finished(False)
+        self.assertFalse(reg.scenario_exists(5))
+        self.assertFalse(reg.scenario_name_exists('Scenario 6'))
+
+    def testBranchTaskDatabase(self):
+        """
+        Test branching scenario directly within a GeoPackage
+        """
+        temp_dir = QTemporaryDir()
+        database_path = os.path.join(temp_dir.path(), 'branch.gpkg')
+        writer = GeoPackageWriter(database_path)
+        mb_electorate_fields = QgsFields()
+        for name in ('id', 'scenario_id', 'meshblock_number', 'gn_id', 'gs_id', 'm_id'):
+            mb_electorate_fields.append(QgsField(name, QVariant.Int))
+        self.assertTrue(writer.create_layer('meshblock_electorates', QgsWkbTypes.NoGeometry, mb_electorate_fields))
+        for attributes in ([1, 1, 11, 1, 4, 7], [2, 1, 12, 2, 5, 7], [3, 2, 11, 3, 6, 8]):
+            f = QgsFeature()
+            f.setAttributes(attributes)
+            self.assertTrue(writer.add_feature('meshblock_electorates', f))
+        self.assertTrue(writer.commit())
+
+        mb_electorate_layer = QgsVectorLayer('{}|layername=meshblock_electorates'.format(database_path), 'mb', 'ogr')
+        self.assertTrue(mb_electorate_layer.isValid())
+        reg = ScenarioRegistry(
+            source_layer=make_scenario_layer(),
+            id_field='id',
+            name_field='name',
+            meshblock_electorate_layer=mb_electorate_layer
+        )
+
+        res, error = reg.create_branch_scenario(1, 'Scenario 5')
+        self.assertFalse(error)
+        task = BranchScenarioTask(task_name='', scenario_registry=reg, source_scenario_id=1, new_scenario_id=res)
+        self.assertEqual(task.database_path, database_path)
+        self.assertTrue(task.run())
+        self.assertTrue(task.updated_database)
+        task.finished(True)
+        self.assertEqual(mb_electorate_layer.featureCount(), 5)
+        self.assertEqual([f.attributes() for f in mb_electorate_layer.getFeatures()],
+                         [[1, 1, 1, 11, 1, 4, 7],
+                          [2, 2, 1, 12, 2, 5, 7],
+                          [3, 3, 2, 11, 3, 6, 8],
+                          [4, 1, 4, 11, 1, 4, 7],
+                          [5, 2, 4, 12, 2, 5, 7]])
+
+    def testImportScenariosTask(self):
+        """
+        Test importing scenarios using a background task
+        """
+        temp_dir = QTemporaryDir()
+        source_path = os.path.join(temp_dir.path(), 'source.gpkg')
+        make_meshblock_electorate_database(source_path, [[1, 11, 1, 4, 7], [1, 12, 2, 5, 7],
+                                                         [2, 12, 1, 4, 7], [2, 11, 1, 4, 7],
+                                                         [3, 11, 1, 4, 7], [3, 12, 2, 5, 7]])
+
+        layer = make_scenario_layer()
+        mb_electorate_layer = QgsVectorLayer(
+            "NoGeometry?field=scenario_id:int&field=meshblock_number:int&field=gn_id:int&field=gs_id:int&field=m_id:int",
+            "source", "memory")
+        f = QgsFeature()
+        f.setAttributes([1, 12, 2, 5, 7])
+        f2 = QgsFeature()
+        f2.setAttributes([1, 11, 1, 4, 7])
+        mb_electorate_layer.dataProvider().addFeatures([f, f2])
+        reg = ScenarioRegistry(
+            source_layer=layer,
+            id_field='id',
+            name_field='name',
+            meshblock_electorate_layer=mb_electorate_layer
+        )
+
+        scenarios = [ImportedScenario(1, 'imported 1'),
+                     ImportedScenario(2, 'imported 2', QDateTime(QDate(2018, 6, 4), QTime(12, 13, 14)), 'user 5'),
+                     ImportedScenario(3, 'imported 3')]
+        task = ImportScenariosTask(task_name='', scenario_registry=reg, source_database_path=source_path,
+                                   scenarios=scenarios)
+        self.assertIsNone(task.database_path)
+        # ids are reserved while the task runs
+        self.assertEqual(task.reserved_scenario_ids, [4, 5, 6])
+        self.assertEqual(reg.next_scenario_id(), 7)
+        self.assertTrue(task.run())
+        task.finished(True)
+        self.assertEqual(reg.next_scenario_id(), 5)
+
+        # scenario 1 is identical to existing scenario 1, scenario 3 is identical to scenario 1
+        self.assertEqual([s.source_scenario_id for s in task.imported_scenarios()], [2])
+        self.assertEqual([(s.source_scenario_id, s.duplicate_of) for s in task.skipped_scenarios()], [(1, 1), (3, 1)])
+        self.assertEqual(scenarios[1].new_scenario_id, 4)
+        self.assertEqual(reg.get_scenario_name(4), 'imported 2')
+        self.assertEqual(reg.get_scenario(4)['created_by'], 'user 5')
+        self.assertFalse(reg.scenario_name_exists('imported 1'))
+        self.assertEqual([f.attributes() for f in mb_electorate_layer.getFeatures()],
+                         [[1, 12, 2, 5, 7], [1, 11, 1, 4, 7], [4, 12, 1, 4, 7], [4, 11, 1, 4, 7]])
+
+    def testImportScenariosTaskDatabase(self):
+        """
+        Test importing scenarios directly within a GeoPackage
+        """
+        temp_dir = QTemporaryDir()
+        source_path = os.path.join(temp_dir.path(), 'source.gpkg')
+        make_meshblock_electorate_database(source_path, [[1, 11, 1, 4, 7], [1, 12, 2, 5, 7],
+                                                         [2, 12, 1, 4, 7], [2, 11, 1, 4, 7],
+                                                         [3, 11, 3, 4, 7], [3, 12, 2, 5, 7],
+                                                         [4, 11, 3, 4, 7], [4, 12, 2, 5, 7]])
+        database_path = os.path.join(temp_dir.path(), 'dest.gpkg')
+        make_meshblock_electorate_database(database_path, [[1, 11, 1, 4, 7], [1, 12, 2, 5, 7]])
+
+        mb_electorate_layer = QgsVectorLayer('{}|layername=meshblock_electorates'.format(database_path), 'mb', 'ogr')
+        self.assertTrue(mb_electorate_layer.isValid())
+        reg = ScenarioRegistry(
+            source_layer=make_scenario_layer(),
+            id_field='id',
+            name_field='name',
+            meshblock_electorate_layer=mb_electorate_layer
+        )
+
+        scenarios = [ImportedScenario(1, 'imported 1'),
+                     ImportedScenario(2, 'imported 2'),
+                     ImportedScenario(3, 'imported 3'),
+                     ImportedScenario(4, 'imported 4')]
+        task = ImportScenariosTask(task_name='', scenario_registry=reg, source_database_path=source_path,
+                                   scenarios=scenarios)
+        self.assertEqual(task.database_path, database_path)
+        self.assertTrue(task.run())
+        self.assertTrue(task.updated_database)
+        task.finished(True)
+
+        # scenario 4 is identical to scenario 3
+        self.assertEqual([(s.source_scenario_id, s.new_scenario_id) for s in task.imported_scenarios()],
+                         [(2, 4), (3, 5)])
+        self.assertEqual([(s.source_scenario_id, s.duplicate_of) for s in task.skipped_scenarios()], [(1, 1), (4, 5)])
+        self.assertEqual(reg.get_scenario_name(4), 'imported 2')
+        self.assertEqual(reg.get_scenario_name(5), 'imported 3')
+        self.assertEqual(mb_electorate_layer.featureCount(), 6)
+        self.assertEqual([f.attributes() for f in mb_electorate_layer.getFeatures()],
+                         [[1, 1, 11, 1, 4, 7], [2, 1, 12, 2, 5, 7],
+                          [3, 4, 12, 1, 4, 7], [4, 4, 11, 1, 4, 7],
+                          [5, 5, 11, 3, 4, 7], [6, 5, 12, 2, 5, 7]])
+
+    def testUniqueScenarioName(self):
+        """
+        Test generating unique scenario names
+        """
+        reg = ScenarioRegistry(
+            source_layer=make_scenario_layer(),
+            id_field='id',
+            name_field='name',
+            meshblock_electorate_layer=make_meshblock_electorate_layer()
+        )
+        self.assertEqual(reg.unique_scenario_name('new'), 'new')
+        self.assertEqual(reg.unique_scenario_name('Scenario 1'), 'Scenario 1 (2)')
+        self.assertEqual(reg.unique_scenario_name('Scenario 1', reserved_names=['Scenario 1 (2)']), 'Scenario 1 (3)')
+        self.assertEqual(reg.unique_scenario_name('new', reserved_names=['new']), 'new (2)')
+
+    def testDeltaScenarios(self):  # pylint: disable=too-many-statements
+        """
+        Test delta scenarios
+        """
+        layer = make_scenario_layer()
+        mb_electorate_layer = make_meshblock_electorate_layer()
+
+        reg = ScenarioRegistry(
+            source_layer=layer,
+            id_field='id',
+            name_field='name',
+            meshblock_electorate_layer=mb_electorate_layer
+        )
+        self.assertFalse(reg.supports_delta_scenarios())
+        res, error = reg.create_branch_scenario(1, 'delta', delta=True)
+        self.assertFalse(res)
+        self.assertIn('not supported', error)
+
+        self.assertTrue(ScenarioRegistry.add_parent_field(layer))
+        reg = ScenarioRegistry(
+            source_layer=layer,
+            id_field='id',
+            name_field='name',
+            meshblock_electorate_layer=mb_electorate_layer
+        )
+        self.assertTrue(reg.supports_delta_scenarios())
+        self.assertEqual(reg.scenario_chain(1), [1])
+        self.assertFalse(reg.is_delta_scenario(1))
+
+        res, error = reg.create_branch_scenario(1, 'delta', delta=True)
+        self.assertFalse(error)
+        self.assertEqual(res, 4)
+        self.assertTrue(reg.is_delta_scenario(4))
+        self.assertEqual(reg.scenario_chain(4), [4, 1])
+        self.assertEqual(reg.delta_children(1), [4])
+        # no records copied
+        self.assertEqual(mb_electorate_layer.featureCount(), 4)
+
+        # delta scenario inherits parent's assignments
+        self.assertEqual(reg.scenario_electorate_meshblocks(4),
+                         {'GN': {'c': [0], 'd': [1]}, 'GS': {'z': [0], 'zz': [1]}})
+
+        # override a meshblock
+        f = QgsFeature()
+        f.setAttributes([5, 4, 1, 'c', 'zz'])
+        mb_electorate_layer.dataProvider().addFeatures([f])
+        self.assertEqual(reg.scenario_electorate_meshblocks(4),
+                         {'GN': {'c': [0, 1]}, 'GS': {'z': [0], 'zz': [1]}})
+        self.assertEqual(sorted([f['meshblock_number'] for f in
+                                 reg.electorate_meshblocks(electorate_id='c', electorate_type='GN', scenario_id=4)]),
+                         [0, 1])
+        self.assertEqual([f['meshblock_number'] for f in
+                          reg.electorate_meshblocks(electorate_id='d', electorate_type='GN', scenario_id=4)], [])
+        self.assertTrue(reg.electorate_has_meshblocks(electorate_id='c', electorate_type='GN', scenario_id=4))
+        self.assertFalse(reg.electorate_has_meshblocks(electorate_id='d', electorate_type='GN', scenario_id=4))
+        # parent unchanged
+        self.assertEqual(reg.scenario_electorate_meshblocks(1),
+                         {'GN': {'c': [0], 'd': [1]}, 'GS': {'z': [0], 'zz': [1]}})
+
+        # nested delta
+        res, error = reg.create_branch_scenario(4, 'delta 2', delta=True)
+        self.assertEqual(res, 5)
+        self.assertEqual(reg.scenario_chain(5), [5, 4, 1])
+        self.assertEqual(reg.scenario_electorate_meshblocks(5),
+                         {'GN': {'c': [0, 1]}, 'GS': {'z': [0], 'zz': [1]}})
+
+        # materialize records
+        self.assertEqual(reg.materialize_meshblocks(1, [0, 1]), {})
+        added = reg.materialize_meshblocks(5, [0, 1])
+        self.assertEqual(sorted(added.keys()), [0, 1])
+        self.assertEqual(sorted([f.attributes()[1:] for f in mb_electorate_layer.getFeatures() if f['scenario_id'] == 5]),
+                         [[5, 0, 'c', 'z'], [5, 1, 'c', 'zz']])
+        self.assertEqual(reg.materialize_meshblocks(5, [0, 1]), {})
+
+        # branching a delta scenario in full copies all resolved records
+        res, error = reg.create_branch_scenario(4, 'full')
+        self.assertEqual(res, 6)
+        self.assertFalse(reg.is_delta_scenario(6))
+        task = BranchScenarioTask(task_name='', scenario_registry=reg, source_scenario_id=4, new_scenario_id=res)
+        self.assertTrue(task.run())
+        self.assertEqual(sorted([f.attributes()[1:] for f in mb_electorate_layer.getFeatures() if f['scenario_id'] == 6]),
+                         [[6, 0, 'c', 'z'], [6, 1, 'c', 'zz']])
+
+        # compact scenario
+        task = CompactScenarioTask(task_name='', scenario_registry=reg, scenario_id=4)
+        self.assertTrue(task.run())
+        task.finished(True)
+        self.assertFalse(reg.is_delta_scenario(4))
+        self.assertEqual(reg.scenario_chain(4), [4])
+        self.assertEqual(sorted([f.attributes()[1:] for f in mb_electorate_layer.getFeatures() if f['scenario_id'] == 4]),
+                         [[4, 0, 'c', 'z'], [4, 1, 'c', 'zz']])
+        self.assertEqual(reg.scenario_electorate_meshblocks(4),
+                         {'GN': {'c': [0, 1]}, 'GS': {'z': [0], 'zz': [1]}})
+
+    def testDeltaScenarioSql(self):
+        """
+        Test resolving delta scenarios in SQL
+        """
+        sql, params = ScenarioRegistry.chain_rows_sql([1], '"t"', 'meshblock_number')
+        self.assertEqual(sql, 'SELECT meshblock_number FROM "t" WHERE scenario_id=?')
+        self.assertEqual(params, [1])
+        sql, params = ScenarioRegistry.chain_rows_sql([3, 2], '"t"', '?, meshblock_number', [5])
+        self.assertEqual(sql, 'SELECT ?, meshblock_number FROM "t" WHERE scenario_id=? UNION ALL '
+                              'SELECT ?, meshblock_number FROM "t" WHERE scenario_id=? AND meshblock_number NOT IN '
+                              '(SELECT meshblock_number FROM "t" WHERE scenario_id IN (?))')
+        self.assertEqual(params, [5, 3, 5, 2, 3])
+
     def testCopyScenarios(self):
         """
         Test copying scenarios between registries
@@ -413,6 +735,30 @@ class ScenarioRegistryTest(unittest.TestCase):
                reg.electorate_meshblocks(electorate_id='z', electorate_type='GS', scenario_id=2)]
         self.assertEqual(res, [])
 
+    def testScenarioElectorateMeshblocks(self):
+        """
+        Test retrieving the complete electorate to meshblock mapping for a scenario
+        """
+        layer = make_scenario_layer()
+        mb_electorate_layer = make_meshblock_electorate_layer()
+
+        reg = ScenarioRegistry(
+            source_layer=layer,
+            id_field='id',
+            name_field='name',
+            meshblock_electorate_layer=mb_electorate_layer
+        )
+
+        res = reg.scenario_electorate_meshblocks(scenario_id=1)
+        self.assertEqual(list(res.keys()), ['GN', 'GS'])
+        self.assertEqual(res['GN'], {'c': [0], 'd': [1]})
+        self.assertEqual(res['GS'], {'z': [0], 'zz': [1]})
+        res = reg.scenario_electorate_meshblocks(scenario_id=2, electorate_types=['GS'])
+        self.assertEqual(list(res.keys()), ['GS'])
+        self.assertEqual(res['GS'], {'x': [0], 'y': [1]})
+        res = reg.scenario_electorate_meshblocks(scenario_id=5, electorate_types=['GN'])
+        self.assertEqual(res, {'GN': {}})
+
     def testElectorateHasMeshblocks(self):
         """
         Test checking whether an electorate has meshblocks assigned
@@ -440,152 +786,6 @@ class ScenarioRegistryTest(unittest.TestCase):
         self.assertTrue(reg.electorate_has_meshblocks(electorate_id='y', electorate_type='GS', scenario_id=2))
         self.assertFalse(reg.electorate_has_meshblocks(electorate_id='z', electorate_type='GS', scenario_id=2))
 
-    def testSwitchTask(self):  # pylint: disable=too-many-locals, too-many-statements
-        """
-        Test scenario switch task
-        """
-        layer = make_scenario_layer()
-        mb_electorate_layer = QgsVectorLayer(
-            "NoGeometry?field=id:int&field=scenario_id:int&field=meshblock_number:int&field=gn_id:int&field=gs_id:int&field=m_id:int",
-            "source", "memory")
-        f = QgsFeature()
-        f.setAttributes([1, 1, 11, 1, 0, 7])
-        f2 = QgsFeature()
-        f2.setAttributes([2, 1, 12, 2, 0, 7])
-        f3 = QgsFeature()
-        f3.setAttributes([3, 1, 13, 2, 0, 7])
-        f4 = QgsFeature()
-        f4.setAttributes([4, 1, 14, 0, 4, 8])
-        f5 = QgsFeature()
-        f5.setAttributes([5, 1, 15, 0, 5, 8])
-        f6 = QgsFeature()
-        f6.setAttributes([6, 1, 16, 0, 5, 8])
-        f7 = QgsFeature()
-        f7.setAttributes([7, 2, 11, 2, 0, 7])
-        f8 = QgsFeature()
-        f8.setAttributes([8, 2, 12, 2, 0, 8])
-        f9 = QgsFeature()
-        f9.setAttributes([9, 2, 13, 3, 0, 7])
-        f10 = QgsFeature()
-        f10.setAttributes([10, 2, 14, 0, 5, 8])
-        f11 = QgsFeature()
-        f11.setAttributes([11, 2, 15, 0, 4, 7])
-        f12 = QgsFeature()
-        f12.setAttributes([12, 2, 16, 0, 4, 8])
-        mb_electorate_layer.dataProvider().addFeatures([f, f2, f3, f4, f5, f6, f7, f8, f9, f10, f11, f12])
-
-        reg = ScenarioRegistry(
-            source_layer=layer,
-            id_field='id',
-            name_field='name',
-            meshblock_electorate_layer=mb_electorate_layer
-        )
-        electorate_layer = QgsVectorLayer(
-            "Point?crs=EPSG:4326&field=electorate_id:int&field=code:string&field=type:string&field=estimated_pop:int&field=scenario_id:int&field=invalid:int&field=invalid_reason:string&field=name:string&field=stats_nz_pop:int&field=stats_nz_var_20:int&field=stats_nz_var_23:int&field=expected_regions:int&field=deprecated:int",
-            "source", "memory")
-        f = QgsFeature()
-        f.setAttributes([1, "test1", 'GN', -1, 0, 1, 'old invalid', NULL, 1111, 11, -11])
-        f2 = QgsFeature()
-        f2.setAttributes([2, "test2", 'GN', -1, 0, 1, 'old invalid 2', NULL, 1112, 12, -12])
-        f3 = QgsFeature()
-        f3.setAttributes([3, "test3", 'GN', -1, 0, 1, 'old invalid 3', NULL, 1113, 13, -13])
-        f4 = QgsFeature()
-        f4.setAttributes([4, "test4", 'GS', -1, 0, 1, 'old invalid 4', NULL, 1114, 14, -14])
-        f5 = QgsFeature()
-        f5.setAttributes([5, "test5", 'GS', -1, 0, 1, 'old invalid 5', NULL, 1115, 15, -15])
-        f6 = QgsFeature()
-        f6.setAttributes([6, "test6", 'GS', -1, 0, 1, 'old invalid 6', NULL, 1116, 16, -16])
-        f7 = QgsFeature()
-        f7.setAttributes([7, "test7", 'M', -1, 0, 1, 'old invalid 7', NULL, 1117, 17, -17])
-        f8 = QgsFeature()
-        f8.setAttributes([8, "test8", 'M', -1, 0, 1, 'old invalid 8', NULL, 1118, 18, -18])
-        electorate_layer.dataProvider().addFeatures([f, f2, f3, f4, f5, f6, f7, f8])
-
-        meshblock_layer = QgsVectorLayer(
-            "Point?crs=EPSG:4326&field=MeshblockNumber:string&field=offline_pop_m:int&field=offline_pop_gn:int&field=offline_pop_gs:int&field=staged_electorate:int&field=offshore:int",
-            "source", "memory")
-        f = QgsFeature()
-        f.setAttributes(["11", 5, 11, 0])
-        f.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(1, 2)))
-        f2 = QgsFeature()
-        f2.setAttributes(["12", 6, 12, 0])
-        f2.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(2, 3)))
-        f3 = QgsFeature()
-        f3.setAttributes(["13", 7, 13, 0])
-        f3.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(4, 5)))
-        f4 = QgsFeature()
-        f4.setAttributes(["14", 8, 0, 20])
-        f4.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(6, 7)))
-        f5 = QgsFeature()
-        f5.setAttributes(["15", 9, 0, 30])
-        f5.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(8, 9)))
-        f6 = QgsFeature()
-        f6.setAttributes(["16", 10, 0, 40])
-        f6.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(10, 11)))
-        meshblock_layer.dataProvider().addFeatures([f, f2, f3, f4, f5, f6])
-
-        task = ScenarioSwitchTask(task_name='', electorate_layer=electorate_layer, meshblock_layer=meshblock_layer,
-                                  meshblock_number_field_name='MeshblockNumber', scenario_registry=reg, scenario=1)
-        self.assertTrue(task.run())
-        self.assertEqual([f.attributes() for f in electorate_layer.getFeatures()],
-                         [[1, 'test1', 'GN', 11, 1, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
-                          [2, 'test2', 'GN', 25, 1, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
-                          [3, 'test3', 'GN', 0, 1, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
-                          [4, 'test4', 'GS', 20, 1, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
-                          [5, 'test5', 'GS', 70, 1, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
-                          [6, 'test6', 'GS', 0, 1, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
-                          [7, 'test7', 'M', 18, 1, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
-                          [8, 'test8', 'M', 27, 1, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL]])
-        self.assertEqual([f.geometry().asWkt() for f in electorate_layer.getFeatures()], ['Point (1 2)',
-                                                                                          'MultiPoint ((2 3),(4 5))',
-                                                                                          EMPTY_GEOMETRY_COLLECTION_WKT,
-                                                                                          'Point (6 7)',
-                                                                                          'MultiPoint ((8 9),(10 11))',
-                                                                                          EMPTY_GEOMETRY_COLLECTION_WKT,
-                                                                                          'MultiPoint ((1 2),(2 3),(4 5))',
-                                                                                          'MultiPoint ((6 7),(8 9),(10 11))'])
-        task = UpdateStagedElectoratesTask(task_name='', meshblock_layer=meshblock_layer,
-                                           meshblock_number_field_name='MeshblockNumber',
-                                           scenario_registry=reg, scenario=1, task='GN')
-        self.assertTrue(task.run())
-        self.assertEqual([f['staged_electorate'] for f in meshblock_layer.getFeatures()], [1, 2, 2, 0, 0, 0])
-        task = UpdateStagedElectoratesTask(task_name='', meshblock_layer=meshblock_layer,
-                                           meshblock_number_field_name='MeshblockNumber',
-                                           scenario_registry=reg, scenario=1, task='M')
-        self.assertTrue(task.run())
-        self.assertEqual([f['staged_electorate'] for f in meshblock_layer.getFeatures()], [7, 7, 7, 8, 8, 8])
-
-        task = ScenarioSwitchTask(task_name='', electorate_layer=electorate_layer, meshblock_layer=meshblock_layer,
-                                  meshblock_number_field_name='MeshblockNumber', scenario_registry=reg, scenario=2)
-        self.assertTrue(task.run())
-        self.assertEqual([f.attributes() for f in electorate_layer.getFeatures()],
-                         [[1, 'test1', 'GN', 0, 2, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
-                          [2, 'test2', 'GN', 23, 2, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
-                          [3, 'test3', 'GN', 13, 2, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
-                          [4, 'test4', 'GS', 70, 2, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
-                          [5, 'test5', 'GS', 20, 2, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
-                          [6, 'test6', 'GS', 0, 2, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
-                          [7, 'test7', 'M', 21, 2, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
-                          [8, 'test8', 'M', 24, 2, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL]])
-        self.assertEqual([f.geometry().asWkt() for f in electorate_layer.getFeatures()], [EMPTY_GEOMETRY_COLLECTION_WKT,
-                                                                                          'MultiPoint ((1 2),(2 3))',
-                                                                                          'Point (4 5)',
-                                                                                          'MultiPoint ((8 9),(10 11))',
-                                                                                          'Point (6 7)',
-                                                                                          EMPTY_GEOMETRY_COLLECTION_WKT,
-                                                                                          'MultiPoint ((1 2),(4 5),(8 9))',
-                                                                                          'MultiPoint ((2 3),(6 7),(10 11))'])
-        task = UpdateStagedElectoratesTask(task_name='', meshblock_layer=meshblock_layer,
-                                           meshblock_number_field_name='MeshblockNumber',
-                                           scenario_registry=reg, scenario=2, task='GN')
-        self.assertTrue(task.run())
-        self.assertEqual([f['staged_electorate'] for f in meshblock_layer.getFeatures()], [2, 2, 3, 0, 0, 0])
-        task = UpdateStagedElectoratesTask(task_name='', meshblock_layer=meshblock_layer,
-                                           meshblock_number_field_name='MeshblockNumber',
-                                           scenario_registry=reg, scenario=2, task='M')
-        self.assertTrue(task.run())
-        self.assertEqual([f['staged_electorate'] for f in meshblock_layer.getFeatures()], [7, 8, 7, 8, 7, 8])
-
 
 if __name__ == "__main__":
     suite = unittest.makeSuite(ScenarioRegistry)
@@ -0,0 +1,330 @@
+# coding=utf-8
+"""LINZ Scenario Switch Task Test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import unittest
+from redistrict.linz.scenario_registry import ScenarioRegistry
+from redistrict.linz.scenario_switch_task import ScenarioSwitchTask
+from redistrict.linz.linz_district_registry import LinzElectoralDistrictRegistry
+from redistrict.linz.staged_electorate_update_task import UpdateStagedElectoratesTask
+from redistrict.test.test_linz_scenario_registry import make_scenario_layer
+from redistrict.test.test_linz_district_registry import make_quota_layer
+from qgis.core import (NULL,
+                       QgsFeatureRequest,
+                       QgsVectorLayer,
+                       QgsGeometry,
+                       QgsPointXY,
+                       QgsFeature)
+
+EMPTY_GEOMETRY_COLLECTION_WKT = QgsGeometry.fromWkt('GeometryCollection ()').asWkt()
+
+
+class ScenarioSwitchTaskTest(unittest.TestCase):
+    """Test ScenarioSwitchTask."""
+
+    def testSwitchTask(self):  # pylint: disable=too-many-locals, too-many-statements
+        """
+        Test scenario switch task
+        """
+        layer = make_scenario_layer()
+        mb_electorate_layer = QgsVectorLayer(
+            "NoGeometry?field=id:int&field=scenario_id:int&field=meshblock_number:int&field=gn_id:int&field=gs_id:int&field=m_id:int",
+            "source", "memory")
+        f = QgsFeature()
+        f.setAttributes([1, 1, 11, 1, 0, 7])
+        f2 = QgsFeature()
+        f2.setAttributes([2, 1, 12, 2, 0, 7])
+        f3 = QgsFeature()
+        f3.setAttributes([3, 1, 13, 2, 0, 7])
+        f4 = QgsFeature()
+        f4.setAttributes([4, 1, 14, 0, 4, 8])
+        f5 = QgsFeature()
+        f5.setAttributes([5, 1, 15, 0, 5, 8])
+        f6 = QgsFeature()
+        f6.setAttributes([6, 1, 16, 0, 5, 8])
+        f7 = QgsFeature()
+        f7.setAttributes([7, 2, 11, 2, 0, 7])
+        f8 = QgsFeature()
+        f8.setAttributes([8, 2, 12, 2, 0, 8])
+        f9 = QgsFeature()
+        f9.setAttributes([9, 2, 13, 3, 0, 7])
+        f10 = QgsFeature()
+        f10.setAttributes([10, 2, 14, 0, 5, 8])
+        f11 = QgsFeature()
+        f11.setAttributes([11, 2, 15, 0, 4, 7])
+        f12 = QgsFeature()
+        f12.setAttributes([12, 2, 16, 0, 4, 8])
+        mb_electorate_layer.dataProvider().addFeatures([f, f2, f3, f4, f5, f6, f7, f8, f9, f10, f11, f12])
+
+        reg = ScenarioRegistry(
+            source_layer=layer,
+            id_field='id',
+            name_field='name',
+            meshblock_electorate_layer=mb_electorate_layer
+        )
+        electorate_layer = QgsVectorLayer(
+            "Point?crs=EPSG:4326&field=electorate_id:int&field=code:string&field=type:string&field=estimated_pop:int&field=scenario_id:int&field=invalid:int&field=invalid_reason:string&field=name:string&field=stats_nz_pop:int&field=stats_nz_var_20:int&field=stats_nz_var_23:int&field=expected_regions:int&field=deprecated:int",
+            "source", "memory")
+        f = QgsFeature()
+        f.setAttributes([1, "test1", 'GN', -1, 0, 1, 'old invalid', NULL, 1111, 11, -11])
+        f2 = QgsFeature()
+        f2.setAttributes([2, "test2", 'GN', -1, 0, 1, 'old invalid 2', NULL, 1112, 12, -12])
+        f3 = QgsFeature()
+        f3.setAttributes([3, "test3", 'GN', -1, 0, 1, 'old invalid 3', NULL, 1113, 13, -13])
+        f4 = QgsFeature()
+        f4.setAttributes([4, "test4", 'GS', -1, 0, 1, 'old invalid 4', NULL, 1114, 14, -14])
+        f5 = QgsFeature()
+        f5.setAttributes([5, "test5", 'GS', -1, 0, 1, 'old invalid 5', NULL, 1115, 15, -15])
+        f6 = QgsFeature()
+        f6.setAttributes([6, "test6", 'GS', -1, 0, 1, 'old invalid 6', NULL, 1116, 16, -16])
+        f7 = QgsFeature()
+        f7.setAttributes([7, "test7", 'M', -1, 0, 1, 'old invalid 7', NULL, 1117, 17, -17])
+        f8 = QgsFeature()
+        f8.setAttributes([8, "test8", 'M', -1, 0, 1, 'old invalid 8', NULL, 1118, 18, -18])
+        electorate_layer.dataProvider().addFeatures([f, f2, f3, f4, f5, f6, f7, f8])
+
+        meshblock_layer = QgsVectorLayer(
+            "Point?crs=EPSG:4326&field=MeshblockNumber:string&field=offline_pop_m:int&field=offline_pop_gn:int&field=offline_pop_gs:int&field=staged_electorate:int&field=offshore:int",
+            "source", "memory")
+        f = QgsFeature()
+        f.setAttributes(["11", 5, 11, 0])
+        f.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(1, 2)))
+        f2 = QgsFeature()
+        f2.setAttributes(["12", 6, 12, 0])
+        f2.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(2, 3)))
+        f3 = QgsFeature()
+        f3.setAttributes(["13", 7, 13, 0])
+        f3.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(4, 5)))
+        f4 = QgsFeature()
+        f4.setAttributes(["14", 8, 0, 20])
+        f4.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(6, 7)))
+        f5 = QgsFeature()
+        f5.setAttributes(["15", 9, 0, 30])
+        f5.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(8, 9)))
+        f6 = QgsFeature()
+        f6.setAttributes(["16", 10, 0, 40])
+        f6.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(10, 11)))
+        meshblock_layer.dataProvider().addFeatures([f, f2, f3, f4, f5, f6])
+
+        task = ScenarioSwitchTask(task_name='', electorate_layer=electorate_layer, meshblock_layer=meshblock_layer,
+                                  meshblock_number_field_name='MeshblockNumber', scenario_registry=reg, scenario=1)
+        self.assertTrue(task.run())
+        self.assertEqual([f.attributes() for f in electorate_layer.getFeatures()],
+                         [[1, 'test1', 'GN', 11, 1, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
+                          [2, 'test2', 'GN', 25, 1, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
+                          [3, 'test3', 'GN', 0, 1, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
+                          [4, 'test4', 'GS', 20, 1, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
+                          [5, 'test5', 'GS', 70, 1, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
+                          [6, 'test6', 'GS', 0, 1, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
+                          [7, 'test7', 'M', 18, 1, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
+                          [8, 'test8', 'M', 27, 1, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL]])
+        self.assertEqual([f.geometry().asWkt() for f in electorate_layer.getFeatures()], ['Point (1 2)',
+                                                                                          'MultiPoint ((2 3),(4 5))',
+                                                                                          EMPTY_GEOMETRY_COLLECTION_WKT,
+                                                                                          'Point (6 7)',
+                                                                                          'MultiPoint ((8 9),(10 11))',
+                                                                                          EMPTY_GEOMETRY_COLLECTION_WKT,
+                                                                                          'MultiPoint ((1 2),(2 3),(4 5))',
+                                                                                          'MultiPoint ((6 7),(8 9),(10 11))'])
+        task = UpdateStagedElectoratesTask(task_name='', meshblock_layer=meshblock_layer,
+                                           meshblock_number_field_name='MeshblockNumber',
+                                           scenario_registry=reg, scenario=1, task='GN')
+        self.assertTrue(task.run())
+        self.assertEqual([f['staged_electorate'] for f in meshblock_layer.getFeatures()], [1, 2, 2, 0, 0, 0])
+        task = UpdateStagedElectoratesTask(task_name='', meshblock_layer=meshblock_layer,
+                                           meshblock_number_field_name='MeshblockNumber',
+                                           scenario_registry=reg, scenario=1, task='M')
+        self.assertTrue(task.run())
+        self.assertEqual([f['staged_electorate'] for f in meshblock_layer.getFeatures()], [7, 7, 7, 8, 8, 8])
+
+        task = ScenarioSwitchTask(task_name='', electorate_layer=electorate_layer, meshblock_layer=meshblock_layer,
+                                  meshblock_number_field_name='MeshblockNumber', scenario_registry=reg, scenario=2)
+        self.assertTrue(task.run())
+        self.assertEqual([f.attributes() for f in electorate_layer.getFeatures()],
+                         [[1, 'test1', 'GN', 0, 2, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
+                          [2, 'test2', 'GN', 23, 2, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
+                          [3, 'test3', 'GN', 13, 2, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
+                          [4, 'test4', 'GS', 70, 2, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
+                          [5, 'test5', 'GS', 20, 2, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
+                          [6, 'test6', 'GS', 0, 2, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
+                          [7, 'test7', 'M', 21, 2, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
+                          [8, 'test8', 'M', 24, 2, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL]])
+        self.assertEqual([f.geometry().asWkt() for f in electorate_layer.getFeatures()], [EMPTY_GEOMETRY_COLLECTION_WKT,
+                                                                                          'MultiPoint ((1 2),(2 3))',
+                                                                                          'Point (4 5)',
+                                                                                          'MultiPoint ((8 9),(10 11))',
+                                                                                          'Point (6 7)',
+                                                                                          EMPTY_GEOMETRY_COLLECTION_WKT,
+                                                                                          'MultiPoint ((1 2),(4 5),(8 9))',
+                                                                                          'MultiPoint ((2 3),(6 7),(10 11))'])
+        task = UpdateStagedElectoratesTask(task_name='', meshblock_layer=meshblock_layer,
+                                           meshblock_number_field_name='MeshblockNumber',
+                                           scenario_registry=reg, scenario=2, task='GN')
+        self.assertTrue(task.run())
+        self.assertEqual([f['staged_electorate'] for f in meshblock_layer.getFeatures()], [2, 2, 3, 0, 0, 0])
+        task = UpdateStagedElectoratesTask(task_name='', meshblock_layer=meshblock_layer,
+                                           meshblock_number_field_name='MeshblockNumber',
+                                           scenario_registry=reg, scenario=2, task='M')
+        self.assertTrue(task.run())
+        self.assertEqual([f['staged_electorate'] for f in meshblock_layer.getFeatures()], [7, 8, 7, 8, 7, 8])
+
+        # switch back to scenario 1 - electorate 6 has no meshblocks in either scenario, so should
+        # be left untouched
+        feature_ids = {f['electorate_id']: f.id() for f in electorate_layer.getFeatures()}
+        electorate_layer.dataProvider().changeGeometryValues(
+            {feature_ids[1]: QgsGeometry.fromWkt('Point (100 100)'),
+             feature_ids[6]: QgsGeometry.fromWkt('Point (100 100)')})
+        electorate_layer.dataProvider().changeAttributeValues({feature_ids[6]: {3: 99, 8: 1234}})
+        task = ScenarioSwitchTask(task_name='', electorate_layer=electorate_layer, meshblock_layer=meshblock_layer,
+                                  meshblock_number_field_name='MeshblockNumber', scenario_registry=reg, scenario=1)
+        self.assertTrue(task.run())
+        self.assertEqual(task.unchanged_electorates, [feature_ids[6]])
+        self.assertEqual([f.attributes() for f in electorate_layer.getFeatures()],
+                         [[1, 'test1', 'GN', 11, 1, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
+                          [2, 'test2', 'GN', 25, 1, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
+                          [3, 'test3', 'GN', 0, 1, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
+                          [4, 'test4', 'GS', 20, 1, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
+                          [5, 'test5', 'GS', 70, 1, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
+                          [6, 'test6', 'GS', 99, 1, NULL, None, NULL, 1234, NULL, NULL, NULL, NULL],
+                          [7, 'test7', 'M', 18, 1, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL],
+                          [8, 'test8', 'M', 27, 1, NULL, None, NULL, NULL, NULL, NULL, NULL, NULL]])
+        self.assertEqual([f.geometry().asWkt() for f in electorate_layer.getFeatures()], ['Point (1 2)',
+                                                                                          'MultiPoint ((2 3),(4 5))',
+                                                                                          EMPTY_GEOMETRY_COLLECTION_WKT,
+                                                                                          'Point (6 7)',
+                                                                                          'MultiPoint ((8 9),(10 11))',
+                                                                                          'Point (100 100)',
+                                                                                          'MultiPoint ((1 2),(2 3),(4 5))',
+                                                                                          'MultiPoint ((6 7),(8 9),(10 11))'])
+
+        # a full rebuild should rebuild all electorates
+        task = ScenarioSwitchTask(task_name='', electorate_layer=electorate_layer, meshblock_layer=meshblock_layer,
+                                  meshblock_number_field_name='MeshblockNumber', scenario_registry=reg, scenario=1,
+                                  full_rebuild=True)
+        self.assertTrue(task.run())
+        self.assertEqual(task.unchanged_electorates, [])
+        self.assertEqual([f['estimated_pop'] for f in electorate_layer.getFeatures()], [11, 25, 0, 20, 70, 0, 18, 27])
+        self.assertEqual([f.geometry().asWkt() for f in electorate_layer.getFeatures()][5],
+                         EMPTY_GEOMETRY_COLLECTION_WKT)
+
+        # dirty electorates should always be rebuilt, as their current geometry can't be trusted
+        electorate_layer.dataProvider().changeGeometryValues({feature_ids[6]: QgsGeometry.fromWkt('Point (100 100)')})
+        task = ScenarioSwitchTask(task_name='', electorate_layer=electorate_layer, meshblock_layer=meshblock_layer,
+                                  meshblock_number_field_name='MeshblockNumber', scenario_registry=reg, scenario=1,
+                                  dirty_electorates=[feature_ids[6]])
+        self.assertTrue(task.run())
+        self.assertNotIn(feature_ids[6], task.unchanged_electorates)
+        self.assertEqual([f.geometry().asWkt() for f in electorate_layer.getFeatures()][5],
+                         EMPTY_GEOMETRY_COLLECTION_WKT)
+
+    def testSwitchAfterBranch(self):  # pylint: disable=too-many-locals, too-many-statements
+        """
+        Test switching back to a scenario after editing and saving a branch of it
+        """
+        layer = make_scenario_layer()
+        mb_electorate_layer = QgsVectorLayer(
+            "NoGeometry?field=id:int&field=scenario_id:int&field=meshblock_number:int&field=gn_id:int&field=gs_id:int&field=m_id:int",
+            "source", "memory")
+        f = QgsFeature()
+        f.setAttributes([1, 1, 11, 1, 0, 7])
+        f2 = QgsFeature()
+        f2.setAttributes([2, 1, 12, 2, 0, 7])
+        f3 = QgsFeature()
+        f3.setAttributes([3, 1, 13, 2, 0, 7])
+        mb_electorate_layer.dataProvider().addFeatures([f, f2, f3])
+
+        reg = ScenarioRegistry(
+            source_layer=layer,
+            id_field='id',
+            name_field='name',
+            meshblock_electorate_layer=mb_electorate_layer
+        )
+        electorate_layer = QgsVectorLayer(
+            "Point?crs=EPSG:4326&field=electorate_id:int&field=code:string&field=type:string&field=estimated_pop:int&field=scenario_id:int&field=invalid:int&field=invalid_reason:string&field=name:string&field=stats_nz_pop:int&field=stats_nz_var_20:int&field=stats_nz_var_23:int&field=expected_regions:int&field=deprecated:int",
+            "source", "memory")
+        f = QgsFeature()
+        f.setAttributes([1, "test1", 'GN', -1, 0])
+        f2 = QgsFeature()
+        f2.setAttributes([2, "test2", 'GN', -1, 0])
+        f3 = QgsFeature()
+        f3.setAttributes([7, "test7", 'M', -1, 0])
+        electorate_layer.dataProvider().addFeatures([f, f2, f3])
+        feature_ids = {f['electorate_id']: f.id() for f in electorate_layer.getFeatures()}
+
+        meshblock_layer = QgsVectorLayer(
+            "Point?crs=EPSG:4326&field=MeshblockNumber:string&field=offline_pop_m:int&field=offline_pop_gn:int&field=offline_pop_gs:int&field=staged_electorate:int&field=offshore:int",
+            "source", "memory")
+        f = QgsFeature()
+        f.setAttributes(["11", 5, 11, 0])
+        f.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(1, 2)))
+        f2 = QgsFeature()
+        f2.setAttributes(["12", 6, 12, 0])
+        f2.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(2, 3)))
+        f3 = QgsFeature()
+        f3.setAttributes(["13", 7, 13, 0])
+        f3.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(4, 5)))
+        meshblock_layer.dataProvider().addFeatures([f, f2, f3])
+
+        task = ScenarioSwitchTask(task_name='', electorate_layer=electorate_layer, meshblock_layer=meshblock_layer,
+                                  meshblock_number_field_name='MeshblockNumber', scenario_registry=reg, scenario=1)
+        self.assertTrue(task.run())
+        self.assertEqual([f['estimated_pop'] for f in electorate_layer.getFeatures()], [11, 25, 18])
+
+        # branch scenario 1, and make the branch current
+        branch, error = reg.branch_scenario(1, 'branch')
+        self.assertFalse(error)
+        district_registry = LinzElectoralDistrictRegistry(
+            source_layer=electorate_layer,
+            quota_layer=make_quota_layer(),
+            electorate_type='GN',
+            source_field='electorate_id',
+            title_field='name')
+        self.assertTrue(district_registry.relabel_electorate_scenario(1, branch))
+        self.assertEqual([f['scenario_id'] for f in electorate_layer.getFeatures()], [branch, branch, branch])
+
+        # edit and save the branch - move meshblock 13 to electorate 1, as the boundary updater would
+        request = QgsFeatureRequest().setFilterExpression('scenario_id={} and meshblock_number=13'.format(branch))
+        edited_id = next(mb_electorate_layer.getFeatures(request)).id()
+        mb_electorate_layer.dataProvider().changeAttributeValues({edited_id: {3: 1}})
+        electorate_layer.dataProvider().changeGeometryValues(
+            {feature_ids[1]: QgsGeometry.fromWkt('MultiPoint ((1 2),(4 5))'),
+             feature_ids[2]: QgsGeometry.fromWkt('Point (2 3)')})
+        electorate_layer.dataProvider().changeAttributeValues({feature_ids[1]: {3: 24},
+                                                               feature_ids[2]: {3: 12}})
+
+        # switching back to the original scenario must restore its electorates
+        task = ScenarioSwitchTask(task_name='', electorate_layer=electorate_layer, meshblock_layer=meshblock_layer,
+                                  meshblock_number_field_name='MeshblockNumber', scenario_registry=reg, scenario=1)
+        self.assertTrue(task.run())
+        self.assertEqual(task.unchanged_electorates, [feature_ids[7]])
+        self.assertEqual([f['estimated_pop'] for f in electorate_layer.getFeatures()], [11, 25, 18])
+        self.assertEqual([f['scenario_id'] for f in electorate_layer.getFeatures()], [1, 1, 1])
+        self.assertEqual([f.geometry().asWkt() for f in electorate_layer.getFeatures()],
+                         ['Point (1 2)', 'MultiPoint ((2 3),(4 5))', 'MultiPoint ((1 2),(2 3),(4 5))'])
+
+        # and switching to the branch again must restore the edits
+        task = ScenarioSwitchTask(task_name='', electorate_layer=electorate_layer, meshblock_layer=meshblock_layer,
+                                  meshblock_number_field_name='MeshblockNumber', scenario_registry=reg, scenario=branch)
+        self.assertTrue(task.run())
+        self.assertEqual(task.unchanged_electorates, [feature_ids[7]])
+        self.assertEqual([f['estimated_pop'] for f in electorate_layer.getFeatures()], [24, 12, 18])
+        self.assertEqual([f.geometry().asWkt() for f in electorate_layer.getFeatures()],
+                         ['MultiPoint ((1 2),(4 5))', 'Point (2 3)', 'MultiPoint ((1 2),(2 3),(4 5))'])
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(ScenarioSwitchTaskTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,148 @@
+# coding=utf-8
+"""LINZ Staged Electorate Update Task Test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import unittest
+from redistrict.linz.scenario_registry import ScenarioRegistry
+from redistrict.linz.staged_electorate_update_task import UpdateStagedElectoratesTask
+from redistrict.core.gpkg_writer import GeoPackageWriter
+from redistrict.test.test_linz_scenario_registry import make_scenario_layer
+from qgis.PyQt.QtCore import (QTemporaryDir,
+                              QVariant)
+from qgis.core import (NULL,
+                       QgsField,
+                       QgsFields,
+                       QgsWkbTypes,
+                       QgsVectorLayer,
+                       QgsGeometry,
+                       QgsPointXY,
+                       QgsFeature)
+
+
+class UpdateStagedElectoratesTaskTest(unittest.TestCase):
+    """Test UpdateStagedElectoratesTask."""
+
+    def testUpdateStagedElectoratesDatabase(self):  # pylint: disable=too-many-locals
+        """
+        Test updating staged electorates directly within a GeoPackage
+        """
+        temp_dir = QTemporaryDir()
+        database_path = os.path.join(temp_dir.path(), 'staged.gpkg')
+        writer = GeoPackageWriter(database_path)
+        mb_electorate_fields = QgsFields()
+        for name in ('id', 'scenario_id', 'meshblock_number', 'gn_id', 'gs_id', 'm_id'):
+            mb_electorate_fields.append(QgsField(name, QVariant.Int))
+        self.assertTrue(writer.create_layer('meshblock_electorates', QgsWkbTypes.NoGeometry, mb_electorate_fields))
+        for attributes in ([1, 1, 11, 1, 4, 7], [2, 1, 12, 2, 5, 7], [3, 2, 11, 3, 6, 8], [4, 2, 13, 3, 6, 8]):
+            f = QgsFeature()
+            f.setAttributes(attributes)
+            self.assertTrue(writer.add_feature('meshblock_electorates', f))
+        meshblock_fields = QgsFields()
+        meshblock_fields.append(QgsField('MeshblockNumber', QVariant.String))
+        meshblock_fields.append(QgsField('staged_electorate', QVariant.Int))
+        self.assertTrue(writer.create_layer('meshblocks', QgsWkbTypes.Point, meshblock_fields))
+        for attributes in (["11", NULL], ["12", NULL], ["13", 5]):
+            f = QgsFeature()
+            f.setAttributes(attributes)
+            f.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(1, 2)))
+            self.assertTrue(writer.add_feature('meshblocks', f))
+        self.assertTrue(writer.commit())
+
+        mb_electorate_layer = QgsVectorLayer('{}|layername=meshblock_electorates'.format(database_path), 'mb', 'ogr')
+        self.assertTrue(mb_electorate_layer.isValid())
+        meshblock_layer = QgsVectorLayer('{}|layername=meshblocks'.format(database_path), 'mb', 'ogr')
+        self.assertTrue(meshblock_layer.isValid())
+        reg = ScenarioRegistry(
+            source_layer=make_scenario_layer(),
+            id_field='id',
+            name_field='name',
+            meshblock_electorate_layer=mb_electorate_layer
+        )
+
+        task = UpdateStagedElectoratesTask(task_name='', meshblock_layer=meshblock_layer,
+                                           meshblock_number_field_name='MeshblockNumber',
+                                           scenario_registry=reg, scenario=1, task='GS')
+        self.assertEqual(task.database_path, database_path)
+        self.assertTrue(task.run())
+        self.assertTrue(task.updated_database)
+        task.finished(True)
+        self.assertEqual([f['staged_electorate'] for f in meshblock_layer.getFeatures()], [4, 5, NULL])
+
+        task = UpdateStagedElectoratesTask(task_name='', meshblock_layer=meshblock_layer,
+                                           meshblock_number_field_name='MeshblockNumber',
+                                           scenario_registry=reg, scenario=2, task='M')
+        self.assertTrue(task.run())
+        task.finished(True)
+        self.assertEqual([f['staged_electorate'] for f in meshblock_layer.getFeatures()], [8, NULL, 8])
+
+    def testUpdateTaskStagedElectorates(self):
+        """
+        Test updating per-task staged electorate fields
+        """
+        mb_electorate_layer = QgsVectorLayer(
+            "NoGeometry?field=id:int&field=scenario_id:int&field=meshblock_number:int&field=gn_id:int&field=gs_id:int&field=m_id:int",
+            "source", "memory")
+        f = QgsFeature()
+        f.setAttributes([1, 1, 11, 1, 4, 7])
+        f2 = QgsFeature()
+        f2.setAttributes([2, 1, 12, 2, 5, 7])
+        f3 = QgsFeature()
+        f3.setAttributes([3, 2, 11, 3, 6, 8])
+        mb_electorate_layer.dataProvider().addFeatures([f, f2, f3])
+        reg = ScenarioRegistry(
+            source_layer=make_scenario_layer(),
+            id_field='id',
+            name_field='name',
+            meshblock_electorate_layer=mb_electorate_layer
+        )
+
+        meshblock_layer = QgsVectorLayer(
+            "Point?crs=EPSG:4326&field=MeshblockNumber:string&field=staged_electorate:int",
+            "source", "memory")
+        f = QgsFeature()
+        f.setAttributes(["11", NULL])
+        f2 = QgsFeature()
+        f2.setAttributes(["12", NULL])
+        meshblock_layer.dataProvider().addFeatures([f, f2])
+
+        self.assertFalse(UpdateStagedElectoratesTask.has_task_fields(meshblock_layer))
+        self.assertEqual(UpdateStagedElectoratesTask.staged_field_for_task(meshblock_layer, 'GS'), 'staged_electorate')
+        self.assertTrue(UpdateStagedElectoratesTask.add_task_fields(meshblock_layer))
+        self.assertTrue(UpdateStagedElectoratesTask.has_task_fields(meshblock_layer))
+        self.assertEqual(UpdateStagedElectoratesTask.staged_field_for_task(meshblock_layer, 'GN'), 'staged_gn')
+        self.assertEqual(UpdateStagedElectoratesTask.staged_field_for_task(meshblock_layer, 'GS'), 'staged_gs')
+        self.assertEqual(UpdateStagedElectoratesTask.staged_field_for_task(meshblock_layer, 'M'), 'staged_m')
+
+        # all tasks should be updated at once
+        task = UpdateStagedElectoratesTask(task_name='', meshblock_layer=meshblock_layer,
+                                           meshblock_number_field_name='MeshblockNumber',
+                                           scenario_registry=reg, scenario=1)
+        self.assertTrue(task.run())
+        self.assertEqual([f.attributes() for f in meshblock_layer.getFeatures()],
+                         [['11', NULL, 1, 4, 7], ['12', NULL, 2, 5, 7]])
+
+        task = UpdateStagedElectoratesTask(task_name='', meshblock_layer=meshblock_layer,
+                                           meshblock_number_field_name='MeshblockNumber',
+                                           scenario_registry=reg, scenario=2, task='GN')
+        self.assertTrue(task.run())
+        self.assertEqual([f.attributes() for f in meshblock_layer.getFeatures()],
+                         [['11', NULL, 3, 6, 8], ['12', NULL, NULL, NULL, NULL]])
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(UpdateStagedElectoratesTaskTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -18,6 +18,7 @@ import unittest
 from redistrict.linz.scenario_registry import ScenarioRegistry
 from redistrict.linz.linz_district_registry import LinzElectoralDistrictRegistry
 from redistrict.linz.validation_task import ValidationTask
+from redistrict.linz.electorate_validation_cache import ElectorateValidationCache
 from redistrict.test.test_linz_scenario_registry import make_scenario_layer
 from redistrict.test.test_linz_district_registry import make_quota_layer
 from qgis.core import (NULL,
@@ -226,6 +227,29 @@ class ValidationTaskTest(unittest.TestCase):
                           [7, 'test7', 'M', 1, 0, 1, 1, 'Deprecated electorate has meshblocks assigned', NULL],
                           [8, 'test8', 'M', 0, 1, 1, 0, NULL, NULL]])
 
+        # with a validation cache, unchanged electorates should not be re-checked
+        validation_cache = ElectorateValidationCache()
+        electorate_registry = LinzElectoralDistrictRegistry(source_layer=electorate_layer, source_field='electorate_id',
+                                                            title_field='code', electorate_type='GS',
+                                                            quota_layer=quota_layer)
+        task = ValidationTask(task_name='', electorate_registry=electorate_registry, meshblock_layer=meshblock_layer,
+                              meshblock_number_field_name='MeshblockNumber', scenario_registry=reg, scenario=1,
+                              task='GS', validation_cache=validation_cache)
+        self.assertTrue(task.run())
+        self.assertIsNotNone(task.adjacency.neighbours)
+        expected = [(r[ValidationTask.ELECTORATE_ID], r[ValidationTask.ERROR],
+                     r[ValidationTask.ELECTORATE_GEOMETRY].asWkt(0)) for r in task.results]
+        self.assertEqual(len(expected), 7)
+
+        task = ValidationTask(task_name='', electorate_registry=electorate_registry, meshblock_layer=meshblock_layer,
+                              meshblock_number_field_name='MeshblockNumber', scenario_registry=reg, scenario=1,
+                              task='GS', validation_cache=validation_cache)
+        self.assertTrue(task.run())
+        # adjacency graph not required, all results were cached
+        self.assertIsNone(task.adjacency.neighbours)
+        self.assertEqual([(r[ValidationTask.ELECTORATE_ID], r[ValidationTask.ERROR],
+                           r[ValidationTask.ELECTORATE_GEOMETRY].asWkt(0)) for r in task.results], expected)
+
 
 if __name__ == "__main__":
     suite = unittest.makeSuite(ValidationTaskTest)
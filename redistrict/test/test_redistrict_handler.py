@@ -100,6 +100,39 @@ class RedistrictHandlerTest(unittest.TestCase):
         # self.assertEqual(layer.undoStack().count(), 1) # awaiting core change
         self.assertEqual([f['fld1'] for f in layer.getFeatures()], ['aaa', 'test2', 'aaa', 'test1', 'aaa'])
 
+    def testPreviousDistricts(self):
+        """
+        Test assigning districts with known previous districts
+        """
+        layer = QgsVectorLayer(
+            "Point?crs=EPSG:4326&field=fld1:string&field=fld2:string",
+            "source", "memory")
+        f = QgsFeature()
+        f.setAttributes(["test4", "xtest1"])
+        f2 = QgsFeature()
+        f2.setAttributes(["test2", "xtest3"])
+        f3 = QgsFeature()
+        f3.setAttributes([NULL, "xtest3"])
+        success, [f, f2, f3] = layer.dataProvider().addFeatures([f, f2, f3])
+        self.assertTrue(success)
+
+        handler = RedistrictHandler(target_layer=layer, target_field='fld1')
+        self.assertEqual(handler.current_districts([f.id(), f3.id()]), {f.id(): 'test4', f3.id(): NULL})
+
+        self.assertTrue(layer.startEditing())
+        handler.begin_edit_group('test')
+        self.assertTrue(handler.assign_district([f.id(), f2.id(), f3.id()], 'test2',
+                                                previous_districts={f.id(): 'test4', f2.id(): 'test2',
+                                                                    f3.id(): NULL}))
+        handler.end_edit_group()
+        self.assertEqual(layer.undoStack().count(), 1)
+        self.assertEqual([f['fld1'] for f in layer.getFeatures()], ['test2', 'test2', 'test2'])
+        # features already assigned to the district are not changed
+        self.assertCountEqual(layer.editBuffer().changedAttributeValues().keys(), [f.id(), f3.id()])
+
+        layer.undoStack().undo()
+        self.assertEqual([f['fld1'] for f in layer.getFeatures()], ['test4', 'test2', NULL])
+
 
 if __name__ == "__main__":
     suite = unittest.makeSuite(RedistrictHandlerTest)
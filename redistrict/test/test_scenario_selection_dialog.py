@@ -80,6 +80,28 @@ class ScenarioSelectionDialogTest(unittest.TestCase):
         dlg.list.clearSelection()
         self.assertIsNone(dlg.selected_scenario())
 
+    def testMultipleSelection(self):
+        """
+        Test selecting multiple scenarios
+        """
+        layer = make_scenario_layer()
+        mb_electorate_layer = make_meshblock_electorate_layer()
+        registry = ScenarioRegistry(source_layer=layer,
+                                    id_field='id',
+                                    name_field='name',
+                                    meshblock_electorate_layer=mb_electorate_layer)
+        dlg = ScenarioSelectionDialog(scenario_registry=registry)
+        self.assertEqual(dlg.selected_scenarios(), [2])
+        dlg.set_selected_scenario(1)
+        self.assertEqual(dlg.selected_scenarios(), [1])
+
+        dlg = ScenarioSelectionDialog(scenario_registry=registry, allow_multiple_selection=True)
+        self.assertEqual(dlg.selected_scenarios(), [2])
+        dlg.set_selected_scenario(1)
+        self.assertEqual(dlg.selected_scenarios(), [1, 2])
+        dlg.list.clearSelection()
+        self.assertEqual(dlg.selected_scenarios(), [])
+
     def testAccept(self):
         """
         Test that accepting dialog
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""LINZ Redistricting Plugin - Dissolve benchmark
+
+Compares the generic (unary union + make valid) and coverage union dissolve
+paths for every electorate in a scenario. Run using a Python environment
+configured for QGIS (see run-env-linux.sh), from the repository root, e.g.
+
+    python3 scripts/benchmark_dissolve.py /path/to/redistricting.gpkg meshblocks 1 GN
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import argparse
+import os
+import sys
+import time
+
+from qgis.core import (QgsApplication,
+                       QgsGeometry,
+                       QgsVectorLayer)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from redistrict.core.dissolve import coverage_union  # pylint: disable=wrong-import-position
+from redistrict.linz.meshblock_store import MeshblockStore  # pylint: disable=wrong-import-position
+from redistrict.linz.scenario_registry import ScenarioRegistry  # pylint: disable=wrong-import-position
+
+
+def main():  # pylint: disable=too-many-locals
+    """
+    Runs the benchmark
+    """
+    parser = argparse.ArgumentParser(description='Benchmark electorate dissolve methods')
+    parser.add_argument('database', help='redistricting database (GeoPackage)')
+    parser.add_argument('meshblock_layer', help='name of meshblock layer within database')
+    parser.add_argument('scenario', type=int, help='scenario id')
+    parser.add_argument('type', choices=['GN', 'GS', 'M'], help='electorate type')
+    parser.add_argument('--meshblock-number-field', default='meshblock_no', help='meshblock number field name')
+    args = parser.parse_args()
+
+    app = QgsApplication([], False)
+    app.initQgis()
+
+    meshblock_layer = QgsVectorLayer('{}|layername={}'.format(args.database, args.meshblock_layer), 'meshblocks')
+    scenario_layer = QgsVectorLayer('{}|layername=scenarios'.format(args.database), 'scenarios')
+    meshblock_electorate_layer = QgsVectorLayer('{}|layername=meshblock_electorates'.format(args.database),
+                                                'meshblock_electorates')
+    for layer in (meshblock_layer, scenario_layer, meshblock_electorate_layer):
+        if not layer.isValid():
+            print('Could not open layer {}'.format(layer.source()))
+            return 1
+
+    start = time.perf_counter()
+    store = MeshblockStore(meshblock_layer=meshblock_layer,
+                           meshblock_number_field_name=args.meshblock_number_field,
+                           load_geometries=True)
+    print('Loaded {} meshblocks in {:.2f}s'.format(store.meshblock_count(), time.perf_counter() - start))
+
+    registry = ScenarioRegistry(source_layer=scenario_layer, id_field='scenario_id', name_field='name',
+                                meshblock_electorate_layer=meshblock_electorate_layer)
+    assignments = registry.scenario_electorate_meshblocks(scenario_id=args.scenario,
+                                                          electorate_types=[args.type])[args.type]
+
+    generic_total = 0
+    coverage_total = 0
+    fallbacks = 0
+    for electorate_id, meshblocks in assignments.items():
+        parts = store.geometries_for_rows(store.rows_for_meshblocks(meshblocks))
+
+        start = time.perf_counter()
+        generic = QgsGeometry.unaryUnion(parts).makeValid()
+        generic_elapsed = time.perf_counter() - start
+        generic_total += generic_elapsed
+
+        start = time.perf_counter()
+        coverage = coverage_union(parts)
+        coverage_elapsed = time.perf_counter() - start
+        coverage_total += coverage_elapsed
+
+        if coverage is None:
+            fallbacks += 1
+            print('{}: {} meshblocks, generic {:.3f}s, coverage union not possible'.format(
+                electorate_id, len(meshblocks), generic_elapsed))
+        else:
+            print('{}: {} meshblocks, generic {:.3f}s, coverage {:.3f}s, area difference {:.6f}'.format(
+                electorate_id, len(meshblocks), generic_elapsed, coverage_elapsed,
+                abs(generic.area() - coverage.area())))
+
+    print()
+    print('Generic union total: {:.2f}s'.format(generic_total))
+    print('Coverage union total: {:.2f}s ({} electorates fell back to generic union)'.format(coverage_total,
+                                                                                          fallbacks))
+    if not hasattr(QgsGeometry, 'unionCoverage'):
+        print('Coverage union requires QGIS 3.40 or later')
+
+    app.exitQgis()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
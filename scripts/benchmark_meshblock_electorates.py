@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""LINZ Redistricting Plugin - meshblock_electorates storage benchmark
+
+Builds a synthetic meshblock_electorates table with rows for a growing number
+of scenarios (inserted in a shuffled order, as happens when scenarios are
+branched, imported and edited over time), and times the common scenario
+queries with no indexes, with the composite indexes created when redistricting
+begins, and after clustering the table by scenario. Run using a Python
+environment configured for QGIS (see run-env-linux.sh), from the repository
+root, e.g.
+
+    python3 scripts/benchmark_meshblock_electorates.py --meshblocks 50000 --scenarios 1 5 20 50
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+
+__author__ = '(C) 2018 by Nyall Dawson'
+__date__ = '20/04/2018'
+__copyright__ = 'Copyright 2018, LINZ'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import argparse
+import functools
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from redistrict.linz.db_utils import DbUtils  # pylint: disable=wrong-import-position
+
+TABLE = 'meshblock_electorates'
+
+
+def create_table(path: str, meshblocks: int, scenarios: int):
+    """
+    Creates a synthetic meshblock_electorates table
+    :param path: database path
+    :param meshblocks: number of meshblocks in each scenario
+    :param scenarios: number of scenarios
+    """
+    connection = DbUtils.connect(path)
+    connection.execute('CREATE TABLE "{}" (fid INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, '
+                       'scenario_id MEDIUMINT, meshblock_number MEDIUMINT, '
+                       'gn_id MEDIUMINT, gs_id MEDIUMINT, m_id MEDIUMINT)'.format(TABLE))
+    rows = [(scenario, meshblock, meshblock % 65 + 1, meshblock % 7 + 100, meshblock % 7 + 200)
+            for scenario in range(1, scenarios + 1) for meshblock in range(meshblocks)]
+    random.Random(0).shuffle(rows)
+    connection.executemany('INSERT INTO "{}" (scenario_id, meshblock_number, gn_id, gs_id, m_id) '
+                           'VALUES (?, ?, ?, ?, ?)'.format(TABLE), rows)
+    connection.commit()
+    connection.close()
+
+
+def time_queries(path: str, scenario: int, repeats: int) -> dict:
+    """
+    Times the common scenario queries, returning a dictionary of query name to
+    best elapsed time
+    :param path: database path
+    :param scenario: scenario to query
+    :param repeats: number of times to repeat each query
+    """
+    queries = {
+        # scenario switch/staged electorate update
+        'scenario': ('SELECT meshblock_number, gn_id, gs_id, m_id FROM "{}" WHERE scenario_id=?'.format(TABLE),
+                     (scenario,)),
+        # electorate meshblock lookup
+        'electorate': ('SELECT meshblock_number FROM "{}" WHERE scenario_id=? AND gn_id=?'.format(TABLE),
+                       (scenario, 5)),
+        # bridge lookup of individual meshblocks
+        'meshblock': ('SELECT fid FROM "{}" WHERE scenario_id=? AND meshblock_number IN ({})'.format(
+            TABLE, ','.join(str(m) for m in range(0, 10000, 100))), (scenario,)),
+    }
+
+    results = {}
+    connection = DbUtils.connect(path)
+    for name, (sql, params) in queries.items():
+        best = None
+        for _ in range(repeats):
+            start = time.perf_counter()
+            connection.execute(sql, params).fetchall()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = best
+    connection.close()
+    return results
+
+
+def cluster(path: str):
+    """
+    Clusters the benchmark table
+    :param path: path to benchmark database
+    """
+    connection = DbUtils.connect(path)
+    DbUtils.cluster_table(connection, TABLE, DbUtils.MESHBLOCK_ELECTORATE_CLUSTER_COLUMNS)
+    connection.commit()
+    connection.execute('ANALYZE')
+    connection.close()
+
+
+def main():
+    """
+    Runs the benchmark
+    """
+    parser = argparse.ArgumentParser(description='Benchmark meshblock_electorates indexes and clustering')
+    parser.add_argument('--meshblocks', type=int, default=50000, help='number of meshblocks in each scenario')
+    parser.add_argument('--scenarios', type=int, nargs='+', default=[1, 5, 20, 50],
+                        help='scenario counts to benchmark')
+    parser.add_argument('--repeats', type=int, default=5, help='number of times to repeat each query')
+    args = parser.parse_args()
+
+    print('{:>10} {:>12} {:>12} {:>12} {:>12}'.format('scenarios', 'layout', 'scenario', 'electorate', 'meshblock'))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for scenarios in args.scenarios:
+            path = os.path.join(temp_dir, 'benchmark_{}.gpkg'.format(scenarios))
+            create_table(path, args.meshblocks, scenarios)
+            # query a scenario from the middle of the table
+            scenario = scenarios // 2 + 1
+
+            layouts = [('no index', lambda: None),
+                       ('indexed', functools.partial(DbUtils.ensure_indexes, path, TABLE,
+                                                     DbUtils.MESHBLOCK_ELECTORATE_INDEXES)),
+                       ('clustered', functools.partial(cluster, path))]
+
+            for name, prepare in layouts:
+                prepare()
+                results = time_queries(path, scenario, args.repeats)
+                print('{:>10} {:>12} {:>11.2f}ms {:>11.2f}ms {:>11.2f}ms'.format(
+                    scenarios, name, results['scenario'] * 1000, results['electorate'] * 1000,
+                    results['meshblock'] * 1000))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())